@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+import math
+import threading
+import time
+
+import metrics
+from highres import highres_work
+
+# 작업량 단위: 1024×1024 이미지 한 장의 디노이징 스텝 하나
+UNIT_PIXELS = 1024 * 1024
+
+# 관측 하나마다 이전 관측의 가중치에 곱하는 값. 최근 관측(대략 10개 배치)을 중심으로 비용을 추정합니다.
+COST_DECAY = 0.9
+
+ADMISSION_REJECTIONS_TOTAL = metrics.REGISTRY.counter(
+    "aigen_admission_rejections_total", "입장 제어로 거절된 작업 수 (사유별)", ["reason"]
+)
+
+
+def request_work(request, images=1):
+    """요청의 작업량: 스텝 수 × 메가픽셀(1024×1024 = 1) × 이미지 수. 고해상도 모드는 기본 크기 생성과 타일 스텝의 합입니다."""
+    if request.get("highres_base"):
+        return highres_work(request) / UNIT_PIXELS * images
+    pixels = (request.get("width") or 1024) * (request.get("height") or 1024)
+    return (request.get("steps") or 1) * pixels / UNIT_PIXELS * images
+
+
+class AdmissionError(Exception):
+    """
+    작업을 받을 수 없을 때 발생합니다.
+    reason은 거절 사유("queue_full", "deadline", "client_budget", "client_concurrency"),
+    retry_after는 다시 시도해 볼 만한 시간(초, 기다려도 받을 수 없으면 None), hints는 응답에 함께 보낼 추정값입니다.
+    """
+
+    status_code = 503
+
+    def __init__(self, message, reason, retry_after=None, status_code=None, **hints):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+        if status_code is not None:
+            self.status_code = status_code
+        self.hints = hints
+
+    def to_dict(self):
+        """API 응답 본문: 기존 클라이언트가 읽는 detail 문자열과 구조화된 재시도 힌트"""
+        return {"detail": str(self), "reason": self.reason, "retry_after": self.retry_after, **self.hints}
+
+
+class _LinearFit:
+    """지수 가중 최소제곱으로 맞추는 직선 seconds = overhead + unit_seconds × work 의 누적 합입니다."""
+
+    def __init__(self):
+        self.n = self.sx = self.sy = self.sxx = self.sxy = 0.0
+        self.count = 0
+
+    def add(self, x, y, decay):
+        self.n = self.n * decay + 1
+        self.sx = self.sx * decay + x
+        self.sy = self.sy * decay + y
+        self.sxx = self.sxx * decay + x * x
+        self.sxy = self.sxy * decay + x * y
+        self.count += 1
+
+    def coefficients(self):
+        """(overhead, unit_seconds). 관측이 없으면 None."""
+        if not self.count:
+            return None
+        mean_x, mean_y = self.sx / self.n, self.sy / self.n
+        variance = self.sxx / self.n - mean_x * mean_x
+        if variance > 0.01 * mean_x * mean_x:
+            slope = (self.sxy / self.n - mean_x * mean_y) / variance
+            intercept = mean_y - slope * mean_x
+            if slope > 0 and intercept >= 0:
+                return intercept, slope
+        # 작업량이 한 가지뿐이거나 직선이 맞지 않으면 시간이 작업량에 비례한다고 봅니다.
+        return 0.0, (self.sy / self.sx if self.sx > 0 else 0.0)
+
+
+class CostModel:
+    """
+    관측한 배치 실행 시간으로 모델별 작업 비용(초)을 온라인으로 추정합니다.
+
+    비용 = 고정 시간 + 단위 시간 × 작업량(스텝 × 메가픽셀 × 이미지 수). 모델마다 따로 맞추며,
+    관측이 없는 모델은 모든 모델의 관측을 합친 직선을, 아무 관측도 없으면 prior 값을 사용합니다.
+    모델 로딩 시간은 생성 시간과 분리해 모델별 이동 평균으로 추정합니다.
+    """
+
+    def __init__(self, prior_unit_seconds=0.2, prior_overhead=1.0, decay=COST_DECAY):
+        self.prior = (prior_overhead, prior_unit_seconds)
+        self.decay = decay
+        self._fits = {}
+        self._pooled = _LinearFit()
+        self._load_seconds = {}
+        self._lock = threading.Lock()
+
+    def observe(self, model_name, work, seconds, load_seconds=0.0):
+        """배치 하나의 작업량 합계와 생성 시간(모델/LoRA 로딩 제외), 로딩 시간을 기록합니다."""
+        with self._lock:
+            self._fits.setdefault(model_name, _LinearFit()).add(work, seconds, self.decay)
+            self._pooled.add(work, seconds, self.decay)
+            if load_seconds > 0:
+                previous = self._load_seconds.get(model_name)
+                self._load_seconds[model_name] = load_seconds if previous is None else 0.7 * previous + 0.3 * load_seconds
+
+    def coefficients(self, model_name):
+        with self._lock:
+            fit = self._fits.get(model_name)
+            return (fit and fit.coefficients()) or self._pooled.coefficients() or self.prior
+
+    def estimate(self, model_name, work):
+        """작업량 work인 작업의 예상 생성 시간 (초)"""
+        overhead, unit_seconds = self.coefficients(model_name)
+        return overhead + unit_seconds * work
+
+    def load_estimate(self, model_name):
+        """모델을 새로 로드하는 데 걸릴 예상 시간 (초). 관측이 없으면 다른 모델의 평균, 그것도 없으면 0."""
+        with self._lock:
+            if model_name in self._load_seconds:
+                return self._load_seconds[model_name]
+            values = list(self._load_seconds.values())
+        return sum(values) / len(values) if values else 0.0
+
+    def stats(self):
+        with self._lock:
+            models = {name: fit for name, fit in self._fits.items()}
+            load_seconds = dict(self._load_seconds)
+        result = {}
+        for name, fit in models.items():
+            overhead, unit_seconds = self.coefficients(name)
+            result[name] = {"observations": fit.count, "overhead_seconds": round(overhead, 4),
+                            "unit_seconds": round(unit_seconds, 4), "load_seconds": load_seconds.get(name)}
+        return result
+
+
+class AdmissionController:
+    """
+    비용 기반 입장 제어입니다. 작업을 큐에 넣기 전에 예상 비용으로 다음을 검사합니다.
+
+    - 클라이언트 동시 작업 수: 대기/실행 중인 작업이 max_jobs개 이상이면 거절 (429)
+    - 클라이언트 비용 예산: 클라이언트마다 window초 동안 budget초만큼의 예상 GPU 시간을 쓸 수 있는 토큰 버킷.
+      작업을 받을 때 예상 비용을 차감하고, 끝나면 실제 시간과의 차이를 정산하며, 실행되지 않은 작업은 돌려줍니다. (429)
+    - 마감 시간(deadline_ms): 앞선 작업의 남은 시간 + 모델 로딩 + 이 작업의 비용이 마감 시간을 넘으면 거절 (503)
+    cost_budget과 max_jobs가 0이면 해당 제한을 사용하지 않습니다. limits는 클라이언트별 {"cost_budget": ..., "max_jobs": ...}입니다.
+    """
+
+    def __init__(self, cost_model=None, cost_budget=0, cost_window=60, max_jobs=0, limits=None):
+        self.cost_model = cost_model or CostModel()
+        self.cost_budget = cost_budget
+        self.cost_window = cost_window
+        self.max_jobs = max_jobs
+        self.limits = limits or {}
+        self._buckets = {} # client_id -> [남은 토큰(초), 마지막 갱신 시각]
+        self._active = {} # client_id -> {job_id: 예상 비용}
+        self._lock = threading.Lock()
+        self._stats = {"admitted": 0, "rejected": {}}
+
+    def client_limits(self, client_id):
+        """클라이언트의 (비용 예산(초), 동시 작업 수). 0이면 제한 없음. 클라이언트가 없는 내부 작업은 제한하지 않습니다."""
+        if client_id is None:
+            return 0, 0
+        limits = self.limits.get(client_id, {})
+        return limits.get("cost_budget", self.cost_budget), limits.get("max_jobs", self.max_jobs)
+
+    def _tokens(self, client_id, budget, now):
+        """토큰 버킷을 현재 시각까지 채운 뒤 [남은 토큰, 갱신 시각]을 반환합니다."""
+        bucket = self._buckets.setdefault(client_id, [budget, now])
+        bucket[0] = min(budget, bucket[0] + (now - bucket[1]) * budget / self.cost_window)
+        bucket[1] = now
+        return bucket
+
+    def _reject(self, reason, message, retry_after, status_code, **hints):
+        ADMISSION_REJECTIONS_TOTAL.inc(reason=reason)
+        self._stats["rejected"][reason] = self._stats["rejected"].get(reason, 0) + 1
+        if retry_after is not None:
+            retry_after = max(1, int(math.ceil(retry_after)))
+        raise AdmissionError(message, reason, retry_after=retry_after, status_code=status_code, **hints)
+
+    def admit(self, job, cost, queue_seconds, load_seconds=0.0, now=None):
+        """
+        예상 비용 cost(초)인 작업을 받을지 결정합니다. 받을 수 없으면 AdmissionError.
+        queue_seconds: 앞선 대기/실행 중인 작업의 남은 예상 시간, load_seconds: 모델을 새로 로드해야 하면 그 예상 시간
+        """
+        now = time.time() if now is None else now
+        deadline_ms = job.request.get("deadline_ms")
+        finish_seconds = queue_seconds + load_seconds + cost
+        hints = {"estimated_ms": int(cost * 1000), "queue_ms": int(queue_seconds * 1000),
+                 "estimated_finish_ms": int(finish_seconds * 1000)}
+        with self._lock:
+            budget, max_jobs = self.client_limits(job.client_id)
+            active = self._active.get(job.client_id, {})
+            if max_jobs and len(active) >= max_jobs:
+                # 진행 중인 작업 중 가장 짧은 작업이 끝날 즈음에 자리가 납니다.
+                self._reject("client_concurrency", f"클라이언트의 동시 작업 수 제한({max_jobs}개)을 넘었습니다.",
+                             min(active.values()), 429, max_jobs=max_jobs, active_jobs=len(active), **hints)
+            if budget:
+                tokens = self._tokens(job.client_id, budget, now)[0]
+                if cost > tokens:
+                    # 작업 하나가 예산 전체보다 크면 기다려도 받을 수 없습니다.
+                    retry_after = (cost - tokens) * self.cost_window / budget if cost <= budget else None
+                    self._reject("client_budget", f"클라이언트의 GPU 시간 예산({budget}초/{self.cost_window}초)을 넘었습니다.",
+                                 retry_after, 429, budget_seconds=budget, budget_remaining_seconds=round(max(0.0, tokens), 3),
+                                 **hints)
+            if deadline_ms is not None and finish_seconds * 1000 > deadline_ms:
+                # 앞선 작업이 줄어들면 받을 수 있지만, 이 작업만으로 마감 시간을 넘으면 기다려도 소용없습니다.
+                own_seconds = load_seconds + cost
+                retry_after = finish_seconds - deadline_ms / 1000 if own_seconds * 1000 <= deadline_ms else None
+                self._reject("deadline", f"마감 시간({deadline_ms}ms) 안에 끝낼 수 없습니다. "
+                                         f"(예상 완료 {int(finish_seconds * 1000)}ms)",
+                             retry_after, 503, deadline_ms=deadline_ms, **hints)
+            if budget:
+                self._buckets[job.client_id][0] -= cost
+            self._active.setdefault(job.client_id, {})[job.id] = cost
+            self._stats["admitted"] += 1
+        job.estimated_seconds = cost
+
+    def release(self, job, seconds=None):
+        """
+        작업이 끝나면(또는 큐에 넣지 못하거나 취소되면) 호출합니다.
+        seconds는 작업이 실제로 쓴 생성 시간이며, None이면(실행되지 않음) 차감한 예산을 돌려줍니다.
+        """
+        with self._lock:
+            active = self._active.get(job.client_id)
+            if active is None or job.id not in active:
+                return
+            cost = active.pop(job.id)
+            if not active:
+                del self._active[job.client_id]
+            bucket = self._buckets.get(job.client_id)
+            if bucket is not None:
+                budget = self.client_limits(job.client_id)[0]
+                bucket[0] = min(budget, bucket[0] + cost - (seconds or 0.0))
+
+    def stats(self):
+        now = time.time()
+        with self._lock:
+            clients = {}
+            for client_id in set(self._buckets) | set(self._active):
+                budget, max_jobs = self.client_limits(client_id)
+                clients[client_id] = {
+                    "active_jobs": len(self._active.get(client_id, {})),
+                    "max_jobs": max_jobs or None,
+                    "budget_seconds": budget or None,
+                    "budget_remaining_seconds": round(self._tokens(client_id, budget, now)[0], 3) if budget else None,
+                }
+            stats = {"admitted": self._stats["admitted"], "rejected": dict(self._stats["rejected"]), "clients": clients}
+        stats["cost_model"] = self.cost_model.stats()
+        return stats
@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 import requests
 import os
+import time
 
 # --- 설정 ---
 BASE_URL = "http://127.0.0.1:8888"
 OUTPUT_IMAGE_PATH = "api_test_output.png"
+POLL_INTERVAL = 1.0 # 작업 상태 조회 간격 (초)
 
 def get_all_models():
     """API에서 사용 가능한 모든 모델 목록을 가져옵니다."""
@@ -137,8 +139,28 @@ def run_generation_test():
     print("Payload:", json.dumps(payload, indent=2, ensure_ascii=False))
     
     try:
-        # 4. POST 요청 보내기
-        response = requests.post(f"{BASE_URL}/api/generate", json=payload, timeout=300) # 타임아웃 증가
+        # 4. 작업 등록 후 완료될 때까지 상태 조회 (긴 연결을 유지하지 않음)
+        response = requests.post(f"{BASE_URL}/api/jobs", json=payload, timeout=10)
+        response.raise_for_status()
+        job_id = response.json()["job_id"]
+        print(f"작업이 등록되었습니다. (ID: {job_id})")
+
+        while True:
+            status = requests.get(f"{BASE_URL}/api/jobs/{job_id}", timeout=10).json()
+            if status["status"] == "queued":
+                print(f"   > 대기 중... (큐 위치: {status['queue_position']})")
+            elif status["status"] == "running":
+                print(f"   > 생성 중... ({status['step']}/{status['total_steps']} 스텝)")
+            else:
+                break
+            time.sleep(POLL_INTERVAL)
+
+        if status["status"] != "done":
+            print(f"\n--- 작업이 실패했습니다 (상태: {status['status']}) ---")
+            print(status.get("error"))
+            return
+
+        response = requests.get(f"{BASE_URL}/api/jobs/{job_id}/image", timeout=30)
         response.raise_for_status()
 
         # 5. 반환된 이미지 데이터 저장
@@ -3,17 +3,39 @@ import os
 import sys
 import uvicorn
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi.responses import StreamingResponse, FileResponse, Response, PlainTextResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel, Field
-from typing import Optional
 import threading
 import time
 import subprocess
 import re
-import io
+import json
+import asyncio
+import uuid
+import concurrent.futures
+import socket
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
 
-from model_handler import ModelHandler
+import devices
+import metrics
+from admission import AdmissionController, AdmissionError, CostModel
+from cluster import GatewayClient
+from config import config
+from model_handler import create_handler
+from model_registry import IncompatibleLoraError, ModelRegistry
+from prompt_cache import MB
+from image_encoding import ZipStream, accepts_zip, choose_encoding, multipart_end, multipart_part
+from feature_cache import SpeedPolicy
+from highres import HighResPolicy
+from resolution import ResolutionPolicy
+from result_cache import ResultCache, file_fingerprint, is_deterministic, model_revision, result_key
+from lora_cache import request_loras
+from scheduler import create_policy
+from job_store import JobStore
+from schemas import GenerationRequest
+from worker import GenerationWorker, request_image_count
+from warmup import Warmup, parse_preload_entries
 
 # --- 휴대용 실행 파일을 위한 경로 설정 ---
 if getattr(sys, 'frozen', False):
@@ -26,60 +48,352 @@ else:
 LORA_DIR = os.path.join(os.path.expanduser("~"), "AI-loras")
 MODELS_DIR = os.path.join(os.path.expanduser("~"), "AI-models")
 
-# 모델 핸들러 초기화
+# 모델/LoRA 목록: 디렉토리를 요청마다 스캔하지 않고 색인을 유지하며 변경된 항목만 다시 읽습니다.
+registry = ModelRegistry(MODELS_DIR, LORA_DIR, poll_interval=config["registry_poll_interval"])
+
+# 모델 핸들러 초기화 (모델 상주 캐시와 프롬프트 임베딩 캐시 포함)
 try:
-    handler = ModelHandler()
+    handler = create_handler(config, model_type_resolver=registry.model_type)
 except Exception as e:
     print(f"ModelHandler 초기화 실패: {e}")
     # 핸들러가 중요하고 초기화할 수 없는 경우 종료
     sys.exit(1)
+pipeline_cache = handler.pipeline_cache
+prompt_cache = handler.prompt_cache
+
+# 결과 캐시: 시드가 고정된 같은 요청은 다시 렌더링하지 않고 저장된 이미지를 바로 반환합니다.
+result_cache = None
+if config["result_cache_mb"]:
+    result_cache = ResultCache(
+        config["result_cache_dir"] or os.path.join(os.path.expanduser("~"), "AI-cache", "results"),
+        max_bytes=int(config["result_cache_mb"] * MB),
+    )
+
+# 해상도 정책: 요청 크기를 모델 타입별 버킷에 맞춰 배치로 묶일 수 있게 합니다.
+resolution_policy = ResolutionPolicy(config["resolution_mode"], config["resolution_buckets"])
+
+# 속도 정책: 요청의 speed_mode를 블록 캐시 설정(cache_interval, cache_threshold)으로 바꿉니다.
+speed_policy = SpeedPolicy(config["speed_mode"], config["speed_presets"])
 
-# --- 모델 및 LoRA 동적 스캐너 ---
+# 고해상도 정책: 큰 요청을 버킷 크기로 생성한 뒤 확대해 타일별로 다시 디노이징하도록 설정합니다.
+highres_policy = HighResPolicy(resolution_policy, config["highres_mode"], config["highres_min_pixels"],
+                               config["highres_tile_size"], config["highres_tile_overlap"], config["highres_strength"])
+
+# 작업 저장소: 비동기 작업 API에서 작업 ID로 상태와 결과를 조회합니다.
+job_store = JobStore(ttl=config["job_ttl"])
+
+# 입장 제어: 관측한 작업 시간으로 비용을 추정해 마감 시간과 클라이언트별 예산/동시 작업 수를 넘는 작업을 미리 거절합니다.
+admission = AdmissionController(
+    CostModel(prior_unit_seconds=config["cost_prior_unit_seconds"], prior_overhead=config["cost_prior_overhead"]),
+    cost_budget=config["client_cost_budget"],
+    cost_window=config["client_cost_window"],
+    max_jobs=config["client_max_jobs"],
+    limits=config["client_limits"],
+)
+
+# GPU 워커: 핸들러를 소유하고 전용 스레드에서 생성 작업을 처리합니다.
+worker = GenerationWorker(
+    handler,
+    LORA_DIR,
+    max_queue_size=config["queue_size"],
+    default_retry_after=config["retry_after"],
+    store=job_store,
+    max_batch_size=config["max_batch_size"],
+    batch_wait=config["batch_wait_ms"] / 1000.0,
+    scheduling_policy=create_policy(
+        config["scheduler"],
+        max_wait=config["scheduler_max_wait"],
+    ),
+    admission=admission,
+)
+
+# 예열: 설정한 모델/LoRA를 미리 로드하고 예열 렌더링을 마친 뒤 준비 상태가 됩니다.
+warmup = Warmup(
+    handler,
+    worker,
+    LORA_DIR,
+    parse_preload_entries(config["preload_models"], config["pinned_models"]),
+    resolutions=config["warmup_resolutions"],
+    steps=config["warmup_steps"],
+    preload_libraries=config["preload_libraries"],
+)
+
+# 이미지 인코딩 스레드 풀: PNG/WebP/JPEG 인코딩을 이벤트 루프 밖에서 실행합니다.
+encode_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=config["encode_workers"],
+    thread_name_prefix="encode",
+)
+
+# 워커 모드: gateway_url이 설정되어 있으면 게이트웨이에 이 서버의 상태를 주기적으로 등록합니다.
+WORKER_ID = f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}"
+gateway_client = None
+if config["gateway_url"]:
+    gateway_client = GatewayClient(config["gateway_url"], lambda: worker_info(), interval=config["worker_heartbeat"],
+                                   token=config["cluster_token"])
+
+# --- 모델 및 LoRA 목록 ---
 def get_lora_files():
-    """LORA_DIR에서 .safetensors 파일을 스캔합니다."""
-    if not os.path.exists(LORA_DIR):
-        os.makedirs(LORA_DIR)
-        return ["None"]
-    
-    files = [f for f in os.listdir(LORA_DIR) if f.endswith(".safetensors")]
-    return ["None"] + files
+    """LoRA 디렉토리의 .safetensors 파일 목록 (첫 항목은 'LoRA 없음'을 뜻하는 "None")"""
+    return ["None"] + registry.lora_names()
 
 def get_model_names():
+    """모델 디렉토리에 있는 모델의 Hugging Face 저장소 ID 목록"""
+    return registry.model_names()
+
+# --- 클라이언트 식별 ---
+def resolve_addresses(hosts):
+    """호스트 이름/IP 목록을 IP 주소 집합으로 바꿉니다. 찾을 수 없는 이름은 경고 후 건너뜁니다."""
+    addresses = set()
+    for host in hosts:
+        try:
+            addresses.update(info[4][0] for info in socket.getaddrinfo(host, None))
+        except socket.gaierror:
+            print(f"경고: 신뢰할 프록시 주소 '{host}'을(를) 찾을 수 없어 건너뜁니다.")
+    return addresses
+
+# X-Client-Id 헤더를 믿는 프록시 주소 (게이트웨이 + trusted_proxies)와 인정하는 API 키 (설정에 등록된 키)
+TRUSTED_PROXIES = resolve_addresses(
+    list(config["trusted_proxies"]) + ([urlsplit(config["gateway_url"]).hostname] if config["gateway_url"] else [])
+)
+KNOWN_API_KEYS = set(config["client_limits"]) | set(config["client_priorities"])
+
+def get_client_id(http_request):
     """
-    MODELS_DIR에서 모델 디렉토리를 스캔하고
-    Hugging Face 저장소 ID로 다시 변환합니다.
+    요청한 클라이언트를 식별합니다. 클라이언트별 예산, 동시 작업 수, 우선순위가 이 값으로 정해집니다.
+    X-API-Key는 설정(client_limits, client_priorities)에 등록된 키일 때만, X-Client-Id는 게이트웨이나
+    trusted_proxies에서 온 요청일 때만 사용하고, 그 밖에는 접속 IP를 씁니다. (헤더를 바꿔 다른 클라이언트의 예산이나 우선순위를 쓸 수 없음)
     """
-    if not os.path.exists(MODELS_DIR):
-        os.makedirs(MODELS_DIR)
-        return []
-    
-    model_names = []
-    for d in os.listdir(MODELS_DIR):
-        if d.startswith("models--"):
-            repo_id = d.replace("models--", "").replace("--", "/")
-            model_names.append(repo_id)
-    return model_names
-
-# --- API 유효성 검사를 위한 Pydantic 모델 ---
-class GenerationRequest(BaseModel):
-    model_name: str
-    lora_name: Optional[str] = "None"
-    lora_scale: Optional[float] = 0.7
-    prompt: str
-    negative_prompt: Optional[str] = ""
-    steps: int = Field(default=8, ge=1, le=50)
-    guidance_scale: float = Field(default=0.0)
-    width: int = Field(default=1024, ge=256, le=2048)
-    height: int = Field(default=1024, ge=256, le=2048)
-    seed: int = Field(default=-1)
+    api_key = http_request.headers.get("x-api-key")
+    if api_key and api_key in KNOWN_API_KEYS:
+        return api_key
+    peer = http_request.client.host if http_request.client else None
+    client_id = http_request.headers.get("x-client-id")
+    if client_id and peer in TRUSTED_PROXIES:
+        return client_id
+    return peer or "unknown"
+
+def get_client_priority(client_id):
+    """설정(client_priorities)에 지정된 클라이언트 우선순위를 반환합니다. 기본값은 0입니다."""
+    return int(config["client_priorities"].get(client_id, 0))
+
+# --- 결과 캐시 ---
+def get_result_key(request, encoding):
+    """
+    시드가 고정된 요청의 결과 캐시 키를 반환합니다. 캐시를 쓰지 않거나 무작위 시드이면 None.
+    모델 리비전과 LoRA 파일 지문을 키에 포함하므로 모델이나 LoRA 파일이 바뀌면 이전 결과를 쓰지 않습니다.
+    같은 이미지라도 출력 형식/품질이 다르면 다른 바이트이므로 키가 달라집니다.
+    정책을 적용한 뒤의 요청(resolution/speed/highres 모드와 그 결과 값)과 모델의 실행 장치, dtype,
+    오프로드, VAE 타일링, LoRA 병합 설정도 키에 포함하므로 서버 설정이 바뀌면 이전 결과를 쓰지 않습니다.
+    """
+    if result_cache is None or not is_deterministic(request) or request_image_count(request) > 1:
+        return None
+    fingerprint = {
+        "backend": config["backend"],
+        "model_revision": model_revision(MODELS_DIR, request["model_name"]),
+        "loras": {name: file_fingerprint(os.path.join(LORA_DIR, name)) for name, _ in request_loras(request)},
+        "encoding": encoding.cache_key(),
+        "settings": handler.result_settings(request["model_name"]),
+    }
+    return result_key(request, fingerprint)
+
+def etag_matches(http_request, etag):
+    """If-None-Match 헤더에 etag가 포함되어 있는지 확인합니다."""
+    if_none_match = http_request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags or f"W/{etag}" in tags
+
+# --- 요청 검증 ---
+MAX_IMAGES_PER_REQUEST = 8
+
+def normalize_image_count(request_data):
+    """
+    seeds 목록이 있으면 num_images를 그 길이로 맞춥니다. 시드가 하나뿐이면 일반 seed 요청으로 바꿉니다.
+    num_images와 seeds 길이가 다르면 400.
+    """
+    seeds = request_data.get("seeds")
+    if not seeds:
+        request_data["seeds"] = None
+        return request_data
+    if len(seeds) > MAX_IMAGES_PER_REQUEST:
+        raise HTTPException(status_code=400, detail=f"seeds는 최대 {MAX_IMAGES_PER_REQUEST}개까지 지정할 수 있습니다.")
+    if request_data.get("num_images", 1) not in (1, len(seeds)):
+        raise HTTPException(status_code=400, detail="num_images와 seeds의 개수가 다릅니다.")
+    request_data["num_images"] = len(seeds)
+    if len(seeds) == 1:
+        request_data["seed"] = seeds[0]
+        request_data["seeds"] = None
+    return request_data
+
+def apply_resolution_policy(request_data):
+    """요청 크기를 해상도 정책(버킷)에 맞춥니다. 지원하지 않는 resolution_mode이면 400."""
+    try:
+        return resolution_policy.apply(request_data, handler.model_type_of(request_data["model_name"]))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def apply_speed_policy(request_data):
+    """요청의 speed_mode를 블록 캐시 설정으로 바꿉니다. 지원하지 않는 speed_mode이면 400."""
+    try:
+        return speed_policy.apply(request_data)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def apply_highres_policy(request_data):
+    """큰 요청을 2단계(기본 크기 생성 + 타일 다시 디노이징)로 생성할지 정합니다. 지원하지 않는 highres_mode이면 400."""
+    try:
+        return highres_policy.apply(request_data, handler.model_type_of(request_data["model_name"]))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def check_lora_compatibility(request_data):
+    """모델과 다른 아키텍처용 LoRA를 요청하면 GPU 작업을 시작하기 전에 400으로 거절합니다."""
+    try:
+        registry.check_compatibility(request_data["model_name"], [name for name, _ in request_loras(request_data)])
+    except IncompatibleLoraError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+# --- 이미지 인코딩 ---
+def get_encoding(request_data, http_request):
+    """요청 필드와 Accept 헤더로 출력 형식을 정합니다. 지원하지 않는 형식이면 400."""
+    try:
+        return choose_encoding(request_data, http_request.headers.get("accept"), config)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def _encode_timed(image, encoding):
+    with metrics.stage("image_encode"):
+        return encoding.encode(image)
+
+async def encode_image(image, encoding):
+    """이벤트 루프를 막지 않도록 인코딩 스레드 풀에서 이미지를 인코딩합니다."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(encode_executor, _encode_timed, image, encoding)
+
+def image_response(http_request, data, encoding, size, key=None, cache_status=None):
+    """인코딩된 이미지 응답을 만듭니다. 캐시 키가 있으면 ETag를 붙이고, If-None-Match가 일치하면 304를 반환합니다."""
+    headers = {"Vary": "Accept"}
+    headers.update(encoding.headers(size))
+    if cache_status:
+        headers["X-Cache"] = cache_status
+    if key is not None:
+        headers["ETag"] = f'"{key}"'
+        if etag_matches(http_request, headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+    return Response(content=data, media_type=encoding.media_type, headers=headers)
+
+# 같은 키로 진행 중인 렌더링 (동시에 들어온 같은 요청은 하나의 렌더링 결과를 공유)
+_inflight_renders = {}
+
+# --- 지표 ---
+def collect_server_metrics():
+    """큐 길이와 모델/LoRA/프롬프트/결과/아티팩트 캐시 통계를 /metrics 조회 시점에 읽어 내보냅니다."""
+    yield ("aigen_queue_depth", "gauge", "대기 중인 작업 수", [({}, len(worker.queue))])
+    yield ("aigen_running_jobs", "gauge", "실행 중인 작업 수", [({}, len(worker.current_jobs))])
+
+    model_stats = pipeline_cache.stats()
+    lora_stats = handler.lora_cache_stats()
+    caches = {"model": model_stats, "lora": lora_stats}
+    if prompt_cache is not None:
+        caches["prompt"] = prompt_cache.stats()
+    if result_cache is not None:
+        caches["result"] = result_cache.stats()
+    if handler.artifact_cache is not None:
+        caches["artifact"] = handler.artifact_cache.stats()
+    for field, description in (("hits", "히트"), ("misses", "미스"), ("evictions", "제거")):
+        yield (f"aigen_cache_{field}_total", "counter", f"캐시 {description} 수 (캐시 종류별)",
+               [({"cache": name}, stats[field]) for name, stats in caches.items()])
+
+    yield ("aigen_model_cache_bytes", "gauge", "상주 모델이 차지하는 메모리 (위치별)",
+           [({"location": "gpu"}, model_stats["gpu_bytes"]), ({"location": "cpu"}, model_stats["cpu_bytes"])])
+    yield ("aigen_model_cache_offloads_total", "counter", "GPU에서 CPU로 내린 모델 수", [({}, model_stats["offloads"])])
+    yield ("aigen_lora_fuses_total", "counter", "LoRA를 기본 가중치에 병합한 횟수", [({}, lora_stats["fuses"])])
+
+metrics.REGISTRY.add_collector(collect_server_metrics)
+
+class ResponseTimingMiddleware:
+    """이미지 응답의 헤더 전송부터 본문 전송 완료까지의 시간을 response_write 단계로 기록합니다."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        path = scope.get("path", "")
+        if scope["type"] != "http" or not (path == "/api/generate" or path.endswith(("/image", "/images"))):
+            await self.app(scope, receive, send)
+            return
+
+        started = None
+
+        async def timed_send(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = time.perf_counter()
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body") and started is not None:
+                metrics.record_stage("response_write", time.perf_counter() - started)
+
+        await self.app(scope, receive, timed_send)
+
+# --- 워커 등록 정보 ---
+def worker_info():
+    """게이트웨이에 보낼 이 워커의 장치, 메모리, 상주 모델, 로드된 LoRA, 큐 상태입니다."""
+    model_stats = pipeline_cache.stats()
+    device = handler.device or ("fake" if config["backend"] == "fake" else config["device"])
+    return {
+        "worker_id": WORKER_ID,
+        "ready": warmup.ready,
+        "url": config["worker_url"] or f"http://{socket.gethostname()}:{config['port']}",
+        "backend": config["backend"],
+        "device": device,
+        "free_memory_bytes": devices.free_memory(device) if handler.device else None,
+        "gpu_budget_bytes": model_stats["gpu_budget_bytes"],
+        "gpu_bytes": model_stats["gpu_bytes"],
+        "current_model": handler.current_model_name,
+        "models": [{"model_name": e["model_name"], "location": e["location"]} for e in model_stats["entries"]],
+        "loras": [os.path.basename(path) for path in handler.loaded_loras()],
+        # 대기/실행 중인 작업의 모델: 로딩이 끝나기 전에도 게이트웨이가 같은 모델 요청을 이 워커로 보낼 수 있게 합니다.
+        "pending_models": sorted({job.request["model_name"] for job in worker.queue.snapshot() + list(worker.current_jobs)}),
+        "queue_depth": len(worker.queue),
+        "running_jobs": len(worker.current_jobs),
+        "max_queue_size": worker.queue.max_size,
+        "max_batch_size": worker.max_batch_size,
+        "retry_after": worker.estimate_retry_after(),
+    }
 
 # --- FastAPI 앱 ---
+@asynccontextmanager
+async def lifespan(app):
+    """서버 시작 시 GPU 워커와 예열(과 게이트웨이 등록)을 시작하고, 종료 시 정지합니다."""
+    registry.start()
+    worker.start()
+    warmup.start()
+    if gateway_client is not None:
+        gateway_client.start()
+    yield
+    if gateway_client is not None:
+        gateway_client.stop()
+    worker.stop()
+    handler.compile_policy.shutdown()
+    registry.stop()
+    encode_executor.shutdown(wait=False)
+
 app = FastAPI(
     title="Z-Image-Turbo API",
     description="초고속 AI 이미지 생성을 위한 API입니다.",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
+app.add_middleware(ResponseTimingMiddleware)
+
+@app.exception_handler(AdmissionError)
+async def admission_error_handler(http_request, error):
+    """큐가 가득 찼거나 입장 제어가 거절한 요청: detail과 함께 사유, 재시도 시간, 비용 추정값을 반환합니다."""
+    headers = {"Retry-After": str(error.retry_after)} if error.retry_after is not None else None
+    return JSONResponse(error.to_dict(), status_code=error.status_code, headers=headers)
+
 # --- 정적 파일 및 루트 페이지 제공 ---
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
@@ -89,43 +403,272 @@ async def read_root():
     return "static/index.html"
 
 
+def listing_response(http_request, kind, content):
+    """모델/LoRA 목록 응답. 목록의 ETag를 붙이고, If-None-Match가 일치하면 304를 반환합니다."""
+    headers = {"ETag": registry.etag(kind), "Cache-Control": "no-cache"}
+    if etag_matches(http_request, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(content, headers=headers)
+
 @app.get("/api/models", tags=["정보"])
-async def get_models_api():
-    """사용 가능한 모델 목록을 반환합니다."""
-    return {"models": get_model_names()}
+async def get_models_api(http_request: Request, details: bool = False):
+    """
+    사용 가능한 모델 목록을 반환합니다. details=true이면 모델별 파이프라인 클래스, 아키텍처,
+    구성 요소 크기와 양자화 방식도 함께 반환합니다.
+    """
+    content = {"models": get_model_names()}
+    if details:
+        content["details"] = registry.models()
+    return listing_response(http_request, "models", content)
 
 @app.get("/api/loras", tags=["정보"])
-async def get_loras_api():
-    """사용 가능한 LoRA 파일 목록을 반환합니다."""
-    return {"loras": get_lora_files()}
+async def get_loras_api(http_request: Request, details: bool = False):
+    """사용 가능한 LoRA 파일 목록을 반환합니다. details=true이면 LoRA별 랭크, 대상 모듈, 기반 아키텍처도 함께 반환합니다."""
+    content = {"loras": get_lora_files()}
+    if details:
+        content["details"] = registry.loras()
+    return listing_response(http_request, "loras", content)
+
+@app.get("/api/status", tags=["정보"])
+async def get_status_api():
+    """작업 큐 상태와 모델/LoRA/프롬프트 임베딩/결과 캐시 통계(히트/미스, 로딩 시간, 상주 모델과 어댑터)를 반환합니다."""
+    return {
+        "queue_depth": len(worker.queue),
+        "running_jobs": len(worker.current_jobs),
+        "current_model": handler.current_model_name,
+        "warmup": warmup.to_dict(),
+        "model_cache": pipeline_cache.stats(),
+        "lora_cache": handler.lora_cache_stats(),
+        "prompt_cache": prompt_cache.stats() if prompt_cache is not None else None,
+        "result_cache": result_cache.stats() if result_cache is not None else None,
+        "artifact_cache": handler.artifact_cache.stats() if handler.artifact_cache is not None else None,
+        "registry": registry.stats(),
+        "compile": handler.compile_policy.stats(),
+        "feature_cache": handler.feature_cache.stats(),
+        "highres": highres_policy.describe(),
+        "admission": admission.stats(),
+    }
+
+@app.get("/api/ready", tags=["정보"])
+async def get_ready_api():
+    """
+    준비 상태(readiness)를 반환합니다. 미리 로드할 모델의 로딩과 예열 렌더링이 끝나면 200, 그 전이나 실패하면 503.
+    오케스트레이터(Kubernetes readinessProbe, 로드 밸런서 상태 검사)가 예열된 인스턴스로만 요청을 보내게 할 때 사용합니다.
+    """
+    status = warmup.to_dict()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+@app.get("/metrics", response_class=PlainTextResponse, tags=["정보"])
+async def metrics_api():
+    """Prometheus 형식의 지표(단계별 소요 시간, 캐시 히트/미스, 큐 길이, GPU 메모리 최고 기록 등)를 반환합니다."""
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
 
 @app.post("/api/generate", tags=["이미지 생성"])
-async def generate_image_api(request: GenerationRequest):
-    """제공된 프롬프트와 설정을 기반으로 이미지를 생성합니다."""
-    try:
-        # 현재 모델이 아닌 경우 기본 모델 로드
-        handler.load_model(request.model_name)
-        
-        # 선택된 경우 LoRA 로드
-        lora_path = os.path.join(LORA_DIR, request.lora_name) if request.lora_name != "None" else None
-        handler.load_lora(lora_path)
+async def generate_image_api(request: GenerationRequest, http_request: Request):
+    """
+    제공된 프롬프트와 설정을 기반으로 이미지를 생성합니다.
+    출력 형식은 output_format 필드 또는 Accept 헤더(image/webp, image/jpeg, image/png, application/x-rgb)로 정합니다.
+    시드가 고정된 요청은 결과가 캐시되며, 응답의 ETag를 If-None-Match로 보내면 변경이 없을 때 304를 반환합니다.
+    """
+    request_data = apply_highres_policy(apply_speed_policy(apply_resolution_policy(normalize_image_count(request.dict()))))
+    check_lora_compatibility(request_data)
+    encoding = get_encoding(request_data, http_request)
+    if request_data["num_images"] > 1:
+        job = await run_job(request_data, http_request)
+        response = multi_image_response(http_request, job.future.result(), job.seeds, encoding)
+        response.headers["Server-Timing"] = metrics.server_timing(job.timings)
+        return response
 
-        # 이미지 생성 (전체 요청을 kwargs로 전달하여 유연성 확보)
-        image = handler.generate(**request.dict())
+    size = tuple(request_data.get("output_size") or (request_data["width"], request_data["height"]))
+    key = get_result_key(request_data, encoding)
+    if key is None:
+        data, seed, timings = await render_image(request_data, encoding, http_request)
+        response = image_response(http_request, data, encoding, size)
+        response.headers["X-Seed"] = str(seed)
+        response.headers["Server-Timing"] = metrics.server_timing(timings)
+        return response
 
-        if image is None:
-            raise HTTPException(status_code=500, detail="모델이 이미지 생성에 실패했습니다.")
-        
-        # PIL 이미지를 바이트 스트림으로 변환
-        buffer = io.BytesIO()
-        image.save(buffer, format="PNG")
-        buffer.seek(0)
-        
-        return StreamingResponse(buffer, media_type="image/png")
+    data = await asyncio.to_thread(result_cache.get, key)
+    if data is not None:
+        response = image_response(http_request, data, encoding, size, key, "HIT")
+        response.headers["X-Seed"] = str(request_data["seed"])
+        return response
+
+    # 같은 요청이 이미 렌더링 중이면 새로 큐에 넣지 않고 그 결과를 기다립니다.
+    render = _inflight_renders.get(key)
+    cache_status = "SHARED"
+    if render is None:
+        cache_status = "MISS"
+        render = asyncio.ensure_future(render_and_cache_image(key, request_data, encoding, http_request))
+        _inflight_renders[key] = render
+        render.add_done_callback(lambda _: _inflight_renders.pop(key, None))
+    # 먼저 요청한 클라이언트의 연결이 끊겨도 렌더링은 계속되어 다른 클라이언트가 결과를 받습니다.
+    data, timings = await asyncio.shield(render)
+    response = image_response(http_request, data, encoding, size, key, cache_status)
+    response.headers["X-Seed"] = str(request_data["seed"])
+    response.headers["Server-Timing"] = metrics.server_timing(timings)
+    return response
+
+async def render_and_cache_image(key, request_data, encoding, http_request):
+    data, _, timings = await render_image(request_data, encoding, http_request)
+    await asyncio.to_thread(result_cache.put, key, data)
+    return data, timings
 
+async def render_image(request_data, encoding, http_request):
+    """요청을 GPU 워커에 넣고 완료되면 (인코딩된 이미지 바이트, 시드, 단계별 소요 시간)을 반환합니다."""
+    job = await run_job(request_data, http_request)
+    start = time.perf_counter()
+    data = await encode_image(job.future.result()[0], encoding)
+    timings = dict(job.timings, image_encode=time.perf_counter() - start)
+    return data, job.seeds[0], timings
+
+async def run_job(request_data, http_request):
+    """요청을 GPU 워커에 넣고 완료된 작업을 반환합니다."""
+    # 생성은 GPU 워커 스레드에서 실행되므로 이벤트 루프는 다른 요청을 계속 처리합니다.
+    # 큐가 가득 찼거나 입장 제어가 거절하면 AdmissionError (admission_error_handler가 응답)
+    client_id = get_client_id(http_request)
+    job = worker.submit(request_data, client_id=client_id, priority=get_client_priority(client_id))
+
+    try:
+        await job.wait()
     except Exception as e:
         print(f"/api/generate 오류: {e}")
         raise HTTPException(status_code=500, detail=str(e))
+    return job
+
+def multi_image_response(http_request, images, seeds, encoding):
+    """
+    여러 이미지를 인코딩이 끝나는 대로 스트리밍합니다. Accept에 application/zip이 있으면 zip,
+    아니면 multipart/mixed로 보냅니다. 각 이미지의 시드는 파트 헤더(X-Seed)와 파일 이름, zip의 seeds.json에 기록됩니다.
+    """
+    use_zip = accepts_zip(http_request.headers.get("accept"))
+    boundary = uuid.uuid4().hex
+
+    async def encode_indexed(index, image):
+        return index, await encode_image(image, encoding)
+
+    async def stream():
+        archive = ZipStream() if use_zip else None
+        for next_done in asyncio.as_completed([encode_indexed(i, image) for i, image in enumerate(images)]):
+            index, data = await next_done
+            filename = f"image-{index}-{seeds[index]}.{encoding.extension}"
+            if archive is not None:
+                yield archive.add(filename, data)
+            else:
+                headers = {
+                    "Content-Type": encoding.media_type,
+                    "Content-Disposition": f'attachment; filename="{filename}"',
+                    "X-Image-Index": str(index),
+                    "X-Seed": str(seeds[index]),
+                }
+                headers.update(encoding.headers(images[index].size))
+                yield multipart_part(boundary, data, headers)
+        if archive is not None:
+            manifest = [{"index": i, "seed": seed, "file": f"image-{i}-{seed}.{encoding.extension}"} for i, seed in enumerate(seeds)]
+            yield archive.add("seeds.json", json.dumps(manifest, indent=2).encode("utf-8"))
+            yield archive.close()
+        else:
+            yield multipart_end(boundary)
+
+    headers = {"X-Seeds": ",".join(str(seed) for seed in seeds), "Vary": "Accept"}
+    if use_zip:
+        headers["Content-Disposition"] = 'attachment; filename="images.zip"'
+        return StreamingResponse(stream(), media_type="application/zip", headers=headers)
+    return StreamingResponse(stream(), media_type=f"multipart/mixed; boundary={boundary}", headers=headers)
+
+# --- 비동기 작업 API ---
+def _get_job_or_404(job_id):
+    job = job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"작업 '{job_id}'을(를) 찾을 수 없습니다.")
+    return job
+
+def _job_status(job):
+    return job.to_dict(queue_position=worker.queue_position(job))
+
+@app.post("/api/jobs", status_code=202, tags=["작업"])
+async def submit_job_api(request: GenerationRequest, http_request: Request):
+    """생성 작업을 큐에 등록하고 즉시 작업 ID를 반환합니다."""
+    client_id = get_client_id(http_request)
+    request_data = apply_highres_policy(apply_speed_policy(apply_resolution_policy(normalize_image_count(request.dict()))))
+    check_lora_compatibility(request_data)
+    job = worker.submit(request_data, client_id=client_id, priority=get_client_priority(client_id))
+    return _job_status(job)
+
+@app.get("/api/jobs/{job_id}", tags=["작업"])
+async def get_job_api(job_id: str):
+    """작업 상태, 큐 위치, 진행률을 반환합니다."""
+    return _job_status(_get_job_or_404(job_id))
+
+@app.delete("/api/jobs/{job_id}", tags=["작업"])
+async def cancel_job_api(job_id: str):
+    """대기 중인 작업을 취소합니다."""
+    job = _get_job_or_404(job_id)
+    if not worker.cancel(job):
+        raise HTTPException(status_code=409, detail=f"작업이 이미 '{job.status}' 상태라 취소할 수 없습니다.")
+    return _job_status(job)
+
+@app.get("/api/jobs/{job_id}/events", tags=["작업"])
+async def job_events_api(job_id: str):
+    """작업 상태와 스텝별 진행률을 Server-Sent Events로 스트리밍합니다."""
+    job = _get_job_or_404(job_id)
+
+    async def event_stream():
+        updates = job.subscribe()
+        try:
+            status = _job_status(job)
+            yield f"data: {json.dumps(status)}\n\n"
+            while status["status"] not in job.FINISHED_STATUSES:
+                try:
+                    status = await asyncio.wait_for(updates.get(), timeout=config["sse_keepalive"])
+                except asyncio.TimeoutError:
+                    # 대기 중에는 큐 위치가 바뀌므로 주기적으로 현재 상태를 다시 보냅니다.
+                    status = _job_status(job)
+                yield f"data: {json.dumps(status)}\n\n"
+        finally:
+            job.unsubscribe(updates)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+def _get_finished_job(job_id):
+    job = _get_job_or_404(job_id)
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error)
+    # 결과가 설정되기 전에 future.result()를 부르면 이벤트 루프가 막히므로 future도 확인합니다.
+    if job.status != "done" or not job.future.done():
+        raise HTTPException(status_code=409, detail=f"작업이 아직 완료되지 않았습니다. (상태: {job.status})")
+    return job
+
+@app.get("/api/jobs/{job_id}/images", tags=["작업"])
+async def get_job_images_api(job_id: str, http_request: Request):
+    """완료된 작업의 모든 이미지를 multipart/mixed 또는 zip(Accept: application/zip)으로 스트리밍합니다."""
+    job = _get_finished_job(job_id)
+    encoding = get_encoding(job.request, http_request)
+    return multi_image_response(http_request, job.future.result(), job.seeds, encoding)
+
+@app.get("/api/jobs/{job_id}/image", tags=["작업"])
+async def get_job_image_api(job_id: str, http_request: Request, index: int = 0):
+    """
+    완료된 작업의 결과 이미지(여러 장이면 index번째)를 반환합니다. 출력 형식은 작업 요청의 output_format 또는 Accept 헤더로 정합니다.
+    시드가 고정된 작업은 ETag를 포함하고 결과 캐시에도 저장됩니다.
+    """
+    job = _get_finished_job(job_id)
+    images = job.future.result()
+    if not 0 <= index < len(images):
+        raise HTTPException(status_code=404, detail=f"이미지 인덱스 {index}이(가) 범위를 벗어났습니다. (0~{len(images) - 1})")
+
+    image = images[index]
+    encoding = get_encoding(job.request, http_request)
+    key = get_result_key(job.request, encoding)
+    if key is not None and etag_matches(http_request, f'"{key}"'):
+        return image_response(http_request, None, encoding, image.size, key)
+
+    data = await encode_image(image, encoding)
+    if key is not None:
+        await asyncio.to_thread(result_cache.put, key, data)
+    response = image_response(http_request, data, encoding, image.size, key)
+    response.headers["X-Seed"] = str(job.seeds[index])
+    return response
 
 # --- 서버 생명주기 관리 ---
 server_instance = None
@@ -173,7 +716,7 @@ async def shutdown():
     return {"message": "서버 인스턴스를 찾을 수 없습니다."}
 
 if __name__ == "__main__":
-    PORT = 8888
+    PORT = config["port"]
     
     # 시작하기 전에 서버 포트를 사용하는 모든 프로세스를 확인하고 종료합니다.
     kill_process_on_port(PORT)
@@ -182,10 +725,11 @@ if __name__ == "__main__":
         def install_signal_handlers(self):
             pass
 
-    config = uvicorn.Config(app, host="0.0.0.0", port=PORT, log_level="info")
-    server = Server(config=config)
+    # 요청 처리기가 서버 설정(config)을 계속 읽으므로 uvicorn 설정은 다른 이름을 사용합니다.
+    server_config = uvicorn.Config(app, host=config["host"], port=PORT, log_level="info")
+    server = Server(config=server_config)
     server_instance = server
     
-    print(f"API 서버를 http://0.0.0.0:{PORT} 에서 시작합니다.")
-    print(f"API 문서는 http://0.0.0.0:{PORT}/docs 에서 볼 수 있습니다.")
+    print(f"API 서버를 http://{config['host']}:{PORT} 에서 시작합니다.")
+    print(f"API 문서는 http://{config['host']}:{PORT}/docs 에서 볼 수 있습니다.")
     server.run()
\ No newline at end of file
@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import importlib.metadata
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import uuid
+
+# 아티팩트 저장 형식 버전. 저장 방식을 바꾸면 올려서 이전 아티팩트를 모두 무효화합니다.
+ARTIFACT_FORMAT = 1
+# 변환 결과에 영향을 주는 라이브러리 (버전이 바뀌면 아티팩트를 다시 만듭니다)
+KEY_LIBRARIES = ("torch", "diffusers", "transformers", "safetensors", "sdnq", "triton")
+MANIFEST_NAME = "artifact.json"
+
+
+def library_versions():
+    """KEY_LIBRARIES의 설치된 버전을 반환합니다. 설치되지 않은 라이브러리는 None."""
+    versions = {}
+    for name in KEY_LIBRARIES:
+        try:
+            versions[name] = importlib.metadata.version(name)
+        except importlib.metadata.PackageNotFoundError:
+            versions[name] = None
+    return versions
+
+
+def device_signature(device):
+    """장치 종류와 (알 수 있으면) GPU 이름, compute capability, CUDA 버전. 양자화 커널은 장치마다 다를 수 있습니다."""
+    signature = {"device": device}
+    torch = sys.modules.get("torch")
+    if torch is None:
+        return signature
+    try:
+        if device == "cuda" and torch.cuda.is_available():
+            signature["name"] = torch.cuda.get_device_name(0)
+            signature["capability"] = list(torch.cuda.get_device_capability(0))
+            signature["cuda"] = torch.version.cuda
+        elif device == "xpu" and hasattr(torch, "xpu") and torch.xpu.is_available():
+            signature["name"] = torch.xpu.get_device_name(0)
+    except Exception:
+        pass
+    return signature
+
+
+def _directory_bytes(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class Artifact:
+    """저장된 아티팩트 하나. components는 구성 요소 이름 -> 저장할 때 기록한 메타데이터입니다."""
+
+    def __init__(self, path, manifest):
+        self.path = path
+        self.manifest = manifest
+
+    @property
+    def components(self):
+        return self.manifest["components"]
+
+    def component_path(self, name):
+        return os.path.join(self.path, name)
+
+
+class ArtifactCache:
+    """
+    모델을 로드한 뒤 후처리(SDNQ 양자화 최적화 등)를 마친 구성 요소를 디스크에 저장해 두고,
+    다음 로딩 때 변환 없이 바로 읽도록 하는 캐시입니다.
+
+    키는 모델 이름과 리비전, 변환에 관여하는 라이브러리 버전, 장치(GPU 종류와 compute capability),
+    dtype, 후처리 옵션으로 만들며, 이 중 하나라도 바뀌면 다른 키가 되어 다시 변환합니다.
+    같은 모델의 이전 키 아티팩트는 새 아티팩트를 저장할 때 지우고, 전체 크기가 max_bytes를 넘으면
+    가장 오래 사용하지 않은 아티팩트부터 지웁니다.
+
+    디렉토리 구조: <directory>/models--<조직>--<이름>/<키>/{artifact.json, <구성 요소>/...}
+    artifact.json은 모든 파일을 쓴 뒤 마지막에 만들어지므로, 이 파일이 없는 디렉토리는 쓰다 만 것으로 보고 무시합니다.
+    아티팩트별 크기는 시작할 때 한 번 읽고 저장/삭제할 때 갱신하므로, stats()는 디스크를 읽지 않습니다.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "invalidations": 0,
+                       "load_seconds_total": 0.0, "store_seconds_total": 0.0}
+        os.makedirs(directory, exist_ok=True)
+        self._sizes = {path: self._read_size(path) for _, path in self._artifacts()} # 경로 -> 크기 (바이트)
+
+    @staticmethod
+    def _read_size(path):
+        """artifact.json에 기록된 크기. (기록이 없는 이전 형식이면 디렉토리를 훑어 계산)"""
+        try:
+            with open(os.path.join(path, MANIFEST_NAME), "r", encoding="utf-8") as f:
+                size = json.load(f).get("bytes")
+        except (OSError, ValueError):
+            size = None
+        return size if isinstance(size, int) else _directory_bytes(path)
+
+    def configure_compile_cache(self):
+        """
+        torch.compile(inductor)의 컴파일 결과도 같은 위치에 보관하도록 환경 변수를 설정합니다.
+        torch를 가져오기 전에 호출해야 하며, 이미 설정된 값은 바꾸지 않습니다. (inductor 캐시 키에는 torch 버전과 장치가 포함됨)
+        """
+        os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(self.directory, "inductor"))
+        os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+
+    def key_inputs(self, model_name, revision, device, dtype, options):
+        """아티팩트 키를 만드는 값들을 반환합니다. (아티팩트에 함께 기록되어 불일치를 검사하는 데 쓰임)"""
+        return {
+            "format": ARTIFACT_FORMAT,
+            "model_name": model_name,
+            "revision": revision,
+            "libraries": library_versions(),
+            "device": device_signature(device),
+            "dtype": str(dtype).replace("torch.", ""),
+            "options": options,
+        }
+
+    @staticmethod
+    def key(inputs):
+        canonical = json.dumps(inputs, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:32]
+
+    def _model_dir(self, model_name):
+        return os.path.join(self.directory, "models--" + model_name.replace("/", "--").replace(os.sep, "--"))
+
+    def _path(self, inputs):
+        return os.path.join(self._model_dir(inputs["model_name"]), self.key(inputs))
+
+    def lookup(self, inputs):
+        """키에 맞는 완성된 아티팩트를 반환합니다. 없거나 기록된 키 값이 다르면 None."""
+        path = self._path(inputs)
+        try:
+            with open(os.path.join(path, MANIFEST_NAME), "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = None
+        with self._lock:
+            if manifest is None or manifest.get("inputs") != inputs:
+                self._stats["misses"] += 1
+                return None
+            self._stats["hits"] += 1
+        os.utime(path) # 마지막 사용 시각 갱신 (LRU)
+        return Artifact(path, manifest)
+
+    def record_load(self, seconds):
+        with self._lock:
+            self._stats["load_seconds_total"] += seconds
+
+    def store(self, inputs, components):
+        """
+        구성 요소들을 저장합니다. components: 이름 -> save(경로) 함수. save는 불러올 때 필요한 메타데이터 딕셔너리를 반환합니다.
+        임시 디렉토리에 모두 쓴 뒤 이름을 바꾸므로, 저장 중 중단되어도 불완전한 아티팩트가 사용되지 않습니다.
+        저장에 실패하면 경고만 출력하고 None을 반환합니다.
+        """
+        path = self._path(inputs)
+        tmp_path = f"{path}.tmp-{uuid.uuid4().hex[:8]}"
+        start = time.perf_counter()
+        try:
+            os.makedirs(tmp_path)
+            saved = {}
+            for name, save in components.items():
+                saved[name] = save(os.path.join(tmp_path, name)) or {}
+            size = _directory_bytes(tmp_path)
+            manifest = {"inputs": inputs, "components": saved, "created_at": time.time(), "bytes": size}
+            with open(os.path.join(tmp_path, MANIFEST_NAME), "w", encoding="utf-8") as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+            if os.path.exists(path):
+                shutil.rmtree(path, ignore_errors=True)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"경고: '{inputs['model_name']}'의 변환 결과를 아티팩트 캐시에 저장하지 못했습니다: {e}")
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            try:
+                os.rmdir(os.path.dirname(path)) # 이 모델의 다른 아티팩트가 없으면 빈 디렉토리도 지움
+            except OSError:
+                pass
+            return None
+
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self._stats["stores"] += 1
+            self._stats["store_seconds_total"] += elapsed
+            self._sizes[path] = size
+        print(f"아티팩트 캐시: '{inputs['model_name']}' 저장 ({', '.join(components)}, {elapsed:.1f}초)")
+        self._prune(inputs["model_name"], keep=path)
+        return Artifact(path, manifest)
+
+    def invalidate(self, inputs):
+        """아티팩트를 지웁니다. (불러오기에 실패한 경우 등)"""
+        path = self._path(inputs)
+        if os.path.exists(path):
+            shutil.rmtree(path, ignore_errors=True)
+            with self._lock:
+                self._stats["invalidations"] += 1
+                self._sizes.pop(path, None)
+
+    def _artifacts(self):
+        """(마지막 사용 시각, 경로) 목록. 쓰다 만 임시 디렉토리는 제외합니다."""
+        found = []
+        for model_dir in os.listdir(self.directory):
+            if not model_dir.startswith("models--"):
+                continue
+            model_path = os.path.join(self.directory, model_dir)
+            for key in os.listdir(model_path):
+                path = os.path.join(model_path, key)
+                if ".tmp-" not in key and os.path.exists(os.path.join(path, MANIFEST_NAME)):
+                    found.append((os.path.getmtime(path), path))
+        return sorted(found)
+
+    def _prune(self, model_name, keep):
+        """같은 모델의 다른 키 아티팩트(리비전, 라이브러리, 장치가 바뀌기 전의 것)를 지우고 크기 예산을 맞춥니다."""
+        model_dir = self._model_dir(model_name)
+        for key in os.listdir(model_dir):
+            path = os.path.join(model_dir, key)
+            if path != keep:
+                shutil.rmtree(path, ignore_errors=True)
+                with self._lock:
+                    self._stats["evictions"] += 1
+                    self._sizes.pop(path, None)
+
+        if not self.max_bytes:
+            return
+        with self._lock:
+            sizes = dict(self._sizes)
+        artifacts = [(mtime, path, sizes[path] if path in sizes else self._read_size(path))
+                     for mtime, path in self._artifacts()]
+        total = sum(size for _, _, size in artifacts)
+        for _, path, size in artifacts:
+            if total <= self.max_bytes or path == keep:
+                continue
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+            with self._lock:
+                self._stats["evictions"] += 1
+                self._sizes.pop(path, None)
+
+    def stats(self):
+        """히트/미스, 저장/삭제 수, 아티팩트 수와 크기. 메모리에 기록한 값만 읽으므로 이벤트 루프에서 호출해도 됩니다."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._sizes)
+            stats["bytes"] = sum(self._sizes.values())
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        stats["max_bytes"] = self.max_bytes
+        return stats
@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+JSONL/CSV 프롬프트 파일을 읽어 이미지를 일괄 생성하는 오프라인 배치 도구입니다.
+
+각 행은 /api/generate 요청(GenerationRequest)과 같은 필드를 가지며, 선택적으로 'id' 필드로
+행 이름을 지정할 수 있습니다. (없으면 JSONL은 줄 번호, CSV는 행 번호를 사용)
+CSV에서 loras, seeds 열은 JSON 문자열로 적습니다. 예: [{"name": "a.safetensors", "scale": 0.8}]
+
+    python batch_generate.py prompts.jsonl -o output/
+    python batch_generate.py prompts.csv -o output/ --format webp --backend fake
+
+입력은 한 번에 --window개 행씩 스트리밍으로 읽고, 창 안의 행을 모델/LoRA/해상도별로 묶어
+모델과 LoRA 전환을 줄입니다. 묶인 행은 --batch-size장씩 한 번의 파이프라인 호출로 생성하며,
+이미지 인코딩과 파일 저장은 별도 스레드에서 진행되어 다음 배치 생성과 겹쳐 실행됩니다.
+
+완료된 행은 출력 디렉토리의 manifest.jsonl에 기록됩니다. 중단된 뒤 같은 명령을 다시 실행하면
+이미 완료된 행은 건너뛰고 나머지만 생성합니다. (--restart로 처음부터 다시 생성)
+"""
+import argparse
+import concurrent.futures
+import csv
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+
+from pydantic import ValidationError
+
+from config import config
+from feature_cache import SpeedPolicy
+from highres import HighResPolicy
+from image_encoding import choose_encoding, normalize_format
+from model_handler import create_handler, get_model_type
+from resolution import ResolutionPolicy
+from schemas import GenerationRequest
+from worker import batch_key, render_batch, request_seeds
+
+LORA_DIR = os.path.join(os.path.expanduser("~"), "AI-loras")
+
+# CSV에서 JSON 문자열로 적는 열
+JSON_COLUMNS = ("loras", "seeds")
+
+# 서버와 같은 해상도 버킷 정책 (행의 resolution_mode가 우선)
+RESOLUTION_POLICY = ResolutionPolicy(config["resolution_mode"], config["resolution_buckets"])
+# 서버와 같은 속도 모드 정책 (행의 speed_mode가 우선)
+SPEED_POLICY = SpeedPolicy(config["speed_mode"], config["speed_presets"])
+# 서버와 같은 고해상도 정책 (행의 highres_mode가 우선)
+HIGHRES_POLICY = HighResPolicy(RESOLUTION_POLICY, config["highres_mode"], config["highres_min_pixels"],
+                               config["highres_tile_size"], config["highres_tile_overlap"], config["highres_strength"])
+
+
+class BatchRow:
+    """입력 파일의 한 행과 생성 진행 상태입니다."""
+
+    def __init__(self, row_id, request=None, error=None):
+        self.id = row_id
+        self.request = request
+        self.error = error
+        self.seeds = request["seeds"] if request else []
+        self.files = [None] * len(self.seeds)
+        self.remaining = len(self.seeds) # 아직 저장되지 않은 이미지 수
+        self.failed = False
+
+
+def _parse_csv_row(row):
+    """CSV 행에서 빈 칸은 기본값을 쓰도록 제거하고, JSON 열은 파싱합니다."""
+    request = {}
+    for key, value in row.items():
+        if key is None or value is None or value.strip() == "":
+            continue
+        key = key.strip()
+        request[key] = json.loads(value) if key in JSON_COLUMNS else value
+    return request
+
+
+def read_rows(path):
+    """입력 파일에서 (행 ID, 요청 딕셔너리 또는 None, 오류 메시지)를 순서대로 읽습니다."""
+    is_csv = os.path.splitext(path)[1].lower() == ".csv"
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        if is_csv:
+            for number, row in enumerate(csv.DictReader(f), start=1):
+                try:
+                    data = _parse_csv_row(row)
+                except json.JSONDecodeError as e:
+                    yield str(row.get("id") or number), None, f"JSON 열을 해석할 수 없습니다: {e}"
+                    continue
+                yield str(data.get("id") or number), data, None
+        else:
+            for number, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                try:
+                    data = json.loads(line)
+                except json.JSONDecodeError as e:
+                    yield str(number), None, f"JSON을 해석할 수 없습니다: {e}"
+                    continue
+                if not isinstance(data, dict):
+                    yield str(number), None, "각 줄은 JSON 객체여야 합니다."
+                    continue
+                yield str(data.get("id") or number), data, None
+
+
+def make_row(row_id, data, error):
+    """요청을 검증하고 이미지별 시드를 정해 BatchRow를 만듭니다. (무작위 시드도 매니페스트에 기록되도록 미리 정함)"""
+    if error is not None:
+        return BatchRow(row_id, error=error)
+    try:
+        request = GenerationRequest(**data).dict()
+        RESOLUTION_POLICY.apply(request, get_model_type(request["model_name"]))
+        SPEED_POLICY.apply(request)
+        HIGHRES_POLICY.apply(request, get_model_type(request["model_name"]))
+    except (ValidationError, TypeError, ValueError) as e:
+        return BatchRow(row_id, error=f"잘못된 요청입니다: {e}")
+    request["seeds"] = request_seeds(request)
+    request["num_images"] = len(request["seeds"])
+    return BatchRow(row_id, request=request)
+
+
+def group_rows(rows, last_key=None):
+    """
+    행을 batch_key별로 묶어 [(키, 행 목록), ...]으로 반환합니다.
+    직전에 사용한 모델과 LoRA 조합의 묶음을 먼저, 그다음 같은 모델끼리 이어지도록 정렬합니다.
+    """
+    groups = OrderedDict()
+    for row in rows:
+        groups.setdefault(batch_key(row.request), []).append(row)
+
+    last_model = last_key[0] if last_key else None
+    last_loras = last_key[1] if last_key else None
+
+    def order(key):
+        model_name, loras = key[0], key[1]
+        return (model_name != last_model, model_name, loras != last_loras, repr(key[1:]))
+
+    return sorted(groups.items(), key=lambda item: order(item[0]))
+
+
+def iter_batches(rows, batch_size):
+    """같은 묶음의 행들을 이미지 단위로 펼쳐 batch_size장씩 [(행, 이미지 번호), ...]로 나눕니다."""
+    batch = []
+    for row in rows:
+        for index in range(len(row.seeds)):
+            batch.append((row, index))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+class Manifest:
+    """
+    완료(또는 실패)한 행을 한 줄씩 추가로 기록하는 체크포인트 파일(JSONL)입니다.
+    줄마다 바로 flush하므로 프로세스가 중단되어도 그때까지 완료된 행은 남습니다.
+    """
+
+    def __init__(self, path, restart=False):
+        self.path = path
+        self.completed = set()
+        if restart:
+            open(path, "w", encoding="utf-8").close()
+        elif os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue # 중단 중에 쓰다 만 마지막 줄
+                    if entry.get("status") == "done":
+                        self.completed.add(entry["id"])
+        self._file = open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def record(self, entry):
+        with self._lock:
+            self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._file.flush()
+            if entry.get("status") == "done":
+                self.completed.add(entry["id"])
+
+    def close(self):
+        self._file.close()
+
+
+def _safe_name(row_id):
+    return re.sub(r"[^\w.-]", "_", row_id)
+
+
+def write_file(path, data):
+    """임시 파일에 쓴 뒤 이름을 바꾸므로 중단되어도 쓰다 만 이미지 파일이 남지 않습니다."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class BatchRunner:
+    """행 묶음을 ModelHandler로 생성하고, 인코딩/저장은 스레드 풀에서 겹쳐 실행합니다."""
+
+    def __init__(self, handler, output_dir, manifest, encode_settings, lora_dir=LORA_DIR, batch_size=4,
+                 writers=2, report_interval=10.0):
+        self.handler = handler
+        self.output_dir = output_dir
+        self.manifest = manifest
+        self.encode_settings = encode_settings
+        self.lora_dir = lora_dir
+        self.batch_size = batch_size
+        self.report_interval = report_interval
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=writers, thread_name_prefix="write")
+        # 저장 대기 중인 이미지가 너무 많이 쌓이지 않도록 제한합니다. (생성이 저장보다 빠를 때 메모리 보호)
+        self._pending = deque()
+        self._max_pending = max(writers, 1) * batch_size * 2
+        self._lock = threading.Lock()
+        self.counts = {"rows_done": 0, "rows_failed": 0, "rows_skipped": 0, "images": 0}
+        self.last_key = None
+        self._started_at = None
+        self._last_report = 0.0
+
+    def fail(self, row, error):
+        with self._lock:
+            if row.failed:
+                return
+            row.failed = True
+            self.counts["rows_failed"] += 1
+        print(f"경고: 행 '{row.id}' 생성 실패: {error}")
+        self.manifest.record({"id": row.id, "status": "failed", "error": str(error)})
+
+    def run_group(self, key, rows):
+        for batch in iter_batches(rows, self.batch_size):
+            batch = [(row, index) for row, index in batch if not row.failed]
+            if not batch:
+                continue
+            samples = [dict(row.request, seed=row.seeds[index]) for row, index in batch]
+            try:
+                images = render_batch(self.handler, self.lora_dir, samples)
+            except Exception as e:
+                for row, _ in batch:
+                    self.fail(row, e)
+                continue
+            self.last_key = key
+            for (row, index), image in zip(batch, images):
+                self._submit_write(row, index, image)
+            self._report()
+
+    def _submit_write(self, row, index, image):
+        while len(self._pending) >= self._max_pending:
+            self._pending.popleft().result()
+        self._pending.append(self._writer.submit(self._write_image, row, index, image))
+
+    def _write_image(self, row, index, image):
+        if row.failed:
+            return
+        try:
+            encoding = choose_encoding(row.request, None, self.encode_settings)
+            name = _safe_name(row.id) if len(row.seeds) == 1 else f"{_safe_name(row.id)}_{index}"
+            filename = f"{name}.{encoding.extension}"
+            write_file(os.path.join(self.output_dir, filename), encoding.encode(image))
+        except Exception as e:
+            self.fail(row, e)
+            return
+
+        with self._lock:
+            row.files[index] = filename
+            row.remaining -= 1
+            self.counts["images"] += 1
+            done = row.remaining == 0 and not row.failed
+            if done:
+                self.counts["rows_done"] += 1
+        if done:
+            self.manifest.record({"id": row.id, "status": "done", "files": row.files, "seeds": row.seeds})
+
+    def run(self, rows, window=256):
+        """행 스트림을 window개씩 모아 묶음별로 생성합니다. 완료 기록이 있는 행은 건너뜁니다."""
+        self._started_at = self._last_report = time.perf_counter()
+        seen = set()
+        buffer = []
+        for row_id, data, error in rows:
+            if row_id in self.manifest.completed:
+                self.counts["rows_skipped"] += 1
+                continue
+            row = make_row(row_id, data, error)
+            if row.error is None and row_id in seen:
+                row = BatchRow(row_id, error="같은 ID의 행이 이미 있습니다.")
+            seen.add(row_id)
+            if row.error is not None:
+                self.fail(row, row.error)
+                continue
+            buffer.append(row)
+            if len(buffer) >= window:
+                self._run_window(buffer)
+                buffer = []
+        if buffer:
+            self._run_window(buffer)
+
+        while self._pending:
+            self._pending.popleft().result()
+        self._writer.shutdown(wait=True)
+        return self.summary()
+
+    def _run_window(self, rows):
+        for key, group in group_rows(rows, self.last_key):
+            self.run_group(key, group)
+
+    def summary(self):
+        elapsed = time.perf_counter() - self._started_at if self._started_at else 0.0
+        with self._lock:
+            summary = dict(self.counts)
+        summary["seconds"] = elapsed
+        summary["images_per_second"] = summary["images"] / elapsed if elapsed > 0 else 0.0
+        return summary
+
+    def _report(self):
+        now = time.perf_counter()
+        if now - self._last_report < self.report_interval:
+            return
+        self._last_report = now
+        summary = self.summary()
+        print(f"진행: 완료 {summary['rows_done']}행, 실패 {summary['rows_failed']}행, "
+              f"이미지 {summary['images']}장 ({summary['images_per_second']:.2f}장/초)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="JSONL/CSV 프롬프트 파일로 이미지를 일괄 생성합니다.")
+    parser.add_argument("input", help="요청이 한 줄에 하나씩 있는 JSONL 파일 또는 CSV 파일")
+    parser.add_argument("-o", "--output", required=True, help="이미지와 manifest.jsonl을 저장할 디렉토리")
+    parser.add_argument("--manifest", default=None, help="체크포인트 파일 경로 (기본: <출력 디렉토리>/manifest.jsonl)")
+    parser.add_argument("--restart", action="store_true", help="체크포인트를 무시하고 처음부터 다시 생성")
+    parser.add_argument("--batch-size", type=int, default=config["max_batch_size"],
+                        help="한 번의 파이프라인 호출로 생성할 최대 이미지 수")
+    parser.add_argument("--window", type=int, default=256, help="모델/LoRA/해상도별로 묶기 위해 한 번에 읽을 행 수")
+    parser.add_argument("--writers", type=int, default=config["encode_workers"], help="인코딩/저장 스레드 수")
+    parser.add_argument("--format", default=None, help="출력 형식 (행의 output_format이 우선, 기본: 설정의 default_output_format)")
+    parser.add_argument("--lora-dir", default=LORA_DIR, help="LoRA 파일 디렉토리")
+    parser.add_argument("--backend", choices=["diffusers", "fake"], default=None,
+                        help="파이프라인 백엔드 (기본: 설정의 backend, fake는 GPU 없이 동작하는 테스트용)")
+    parser.add_argument("--report-interval", type=float, default=10.0, help="진행 상황 출력 간격 (초)")
+    args = parser.parse_args(argv)
+
+    encode_settings = dict(config)
+    if args.format:
+        try:
+            encode_settings["default_output_format"] = normalize_format(args.format)
+        except ValueError as e:
+            parser.error(str(e))
+
+    os.makedirs(args.output, exist_ok=True)
+    manifest = Manifest(args.manifest or os.path.join(args.output, "manifest.jsonl"), restart=args.restart)
+    if manifest.completed:
+        print(f"체크포인트에서 이어서 생성합니다. (완료된 행 {len(manifest.completed)}개 건너뜀)")
+
+    handler = create_handler(config, backend=args.backend)
+    runner = BatchRunner(
+        handler,
+        args.output,
+        manifest,
+        encode_settings,
+        lora_dir=args.lora_dir,
+        batch_size=max(1, args.batch_size),
+        writers=max(1, args.writers),
+        report_interval=args.report_interval,
+    )
+    try:
+        summary = runner.run(read_rows(args.input), window=max(1, args.window))
+    finally:
+        manifest.close()
+
+    print(f"완료: {summary['rows_done']}행 생성, {summary['rows_skipped']}행 건너뜀, {summary['rows_failed']}행 실패")
+    print(f"이미지 {summary['images']}장, {summary['seconds']:.1f}초 ({summary['images_per_second']:.2f}장/초)")
+    return 1 if summary["rows_failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
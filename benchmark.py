@@ -0,0 +1,1727 @@
+# -*- coding: utf-8 -*-
+"""
+생성 서비스 벤치마크 스크립트입니다.
+GPU와 모델 가중치 없이 FakePipeline(가짜 파이프라인)으로 실행할 수 있습니다.
+
+사용법:
+    python benchmark.py batching --jobs 32 --max-batch-size 4
+    python benchmark.py buckets --jobs 64 --modes exact snap_resize
+    python benchmark.py scheduler --jobs 500 --models 3 --loras 3
+    python benchmark.py lora-fuse --jobs 16 --steps 8
+    python benchmark.py admission --duration 10 --heavy-budget 0.25
+    python benchmark.py compile --tokens 256 1024 --steps 8
+    python benchmark.py speed --modes fast fastest --steps 20
+    python benchmark.py highres --sizes 1536 2048 --strength 0.35
+    python benchmark.py encode --sizes 512 1024 2048
+    python benchmark.py session-stress --threads 8 --requests 240
+    python benchmark.py switch --repeat 5
+    python benchmark.py http --clients 1 4 16 --requests 64
+    python benchmark.py backpressure --queue-size 2
+    python benchmark.py --output results.json suite
+    python benchmark.py compare old.json new.json --threshold 10
+"""
+import argparse
+import datetime
+import functools
+import importlib
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from PIL import Image, ImageChops, ImageFilter, ImageStat
+
+from admission import AdmissionController, AdmissionError, CostModel
+from compiler import CompilePolicy, configure_dynamo
+from feature_cache import FeatureCache, SpeedPolicy
+from fake_pipeline import load_fake_pipeline, render_color
+from highres import HighResPolicy, tile_boxes
+from image_encoding import ImageEncoding
+from model_handler import ModelHandler
+from pipeline_cache import PipelineCache
+from resolution import RESOLUTION_MODES, ResolutionPolicy
+from scheduler import AffinityPolicy, FifoPolicy, SchedulingContext
+from worker import GenerationWorker
+
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_object(spec):
+    """'모듈:이름' 형식의 문자열로 객체를 가져옵니다. (예: my_fakes:load_slow_pipeline)"""
+    module_name, _, attr = spec.partition(":")
+    return getattr(importlib.import_module(module_name), attr)
+
+
+def make_handler(args, **handler_kwargs):
+    """
+    FakePipeline을 사용하는 ModelHandler를 만듭니다. (--backend diffusers이면 실제 모델을 사용)
+    --loader로 (pipeline, model_type)을 반환하는 다른 로더 함수를 지정할 수도 있습니다.
+    """
+    if getattr(args, "backend", "fake") == "diffusers":
+        return ModelHandler(**handler_kwargs)
+    if getattr(args, "loader", None):
+        return ModelHandler(pipeline_loader=load_object(args.loader), **handler_kwargs)
+    loader = functools.partial(
+        load_fake_pipeline,
+        step_latency=args.step_latency,
+        decode_latency=args.decode_latency,
+        load_latency=getattr(args, "load_latency", 0.0),
+        lora_load_latency=getattr(args, "lora_load_latency", 0.0),
+        transfer_latency=getattr(args, "transfer_latency", 0.0),
+        pixel_cost=getattr(args, "pixel_cost", 0.0),
+    )
+    return ModelHandler(pipeline_loader=loader, **handler_kwargs)
+
+
+def make_request(index, model_name="bench/model-sd", **overrides):
+    request = {
+        "model_name": model_name,
+        "lora_name": "None",
+        "lora_scale": 0.7,
+        "prompt": f"benchmark prompt {index}",
+        "negative_prompt": "",
+        "steps": 8,
+        "guidance_scale": 0.0,
+        "width": 256,
+        "height": 256,
+        "seed": index,
+    }
+    request.update(overrides)
+    return request
+
+
+def percentile(values, q):
+    """정렬된 값에서 q(0~100) 백분위수를 반환합니다. (최근접 순위 방식)"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(q / 100.0 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BASE_PATH, capture_output=True, text=True, timeout=10,
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_metadata(args):
+    """커밋 간 결과를 비교할 수 있도록 실행 환경과 옵션을 기록합니다."""
+    return {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "args": {key: value for key, value in vars(args).items() if key != "func"},
+    }
+
+
+def write_results(args, results):
+    if args.output:
+        results = dict(results, meta=run_metadata(args))
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"결과가 저장되었습니다: {args.output}")
+
+
+# --- 배칭 벤치마크 ---
+def run_batch_trial(args, max_batch_size):
+    """큐에 작업을 미리 채운 뒤 워커가 모두 처리하는 시간을 측정합니다."""
+    worker = GenerationWorker(
+        make_handler(args),
+        lora_dir=".",
+        max_queue_size=args.jobs,
+        max_batch_size=max_batch_size,
+        batch_wait=args.batch_wait_ms / 1000.0,
+    )
+    jobs = [worker.submit(make_request(i)) for i in range(args.jobs)]
+
+    start = time.perf_counter()
+    worker.start()
+    images = [job.future.result()[0] for job in jobs]
+    elapsed = time.perf_counter() - start
+    worker.stop()
+
+    return {
+        "max_batch_size": max_batch_size,
+        "jobs": args.jobs,
+        "seconds": elapsed,
+        "images_per_second": args.jobs / elapsed,
+    }, [image.tobytes() for image in images]
+
+
+def bench_batching(args):
+    results = []
+    baseline_images = None
+    for max_batch_size in sorted({1, args.max_batch_size}):
+        result, images = run_batch_trial(args, max_batch_size)
+        if baseline_images is None:
+            baseline_images = images
+        # 배치로 생성해도 각 요청의 시드가 유지되어 같은 이미지가 나와야 합니다.
+        result["matches_unbatched"] = images == baseline_images
+        results.append(result)
+
+    print("\n--- 배칭 처리량 ---")
+    print(f"{'batch':>6} {'seconds':>9} {'img/s':>8} {'speedup':>8} {'same seeds':>11}")
+    base = results[0]["images_per_second"]
+    for r in results:
+        print(f"{r['max_batch_size']:>6} {r['seconds']:>9.2f} {r['images_per_second']:>8.2f} "
+              f"{r['images_per_second'] / base:>7.2f}x {str(r['matches_unbatched']):>11}")
+    return {"benchmark": "batching", "results": results}
+
+
+# --- 해상도 버킷 벤치마크 ---
+# 클라이언트가 흔히 보내는 크기: 같은 비율이라도 조금씩 다른 크기가 섞여 있음
+TRACE_SIZES = [
+    (1024, 1024), (1000, 1000), (1024, 1008), (960, 960), (1080, 1080),
+    (1920, 1080), (1280, 720), (1344, 768), (1366, 768),
+    (720, 1280), (768, 1344), (1080, 1920),
+    (1152, 864), (1200, 900), (1024, 768), (1216, 832),
+]
+
+
+def make_size_trace(args):
+    """도착 간격이 지수 분포인 크기 혼합 요청 트레이스를 만듭니다. [(도착 시각, 요청), ...]"""
+    rng = random.Random(args.seed)
+    trace = []
+    now = 0.0
+    for index in range(args.jobs):
+        now += rng.expovariate(args.arrival_rate)
+        width, height = rng.choice(TRACE_SIZES)
+        trace.append((now, make_request(index, steps=args.steps, width=width, height=height)))
+    return trace
+
+
+def run_bucket_trial(args, mode, trace):
+    """트레이스를 실제 도착 간격대로 워커에 넣고 배치 크기, 생성된 크기 종류, 지연 시간을 측정합니다."""
+    policy = ResolutionPolicy(mode)
+    worker = GenerationWorker(
+        make_handler(args),
+        lora_dir=".",
+        max_queue_size=args.jobs,
+        max_batch_size=args.max_batch_size,
+        batch_wait=args.batch_wait_ms / 1000.0,
+    )
+    batch_sizes = []
+    shapes = set()
+    render = worker._render
+
+    def counting_render(requests, progress_callback=None):
+        batch_sizes.append(len(requests))
+        shapes.add((requests[0]["width"], requests[0]["height"]))
+        return render(requests, progress_callback=progress_callback)
+
+    worker._render = counting_render
+    worker.start()
+    start = time.perf_counter()
+    jobs = []
+    for arrival, request in trace:
+        delay = arrival - (time.perf_counter() - start)
+        if delay > 0:
+            time.sleep(delay)
+        jobs.append(worker.submit(policy.apply(dict(request), "sd")))
+    images = [job.future.result()[0] for job in jobs]
+    elapsed = time.perf_counter() - start
+    worker.stop()
+
+    latencies = [job.finished_at - job.created_at for job in jobs]
+    sizes_match = all(image.size == (request["width"], request["height"]) for image, (_, request) in zip(images, trace))
+    return {
+        "mode": mode,
+        "jobs": len(jobs),
+        "batches": len(batch_sizes),
+        "mean_batch_size": len(jobs) / len(batch_sizes),
+        # 다른 요청과 함께 한 배치로 생성된 요청의 비율
+        "batch_hit_rate": sum(size for size in batch_sizes if size > 1) / len(jobs),
+        "shapes": len(shapes),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p90_ms": percentile(latencies, 90) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "images_per_second": len(jobs) / elapsed,
+        "output_sizes_match": sizes_match,
+    }
+
+
+def bench_buckets(args):
+    trace = make_size_trace(args)
+    results = [run_bucket_trial(args, mode, trace) for mode in args.modes]
+
+    print(f"\n--- 해상도 버킷 (요청 {args.jobs}개, 크기 {len({(r['width'], r['height']) for _, r in trace})}종, "
+          f"초당 {args.arrival_rate:.1f}건 도착) ---")
+    print(f"{'mode':>12} {'batches':>8} {'mean bs':>8} {'hit rate':>9} {'shapes':>7} {'p50 ms':>8} {'p90 ms':>8} "
+          f"{'p99 ms':>8} {'img/s':>7} {'size ok':>8}")
+    for r in results:
+        print(f"{r['mode']:>12} {r['batches']:>8} {r['mean_batch_size']:>8.2f} {r['batch_hit_rate']:>9.2f} "
+              f"{r['shapes']:>7} {r['p50_ms']:>8.0f} {r['p90_ms']:>8.0f} {r['p99_ms']:>8.0f} "
+              f"{r['images_per_second']:>7.2f} {str(r['output_sizes_match']):>8}")
+    return {"benchmark": "buckets", "results": results}
+
+
+# --- 스케줄러 시뮬레이션 ---
+class SimJob:
+    """시뮬레이션용 작업. 스케줄링 정책이 요구하는 속성만 가집니다."""
+
+    def __init__(self, request, created_at, priority=0):
+        self.request = request
+        self.created_at = created_at
+        self.priority = priority
+
+
+def make_trace(args):
+    """모델/LoRA 인기도가 치우친(Zipf 형태) 혼합 워크로드 트레이스를 만듭니다."""
+    rng = random.Random(args.seed)
+    models = [f"bench/model-{i}" for i in range(args.models)]
+    loras = ["None"] + [f"lora-{i}.safetensors" for i in range(args.loras)]
+    model_weights = [1.0 / (rank + 1) for rank in range(len(models))]
+    lora_weights = [1.0 / (rank + 1) for rank in range(len(loras))]
+
+    trace = []
+    now = 0.0
+    for index in range(args.jobs):
+        now += rng.expovariate(args.arrival_rate)
+        request = make_request(
+            index,
+            model_name=rng.choices(models, model_weights)[0],
+            lora_name=rng.choices(loras, lora_weights)[0],
+        )
+        priority = 1 if rng.random() < args.priority_fraction else 0
+        trace.append(SimJob(request, now, priority))
+    return trace
+
+
+def simulate(policy, trace, args):
+    """
+    단일 GPU 워커를 이산 사건 방식으로 시뮬레이션합니다.
+    작업 처리 시간 = 렌더링 시간 + (모델 전환 비용) + (LoRA 전환 비용)
+    """
+    pending = []
+    now = 0.0
+    next_arrival = 0
+    current_model, current_lora = None, "None"
+    model_switches = lora_switches = 0
+    latencies = []
+    priority_latencies = []
+
+    while next_arrival < len(trace) or pending:
+        while next_arrival < len(trace) and trace[next_arrival].created_at <= now:
+            pending.append(trace[next_arrival])
+            next_arrival += 1
+        if not pending:
+            now = trace[next_arrival].created_at
+            continue
+
+        context = SchedulingContext(current_model, {current_lora} - {"None"})
+        job = pending.pop(policy.select(pending, context, now))
+
+        cost = args.render_seconds
+        if job.request["model_name"] != current_model:
+            model_switches += 1
+            cost += args.model_switch_seconds
+            current_model, current_lora = job.request["model_name"], "None"
+        if job.request["lora_name"] != current_lora:
+            lora_switches += 1
+            cost += args.lora_switch_seconds
+            current_lora = job.request["lora_name"]
+
+        now += cost
+        latencies.append(now - job.created_at)
+        if job.priority > 0:
+            priority_latencies.append(now - job.created_at)
+
+    makespan = now - trace[0].created_at
+    return {
+        "policy": policy.name,
+        "jobs": len(trace),
+        "model_switches": model_switches,
+        "lora_switches": lora_switches,
+        "p50_latency": percentile(latencies, 50),
+        "p99_latency": percentile(latencies, 99),
+        "max_latency": max(latencies),
+        "priority_p50_latency": percentile(priority_latencies, 50),
+        "throughput": len(trace) / makespan,
+    }
+
+
+def bench_scheduler(args):
+    trace = make_trace(args)
+    policies = [FifoPolicy(), AffinityPolicy(max_wait=args.max_wait)]
+    results = [simulate(policy, trace, args) for policy in policies]
+
+    print("\n--- 스케줄링 정책 비교 (시뮬레이션) ---")
+    print(f"{'policy':>9} {'model sw':>9} {'lora sw':>8} {'p50 (s)':>9} {'p99 (s)':>9} {'max (s)':>9} {'prio p50':>9} {'jobs/s':>7}")
+    for r in results:
+        print(f"{r['policy']:>9} {r['model_switches']:>9} {r['lora_switches']:>8} {r['p50_latency']:>9.1f} "
+              f"{r['p99_latency']:>9.1f} {r['max_latency']:>9.1f} {r['priority_p50_latency']:>9.1f} {r['throughput']:>7.3f}")
+    return {"benchmark": "scheduler", "results": results}
+
+
+# --- 입장 제어 벤치마크 ---
+def make_admission_trace(args):
+    """
+    (도착 시각, 클라이언트, 요청) 목록. 가벼운 클라이언트 여러 개가 작은 요청을 마감 시간과 함께 보내고,
+    무거운 클라이언트 하나가 큰 요청(기본 2048×2048, 가벼운 요청의 약 40배 비용)을 계속 보냅니다.
+    """
+    rng = random.Random(args.seed)
+    trace = []
+    t = 0.0
+    while t < args.duration:
+        t += rng.expovariate(args.light_rate)
+        trace.append((t, f"light-{rng.randrange(args.light_clients)}",
+                      make_request(len(trace), width=512, height=512, steps=8, deadline_ms=args.deadline_ms)))
+    t = 0.0
+    while t < args.duration:
+        trace.append((t, "heavy", make_request(len(trace), width=args.heavy_size, height=args.heavy_size,
+                                              steps=args.heavy_steps)))
+        t += 1.0 / args.heavy_rate
+    return sorted(trace, key=lambda item: item[0])
+
+
+def run_admission_trial(args, mode, trace):
+    admission = None
+    if mode == "admission":
+        admission = AdmissionController(
+            CostModel(),
+            limits={"heavy": {"cost_budget": args.heavy_budget * args.budget_window}},
+            cost_window=args.budget_window,
+        )
+    worker = GenerationWorker(make_handler(args), lora_dir=".", max_queue_size=len(trace) + 2,
+                              max_batch_size=1, admission=admission)
+    worker.start()
+    # 비용 모델이 두 모드에서 같은 조건으로 시작하도록 작은 요청과 큰 요청을 하나씩 먼저 실행합니다.
+    for index, size, steps in ((0, 512, 8), (1, args.heavy_size, args.heavy_steps)):
+        worker.submit(make_request(-1 - index, width=size, height=size, steps=steps)).future.result()
+
+    accepted, rejected = [], {}
+    start = time.perf_counter()
+    for arrival, client_id, request in trace:
+        delay = arrival - (time.perf_counter() - start)
+        if delay > 0:
+            time.sleep(delay)
+        try:
+            accepted.append((client_id, worker.submit(dict(request), client_id=client_id)))
+        except AdmissionError as e:
+            key = ("heavy" if client_id == "heavy" else "light", e.reason)
+            rejected[key] = rejected.get(key, 0) + 1
+    for _, job in accepted:
+        try:
+            job.future.result()
+        except Exception:
+            pass
+    elapsed = time.perf_counter() - start
+    worker.stop()
+
+    light = [job for client_id, job in accepted if client_id != "heavy"]
+    heavy = [job for client_id, job in accepted if client_id == "heavy"]
+    latencies = sorted((job.finished_at - job.created_at) * 1000 for job in light if job.status == "done")
+    on_time = sum(1 for latency in latencies if latency <= args.deadline_ms)
+    light_total = sum(1 for _, client_id, _ in trace if client_id != "heavy")
+    return {
+        "mode": mode,
+        "light_requests": light_total,
+        "light_on_time": on_time,
+        "light_late": len(latencies) - on_time,
+        "light_rejected": sum(count for (kind, _), count in rejected.items() if kind == "light"),
+        "heavy_done": sum(1 for job in heavy if job.status == "done"),
+        "heavy_rejected": sum(count for (kind, _), count in rejected.items() if kind == "heavy"),
+        "rejections": {f"{kind}:{reason}": count for (kind, reason), count in sorted(rejected.items())},
+        "p50_ms": percentile(latencies, 50),
+        "p99_ms": percentile(latencies, 99),
+        "seconds": elapsed,
+    }
+
+
+def bench_admission(args):
+    trace = make_admission_trace(args)
+    results = [run_admission_trial(args, mode, trace) for mode in ("none", "admission")]
+
+    print(f"\n--- 입장 제어 (가벼운 요청 마감 {args.deadline_ms}ms, 무거운 클라이언트 예산 {args.heavy_budget:.0%}) ---")
+    print(f"{'mode':>10} {'light':>6} {'on time':>8} {'late':>5} {'rejected':>9} {'heavy done':>11} "
+          f"{'heavy rej':>10} {'p50 ms':>8} {'p99 ms':>8} {'seconds':>8}")
+    for r in results:
+        print(f"{r['mode']:>10} {r['light_requests']:>6} {r['light_on_time']:>8} {r['light_late']:>5} "
+              f"{r['light_rejected']:>9} {r['heavy_done']:>11} {r['heavy_rejected']:>10} {r['p50_ms']:>8.0f} "
+              f"{r['p99_ms']:>8.0f} {r['seconds']:>8.1f}")
+        if r["rejections"]:
+            print(f"{'':>10} 거절 사유: {r['rejections']}")
+    return {"benchmark": "admission", "results": results}
+
+
+# --- LoRA 병합(fuse) 벤치마크 ---
+def run_lora_trial(args, lora_path, fuse_threshold):
+    """같은 (모델, LoRA, 강도)로 연속 생성하며 초당 디노이징 스텝 수를 측정합니다."""
+    handler = make_handler(args, lora_fuse_threshold=fuse_threshold)
+    loras = [(lora_path, args.lora_scale)]
+    requests = [
+        make_request(i, model_name=args.model, steps=args.steps, width=args.size, height=args.size)
+        for i in range(args.jobs)
+    ]
+
+    with handler.session(args.model, [lora_path]):
+        # 첫 생성은 모델 로딩, 어댑터 활성화(및 병합)를 포함하므로 측정에서 제외합니다.
+        handler.generate_batch([make_request(-1, model_name=args.model, steps=1, width=args.size, height=args.size)],
+                               loras=loras)
+        start = time.perf_counter()
+        images = [handler.generate_batch([request], loras=loras)[0] for request in requests]
+        elapsed = time.perf_counter() - start
+
+    stats = handler.lora_cache_stats()
+    return {
+        "mode": "fused" if stats["fused"] else "unfused",
+        "jobs": args.jobs,
+        "seconds": elapsed,
+        "steps_per_second": args.jobs * args.steps / elapsed,
+        "fuse_seconds": stats["fuse_seconds_total"],
+    }, images
+
+
+def compare_images(images, reference):
+    """같은 시드로 만든 두 이미지 목록의 최대/평균 픽셀 차이(0~255)를 반환합니다."""
+    max_diff = mean_diff = 0.0
+    for image, ref in zip(images, reference):
+        diff = ImageChops.difference(image.convert("RGB"), ref.convert("RGB"))
+        max_diff = max(max_diff, max(high for _, high in diff.getextrema()))
+        mean_diff += sum(ImageStat.Stat(diff).mean) / 3
+    return max_diff, mean_diff / max(len(images), 1)
+
+
+def psnr(images, reference):
+    """두 이미지 목록 전체의 PSNR (dB). 완전히 같으면 inf"""
+    squared = 0.0
+    for image, ref in zip(images, reference):
+        diff = ImageChops.difference(image.convert("RGB"), ref.convert("RGB"))
+        squared += sum(rms ** 2 for rms in ImageStat.Stat(diff).rms) / 3
+    mse = squared / max(len(images), 1)
+    return math.inf if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+
+
+def bench_lora_fuse(args):
+    lora_path = args.lora
+    if lora_path is None:
+        if args.backend == "diffusers":
+            raise SystemExit("--backend diffusers에서는 --lora로 LoRA 파일 경로를 지정해야 합니다.")
+        # 가짜 파이프라인은 파일 내용을 읽지 않으므로 빈 파일을 LoRA로 사용합니다.
+        lora_path = os.path.join(tempfile.mkdtemp(), "bench-lora.safetensors")
+        open(lora_path, "wb").close()
+
+    unfused, reference = run_lora_trial(args, lora_path, fuse_threshold=0)
+    fused, images = run_lora_trial(args, lora_path, fuse_threshold=1)
+    # 병합해도 같은 시드의 결과가 (수치 오차 범위에서) 같아야 합니다.
+    fused["max_pixel_diff"], fused["mean_pixel_diff"] = compare_images(images, reference)
+    fused["psnr"] = psnr(images, reference)
+    unfused["max_pixel_diff"] = unfused["mean_pixel_diff"] = 0.0
+    unfused["psnr"] = math.inf
+    results = [unfused, fused]
+    if fused["mode"] != "fused":
+        print("실패: LoRA가 병합되지 않아 병합 전후 결과를 비교할 수 없습니다.")
+        sys.exit(1)
+
+    print("\n--- LoRA 병합(fuse) 비교 ---")
+    print(f"{'mode':>8} {'steps/s':>9} {'speedup':>8} {'fuse (s)':>9} {'max diff':>9} {'mean diff':>10} {'PSNR':>8}")
+    base = unfused["steps_per_second"]
+    for r in results:
+        print(f"{r['mode']:>8} {r['steps_per_second']:>9.2f} {r['steps_per_second'] / base:>7.2f}x "
+              f"{r['fuse_seconds']:>9.3f} {r['max_pixel_diff']:>9.1f} {r['mean_pixel_diff']:>10.3f} {r['psnr']:>8.1f}")
+    if fused["max_pixel_diff"] > args.tolerance or fused["psnr"] < args.min_psnr:
+        print(f"실패: 병합한 결과가 병합하지 않은 결과와 최대 {fused['max_pixel_diff']:.0f}만큼 다릅니다. "
+              f"(PSNR {fused['psnr']:.1f} dB, 허용: 최대 차이 {args.tolerance}, PSNR {args.min_psnr} dB 이상)")
+        sys.exit(1)
+    print(f"통과: 병합 전후 결과의 최대 픽셀 차이({fused['max_pixel_diff']:.0f})와 PSNR({fused['psnr']:.1f} dB)이 "
+          f"허용 범위 안에 있습니다.")
+    return {"benchmark": "lora-fuse", "results": results}
+
+
+# --- 모델/LoRA 세션 동시성 검사 ---
+def bench_session_stress(args):
+    """
+    여러 스레드가 서로 다른 (모델, LoRA 조합)으로 handler.session()과 generate_batch()를 동시에 호출하게 하고,
+    이미지마다 요청한 모델과 LoRA로 만들어졌는지(FakePipeline의 색이 요청에서 계산한 색과 같은지) 확인합니다.
+    하나라도 다르면 종료 코드 1로 끝납니다.
+    """
+    lora_dir = tempfile.mkdtemp()
+    lora_files = []
+    for index in range(args.loras):
+        # 가짜 파이프라인은 파일 내용을 읽지 않으므로 빈 파일을 LoRA로 사용합니다.
+        path = os.path.join(lora_dir, f"stress-lora-{index}.safetensors")
+        open(path, "wb").close()
+        lora_files.append(path)
+    models = [f"bench/stress-{index}-{'flux' if index % 2 else 'sd'}" for index in range(args.models)]
+    # 상주 모델 수와 어댑터 수를 작게 잡아 모델 전환, 오프로드, 어댑터 교체가 자주 일어나게 합니다.
+    handler = make_handler(
+        args,
+        pipeline_cache=PipelineCache(gpu_budget_bytes=int(args.gpu_models * 2 * 1024 ** 3), cpu_budget_bytes=sys.maxsize),
+        max_loras=args.max_loras,
+    )
+
+    counter = itertools.count()
+    mismatches = []
+    errors = []
+    lock = threading.Lock()
+
+    def client(thread_index):
+        rng = random.Random(args.seed + thread_index)
+        while True:
+            index = next(counter)
+            if index >= args.requests:
+                return
+            model_name = rng.choice(models)
+            paths = rng.sample(lora_files, rng.randint(0, min(args.max_loras, len(lora_files))))
+            loras = [(path, round(rng.uniform(0.3, 1.0), 2)) for path in paths]
+            request = make_request(index, model_name=model_name, steps=1, width=64, height=64)
+            try:
+                with handler.session(model_name, paths):
+                    image = handler.generate_batch([request], loras=loras)[0]
+            except Exception as e:
+                with lock:
+                    errors.append(f"요청 {index}: {e}")
+                continue
+            expected = render_color(model_name, [(os.path.basename(path), scale) for path, scale in loras],
+                                    request["prompt"], request["seed"])
+            actual = image.getpixel((0, 0))
+            if actual != expected:
+                with lock:
+                    mismatches.append(f"요청 {index}: {model_name}, {[os.path.basename(p) for p in paths]}")
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    stats = handler.pipeline_cache.stats()
+    lora_stats = handler.lora_cache_stats()
+    print(f"\n--- 세션 동시성 검사 (스레드 {args.threads}, 요청 {args.requests}, 모델 {args.models}, LoRA {args.loras}) ---")
+    print(f"{elapsed:.2f}초, 모델 캐시 히트 {stats['hits']}/미스 {stats['misses']}, 오프로드 {stats['offloads']}, "
+          f"LoRA 로드 {lora_stats['misses']}, 불일치 {len(mismatches)}, 오류 {len(errors)}")
+    for line in (mismatches + errors)[:20]:
+        print(f"실패: {line}")
+    if mismatches or errors:
+        sys.exit(1)
+    print(f"통과: 이미지 {args.requests}장 모두 요청한 모델과 LoRA로 생성되었습니다.")
+    return {"benchmark": "session-stress", "results": [{"seconds": elapsed, "requests": args.requests,
+                                                         "mismatches": 0, "errors": 0}]}
+
+
+# --- torch.compile 벤치마크 ---
+def make_tiny_pipeline(torch, dim, depth):
+    """
+    CPU에서 실행해 볼 수 있는 작은 파이프라인입니다. diffusers 파이프라인처럼 transformer 속성의
+    디노이저를 스텝마다 (latents, timestep)으로 호출하며, 디노이저는 transformer_blocks 블록 목록으로 이루어집니다.
+    """
+    class TinyBlock(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.norm = torch.nn.LayerNorm(dim)
+            self.linear = torch.nn.Linear(dim, dim)
+
+        def forward(self, hidden_states, temb):
+            return hidden_states + torch.nn.functional.gelu(self.linear(self.norm(hidden_states) + temb))
+
+    class TinyDenoiser(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.time_embed = torch.nn.Linear(1, dim)
+            self.transformer_blocks = torch.nn.ModuleList(TinyBlock() for _ in range(depth))
+            self.norm_out = torch.nn.LayerNorm(dim)
+
+        def forward(self, hidden_states, timestep):
+            temb = self.time_embed(timestep[:, None, None].float() / 1000)
+            x = hidden_states
+            for block in self.transformer_blocks:
+                x = block(x, temb)
+            return self.norm_out(x)
+
+    class TinyPipeline:
+        def __init__(self):
+            self.transformer = TinyDenoiser().eval()
+
+        def __call__(self, batch_size, tokens, steps, seed=0):
+            generator = torch.Generator().manual_seed(seed)
+            latents = torch.randn(batch_size, tokens, dim, generator=generator)
+            with torch.no_grad():
+                for step in range(steps):
+                    # 오일러 방식: 노이즈 예측 방향으로 1/steps씩 이동
+                    timestep = torch.full((batch_size,), 1000.0 * (steps - step) / steps)
+                    latents = latents - self.transformer(latents, timestep=timestep) / steps
+            return latents
+
+    return TinyPipeline()
+
+
+def time_tiny(pipeline, policy, batch_size, tokens, steps, repeat):
+    """policy로 감싼 파이프라인 호출 repeat번의 평균 시간과 마지막 결과, 실행 방식을 반환합니다."""
+    seconds, output, execution = [], None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with policy.activate(pipeline, "tiny", "tiny", (tokens, batch_size)) as execution:
+            output = pipeline(batch_size, tokens, steps)
+        seconds.append(time.perf_counter() - start)
+    return sum(seconds) / len(seconds), output, execution
+
+
+def bench_compile_tiny(args):
+    try:
+        import torch
+    except ImportError:
+        raise SystemExit("compile 벤치마크에는 torch가 필요합니다.")
+    torch.manual_seed(0)
+    pipeline = make_tiny_pipeline(torch, args.dim, args.depth)
+    eager_policy = CompilePolicy()
+    policy = CompilePolicy(models=["tiny"], mode=args.mode, backend=args.compile_backend)
+    configure_dynamo(policy.max_graphs)
+
+    results = []
+    for tokens in args.tokens:
+        eager_seconds, reference, _ = time_tiny(pipeline, eager_policy, args.batch_size, tokens, args.steps, args.repeat)
+        # 처음 보는 모양은 eager로 바로 실행되고(요청이 컴파일을 기다리지 않음) 컴파일은 백그라운드에서 진행됩니다.
+        first_seconds, _, first_execution = time_tiny(pipeline, policy, args.batch_size, tokens, args.steps, 1)
+        start = time.perf_counter()
+        policy.wait()
+        compile_wait = time.perf_counter() - start
+        compiled_seconds, output, execution = time_tiny(pipeline, policy, args.batch_size, tokens, args.steps, args.repeat)
+        for mode, seconds, run_execution in (("eager", eager_seconds, "eager"), ("compiled", compiled_seconds, execution)):
+            results.append({
+                "mode": mode,
+                "tokens": tokens,
+                "batch_size": args.batch_size,
+                "execution": run_execution,
+                "steps_per_second": args.steps / seconds,
+                "first_call_ms": first_seconds * 1000 if mode == "compiled" else eager_seconds * 1000,
+                "first_execution": first_execution if mode == "compiled" else "eager",
+                "compile_wait_seconds": compile_wait if mode == "compiled" else 0.0,
+                "max_abs_diff": float((output - reference).abs().max()) if mode == "compiled" else 0.0,
+            })
+    return results
+
+
+def bench_compile_diffusers(args):
+    handler = ModelHandler(compile_policy=CompilePolicy(models=[args.model], mode=args.mode,
+                                                        backend=args.compile_backend))
+    compile_policy = handler.compile_policy
+    configure_dynamo(compile_policy.max_graphs)
+    results = []
+    for size in args.sizes:
+        request = make_request(0, model_name=args.model, steps=args.steps, width=size, height=size)
+        timings = {}
+        for mode in ("eager", "compiled"):
+            handler.compile_policy = compile_policy if mode == "compiled" else CompilePolicy()
+            first_seconds = time_render(handler, request)
+            compile_policy.wait()
+            seconds = [time_render(handler, request) for _ in range(args.repeat)]
+            timings[mode] = (first_seconds, sum(seconds) / len(seconds))
+        for mode, (first_seconds, seconds) in timings.items():
+            results.append({
+                "mode": mode,
+                "tokens": size,
+                "batch_size": 1,
+                "execution": mode,
+                "steps_per_second": args.steps / seconds,
+                "first_call_ms": first_seconds * 1000,
+                "first_execution": "eager",
+                "compile_wait_seconds": 0.0,
+                "max_abs_diff": 0.0,
+            })
+    return results
+
+
+def bench_compile(args):
+    results = bench_compile_diffusers(args) if args.backend == "diffusers" else bench_compile_tiny(args)
+
+    print(f"\n--- torch.compile ({args.compile_backend}, mode={args.mode}) ---")
+    print(f"{'mode':>9} {'size':>6} {'steps/s':>9} {'speedup':>8} {'first ms':>9} {'first run':>10} "
+          f"{'compile s':>10} {'max diff':>9}")
+    base = {}
+    for r in results:
+        base.setdefault(r["tokens"], r["steps_per_second"])
+        print(f"{r['mode']:>9} {r['tokens']:>6} {r['steps_per_second']:>9.1f} "
+              f"{r['steps_per_second'] / base[r['tokens']]:>7.2f}x {r['first_call_ms']:>9.1f} {r['first_execution']:>10} "
+              f"{r['compile_wait_seconds']:>10.2f} {r['max_abs_diff']:>9.2e}")
+    return {"benchmark": "compile", "results": results}
+
+
+# --- 속도 모드(블록 캐시) 벤치마크 ---
+def image_drift(image, reference):
+    """두 이미지의 평균 절대 픽셀 차이(0~1)와 PSNR(dB)입니다."""
+    stat = ImageStat.Stat(ImageChops.difference(image.convert("RGB"), reference.convert("RGB")))
+    mse = sum(value / stat.count[0] for value in stat.sum2) / 3
+    psnr = float("inf") if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+    return sum(stat.mean) / 3 / 255, psnr
+
+
+def bench_speed_tiny(args, policy):
+    try:
+        import torch
+    except ImportError:
+        raise SystemExit("speed 벤치마크에는 torch가 필요합니다.")
+    torch.manual_seed(0)
+    pipeline = make_tiny_pipeline(torch, args.dim, args.depth)
+    feature_cache = FeatureCache()
+
+    results = []
+    for tokens in args.tokens:
+        reference = {}
+        for mode in args.modes:
+            request = policy.apply({"speed_mode": mode, "cache_interval": args.interval, "cache_threshold": args.threshold})
+            before = feature_cache.stats()
+            seconds, drifts = [], []
+            for seed in range(args.seeds):
+                start = time.perf_counter()
+                with feature_cache.activate(pipeline, request["cache_interval"], request["cache_threshold"]) as method:
+                    latents = pipeline(args.batch_size, tokens, args.steps, seed=seed)
+                seconds.append(time.perf_counter() - start)
+                reference.setdefault(seed, latents)
+                drifts.append(float((latents - reference[seed]).norm() / reference[seed].norm()))
+            after = feature_cache.stats()
+            results.append(speed_result(args, mode, request, method, tokens, seconds, before, after,
+                                        drift=sum(drifts) / len(drifts), psnr=None))
+    return results
+
+
+def bench_speed_diffusers(args, policy):
+    handler = ModelHandler()
+    model_type = handler.model_type_of(args.model)
+    results = []
+    for size in args.sizes:
+        reference = {}
+        for mode in args.modes:
+            request_base = policy.apply({"speed_mode": mode, "cache_interval": args.interval,
+                                         "cache_threshold": args.threshold})
+            before = handler.feature_cache.stats()
+            seconds, drifts, psnrs = [], [], []
+            for seed in range(args.seeds):
+                request = make_request(seed, model_name=args.model, steps=args.steps, width=size, height=size,
+                                       seed=seed, cache_interval=request_base["cache_interval"],
+                                       cache_threshold=request_base["cache_threshold"])
+                with handler.session(args.model):
+                    start = time.perf_counter()
+                    image = handler.generate_batch([request])[0]
+                    seconds.append(time.perf_counter() - start)
+                reference.setdefault(seed, image)
+                drift, psnr = image_drift(image, reference[seed])
+                drifts.append(drift)
+                psnrs.append(psnr)
+            after = handler.feature_cache.stats()
+            method = "disabled" if mode == "off" else model_type
+            results.append(speed_result(args, mode, request_base, method, size, seconds, before, after,
+                                        drift=sum(drifts) / len(drifts), psnr=min(psnrs)))
+    return results
+
+
+def speed_result(args, mode, request, method, size, seconds, before, after, drift, psnr):
+    steps = (after["cached_steps"] + after["computed_steps"]) - (before["cached_steps"] + before["computed_steps"])
+    cached = after["cached_steps"] - before["cached_steps"]
+    # 첫 번째 시드는 워밍업(모델 로딩/할당)이 섞이므로 시드가 여러 개면 제외합니다.
+    timed = seconds[1:] if len(seconds) > 1 else seconds
+    return {
+        "mode": mode,
+        "size": size,
+        "method": method,
+        "cache_interval": request["cache_interval"],
+        "cache_threshold": request["cache_threshold"],
+        "ms_per_step": sum(timed) / len(timed) / args.steps * 1000,
+        "cached_ratio": cached / steps if steps else 0.0,
+        "drift": drift,
+        "psnr": psnr,
+    }
+
+
+def bench_speed(args):
+    modes = list(dict.fromkeys(["off"] + args.modes)) # 드리프트 기준이 되도록 "off"를 먼저 실행
+    args.modes = modes
+    policy = SpeedPolicy()
+    results = bench_speed_diffusers(args, policy) if args.backend == "diffusers" else bench_speed_tiny(args, policy)
+
+    print(f"\n--- 속도 모드 (스텝 {args.steps}, 시드 {args.seeds}개, 기준: off) ---")
+    print(f"{'mode':>8} {'size':>6} {'method':>12} {'interval':>9} {'threshold':>10} {'ms/step':>9} "
+          f"{'speedup':>8} {'cached':>7} {'drift':>9} {'psnr':>7}")
+    base = {}
+    for r in results:
+        base.setdefault(r["size"], r["ms_per_step"])
+        psnr = "-" if r["psnr"] is None else f"{r['psnr']:.1f}"
+        print(f"{r['mode']:>8} {r['size']:>6} {r['method']:>12} {str(r['cache_interval']):>9} "
+              f"{str(r['cache_threshold']):>10} {r['ms_per_step']:>9.1f} {base[r['size']] / r['ms_per_step']:>7.2f}x "
+              f"{r['cached_ratio']:>7.0%} {r['drift']:>9.4f} {psnr:>7}")
+    return {"benchmark": "speed", "results": results}
+
+
+# --- 고해상도 모드 벤치마크 ---
+def peak_memory(handler, reset=False):
+    """
+    가속기의 최대 할당 메모리(바이트)입니다. 가짜 파이프라인이면 한 번의 호출에서 디노이징한 최대 픽셀 수를,
+    CPU에서 실행 중이면 None을 반환합니다. reset=True이면 측정을 다시 시작합니다.
+    """
+    if hasattr(handler.pipeline, "peak_pixels"):
+        if reset:
+            handler.pipeline.peak_pixels = 0
+        return handler.pipeline.peak_pixels
+    import torch
+    if not torch.cuda.is_available():
+        return None
+    if reset:
+        torch.cuda.reset_peak_memory_stats()
+    return torch.cuda.max_memory_allocated()
+
+
+def bench_highres(args):
+    handler = make_handler(args)
+    model_name = args.model if args.backend == "diffusers" else "bench/model-sd"
+    model_type = handler.model_type_of(model_name)
+    policy = HighResPolicy(ResolutionPolicy(), "on", tile_size=args.tile, tile_overlap=args.overlap,
+                           strength=args.strength)
+    with handler.session(model_name):
+        handler.generate_batch([make_request(0, model_name=model_name, steps=1)]) # 모델 로딩/워밍업
+    results = []
+    for size in args.sizes:
+        for mode in ("off", "on"):
+            request = policy.apply(make_request(0, model_name=model_name, steps=args.steps, width=size, height=size,
+                                                highres_mode=mode), model_type)
+            seconds, peak, error = [], None, None
+            for repeat in range(args.repeat):
+                with handler.session(model_name):
+                    peak_memory(handler, reset=True)
+                    start = time.perf_counter()
+                    try:
+                        handler.generate_batch([dict(request, seed=repeat)])
+                    except Exception as e:
+                        if "out of memory" not in str(e).lower():
+                            raise
+                        error = "OOM"
+                        handler._release_memory()
+                        break
+                    seconds.append(time.perf_counter() - start)
+                    peak = max(peak or 0, peak_memory(handler) or 0) or None
+            tiles = len(tile_boxes(size, size, args.tile, args.overlap)) if request["highres_base"] else 0
+            results.append({
+                "mode": "highres" if mode == "on" else "direct",
+                "size": size,
+                "base": request["highres_base"],
+                "tiles": tiles,
+                "seconds": percentile(seconds, 50) if seconds else None,
+                "peak": peak,
+                "error": error,
+            })
+
+    unit = "pixels" if hasattr(handler.pipeline, "peak_pixels") else "GB"
+    print(f"\n--- 고해상도 모드 (스텝 {args.steps}, 타일 {args.tile}/겹침 {args.overlap}, 강도 {args.strength}) ---")
+    print(f"{'size':>6} {'mode':>8} {'base':>10} {'tiles':>6} {'seconds':>9} {'speedup':>8} {'peak ' + unit:>12}")
+    direct = {}
+    for r in results:
+        if r["mode"] == "direct":
+            direct[r["size"]] = r["seconds"]
+        base = "-" if r["base"] is None else f"{r['base'][0]}x{r['base'][1]}"
+        seconds = r["error"] or f"{r['seconds']:.2f}"
+        speedup = f"{direct[r['size']] / r['seconds']:.2f}x" if direct.get(r["size"]) and r["seconds"] else "-"
+        if r["peak"] is None:
+            peak = "-"
+        elif unit == "GB":
+            peak = f"{r['peak'] / 1024 ** 3:.2f}"
+        else:
+            peak = str(r["peak"])
+        print(f"{r['size']:>6} {r['mode']:>8} {base:>10} {r['tiles']:>6} {seconds:>9} {speedup:>8} {peak:>12}")
+    return {"benchmark": "highres", "results": results}
+
+
+# --- 이미지 인코딩 벤치마크 ---
+def make_test_image(size, seed=0):
+    """생성 이미지와 비슷하게 부드러운 영역과 세부 묘사가 섞인 테스트 이미지를 만듭니다."""
+    rng = random.Random(seed)
+    small = Image.new("RGB", (32, 32))
+    small.putdata([(rng.randrange(256), rng.randrange(256), rng.randrange(256)) for _ in range(32 * 32)])
+    base = small.resize((size, size), Image.BICUBIC)
+    noise = Image.effect_noise((size, size), 24).convert("RGB")
+    return Image.blend(base, noise, 0.15).filter(ImageFilter.SMOOTH)
+
+
+def bench_encode(args):
+    encodings = []
+    for fmt in args.formats:
+        if fmt == "png":
+            encodings += [ImageEncoding("png", compress_level=level) for level in args.png_levels]
+        elif fmt in ("webp", "jpeg"):
+            encodings += [ImageEncoding(fmt, quality=quality) for quality in args.qualities]
+        else:
+            encodings.append(ImageEncoding(fmt))
+
+    results = []
+    for size in args.sizes:
+        image = make_test_image(size)
+        for encoding in encodings:
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                data = encoding.encode(image)
+                timings.append(time.perf_counter() - start)
+            results.append({
+                "size": size,
+                "format": encoding.format,
+                "option": encoding.cache_key()[1] if len(encoding.cache_key()) > 1 else None,
+                "p50_ms": percentile(timings, 50) * 1000,
+                "bytes": len(data),
+            })
+
+    print("\n--- 이미지 인코딩 ---")
+    print(f"{'size':>6} {'format':>7} {'option':>7} {'p50 (ms)':>9} {'KB':>9}")
+    for r in results:
+        option = "" if r["option"] is None else r["option"]
+        print(f"{r['size']:>6} {r['format']:>7} {option:>7} {r['p50_ms']:>9.1f} {r['bytes'] / 1024:>9.1f}")
+    return {"benchmark": "encode", "results": results}
+
+
+# --- 모델/LoRA 전환 비용 ---
+def time_render(handler, request, lora_paths=(), lora_scale=0.8):
+    """세션 진입(필요하면 모델/LoRA 전환)부터 이미지 한 장 생성까지의 시간을 측정합니다."""
+    start = time.perf_counter()
+    with handler.session(request["model_name"], lora_paths):
+        handler.generate_batch([request], loras=[(path, lora_scale) for path in lora_paths])
+    return time.perf_counter() - start
+
+
+def switch_result(kind, scenario, cold, same, switching):
+    """전환 비용 = (번갈아 요청할 때의 중앙값) - (같은 대상을 반복할 때의 중앙값)"""
+    baseline = percentile(same, 50)
+    switch = percentile(switching, 50)
+    return {
+        "kind": kind,
+        "scenario": scenario,
+        "cold_ms": percentile(cold, 50) * 1000,
+        "baseline_ms": baseline * 1000,
+        "switch_ms": switch * 1000,
+        "switch_cost_ms": max(0.0, switch - baseline) * 1000,
+    }
+
+
+def bench_model_switch(args):
+    models = args.models
+    request = make_request(0, steps=1, width=args.size, height=args.size)
+    results = []
+    # resident: 모든 모델이 GPU에 상주 / offload: GPU에는 하나만 두고 나머지는 CPU RAM으로 / reload: 매번 디스크에서 로드
+    for scenario, gpu_budget, cpu_budget in (("resident", None, 0), ("offload", 0, sys.maxsize), ("reload", 0, 0)):
+        handler = make_handler(args, pipeline_cache=PipelineCache(gpu_budget_bytes=gpu_budget, cpu_budget_bytes=cpu_budget))
+        cold = [time_render(handler, dict(request, model_name=model)) for model in models]
+        same = [time_render(handler, dict(request, model_name=models[-1])) for _ in range(args.repeat)]
+        switching = [
+            time_render(handler, dict(request, model_name=models[i % len(models)]))
+            for i in range(args.repeat * len(models))
+        ]
+        results.append(switch_result("model", scenario, cold, same, switching))
+    return results
+
+
+def bench_lora_switch(args):
+    lora_paths = args.loras
+    if not lora_paths:
+        if args.backend == "diffusers":
+            raise SystemExit("--backend diffusers에서는 --loras로 LoRA 파일 경로를 2개 이상 지정해야 합니다.")
+        # 가짜 파이프라인은 파일 내용을 읽지 않으므로 빈 파일을 LoRA로 사용합니다.
+        directory = tempfile.mkdtemp()
+        lora_paths = [os.path.join(directory, f"bench-lora-{i}.safetensors") for i in range(2)]
+        for path in lora_paths:
+            open(path, "wb").close()
+
+    request = make_request(0, model_name=args.models[0], steps=1, width=args.size, height=args.size)
+    results = []
+    # cached: 어댑터를 모두 로드해 두고 활성화만 전환 / fused: 전환할 때마다 병합을 되돌리고 다시 병합 / reload: 어댑터 하나만 유지
+    for scenario, max_loras, fuse_threshold in (("cached", len(lora_paths), 0), ("fused", len(lora_paths), 1), ("reload", 1, 0)):
+        handler = make_handler(args, max_loras=max_loras, lora_fuse_threshold=fuse_threshold)
+        time_render(handler, request) # 모델 로딩은 측정에서 제외
+        cold = [time_render(handler, request, (path,)) for path in lora_paths]
+        same = [time_render(handler, request, (lora_paths[-1],)) for _ in range(args.repeat)]
+        switching = [
+            time_render(handler, request, (lora_paths[i % len(lora_paths)],))
+            for i in range(args.repeat * len(lora_paths))
+        ]
+        results.append(switch_result("lora", scenario, cold, same, switching))
+    return results
+
+
+def bench_switch(args):
+    results = bench_model_switch(args) + bench_lora_switch(args)
+
+    print("\n--- 모델/LoRA 전환 비용 ---")
+    print(f"{'kind':>5} {'scenario':>9} {'cold (ms)':>10} {'same (ms)':>10} {'switch (ms)':>12} {'cost (ms)':>10}")
+    for r in results:
+        print(f"{r['kind']:>5} {r['scenario']:>9} {r['cold_ms']:>10.1f} {r['baseline_ms']:>10.1f} "
+              f"{r['switch_ms']:>12.1f} {r['switch_cost_ms']:>10.1f}")
+    return {"benchmark": "switch", "results": results}
+
+
+# --- HTTP 종단 간 지연 시간과 동시 처리량 ---
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(args, app_spec="app:app", extra_settings=None, port=None):
+    """
+    가짜 파이프라인 백엔드로 API 서버(또는 app_spec의 다른 앱)를 별도 프로세스로 시작하고 (프로세스, URL, 로그 파일)을 반환합니다.
+    extra_settings는 --set보다 먼저 적용되는 설정입니다.
+    API 서버는 도커 이미지와 같은 `python app.py` 경로로 실행해 그 진입점도 함께 검증합니다.
+    """
+    port = port or free_port()
+    env = dict(os.environ)
+    settings = {
+        "backend": "fake",
+        "fake_step_latency": args.step_latency,
+        "fake_decode_latency": args.decode_latency,
+        "fake_load_latency": args.load_latency,
+        "result_cache_mb": 0, # 같은 요청의 캐시 히트가 측정을 왜곡하지 않도록 결과 캐시를 끕니다.
+        "queue_size": max(args.clients) * 2,
+        "host": "127.0.0.1",
+        "port": port,
+    }
+    settings.update(extra_settings or {})
+    for item in args.set or []:
+        key, _, value = item.partition("=")
+        settings[key.strip()] = json.loads(value)
+    for key, value in settings.items():
+        env["AIGEN_" + key.upper()] = json.dumps(value)
+
+    log = tempfile.NamedTemporaryFile(prefix="benchmark-server-", suffix=".log", delete=False)
+    if app_spec == "app:app":
+        command = [sys.executable, "app.py"]
+    else:
+        command = [sys.executable, "-m", "uvicorn", app_spec, "--host", "127.0.0.1", "--port", str(port),
+                   "--log-level", "warning"]
+    process = subprocess.Popen(command, cwd=BASE_PATH, env=env, stdout=log, stderr=subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + args.startup_timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            with urllib.request.urlopen(url + "/api/status", timeout=1):
+                return process, url, log.name
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.2)
+    process.kill()
+    with open(log.name, "r", encoding="utf-8", errors="replace") as f:
+        print(f.read()[-4000:])
+    raise SystemExit("벤치마크 서버를 시작하지 못했습니다.")
+
+
+def http_generate(url, body, timeout):
+    """POST /api/generate를 호출하고 응답 본문을 끝까지 읽은 뒤 응답 헤더를 반환합니다. 실패하면 예외가 발생합니다."""
+    request = urllib.request.Request(
+        url + "/api/generate",
+        data=json.dumps(body).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        response.read()
+        return response.headers
+
+
+def run_http_level(args, url, clients):
+    """clients개의 클라이언트가 동시에 요청을 보내 총 args.requests개를 처리하는 동안의 지연 시간과 처리량을 측정합니다."""
+    counter = itertools.count()
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            index = next(counter)
+            if index >= args.requests:
+                return
+            body = make_request(index, model_name=args.model, steps=args.steps, width=args.size, height=args.size,
+                                seed=-1, output_format=args.format)
+            start = time.perf_counter()
+            try:
+                http_generate(url, body, args.timeout)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "clients": clients,
+        "requests": args.requests,
+        "errors": len(errors),
+        "seconds": elapsed,
+        "requests_per_second": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p90_ms": percentile(latencies, 90) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies, default=0.0) * 1000,
+    }, errors
+
+
+def bench_http(args):
+    process = None
+    url = args.url
+    if url is None:
+        process, url, log_path = start_server(args)
+        print(f"벤치마크 서버 시작: {url} (로그: {log_path})")
+    try:
+        # 첫 요청은 모델 로딩을 포함하므로 측정에서 제외합니다.
+        http_generate(url, make_request(-1, model_name=args.model, steps=1, width=args.size, height=args.size), args.timeout)
+        results = []
+        for clients in args.clients:
+            result, errors = run_http_level(args, url, clients)
+            if errors:
+                print(f"경고: 동시 클라이언트 {clients}개에서 {len(errors)}건 실패 (예: {errors[0]})")
+            results.append(result)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=10)
+
+    print("\n--- HTTP 지연 시간과 처리량 ---")
+    print(f"{'clients':>8} {'req/s':>8} {'p50 (ms)':>9} {'p90 (ms)':>9} {'p99 (ms)':>9} {'max (ms)':>9} {'errors':>7}")
+    for r in results:
+        print(f"{r['clients']:>8} {r['requests_per_second']:>8.2f} {r['p50_ms']:>9.1f} {r['p90_ms']:>9.1f} "
+              f"{r['p99_ms']:>9.1f} {r['max_ms']:>9.1f} {r['errors']:>7}")
+    return {"benchmark": "http", "results": results}
+
+
+# --- 큐 포화와 이벤트 루프 응답성 검사 ---
+def http_call(url, path, body=None, timeout=10.0):
+    """JSON 요청을 보내고 (상태 코드, 응답 헤더, 본문 JSON 또는 None)을 반환합니다. 4xx/5xx도 예외 없이 반환합니다."""
+    data = None if body is None else json.dumps(body).encode("utf-8")
+    request = urllib.request.Request(url + path, data=data, headers={"Content-Type": "application/json"})
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        response = e
+    with response:
+        raw = response.read()
+        try:
+            content = json.loads(raw) if raw else None
+        except ValueError:
+            content = None
+        return response.getcode(), response.headers, content
+
+
+def bench_backpressure(args):
+    """
+    가짜 파이프라인 서버에서 작업 하나가 렌더링되는 동안
+    - GET /api/status가 계속 빠르게 응답하는지 (GPU 작업이 이벤트 루프를 막지 않는지)
+    - 큐가 가득 차면 503과 정수 Retry-After 헤더를 반환하는지 검사합니다. 실패하면 종료 코드 1.
+    """
+    process, url, log_path = start_server(args, extra_settings={"queue_size": args.queue_size, "max_batch_size": 1})
+    print(f"검사 서버 시작: {url} (로그: {log_path})")
+    failures = []
+    try:
+        body = {"model_name": args.model, "prompt": "backpressure", "steps": args.steps, "width": 256, "height": 256}
+        status, _, job = http_call(url, "/api/jobs", body)
+        if status != 202:
+            raise SystemExit(f"작업을 등록하지 못했습니다: {status} {job}")
+        deadline = time.monotonic() + args.startup_timeout
+        while http_call(url, f"/api/jobs/{job['job_id']}")[2]["status"] != "running":
+            if time.monotonic() > deadline:
+                raise SystemExit("작업이 실행되지 않았습니다.")
+            time.sleep(0.05)
+
+        # 1. 렌더링 중 이벤트 루프 응답 시간
+        latencies = []
+        for _ in range(args.probes):
+            start = time.perf_counter()
+            status, _, _ = http_call(url, "/api/status")
+            latencies.append(time.perf_counter() - start)
+            if status != 200:
+                failures.append(f"렌더링 중 /api/status가 {status}를 반환했습니다.")
+        still_running = http_call(url, f"/api/jobs/{job['job_id']}")[2]["status"] == "running"
+        worst_ms = max(latencies) * 1000
+        print(f"렌더링 중 /api/status {len(latencies)}회: p50 {percentile(latencies, 50) * 1000:.1f}ms, "
+              f"최대 {worst_ms:.1f}ms (작업 진행 중: {still_running})")
+        if not still_running:
+            failures.append("응답 시간을 재는 동안 작업이 끝났습니다. --steps를 늘리세요.")
+        if worst_ms > args.max_status_ms:
+            failures.append(f"렌더링 중 /api/status가 {worst_ms:.1f}ms 걸렸습니다. (한도 {args.max_status_ms}ms)")
+
+        # 2. 큐를 채운 뒤 503 + Retry-After
+        accepted = 0
+        for _ in range(args.queue_size + 1):
+            status, headers, content = http_call(url, "/api/jobs", body)
+            if status == 202:
+                accepted += 1
+                continue
+            retry_after = headers.get("Retry-After")
+            print(f"큐에 {accepted}개를 넣은 뒤 {status} 응답 (Retry-After: {retry_after}, reason: "
+                  f"{(content or {}).get('reason')})")
+            if status != 503:
+                failures.append(f"큐가 가득 찼을 때 503 대신 {status}를 반환했습니다.")
+            if retry_after is None or not retry_after.isdigit() or int(retry_after) < 1:
+                failures.append(f"Retry-After 헤더가 올바르지 않습니다: {retry_after!r}")
+            break
+        else:
+            failures.append(f"queue_size={args.queue_size}인데 작업 {accepted}개를 모두 받았습니다.")
+        if accepted != args.queue_size:
+            failures.append(f"큐가 가득 차기 전에 받은 작업 수가 {accepted}개입니다. (기대값 {args.queue_size})")
+    finally:
+        process.kill()
+        process.wait()
+
+    for failure in failures:
+        print(f"실패: {failure}")
+    if failures:
+        sys.exit(1)
+    print("통과: 렌더링 중에도 이벤트 루프가 응답하고, 큐가 가득 차면 503과 Retry-After를 반환합니다.")
+    return {"benchmark": "backpressure", "results": [{"status_max_ms": worst_ms, "accepted": accepted}]}
+
+
+# --- 게이트웨이와 여러 워커 ---
+def http_json(url, timeout=5.0):
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def start_cluster(args, routing):
+    """게이트웨이 하나와 가짜 파이프라인 워커 args.workers개를 띄우고, 워커가 모두 등록될 때까지 기다립니다."""
+    processes = []
+    # least_loaded는 친화도를 무시하고 항상 가장 한가한 워커로 보내는 비교 기준입니다.
+    slack = args.affinity_slack if routing == "affinity" else -sys.maxsize
+    gateway, gateway_url, _ = start_server(args, "gateway:app", {
+        "gateway_affinity_slack": slack,
+        "gateway_failure_backoff": 60,
+        "worker_timeout": 10,
+    })
+    processes.append(gateway)
+    workers = []
+    try:
+        for _ in range(args.workers):
+            port = free_port()
+            process, url, log_path = start_server(args, "app:app", {
+                "gateway_url": gateway_url,
+                "worker_url": f"http://127.0.0.1:{port}",
+                "worker_heartbeat": 1,
+                # 모델 전환마다 디스크에서 다시 로드하는 비용이 들도록 모델 캐시를 끕니다.
+                "cpu_memory_budget_gb": 0,
+            }, port=port)
+            processes.append(process)
+            workers.append((process, url))
+        deadline = time.monotonic() + args.startup_timeout
+        while http_json(gateway_url + "/api/workers")["healthy_workers"] < args.workers:
+            if time.monotonic() > deadline:
+                raise SystemExit("워커가 게이트웨이에 모두 등록되지 않았습니다.")
+            time.sleep(0.2)
+    except BaseException:
+        for process in processes:
+            process.kill()
+        raise
+    return gateway, gateway_url, workers
+
+
+def run_gateway_trial(args, routing):
+    gateway, gateway_url, workers = start_cluster(args, routing)
+    rng = random.Random(args.seed)
+    models = [f"bench/model-{i}" for i in range(args.models)]
+    trace = [rng.choice(models) for _ in range(args.requests)]
+    counter = itertools.count()
+    completed = itertools.count(1)
+    latencies = []
+    errors = []
+    served_by = [] # (모델, 워커)
+    killed = []
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            index = next(counter)
+            if index >= len(trace):
+                return
+            body = make_request(index, model_name=trace[index], steps=args.steps, width=args.size, height=args.size,
+                                seed=-1, output_format="raw")
+            start = time.perf_counter()
+            try:
+                headers = http_generate(gateway_url, body, args.timeout)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+                served_by.append((trace[index], headers.get("X-Worker")))
+                # 워커 장애 재현: 지정한 수의 요청이 끝나면 첫 번째 워커를 강제로 종료합니다.
+                if args.kill_after and next(completed) == args.kill_after and not killed:
+                    workers[0][0].kill()
+                    killed.append(workers[0][1])
+
+    try:
+        threads = [threading.Thread(target=client) for _ in range(args.clients[0])]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        model_loads = 0
+        for process, url in workers:
+            if process.poll() is None:
+                model_loads += http_json(url + "/api/status")["model_cache"]["misses"]
+        gateway_stats = http_json(gateway_url + "/api/workers")
+    finally:
+        for process in [gateway] + [process for process, _ in workers]:
+            if process.poll() is None:
+                process.terminate()
+                process.wait(timeout=10)
+
+    # 모델별로 처음 처리한 워커가 아닌 다른 워커에서 처리된 요청 수 (분산된 정도)
+    first_worker = {}
+    moved = 0
+    for model_name, worker_id in served_by:
+        first_worker.setdefault(model_name, worker_id)
+        moved += first_worker[model_name] != worker_id
+
+    return {
+        "routing": routing,
+        "workers": args.workers,
+        "requests": len(trace),
+        "errors": len(errors),
+        "killed_worker": killed[0] if killed else None,
+        "seconds": elapsed,
+        "requests_per_second": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "model_loads": model_loads,
+        "affinity_routes": gateway_stats["affinity_routes"],
+        "retries": gateway_stats["retries"],
+        "moved_requests": moved,
+    }, errors
+
+
+def bench_gateway(args):
+    results = []
+    for routing in args.routing:
+        print(f"\n[{routing}] 워커 {args.workers}개, 모델 {args.models}개, 요청 {args.requests}개")
+        result, errors = run_gateway_trial(args, routing)
+        if errors:
+            print(f"경고: {len(errors)}건 실패 (예: {errors[0]})")
+        results.append(result)
+
+    print("\n--- 게이트웨이 라우팅 비교 ---")
+    print(f"{'routing':>13} {'req/s':>7} {'p50 (ms)':>9} {'p99 (ms)':>9} {'loads':>6} {'retries':>8} {'errors':>7}")
+    for r in results:
+        print(f"{r['routing']:>13} {r['requests_per_second']:>7.2f} {r['p50_ms']:>9.1f} {r['p99_ms']:>9.1f} "
+              f"{r['model_loads']:>6} {r['retries']:>8} {r['errors']:>7}")
+    return {"benchmark": "gateway", "results": results}
+
+
+# --- 전체 실행과 결과 비교 ---
+# 회귀 비교에 사용할 작은 규모의 기본 구성
+SUITE = [
+    ("batching", ["--jobs", "16"]),
+    ("scheduler", ["--jobs", "200"]),
+    ("switch", ["--repeat", "3"]),
+    ("encode", ["--sizes", "512", "1024", "--repeat", "3"]),
+    ("http", ["--clients", "1", "4", "--requests", "16"]),
+]
+
+# 비교할 지표와 방향 (True: 클수록 좋음, False: 작을수록 좋음)
+METRIC_DIRECTIONS = {
+    "images_per_second": True,
+    "batch_hit_rate": True,
+    "requests_per_second": True,
+    "steps_per_second": True,
+    "throughput": True,
+    "p50_ms": False,
+    "p90_ms": False,
+    "p99_ms": False,
+    "p50_latency": False,
+    "p99_latency": False,
+    "cold_ms": False,
+    "switch_cost_ms": False,
+    "bytes": False,
+    "errors": False,
+}
+
+
+def bench_suite(args):
+    parser = build_parser()
+    sections = {}
+    for name, extra in SUITE:
+        sub_args = parser.parse_args([name] + extra)
+        for key in ("step_latency", "decode_latency", "loader"):
+            setattr(sub_args, key, getattr(args, key))
+        print(f"\n=== {name} ===")
+        sections[name] = sub_args.func(sub_args)
+    return {"benchmark": "suite", "results": sections}
+
+
+def flatten_results(results):
+    """결과 파일의 행을 {(벤치마크, 행을 구분하는 필드...): 행}으로 펼칩니다. (suite 결과는 벤치마크별로 펼침)"""
+    payloads = results["results"].values() if results["benchmark"] == "suite" else [results]
+    rows = {}
+    for payload in payloads:
+        for row in payload["results"]:
+            identity = tuple(
+                (key, value) for key, value in row.items()
+                if key not in METRIC_DIRECTIONS and not isinstance(value, (float, bool))
+            )
+            rows[(payload["benchmark"],) + identity] = row
+    return rows
+
+
+def bench_compare(args):
+    with open(args.baseline, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.candidate, "r", encoding="utf-8") as f:
+        candidate = json.load(f)
+
+    old_rows = flatten_results(baseline)
+    new_rows = flatten_results(candidate)
+    results = []
+    for key, new in new_rows.items():
+        old = old_rows.get(key)
+        if old is None:
+            continue
+        for metric, higher_is_better in METRIC_DIRECTIONS.items():
+            if metric not in old or metric not in new:
+                continue
+            before, after = old[metric], new[metric]
+            if before:
+                change = (after - before) / abs(before) * 100
+            else:
+                change = 0.0 if after == before else float("inf")
+            worse = change < -args.threshold if higher_is_better else change > args.threshold
+            results.append({
+                "benchmark": key[0],
+                "row": ", ".join(f"{k}={v}" for k, v in key[1:]),
+                "metric": metric,
+                "baseline": before,
+                "candidate": after,
+                "change_percent": change,
+                "regression": worse,
+            })
+
+    commits = [(r.get("meta") or {}).get("commit") for r in (baseline, candidate)]
+    print(f"\n--- 결과 비교: {commits[0] or args.baseline} -> {commits[1] or args.candidate} (기준 {args.threshold:.0f}%) ---")
+    print(f"{'benchmark':>10} {'metric':>20} {'baseline':>11} {'candidate':>11} {'change':>8}  row")
+    for r in results:
+        flag = "  <-- 회귀" if r["regression"] else ""
+        print(f"{r['benchmark']:>10} {r['metric']:>20} {r['baseline']:>11.2f} {r['candidate']:>11.2f} "
+              f"{r['change_percent']:>+7.1f}%  {r['row']}{flag}")
+    regressions = sum(r["regression"] for r in results)
+    print(f"\n회귀 {regressions}건 / 비교 지표 {len(results)}개")
+    return {"benchmark": "compare", "results": results, "regressions": regressions}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="AI 이미지 생성 서비스 벤치마크")
+    parser.add_argument("--step-latency", type=float, default=0.05, help="가짜 파이프라인의 스텝당 지연 시간 (초)")
+    parser.add_argument("--decode-latency", type=float, default=0.02, help="가짜 파이프라인의 이미지당 디코드 시간 (초)")
+    parser.add_argument("--loader", help="FakePipeline 대신 사용할 파이프라인 로더 ('모듈:함수', (pipeline, model_type) 반환)")
+    parser.add_argument("--output", help="결과를 저장할 JSON 파일 경로")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    batching = subparsers.add_parser("batching", help="동적 배칭 처리량 비교")
+    batching.add_argument("--jobs", type=int, default=32)
+    batching.add_argument("--max-batch-size", type=int, default=4)
+    batching.add_argument("--batch-wait-ms", type=float, default=20)
+    batching.set_defaults(func=bench_batching)
+
+    buckets = subparsers.add_parser("buckets", help="크기가 섞인 요청에서 해상도 버킷 정책별 배치 비율과 지연 시간 비교")
+    buckets.add_argument("--jobs", type=int, default=64)
+    buckets.add_argument("--modes", nargs="+", choices=RESOLUTION_MODES, default=["exact", "snap_resize"])
+    buckets.add_argument("--arrival-rate", type=float, default=8.0, help="초당 평균 요청 도착 수")
+    buckets.add_argument("--steps", type=int, default=4)
+    buckets.add_argument("--max-batch-size", type=int, default=4)
+    buckets.add_argument("--batch-wait-ms", type=float, default=20)
+    buckets.add_argument("--seed", type=int, default=0)
+    buckets.set_defaults(func=bench_buckets)
+
+    sched = subparsers.add_parser("scheduler", help="FIFO와 affinity 스케줄링 시뮬레이션 비교")
+    sched.add_argument("--jobs", type=int, default=500)
+    sched.add_argument("--models", type=int, default=3)
+    sched.add_argument("--loras", type=int, default=3)
+    sched.add_argument("--arrival-rate", type=float, default=0.2, help="초당 평균 요청 도착 수")
+    sched.add_argument("--render-seconds", type=float, default=1.5)
+    sched.add_argument("--model-switch-seconds", type=float, default=8.0)
+    sched.add_argument("--lora-switch-seconds", type=float, default=1.0)
+    sched.add_argument("--priority-fraction", type=float, default=0.1, help="우선순위 1을 가진 요청의 비율")
+    sched.add_argument("--max-wait", type=float, default=60.0)
+    sched.add_argument("--seed", type=int, default=0)
+    sched.set_defaults(func=bench_scheduler)
+
+    admission = subparsers.add_parser("admission", help="무거운 클라이언트가 섞인 부하에서 입장 제어 유무에 따른 마감 시간 준수율 비교")
+    admission.add_argument("--duration", type=float, default=10.0, help="요청을 보내는 시간 (초)")
+    admission.add_argument("--light-rate", type=float, default=5.0, help="가벼운 요청(512×512, 8스텝)의 초당 도착 수")
+    admission.add_argument("--light-clients", type=int, default=4)
+    admission.add_argument("--deadline-ms", type=int, default=1500, help="가벼운 요청의 deadline_ms")
+    admission.add_argument("--heavy-rate", type=float, default=0.5, help="무거운 요청의 초당 도착 수")
+    admission.add_argument("--heavy-size", type=int, default=2048)
+    admission.add_argument("--heavy-steps", type=int, default=20)
+    admission.add_argument("--heavy-budget", type=float, default=0.25, help="무거운 클라이언트의 예산 (GPU 시간 비율)")
+    admission.add_argument("--budget-window", type=float, default=20.0, help="예산 창 (초)")
+    admission.add_argument("--pixel-cost", type=float, default=1.0, help="가짜 파이프라인 지연 시간 중 픽셀 수에 비례하는 비율")
+    admission.add_argument("--seed", type=int, default=0)
+    admission.set_defaults(func=bench_admission)
+
+    fuse = subparsers.add_parser("lora-fuse", help="LoRA 병합(fuse) 전후의 스텝 처리량과 결과 차이 비교")
+    fuse.add_argument("--backend", choices=["fake", "diffusers"], default="fake")
+    fuse.add_argument("--model", default="bench/model-sd", help="--backend diffusers에서 사용할 모델 ID")
+    fuse.add_argument("--lora", help="LoRA 파일 경로 (fake 백엔드에서는 생략 가능)")
+    fuse.add_argument("--lora-scale", type=float, default=0.8)
+    fuse.add_argument("--jobs", type=int, default=16)
+    fuse.add_argument("--steps", type=int, default=8)
+    fuse.add_argument("--size", type=int, default=512)
+    fuse.add_argument("--tolerance", type=float, default=2.0,
+                      help="병합 전후 결과의 허용 최대 픽셀 차이 (0~255, 넘으면 종료 코드 1)")
+    fuse.add_argument("--min-psnr", type=float, default=40.0,
+                      help="병합 전후 결과의 최소 PSNR (dB, 낮으면 종료 코드 1)")
+    fuse.set_defaults(func=bench_lora_fuse)
+
+    stress = subparsers.add_parser("session-stress", help="동시 세션에서 이미지마다 요청한 모델과 LoRA가 적용되었는지 검사")
+    stress.add_argument("--threads", type=int, default=8)
+    stress.add_argument("--requests", type=int, default=240)
+    stress.add_argument("--models", type=int, default=3)
+    stress.add_argument("--loras", type=int, default=5)
+    stress.add_argument("--max-loras", type=int, default=3, help="모델별로 로드해 둘 어댑터 수 (작을수록 교체가 잦음)")
+    stress.add_argument("--gpu-models", type=int, default=1, help="GPU 예산에 들어가는 모델 수")
+    stress.add_argument("--load-latency", type=float, default=0.01)
+    stress.add_argument("--lora-load-latency", type=float, default=0.005)
+    stress.add_argument("--seed", type=int, default=0)
+    stress.set_defaults(func=bench_session_stress)
+
+    encode = subparsers.add_parser("encode", help="출력 형식/해상도별 인코딩 시간과 크기 비교")
+    encode.add_argument("--sizes", type=int, nargs="+", default=[512, 1024, 2048])
+    encode.add_argument("--formats", nargs="+", default=["png", "webp", "jpeg", "raw"])
+    encode.add_argument("--png-levels", type=int, nargs="+", default=[1, 6])
+    encode.add_argument("--qualities", type=int, nargs="+", default=[90])
+    encode.add_argument("--repeat", type=int, default=5)
+    encode.set_defaults(func=bench_encode)
+
+    speed = subparsers.add_parser("speed", help="속도 모드(블록 캐시)의 스텝 시간 단축과 고정 시드 결과의 드리프트 비교")
+    speed.add_argument("--backend", choices=["tiny", "diffusers"], default="tiny",
+                       help="tiny: CPU에서 실행되는 작은 디노이저, diffusers: 실제 모델")
+    speed.add_argument("--model", default="Disty0/Z-Image-Turbo-SDNQ-int8", help="--backend diffusers에서 사용할 모델 ID")
+    speed.add_argument("--modes", nargs="+", default=["fast", "fastest"], help="비교할 speed_mode (off는 항상 포함)")
+    speed.add_argument("--interval", type=int, default=None, help="모드의 cache_interval을 덮어씀")
+    speed.add_argument("--threshold", type=float, default=None, help="모드의 cache_threshold를 덮어씀")
+    speed.add_argument("--sizes", type=int, nargs="+", default=[1024], help="--backend diffusers의 이미지 크기")
+    speed.add_argument("--tokens", type=int, nargs="+", default=[1024], help="tiny 디노이저의 토큰 수")
+    speed.add_argument("--dim", type=int, default=256)
+    speed.add_argument("--depth", type=int, default=12)
+    speed.add_argument("--batch-size", type=int, default=1)
+    speed.add_argument("--steps", type=int, default=20)
+    speed.add_argument("--seeds", type=int, default=4, help="고정 시드 수 (시드마다 off 결과와 비교)")
+    speed.set_defaults(func=bench_speed)
+
+    highres = subparsers.add_parser("highres", help="고해상도 모드(버킷 생성 + 타일 다시 디노이징)와 직접 생성의 시간/최대 메모리 비교")
+    highres.add_argument("--backend", choices=["fake", "diffusers"], default="fake")
+    highres.add_argument("--model", default="Disty0/Z-Image-Turbo-SDNQ-int8", help="--backend diffusers에서 사용할 모델 ID")
+    highres.add_argument("--sizes", type=int, nargs="+", default=[1536, 2048])
+    highres.add_argument("--steps", type=int, default=8)
+    highres.add_argument("--tile", type=int, default=1024, help="타일 크기 (픽셀)")
+    highres.add_argument("--overlap", type=int, default=128, help="타일 겹침 폭 (픽셀)")
+    highres.add_argument("--strength", type=float, default=0.35, help="타일을 다시 디노이징하는 강도")
+    highres.add_argument("--repeat", type=int, default=3)
+    highres.add_argument("--pixel-cost", type=float, default=1.0, help="가짜 파이프라인 지연 시간 중 픽셀 수에 비례하는 비율")
+    highres.set_defaults(func=bench_highres)
+
+    compile_parser = subparsers.add_parser("compile", help="디노이저의 eager와 torch.compile 실행 속도 비교")
+    compile_parser.add_argument("--backend", choices=["tiny", "diffusers"], default="tiny",
+                                help="tiny: CPU에서 실행되는 작은 디노이저, diffusers: 실제 모델")
+    compile_parser.add_argument("--model", default="Disty0/Z-Image-Turbo-SDNQ-int8", help="--backend diffusers에서 사용할 모델 ID")
+    compile_parser.add_argument("--sizes", type=int, nargs="+", default=[1024], help="--backend diffusers의 이미지 크기")
+    compile_parser.add_argument("--tokens", type=int, nargs="+", default=[256, 1024], help="tiny 디노이저의 토큰 수 (입력 모양)")
+    compile_parser.add_argument("--dim", type=int, default=256)
+    compile_parser.add_argument("--depth", type=int, default=8)
+    compile_parser.add_argument("--batch-size", type=int, default=1)
+    compile_parser.add_argument("--steps", type=int, default=8)
+    compile_parser.add_argument("--repeat", type=int, default=5)
+    compile_parser.add_argument("--mode", default="default", help="torch.compile 모드")
+    compile_parser.add_argument("--compile-backend", default="inductor", help="torch.compile 백엔드")
+    compile_parser.set_defaults(func=bench_compile)
+
+    switch = subparsers.add_parser("switch", help="모델 전환과 LoRA 전환 비용 측정")
+    switch.add_argument("--backend", choices=["fake", "diffusers"], default="fake")
+    switch.add_argument("--models", nargs="+", default=["bench/model-sd", "bench/model-flux"], help="번갈아 사용할 모델 ID")
+    switch.add_argument("--loras", nargs="+", help="번갈아 사용할 LoRA 파일 경로 (fake 백엔드에서는 생략 가능)")
+    switch.add_argument("--size", type=int, default=256)
+    switch.add_argument("--repeat", type=int, default=5)
+    switch.add_argument("--load-latency", type=float, default=1.0, help="가짜 파이프라인의 모델 로딩 시간 (초)")
+    switch.add_argument("--lora-load-latency", type=float, default=0.2, help="가짜 파이프라인의 LoRA 로딩 시간 (초)")
+    switch.add_argument("--transfer-latency", type=float, default=0.3, help="가짜 파이프라인의 GPU/CPU 간 이동 시간 (초)")
+    switch.set_defaults(func=bench_switch)
+
+    http = subparsers.add_parser("http", help="HTTP 종단 간 지연 시간 백분위수와 동시 클라이언트 처리량 측정")
+    http.add_argument("--url", help="측정할 서버 주소 (생략하면 가짜 파이프라인 서버를 직접 띄움)")
+    http.add_argument("--clients", type=int, nargs="+", default=[1, 4, 16], help="동시 클라이언트 수 (여러 개 지정 가능)")
+    http.add_argument("--requests", type=int, default=32, help="동시 클라이언트 수마다 보낼 요청 수")
+    http.add_argument("--model", default="bench/model-sd")
+    http.add_argument("--steps", type=int, default=8)
+    http.add_argument("--size", type=int, default=512)
+    http.add_argument("--format", default="png", help="응답 이미지 형식")
+    http.add_argument("--timeout", type=float, default=300.0, help="요청 하나의 제한 시간 (초)")
+    http.add_argument("--load-latency", type=float, default=0.5, help="가짜 파이프라인의 모델 로딩 시간 (초)")
+    http.add_argument("--set", action="append", metavar="KEY=JSON", help="직접 띄우는 서버의 설정 (예: --set max_batch_size=1)")
+    http.add_argument("--startup-timeout", type=float, default=60.0)
+    http.set_defaults(func=bench_http)
+
+    backpressure = subparsers.add_parser("backpressure", help="렌더링 중 이벤트 루프 응답성과 큐 포화 시 503 + Retry-After 검사")
+    backpressure.add_argument("--queue-size", type=int, default=2)
+    backpressure.add_argument("--steps", type=int, default=40, help="첫 작업의 스텝 수 (검사하는 동안 계속 렌더링되도록)")
+    backpressure.add_argument("--model", default="bench/model-sd")
+    backpressure.add_argument("--probes", type=int, default=20, help="렌더링 중 /api/status 호출 수")
+    backpressure.add_argument("--max-status-ms", type=float, default=250.0, help="렌더링 중 /api/status 응답 시간 한도")
+    backpressure.add_argument("--load-latency", type=float, default=0.0, help="가짜 파이프라인의 모델 로딩 시간 (초)")
+    backpressure.add_argument("--set", action="append", metavar="KEY=JSON", help="직접 띄우는 서버의 설정")
+    backpressure.add_argument("--startup-timeout", type=float, default=60.0)
+    backpressure.set_defaults(func=bench_backpressure, clients=[1])
+
+    gateway = subparsers.add_parser("gateway", help="게이트웨이와 여러 가짜 파이프라인 워커 프로세스로 라우팅 비교")
+    gateway.add_argument("--workers", type=int, default=3)
+    gateway.add_argument("--models", type=int, default=3, help="요청에 섞어 쓸 모델 수")
+    gateway.add_argument("--requests", type=int, default=60)
+    gateway.add_argument("--clients", type=int, nargs=1, default=[6], help="동시 클라이언트 수")
+    gateway.add_argument("--routing", nargs="+", choices=["affinity", "least_loaded"], default=["affinity", "least_loaded"])
+    gateway.add_argument("--affinity-slack", type=int, default=4)
+    gateway.add_argument("--kill-after", type=int, default=0, help="이 수의 요청이 끝나면 워커 하나를 강제 종료 (0이면 사용 안 함)")
+    gateway.add_argument("--steps", type=int, default=4)
+    gateway.add_argument("--size", type=int, default=256)
+    gateway.add_argument("--seed", type=int, default=0)
+    gateway.add_argument("--timeout", type=float, default=300.0)
+    gateway.add_argument("--load-latency", type=float, default=1.0, help="가짜 파이프라인의 모델 로딩 시간 (초)")
+    gateway.add_argument("--set", action="append", metavar="KEY=JSON", help="게이트웨이와 워커에 함께 적용할 설정")
+    gateway.add_argument("--startup-timeout", type=float, default=60.0)
+    gateway.set_defaults(func=bench_gateway)
+
+    suite = subparsers.add_parser("suite", help="회귀 비교용 기본 벤치마크를 모두 실행")
+    suite.set_defaults(func=bench_suite)
+
+    compare = subparsers.add_parser("compare", help="두 결과 파일을 비교해 회귀를 찾음 (회귀가 있으면 종료 코드 1)")
+    compare.add_argument("baseline", help="기준 결과 JSON (예: 이전 커밋)")
+    compare.add_argument("candidate", help="비교할 결과 JSON")
+    compare.add_argument("--threshold", type=float, default=10.0, help="회귀로 판단할 변화율 (%%)")
+    compare.set_defaults(func=bench_compare)
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    results = args.func(args)
+    write_results(args, results)
+    if args.command == "compare" and results["regressions"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+여러 GPU 워커 프로세스(또는 노드)에 작업을 나누기 위한 워커 등록부와 등록 클라이언트입니다.
+
+워커(app.py)는 GatewayClient로 장치, 메모리, 상주 모델과 로드된 LoRA, 큐 길이를 주기적으로 게이트웨이에 보내고,
+게이트웨이(gateway.py)는 WorkerRegistry로 요청마다 보낼 워커를 고릅니다.
+"""
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from lora_cache import request_loras
+
+
+class NoWorkerAvailable(Exception):
+    """요청을 처리할 수 있는 워커가 없을 때 발생하는 예외입니다."""
+
+    def __init__(self, retry_after):
+        super().__init__("요청을 처리할 수 있는 워커가 없습니다. 잠시 후 다시 시도해 주세요.")
+        self.retry_after = retry_after
+
+
+class WorkerState:
+    """게이트웨이가 알고 있는 워커 하나의 상태입니다. info는 워커가 마지막으로 보낸 등록 정보입니다."""
+
+    def __init__(self, worker_id, url, info):
+        self.worker_id = worker_id
+        self.url = url
+        self.info = info
+        self.last_seen = time.monotonic()
+        self.failed_until = 0.0 # 연결 실패 후 이 시각까지는 요청을 보내지 않음
+        self.failures = 0
+        self.inflight = 0 # 게이트웨이가 보낸 뒤 아직 응답을 받지 않은 요청 수
+        self.routed = 0
+        # 응답을 기다리는 요청의 모델별 개수 (등록 정보에 아직 반영되지 않았어도 곧 로드될 모델)
+        self.inflight_models = {}
+
+    def resident_models(self):
+        """GPU에 상주하는 모델 이름의 집합"""
+        return {e["model_name"] for e in self.info.get("models", []) if e.get("location") == "gpu"}
+
+    def cached_models(self):
+        """CPU RAM에 내려 둔(디스크에서 다시 읽지 않고 올릴 수 있는) 모델 이름의 집합"""
+        return {e["model_name"] for e in self.info.get("models", []) if e.get("location") == "cpu"}
+
+    def load(self):
+        """대기 중이거나 실행 중인 작업 수. 등록 정보가 오래되었을 수 있으므로 게이트웨이가 보낸 요청 수를 더합니다."""
+        return self.info.get("queue_depth", 0) + self.info.get("running_jobs", 0) + self.inflight
+
+    def has_capacity(self):
+        max_queue = self.info.get("max_queue_size")
+        return max_queue is None or self.info.get("queue_depth", 0) + self.inflight < max_queue
+
+    def affinity(self, model_name, lora_names):
+        """
+        요청을 이 워커에서 처리할 때 전환 비용이 얼마나 적은지 점수로 반환합니다.
+        (현재 모델이고 LoRA가 모두 로드됨) 4 > (현재 모델) 3 > (GPU에 상주) 2 > (CPU RAM에 보관) 1 > 0
+        """
+        if model_name == self.info.get("current_model"):
+            loaded = set(self.info.get("loras", []))
+            return 4 if all(name in loaded for name in lora_names) else 3
+        if (model_name in self.resident_models() or model_name in self.inflight_models
+                or model_name in self.info.get("pending_models", ())):
+            return 2
+        if model_name in self.cached_models():
+            return 1
+        return 0
+
+    def to_dict(self, now=None):
+        now = time.monotonic() if now is None else now
+        return {
+            "worker_id": self.worker_id,
+            "url": self.url,
+            "healthy": now >= self.failed_until,
+            "ready": self.info.get("ready", True),
+            "last_seen_seconds": now - self.last_seen,
+            "inflight": self.inflight,
+            "routed": self.routed,
+            "failures": self.failures,
+            "info": self.info,
+        }
+
+
+class WorkerRegistry:
+    """
+    등록된 워커 목록과 라우팅 정책입니다.
+
+    - 워커는 heartbeat_timeout초 안에 다시 등록하지 않으면 목록에서 빠집니다.
+    - 요청은 필요한 모델(과 LoRA)을 이미 가진 워커로 보내고, 없으면 가장 한가한 워커로 보냅니다.
+    - 친화도가 높은 워커라도 가장 한가한 워커보다 대기 작업이 affinity_slack개 넘게 많으면 한가한 워커를 고릅니다.
+      (한 워커에 인기 모델이 몰려 다른 워커가 노는 것을 방지)
+    - 연결에 실패한 워커는 failure_backoff초 동안 제외하며, 그 사이 다시 등록하면 바로 복귀합니다.
+    """
+
+    def __init__(self, heartbeat_timeout=15.0, affinity_slack=4, failure_backoff=5.0):
+        self.heartbeat_timeout = heartbeat_timeout
+        self.affinity_slack = affinity_slack
+        self.failure_backoff = failure_backoff
+        self._workers = {}
+        self._lock = threading.Lock()
+        self._stats = {"routed": 0, "affinity_routes": 0, "least_loaded_routes": 0, "retries": 0, "failures": 0}
+
+    def register(self, info):
+        """워커의 등록(하트비트) 정보를 반영하고 WorkerState를 반환합니다."""
+        worker_id = info.get("worker_id")
+        url = (info.get("url") or "").rstrip("/")
+        if not worker_id or not url:
+            raise ValueError("worker_id와 url이 필요합니다.")
+        with self._lock:
+            # 같은 주소로 다시 시작한 워커는 이전 등록을 대체합니다.
+            for other_id, other in list(self._workers.items()):
+                if other.url == url and other_id != worker_id:
+                    del self._workers[other_id]
+            state = self._workers.get(worker_id)
+            if state is None:
+                state = self._workers[worker_id] = WorkerState(worker_id, url, info)
+                print(f"게이트웨이: 워커 '{worker_id}' 등록 ({url}, 장치 {info.get('device')})")
+            else:
+                state.url = url
+                state.info = info
+                state.last_seen = time.monotonic()
+                state.failed_until = 0.0
+            return state
+
+    def remove(self, worker_id):
+        with self._lock:
+            state = self._workers.pop(worker_id, None)
+        if state is not None:
+            print(f"게이트웨이: 워커 '{worker_id}' 등록 해제")
+        return state
+
+    def get(self, worker_id):
+        with self._lock:
+            return self._workers.get(worker_id)
+
+    def workers(self):
+        with self._lock:
+            self._purge_expired()
+            return list(self._workers.values())
+
+    def healthy_workers(self, exclude=()):
+        now = time.monotonic()
+        # 예열이 끝나지 않은 워커(ready가 False)에는 요청을 보내지 않습니다.
+        return [
+            w for w in self.workers()
+            if now >= w.failed_until and w.info.get("ready", True) and w.worker_id not in exclude
+        ]
+
+    def choose(self, request, exclude=()):
+        """
+        요청을 보낼 워커를 골라 (WorkerState, 이유)를 반환하고 그 워커의 진행 중 요청 수를 늘립니다.
+        이유는 "affinity" 또는 "least_loaded"입니다. 보낼 워커가 없으면 NoWorkerAvailable.
+        요청이 끝나면 반드시 release(워커, 모델 이름)를 호출해야 합니다.
+        """
+        model_name = request.get("model_name")
+        lora_names = [name for name, _ in request_loras(request)]
+        candidates = [w for w in self.healthy_workers(exclude) if w.has_capacity()]
+        if not candidates:
+            raise NoWorkerAvailable(retry_after=self._retry_after())
+
+        with self._lock:
+            least_loaded = min(candidates, key=lambda w: (w.load(), w.routed))
+            best = max(candidates, key=lambda w: (w.affinity(model_name, lora_names), -w.load(), -w.routed))
+            if best.affinity(model_name, lora_names) > 0 and best.load() - least_loaded.load() <= self.affinity_slack:
+                chosen, reason = best, "affinity"
+            else:
+                chosen, reason = least_loaded, "least_loaded"
+            chosen.inflight += 1
+            chosen.routed += 1
+            chosen.inflight_models[model_name] = chosen.inflight_models.get(model_name, 0) + 1
+            self._stats["routed"] += 1
+            self._stats[f"{reason}_routes"] += 1
+            return chosen, reason
+
+    def release(self, worker, model_name):
+        with self._lock:
+            worker.inflight = max(0, worker.inflight - 1)
+            count = worker.inflight_models.get(model_name, 0) - 1
+            if count > 0:
+                worker.inflight_models[model_name] = count
+            else:
+                worker.inflight_models.pop(model_name, None)
+
+    def mark_failed(self, worker):
+        """연결에 실패한 워커를 잠시 라우팅 대상에서 제외합니다."""
+        with self._lock:
+            worker.failures += 1
+            worker.failed_until = time.monotonic() + self.failure_backoff
+            self._stats["failures"] += 1
+        print(f"경고: 게이트웨이: 워커 '{worker.worker_id}'({worker.url})에 연결하지 못했습니다. {self.failure_backoff:.0f}초 동안 제외합니다.")
+
+    def count_retry(self):
+        with self._lock:
+            self._stats["retries"] += 1
+
+    def stats(self):
+        now = time.monotonic()
+        workers = self.workers()
+        with self._lock:
+            stats = dict(self._stats)
+            stats["workers"] = [w.to_dict(now) for w in workers]
+        stats["healthy_workers"] = sum(1 for w in stats["workers"] if w["healthy"] and w["ready"])
+        return stats
+
+    def _retry_after(self):
+        """워커가 모두 바쁘거나 없을 때 알려 줄 Retry-After 값(초). 워커가 보고한 평균 작업 시간을 사용합니다."""
+        hints = [w.info.get("retry_after") for w in self.workers() if w.info.get("retry_after")]
+        return max(1, int(min(hints))) if hints else max(1, int(self.failure_backoff))
+
+    def _purge_expired(self):
+        # 호출자가 self._lock을 보유해야 합니다.
+        now = time.monotonic()
+        for worker_id, state in list(self._workers.items()):
+            if now - state.last_seen > self.heartbeat_timeout:
+                del self._workers[worker_id]
+                print(f"경고: 게이트웨이: 워커 '{worker_id}'의 등록이 만료되었습니다. (마지막 응답 {now - state.last_seen:.0f}초 전)")
+
+
+class GatewayClient:
+    """
+    워커 프로세스에서 게이트웨이에 자신의 상태를 주기적으로 등록하는 스레드입니다.
+    info_fn()이 반환하는 딕셔너리를 interval초마다 POST {gateway_url}/api/workers/register로 보냅니다.
+    token을 지정하면 게이트웨이가 등록/해제를 확인할 수 있도록 X-Cluster-Token 헤더로 보냅니다.
+    """
+
+    def __init__(self, gateway_url, info_fn, interval=5.0, timeout=5.0, token=None):
+        self.gateway_url = gateway_url.rstrip("/")
+        self.info_fn = info_fn
+        self.token = token
+        self.interval = interval
+        self.timeout = timeout
+        self._stop = threading.Event()
+        self._thread = None
+        self._connected = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="gateway-heartbeat", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """하트비트를 멈추고 게이트웨이에서 등록을 해제합니다. (게이트웨이가 없으면 무시)"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.timeout)
+        try:
+            worker_id = self.info_fn()["worker_id"]
+            self._send("DELETE", f"/api/workers/{worker_id}")
+        except (urllib.error.URLError, OSError):
+            pass
+
+    def register_now(self):
+        """현재 상태를 즉시 게이트웨이에 보냅니다. 실패하면 예외가 발생합니다."""
+        self._send("POST", "/api/workers/register", self.info_fn())
+
+    def _send(self, method, path, payload=None):
+        data = json.dumps(payload).encode("utf-8") if payload is not None else None
+        headers = {"Content-Type": "application/json"}
+        if self.token:
+            headers["X-Cluster-Token"] = self.token
+        request = urllib.request.Request(self.gateway_url + path, data=data, method=method, headers=headers)
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.register_now()
+                if self._connected is not True:
+                    print(f"게이트웨이 {self.gateway_url}에 워커로 등록했습니다.")
+                self._connected = True
+            except Exception as e:
+                # 게이트웨이가 재시작 중일 수 있으므로 경고만 한 번 출력하고 계속 시도합니다.
+                if self._connected is not False:
+                    print(f"경고: 게이트웨이 {self.gateway_url}에 등록하지 못했습니다. 계속 재시도합니다: {e}")
+                self._connected = False
+            self._stop.wait(self.interval)
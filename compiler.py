@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+import concurrent.futures
+import threading
+import time
+import weakref
+from contextlib import contextmanager, nullcontext
+
+import devices
+import metrics
+
+# 컴파일 대상 디노이저 구성 요소 (파이프라인에 있는 첫 번째 것을 사용)
+DENOISER_COMPONENTS = ("transformer", "unet")
+
+COMPILES_TOTAL = metrics.REGISTRY.counter(
+    "aigen_compiles_total", "디노이저 그래프 컴파일 수 (결과별)", ["result"]
+)
+DENOISE_CALLS_TOTAL = metrics.REGISTRY.counter(
+    "aigen_denoise_calls_total", "파이프라인 호출 수 (실행 방식별: compiled, eager)", ["execution"]
+)
+
+
+def _clone_inputs(value):
+    """캡처한 디노이저 입력을 복제합니다. 텐서는 분리(detach)해 복사하고, 튜플/리스트/딕셔너리는 재귀적으로 처리합니다."""
+    if hasattr(value, "detach") and hasattr(value, "clone"):
+        return value.detach().clone()
+    if isinstance(value, (list, tuple)):
+        return type(value)(_clone_inputs(v) for v in value)
+    if isinstance(value, dict):
+        return {k: _clone_inputs(v) for k, v in value.items()}
+    return value
+
+
+def configure_dynamo(max_graphs):
+    """
+    모델마다 max_graphs개의 그래프를 둘 수 있도록 torch._dynamo의 재컴파일 한도를 올립니다.
+    프로세스 전체 설정이므로 컴파일을 사용할 때 시작 시 한 번 호출합니다. (torch를 가져옴)
+    """
+    import torch
+    # 버킷 크기마다 그래프가 하나씩 필요하므로 재컴파일 한도를 max_graphs에 맞춥니다.
+    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, max_graphs)
+
+
+def _is_transient(error):
+    """다시 시도하면 성공할 수 있는 컴파일 오류인지 판단합니다. (장치 메모리 부족, 장치 이동 중 다른 장치에 있는 텐서)"""
+    return devices.is_out_of_memory(error) or (isinstance(error, RuntimeError) and "device" in str(error).lower())
+
+
+class CompiledDenoiser:
+    """
+    파이프라인 하나의 디노이저(transformer/unet)와 torch.compile 결과입니다.
+
+    그래프는 입력 모양이 고정된 채로(dynamic=False) 컴파일되므로, 키(크기, 배치, CFG, dtype, LoRA 조합)마다
+    따로 준비됩니다. keys는 키 -> 상태("compiling", "ready", "failed")입니다.
+    """
+
+    def __init__(self, attr_name, module, compiled):
+        self.attr_name = attr_name
+        self.eager = module
+        self.compiled = compiled
+        self.keys = {}
+        self.compile_seconds = {}
+        self.dtype = str(next(module.parameters()).dtype).replace("torch.", "") if hasattr(module, "parameters") else None
+
+
+class CompilePolicy:
+    """
+    모델별 선택적 torch.compile 실행 정책입니다.
+
+    - models에 포함된 모델 이름 또는 모델 타입("sd", "flux", "qwen", 모두는 "*")의 디노이저만 컴파일합니다.
+    - 처음 보는 키의 요청은 기다리지 않고 eager로 실행하면서 디노이저 입력을 캡처하고,
+      백그라운드 스레드가 캡처한 입력으로 컴파일된 모듈을 한 번 실행해 그래프를 준비합니다.
+    - 준비된 키의 요청만 컴파일된 디노이저로 실행합니다. 컴파일에 실패한 키는 계속 eager로 실행합니다.
+    - 모델마다 max_graphs개를 넘는 키는 컴파일하지 않습니다. (해상도 버킷과 함께 쓰면 키가 몇 개로 모임)
+    - 컴파일은 activate()에 전달한 guard(pipeline, key) 아래에서 실행됩니다. guard는 파이프라인 호출과 같은 잠금을 잡고
+      파이프라인이 키를 만들 때와 같은 상태인지 반환하며, 상태가 달라졌거나 메모리 부족처럼 일시적인 오류로 실패한 키는
+      failed로 남기지 않고 지워서 다음 요청에서 다시 캡처합니다.
+    """
+
+    def __init__(self, models=(), mode="default", backend="inductor", max_graphs=8, fullgraph=False):
+        self.models = set(models or ())
+        self.mode = mode
+        self.backend = backend
+        self.max_graphs = max_graphs
+        self.fullgraph = fullgraph
+        self._denoisers = weakref.WeakKeyDictionary() # pipeline -> CompiledDenoiser (또는 지원하지 않으면 None)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._stats = {"compiled_calls": 0, "eager_calls": 0, "compiles": 0, "compile_failures": 0,
+                       "compile_seconds_total": 0.0}
+
+    def enabled_for(self, model_name, model_type):
+        return bool(self.models) and ("*" in self.models or model_name in self.models or model_type in self.models)
+
+    def _denoiser(self, pipeline, placement=None):
+        """파이프라인의 CompiledDenoiser를 반환합니다. 디노이저가 없거나 CPU 오프로드 중이면 None."""
+        if pipeline in self._denoisers:
+            return self._denoisers[pipeline]
+        denoiser = None
+        # 오프로드 훅은 호출마다 가중치를 옮기므로 컴파일된 그래프와 함께 쓰지 않습니다.
+        if placement is None or not placement.offloaded:
+            for attr_name in DENOISER_COMPONENTS:
+                module = getattr(pipeline, attr_name, None)
+                if module is not None and hasattr(module, "forward"):
+                    import torch
+                    compiled = torch.compile(module, mode=self.mode, backend=self.backend,
+                                             fullgraph=self.fullgraph, dynamic=False)
+                    denoiser = CompiledDenoiser(attr_name, module, compiled)
+                    break
+        self._denoisers[pipeline] = denoiser
+        return denoiser
+
+    @contextmanager
+    def activate(self, pipeline, model_name, model_type, key, placement=None, guard=None):
+        """
+        파이프라인 호출을 감싸 키가 준비되어 있으면 컴파일된 디노이저로, 아니면 eager로 실행합니다.
+        실행 방식("compiled", "eager", "disabled")을 반환하며, 처음 보는 키는 호출이 끝난 뒤 백그라운드 컴파일을 시작합니다.
+        guard: (선택) (pipeline, key)를 받아 컴파일하는 동안 들어가 있을 컨텍스트 관리자를 반환하는 함수.
+               컨텍스트 값이 거짓이면 컴파일하지 않습니다. None이면 잠금 없이 바로 컴파일합니다.
+        """
+        guard_key = tuple(key)
+        if not self.enabled_for(model_name, model_type):
+            yield "disabled"
+            return
+        denoiser = self._denoiser(pipeline, placement)
+        if denoiser is None:
+            yield "disabled"
+            return
+        key = (denoiser.dtype,) + tuple(key)
+
+        with self._lock:
+            status = denoiser.keys.get(key)
+            capture = status is None and len(denoiser.keys) < self.max_graphs
+            if capture:
+                denoiser.keys[key] = "compiling"
+
+        if status == "ready":
+            setattr(pipeline, denoiser.attr_name, denoiser.compiled)
+            try:
+                yield "compiled"
+            finally:
+                setattr(pipeline, denoiser.attr_name, denoiser.eager)
+            self._count("compiled")
+            return
+
+        captured = {}
+        handle = None
+        if capture:
+            # 첫 디노이저 호출의 입력을 캡처해 백그라운드 컴파일에 사용합니다.
+            def capture_inputs(module, args, kwargs):
+                if not captured:
+                    captured["args"] = _clone_inputs(args)
+                    captured["kwargs"] = _clone_inputs(kwargs)
+            handle = denoiser.eager.register_forward_pre_hook(capture_inputs, with_kwargs=True)
+        try:
+            yield "eager"
+        except BaseException:
+            if capture:
+                with self._lock:
+                    denoiser.keys.pop(key, None) # 다음 요청에서 다시 캡처
+            raise
+        finally:
+            if handle is not None:
+                handle.remove()
+        self._count("eager")
+
+        if capture:
+            if captured:
+                self._submit(pipeline, denoiser, key, captured, guard, guard_key)
+            else:
+                with self._lock:
+                    denoiser.keys.pop(key, None)
+
+    def _count(self, execution):
+        DENOISE_CALLS_TOTAL.inc(execution=execution)
+        with self._lock:
+            self._stats[f"{execution}_calls"] += 1
+
+    def _submit(self, pipeline, denoiser, key, captured, guard, guard_key):
+        with self._lock:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="compile")
+        # 컴파일을 기다리는 동안 파이프라인이 캐시에서 제거될 수 있으므로 약한 참조로 넘깁니다.
+        self._executor.submit(self._compile, weakref.ref(pipeline), denoiser, key, captured, guard, guard_key)
+
+    def _compile(self, pipeline_ref, denoiser, key, captured, guard, guard_key):
+        """캡처한 입력으로 컴파일된 디노이저를 한 번 실행해 이 키의 그래프를 준비합니다. (백그라운드 스레드)"""
+        import torch
+        pipeline = pipeline_ref()
+        if pipeline is None:
+            return
+        with guard(pipeline, guard_key) if guard is not None else nullcontext(True) as ready:
+            if not ready:
+                # 모델이나 LoRA 상태가 바뀌어 캡처한 입력과 가중치가 맞지 않으므로 다음 요청에서 다시 캡처합니다.
+                with self._lock:
+                    denoiser.keys.pop(key, None)
+                return
+            start = time.perf_counter()
+            try:
+                # 파이프라인 호출과 같은 no_grad 상태로 실행해야 같은 그래프(가드)가 만들어집니다.
+                with torch.no_grad():
+                    denoiser.compiled(*captured["args"], **captured["kwargs"])
+                result = "ready"
+            except Exception as e:
+                if _is_transient(e):
+                    print(f"경고: 디노이저 컴파일이 일시적인 오류로 중단되었습니다. 다음 요청에서 다시 시도합니다. ({key}: {e})")
+                    result = None
+                    devices.empty_cache()
+                else:
+                    print(f"경고: 디노이저 컴파일에 실패했습니다. 이 크기는 eager로 실행합니다. ({key}: {e})")
+                    result = "failed"
+        elapsed = time.perf_counter() - start
+        if result is None:
+            COMPILES_TOTAL.inc(result="retry")
+            with self._lock:
+                denoiser.keys.pop(key, None)
+                self._stats["compile_failures"] += 1
+            return
+        metrics.record_stage("compile", elapsed)
+        COMPILES_TOTAL.inc(result=result)
+        with self._lock:
+            denoiser.keys[key] = result
+            denoiser.compile_seconds[key] = elapsed
+            self._stats["compiles" if result == "ready" else "compile_failures"] += 1
+            self._stats["compile_seconds_total"] += elapsed
+        if result == "ready":
+            print(f"디노이저 컴파일 완료: {denoiser.attr_name} {key} ({elapsed:.1f}초)")
+
+    def wait(self, timeout=None):
+        """진행 중인 백그라운드 컴파일이 끝날 때까지 기다립니다. (벤치마크/예열용)"""
+        with self._lock:
+            executor = self._executor
+        if executor is not None:
+            executor.submit(lambda: None).result(timeout=timeout)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["models"] = sorted(self.models)
+            stats["graphs"] = [
+                {"component": d.attr_name, "key": list(map(str, key)), "status": status,
+                 "compile_seconds": d.compile_seconds.get(key)}
+                for d in self._denoisers.values() if d is not None
+                for key, status in d.keys.items()
+            ]
+        return stats
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
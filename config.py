@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import sys
+
+# --- 휴대용 실행 파일을 위한 경로 설정 ---
+if getattr(sys, 'frozen', False):
+    BASE_PATH = os.path.dirname(sys.executable)
+else:
+    BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+
+CONFIG_PATH = os.environ.get("AIGEN_CONFIG", os.path.join(BASE_PATH, "config.json"))
+
+# 서버 설정 기본값. config.json 또는 AIGEN_<KEY> 환경 변수로 덮어쓸 수 있습니다.
+DEFAULTS = {
+    # python app.py로 실행할 때 API 서버가 듣는 주소와 포트
+    "host": "0.0.0.0",
+    "port": 8888,
+    # 작업 큐에 대기할 수 있는 최대 작업 수 (초과 시 503 + Retry-After)
+    "queue_size": 16,
+    # 평균 작업 시간을 알 수 없을 때 사용할 Retry-After 기본값 (초)
+    "retry_after": 10,
+    # 완료된 작업 결과를 보관하는 시간 (초)
+    "job_ttl": 600,
+    # SSE 진행률 스트림에서 변경이 없을 때 상태를 다시 보내는 간격 (초)
+    "sse_keepalive": 5,
+    # 호환되는(모델, LoRA, 크기, 스텝, 가이던스가 같은) 요청을 한 번에 생성할 최대 배치 크기
+    "max_batch_size": 4,
+    # 배치를 채우기 위해 첫 작업 이후 추가 작업을 기다리는 최대 시간 (밀리초)
+    "batch_wait_ms": 20,
+    # GPU에 동시에 상주시킬 모델들의 메모리 예산 (GB). 0이면 사용 중인 모델 하나만 GPU에 유지, null이면 제한 없음
+    "gpu_memory_budget_gb": 0,
+    # GPU에서 내린 모델을 보관할 CPU RAM 예산 (GB). 0이면 내린 모델을 바로 메모리에서 제거
+    "cpu_memory_budget_gb": 16,
+    # 예산 초과 시 내보낼 모델 선택 정책: "lru" 또는 "cost"(다시 불러오는 비용이 작은 모델 우선)
+    "model_cache_policy": "lru",
+    # 서버 시작 시 미리 로드할 모델. 모델 이름 또는 {"model_name": ..., "loras": [LoRA 파일 이름, ...], "pin": true}
+    "preload_models": [],
+    # GPU에서 내리거나 캐시에서 제거하지 않을 모델 이름 목록 (예산을 넘더라도 유지)
+    "pinned_models": [],
+    # 미리 로드한 모델마다 예열 렌더링을 할 해상도 목록 ([너비, 높이]). 빈 목록이면 로딩만 함
+    "warmup_resolutions": [[1024, 1024]],
+    # 예열 렌더링의 스텝 수
+    "warmup_steps": 2,
+    # 서버 시작 시 torch/diffusers를 미리 가져옴 (첫 요청의 라이브러리 로딩 시간 제거)
+    "preload_libraries": True,
+    # 모델을 실행할 장치: "auto"(cuda, xpu, mps, cpu 순으로 사용 가능한 장치), "cuda", "xpu", "mps", "cpu"
+    "device": "auto",
+    # 가중치 dtype: "auto"(CUDA는 bf16 지원 시 bfloat16 아니면 float16, XPU는 bfloat16, MPS는 float16, CPU는 float32),
+    # "float16", "bfloat16", "float32"
+    "dtype": "auto",
+    # CPU 오프로드: "auto"(남은 장치 메모리로 결정), "none", "model"(구성 요소 단위), "sequential"(레이어 단위, 가장 느림)
+    "offload": "auto",
+    # 모델 이름 또는 모델 타입("sd", "flux", "qwen")별로 device, dtype, offload를 덮어쓰는 설정
+    # 예: {"black-forest-labs/FLUX.1-dev": {"offload": "model"}, "sd": {"dtype": "float16"}}
+    "model_placements": {},
+    # VAE 타일링(큰 이미지를 타일로 나누어 디코딩): "auto"(vae_tiling_min_pixels 이상이거나 메모리가 부족할 때), true, false
+    "vae_tiling": "auto",
+    "vae_tiling_min_pixels": 1536 * 1536,
+    # VAE 슬라이싱(배치를 한 장씩 디코딩): "auto"(배치가 2장 이상일 때), true, false
+    "vae_slicing": "auto",
+    # 해상도 버킷 정책: "exact"(요청 크기 그대로), "snap"(가장 가까운 버킷 크기로 생성해 반환),
+    # "snap_resize"/"snap_crop"(버킷 크기로 생성한 뒤 요청 크기로 크기 조정/가운데 자르기). 요청의 resolution_mode가 우선
+    "resolution_mode": "exact",
+    # 모델 타입("sd", "flux", "qwen", 그 밖의 타입은 "default")별 버킷 [[너비, 높이], ...]. 지정한 타입만 기본값을 덮어씀
+    "resolution_buckets": {},
+    # 속도 모드 기본값: "off"(모든 스텝 전체 계산), "fast", "fastest"(스텝 사이에 디노이저 블록 출력 재사용). 요청의 speed_mode가 우선
+    "speed_mode": "off",
+    # 속도 모드별 블록 캐시 설정 {모드: {"interval": 전체 계산 사이 최대 간격, "threshold": 첫 블록 출력 변화 기준}}. 지정한 모드만 기본값을 덮어씀
+    "speed_presets": {},
+    # 고해상도 모드 기본값: "off"(요청 크기로 한 번에 생성), "auto"(highres_min_pixels 이상이면 2단계 생성), "on"(버킷보다 크면 항상)
+    # 2단계 생성: 가장 가까운 해상도 버킷 크기로 생성 -> 요청 크기로 확대 -> 겹치는 타일마다 img2img로 다시 디노이징. 요청의 highres_mode가 우선
+    "highres_mode": "off",
+    "highres_min_pixels": 1536 * 1536,
+    # 다시 디노이징할 타일 크기와 이웃 타일과 겹치는 폭 (픽셀). 최대 메모리는 타일 크기에 비례
+    "highres_tile_size": 1024,
+    "highres_tile_overlap": 128,
+    # 타일을 다시 디노이징하는 강도 (0~1, 전체 스텝 중 실행할 비율). 높을수록 세부가 많아지지만 타일 사이 구도가 어긋날 수 있음
+    "highres_strength": 0.35,
+    # 디노이저(transformer/unet)를 torch.compile로 실행할 모델 이름 또는 모델 타입 목록. "*"이면 모든 모델, 빈 목록이면 사용 안 함
+    "compile_models": [],
+    # torch.compile 모드("default", "max-autotune-no-cudagraphs", "reduce-overhead"(CUDA 그래프))와 백엔드
+    "compile_mode": "default",
+    "compile_backend": "inductor",
+    # 모델마다 컴파일해 둘 최대 그래프 수 (크기, 배치, CFG, LoRA 조합마다 하나)
+    "compile_max_graphs": 8,
+    # 모델별로 로드해 둘 LoRA 어댑터의 최대 개수. 넘으면 가장 오래 사용하지 않은 어댑터를 제거
+    "max_loras_per_model": 4,
+    # 최근 lora_fuse_window번의 생성 중 같은 (모델, LoRA, 강도) 조합이 이 횟수 이상 쓰이면 LoRA를 기본 가중치에 병합. 0이면 사용 안 함
+    "lora_fuse_threshold": 0,
+    "lora_fuse_window": 16,
+    # 프롬프트 임베딩(텍스트 인코더 출력) 캐시의 최대 크기 (MB). 0이면 사용 안 함
+    "prompt_cache_mb": 512,
+    # 캐시된 임베딩을 보관할 장치: "cpu"(GPU 메모리 절약) 또는 null(GPU에 그대로 보관)
+    "prompt_cache_device": "cpu",
+    # 시드가 고정된 요청의 결과 이미지를 디스크에 보관하는 캐시의 최대 크기 (MB). 0이면 사용 안 함
+    "result_cache_mb": 1024,
+    # 결과 캐시 디렉토리. null이면 ~/AI-cache/results
+    "result_cache_dir": None,
+    # SDNQ 최적화를 마친 모델 구성 요소와 torch.compile 결과를 보관하는 아티팩트 캐시의 최대 크기 (GB). 0이면 사용 안 함, null이면 제한 없음
+    "artifact_cache_gb": 50,
+    # 아티팩트 캐시 디렉토리. null이면 ~/AI-cache/artifacts
+    "artifact_cache_dir": None,
+    # 모델/LoRA 디렉토리 변경(추가, 삭제, 다운로드 완료)을 확인하는 간격 (초). 0이면 서버 시작 시 한 번만 스캔
+    "registry_poll_interval": 5,
+    # 요청에 output_format이 없고 Accept 헤더로도 정해지지 않을 때 사용할 출력 형식: "png", "webp", "jpeg", "raw"
+    "default_output_format": "png",
+    # 출력 형식별 기본 압축 옵션 (png는 0~9, 낮을수록 빠르고 파일이 큼)
+    "png_compress_level": 6,
+    "webp_quality": 90,
+    "jpeg_quality": 90,
+    # 이미지 인코딩 스레드 수
+    "encode_workers": 2,
+    # 작업 스케줄링 정책: "affinity"(같은 모델/LoRA 작업을 묶어 전환 최소화) 또는 "fifo"
+    "scheduler": "affinity",
+    # affinity 정책에서 이 시간(초) 이상 기다린 작업은 무조건 먼저 처리 (기아 방지)
+    "scheduler_max_wait": 60,
+    # 클라이언트별 우선순위. 값이 클수록 먼저 처리 (기본 0)
+    # 키는 X-API-Key 값(client_priorities나 client_limits에 등록된 키만 인정), 신뢰하는 프록시가 보낸 X-Client-Id 값, 또는 접속 IP
+    "client_priorities": {},
+    # 클라이언트별 GPU 시간 예산: client_cost_window초 동안 예상 생성 시간 합계 client_cost_budget초까지 받음 (0이면 제한 없음)
+    "client_cost_budget": 0,
+    "client_cost_window": 60,
+    # 클라이언트별 동시 작업(대기 + 실행) 수 제한 (0이면 제한 없음)
+    "client_max_jobs": 0,
+    # 클라이언트별로 cost_budget, max_jobs를 덮어쓰는 설정. 예: {"batch-client": {"cost_budget": 600, "max_jobs": 4}}
+    "client_limits": {},
+    # 비용 모델의 초기값: 관측이 없을 때 쓰는 작업량 단위(1024×1024 한 장의 스텝 하나)당 시간과 작업당 고정 시간 (초)
+    "cost_prior_unit_seconds": 0.2,
+    "cost_prior_overhead": 1.0,
+    # 워커 모드: 이 서버를 등록할 게이트웨이 주소 (예: "http://gateway:8880"). null이면 단독 서버로 동작
+    "gateway_url": None,
+    # X-Client-Id 헤더를 믿을 프록시의 주소(호스트 이름 또는 IP) 목록. gateway_url의 호스트는 자동으로 포함.
+    # 그 밖에서 온 요청의 X-Client-Id는 무시하고 접속 IP로 클라이언트를 구분
+    "trusted_proxies": [],
+    # 게이트웨이가 이 워커에 접속할 주소. null이면 http://<호스트 이름>:<port>
+    "worker_url": None,
+    # 게이트웨이에 상태(상주 모델, LoRA, 큐 길이)를 다시 등록하는 간격 (초)
+    "worker_heartbeat": 5,
+    # 워커와 게이트웨이가 공유하는 비밀 토큰. 게이트웨이는 X-Cluster-Token 헤더가 이 값과 같은 워커 등록/해제만 받음.
+    # null이면 게이트웨이와 같은 호스트(루프백 주소)에서 온 등록/해제만 받음
+    "cluster_token": None,
+    # 게이트웨이: python gateway.py로 실행할 때 듣는 포트 (주소는 host)
+    "gateway_port": 8880,
+    # 게이트웨이: 이 시간(초) 동안 등록이 없는 워커는 목록에서 제거
+    "worker_timeout": 15,
+    # 게이트웨이: 워커 연결 실패나 큐 가득 참(503) 시 다른 워커로 다시 보내는 최대 횟수
+    "gateway_retries": 2,
+    # 게이트웨이: 모델을 가진 워커의 대기 작업이 가장 한가한 워커보다 이 개수를 넘게 많으면 한가한 워커로 보냄
+    "gateway_affinity_slack": 4,
+    # 게이트웨이: 연결에 실패한 워커를 라우팅에서 제외하는 시간 (초)
+    "gateway_failure_backoff": 5,
+    # 게이트웨이: 워커 요청 하나의 제한 시간 (초)과 동시에 보낼 수 있는 최대 요청 수
+    "gateway_request_timeout": 600,
+    "gateway_connections": 64,
+    # 파이프라인 백엔드: "diffusers"(실제 모델) 또는 "fake"(CPU용 가짜 파이프라인)
+    "backend": "diffusers",
+    # fake 백엔드의 스텝당 지연 시간과 이미지당 디코드 지연 시간 (초)
+    "fake_step_latency": 0.05,
+    "fake_decode_latency": 0.02,
+    # fake 백엔드의 지연 시간 중 픽셀 수에 비례하는 비율 (0이면 크기와 무관, 1이면 1024×1024 대비 픽셀 수에 비례)
+    "fake_pixel_cost": 0.0,
+    # fake 백엔드의 모델 로딩 지연 시간 (초)과 가상의 모델 크기 (GB)
+    "fake_load_latency": 2.0,
+    "fake_memory_gb": 8.0,
+    # fake 백엔드의 LoRA 로딩 지연 시간과 장치 간 이동(GPU <-> CPU) 지연 시간 (초)
+    "fake_lora_load_latency": 0.0,
+    "fake_transfer_latency": 0.0,
+}
+
+def _parse_env_value(value):
+    """환경 변수 값을 JSON으로 해석하고, 실패하면 문자열 그대로 반환합니다."""
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+def load_config(path=CONFIG_PATH):
+    """
+    기본값, config.json, 환경 변수 순서로 설정을 병합하여 반환합니다.
+    예: AIGEN_QUEUE_SIZE=32 는 "queue_size" 값을 32로 설정합니다.
+    """
+    settings = dict(DEFAULTS)
+
+    if path and os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                settings.update(json.load(f))
+        except (OSError, ValueError) as e:
+            print(f"경고: 설정 파일 '{path}'을(를) 읽지 못했습니다: {e}")
+
+    for key in list(settings.keys()):
+        env_value = os.environ.get(f"AIGEN_{key.upper()}")
+        if env_value is not None:
+            settings[key] = _parse_env_value(env_value)
+
+    return settings
+
+config = load_config()
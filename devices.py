@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import weakref
+
+# 지원하는 장치와 자동 선택 순서
+DEVICE_ORDER = ("cuda", "xpu", "mps", "cpu")
+OFFLOAD_MODES = ("auto", "none", "model", "sequential")
+DTYPE_NAMES = ("auto", "float16", "bfloat16", "float32")
+
+# 자동 배치에서 모델 외에 남겨 둘 여유 메모리 비율 (활성화 텐서, VAE 디코딩 등)
+MEMORY_HEADROOM = 0.25
+# VAE 디코딩에 필요한 메모리를 추정할 때 쓰는 출력 픽셀당 바이트 수 (fp16 기준의 대략적인 값)
+VAE_DECODE_BYTES_PER_PIXEL = 3000
+
+
+def _torch():
+    """이미 로드된 torch 모듈을 반환합니다. 없으면 가져옵니다. (설치되어 있지 않으면 None)"""
+    torch = sys.modules.get("torch")
+    if torch is not None:
+        return torch
+    try:
+        import torch
+        return torch
+    except ImportError:
+        return None
+
+
+def is_available(device):
+    """장치를 현재 환경에서 사용할 수 있는지 반환합니다."""
+    if device == "cpu":
+        return True
+    torch = _torch()
+    if torch is None:
+        return False
+    if device == "cuda":
+        return torch.cuda.is_available()
+    if device == "xpu":
+        return hasattr(torch, "xpu") and torch.xpu.is_available()
+    if device == "mps":
+        return hasattr(torch.backends, "mps") and torch.backends.mps.is_available()
+    return False
+
+
+def resolve_device(requested="auto"):
+    """
+    설정된 장치 이름을 실제로 사용할 장치로 정합니다.
+    "auto"이면 cuda, xpu, mps, cpu 순서로 사용 가능한 첫 장치를, 지정한 장치를 쓸 수 없으면 경고 후 cpu를 사용합니다.
+    """
+    requested = (requested or "auto").lower()
+    if requested == "auto":
+        return next(device for device in DEVICE_ORDER if is_available(device))
+    if requested not in DEVICE_ORDER:
+        raise ValueError(f"지원하지 않는 장치입니다: {requested} (지원: auto, {', '.join(DEVICE_ORDER)})")
+    if not is_available(requested):
+        print(f"경고: 장치 '{requested}'을(를) 사용할 수 없어 CPU로 실행합니다.")
+        return "cpu"
+    return requested
+
+
+def resolve_dtype(device, requested="auto"):
+    """
+    장치에 맞는 torch dtype을 반환합니다.
+    auto: CUDA는 bf16을 지원하면 bfloat16, 아니면 float16 / XPU는 bfloat16 / MPS는 float16 / CPU는 float32
+    """
+    torch = _torch()
+    requested = (requested or "auto").lower()
+    if requested != "auto":
+        if requested not in DTYPE_NAMES:
+            raise ValueError(f"지원하지 않는 dtype입니다: {requested} (지원: {', '.join(DTYPE_NAMES)})")
+        return getattr(torch, requested)
+    if device == "cuda":
+        return torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+    if device == "xpu":
+        return torch.bfloat16
+    if device == "mps":
+        return torch.float16
+    # CPU에서 반정밀도 연산은 지원되지 않거나 매우 느린 경우가 많습니다.
+    return torch.float32
+
+
+def free_memory(device):
+    """장치의 사용 가능한 메모리(바이트)를 반환합니다. 알 수 없으면 None."""
+    torch = _torch()
+    try:
+        if device == "cuda":
+            free, _ = torch.cuda.mem_get_info()
+            return free
+        if device == "xpu":
+            properties = torch.xpu.get_device_properties(0)
+            return properties.total_memory - torch.xpu.memory_reserved(0)
+        if device in ("cpu", "mps"):
+            # MPS는 시스템 메모리를 함께 사용합니다.
+            return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except Exception:
+        return None
+    return None
+
+
+def empty_cache():
+    """사용 가능한 가속기(CUDA, XPU, MPS)의 캐시된 메모리를 반환합니다. torch가 로드되지 않았으면 아무것도 하지 않습니다."""
+    torch = sys.modules.get("torch")
+    if torch is None:
+        return
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    if hasattr(torch, "xpu") and torch.xpu.is_available():
+        torch.xpu.empty_cache()
+    if hasattr(torch, "mps") and hasattr(torch.backends, "mps") and torch.backends.mps.is_available():
+        torch.mps.empty_cache()
+
+
+def generator_device(device):
+    """torch.Generator를 만들 장치. MPS에서는 난수 재현성을 위해 CPU 생성기를 사용합니다."""
+    return device if device in ("cuda", "xpu") else "cpu"
+
+
+def component_bytes(pipeline):
+    """파이프라인 구성 요소별 파라미터/버퍼 크기(바이트)를 반환합니다."""
+    sizes = {}
+    for name, component in (getattr(pipeline, "components", None) or {}).items():
+        total = 0
+        for attr in ("parameters", "buffers"):
+            tensors = getattr(component, attr, None)
+            if not callable(tensors):
+                continue
+            try:
+                total += sum(t.numel() * t.element_size() for t in tensors())
+            except Exception:
+                pass
+        if total:
+            sizes[name] = total
+    return sizes
+
+
+class Placement:
+    """
+    모델 하나의 장치 배치 방법입니다.
+    offload: "none"(전체를 장치에 올림), "model"(구성 요소 단위로 필요할 때만 올림),
+             "sequential"(레이어 단위로 올림, 가장 느리지만 메모리를 가장 적게 씀)
+    """
+
+    def __init__(self, device="cuda", dtype=None, offload="none"):
+        self.device = device
+        self.dtype = dtype
+        self.offload = offload
+
+    @property
+    def offloaded(self):
+        return self.offload != "none"
+
+    def device_bytes(self, size_bytes, components=None):
+        """이 배치에서 장치 메모리를 계속 차지하는 크기를 추정합니다. (CPU 실행과 순차 오프로드는 0)"""
+        if self.device == "cpu" or self.offload == "sequential":
+            return 0
+        if self.offload == "model":
+            return max(components.values()) if components else size_bytes
+        return size_bytes
+
+    def to_dict(self):
+        return {"device": self.device, "dtype": str(self.dtype).replace("torch.", "") if self.dtype else None,
+                "offload": self.offload}
+
+
+def choose_offload(device, size_bytes, components, requested="auto"):
+    """
+    사용 가능한 메모리로 오프로드 방식을 정합니다.
+    auto: 모델 전체가 여유 있게 들어가면 none, 가장 큰 구성 요소가 들어가면 model, 아니면 sequential
+    """
+    if requested not in OFFLOAD_MODES:
+        raise ValueError(f"지원하지 않는 오프로드 방식입니다: {requested} (지원: {', '.join(OFFLOAD_MODES)})")
+    if device == "cpu":
+        return "none"
+    if requested != "auto":
+        return requested
+    free = free_memory(device)
+    if free is None or size_bytes * (1 + MEMORY_HEADROOM) <= free:
+        return "none"
+    largest = max(components.values()) if components else size_bytes
+    if largest * (1 + MEMORY_HEADROOM) <= free:
+        return "model"
+    return "sequential"
+
+
+def apply_offload(pipeline, placement):
+    """오프로드 방식에 맞게 accelerate 훅을 설치합니다. (none이면 아무것도 하지 않음)"""
+    if placement.offload == "model":
+        pipeline.enable_model_cpu_offload(device=placement.device)
+    elif placement.offload == "sequential":
+        pipeline.enable_sequential_cpu_offload(device=placement.device)
+
+
+class VaeMemoryPolicy:
+    """
+    요청 크기에 따라 VAE 타일링(큰 이미지를 타일로 나누어 디코딩)과 슬라이싱(배치를 한 장씩 디코딩)을 켜고 끕니다.
+    mode: "auto", True(항상), False(사용 안 함)
+    """
+
+    def __init__(self, tiling="auto", slicing="auto", tiling_min_pixels=1536 * 1536):
+        self.tiling = tiling
+        self.slicing = slicing
+        self.tiling_min_pixels = tiling_min_pixels
+        self._state = weakref.WeakKeyDictionary() # pipeline -> 현재 (tiling, slicing) 설정
+
+    def wants_tiling(self, device, width, height, batch_size):
+        if self.tiling != "auto":
+            return bool(self.tiling)
+        pixels = width * height
+        if pixels >= self.tiling_min_pixels:
+            return True
+        # 디코딩에 필요한 메모리가 남은 장치 메모리를 넘을 것 같으면 작은 이미지도 타일로 나눕니다.
+        free = free_memory(device) if device != "cpu" else None
+        return free is not None and pixels * batch_size * VAE_DECODE_BYTES_PER_PIXEL > free
+
+    def wants_slicing(self, batch_size):
+        if self.slicing != "auto":
+            return bool(self.slicing)
+        return batch_size > 1
+
+    def configure(self, pipeline, device, width, height, batch_size, force=False):
+        """파이프라인의 VAE 타일링/슬라이싱을 요청에 맞게 설정합니다. force=True이면 둘 다 켭니다. (메모리 부족 후 재시도)"""
+        tiling = force or self.wants_tiling(device, width, height, batch_size)
+        slicing = force or self.wants_slicing(batch_size)
+        if self._state.get(pipeline) == (tiling, slicing):
+            return
+        for enabled, name in ((tiling, "tiling"), (slicing, "slicing")):
+            method = getattr(pipeline, f"{'enable' if enabled else 'disable'}_vae_{name}", None)
+            if method is None:
+                continue
+            try:
+                method()
+            except Exception as e:
+                print(f"경고: VAE {name} 설정을 바꾸지 못했습니다: {e}")
+        self._state[pipeline] = (tiling, slicing)
+
+
+def is_out_of_memory(error):
+    """장치 메모리 부족 오류인지 판단합니다. (torch.cuda.OutOfMemoryError, XPU/MPS의 out of memory RuntimeError)"""
+    return type(error).__name__ == "OutOfMemoryError" or "out of memory" in str(error).lower()
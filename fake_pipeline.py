@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import os
+import random
+import struct
+import time
+from types import SimpleNamespace
+
+from PIL import Image
+
+from model_handler import get_model_type
+
+
+# fuse_lora()가 LoRA 변화량을 더하는 기본 가중치의 크기 (색 단위).
+# 병합한 가중치는 bfloat16으로 저장되므로, 이 크기 근처에서는 변화량이 1~2 단위로 반올림됩니다. (실제 병합 오차의 원인)
+FUSED_BASE_WEIGHT = 256.0
+
+
+def to_bfloat16(value):
+    """float 값을 bfloat16(가수 7비트)으로 반올림합니다. (가장 가까운 짝수로)"""
+    bits = struct.unpack("<I", struct.pack("<f", value))[0]
+    bits = (bits + 0x7FFF + ((bits >> 16) & 1)) & 0xFFFF0000
+    return struct.unpack("<f", struct.pack("<I", bits))[0]
+
+
+def lora_delta(name):
+    """LoRA 파일 이름별로 정해지는, 강도 1일 때 색에 더해지는 (R, G, B) 변화량 (-64~64)"""
+    digest = hashlib.sha256(f"lora|{name}".encode("utf-8")).digest()
+    return tuple(value / 255 * 128 - 64 for value in digest[:3])
+
+
+def lora_offset(loras):
+    """(LoRA 파일 이름, 강도) 목록이 색에 더하는 변화량의 합"""
+    offset = [0.0, 0.0, 0.0]
+    for name, weight in loras:
+        for channel, delta in enumerate(lora_delta(name)):
+            offset[channel] += delta * weight
+    return offset
+
+
+def render_color(model_name, loras, prompt, seed, fused_offset=None):
+    """
+    FakePipeline이 만드는 이미지의 RGB 색입니다. (결과 검증용)
+    (모델, 프롬프트, 시드)로 정해지는 기본 색에 활성 LoRA [(파일 이름, 강도)]의 변화량과
+    기본 가중치에 병합된 변화량(fused_offset)을 더합니다.
+    """
+    digest = hashlib.sha256(f"{model_name}|{prompt}|{seed}".encode("utf-8")).digest()
+    offset = lora_offset(loras)
+    if fused_offset is not None:
+        offset = [a + b for a, b in zip(offset, fused_offset)]
+    return tuple(max(0, min(255, round(64 + base / 2 + delta))) for base, delta in zip(digest[:3], offset))
+
+
+class FakeEmbedding:
+    """FakePipeline.encode_prompt()가 반환하는 가짜 텍스트 임베딩입니다."""
+
+    def __init__(self, text, nbytes=4096):
+        self.text = text
+        self.nbytes = nbytes
+
+    def to(self, device):
+        return self
+
+
+class FakePipeline:
+    """
+    GPU와 모델 가중치 없이 CPU에서 동작하는 가짜 DiffusionPipeline입니다.
+    diffusers 파이프라인과 같은 호출 규약을 따르며, 스텝/디코드 지연 시간을 설정해
+    워커, 배칭, 캐시 등을 실제 모델 없이 측정하고 검증하는 데 사용합니다.
+
+    생성되는 이미지는 (모델 이름, 프롬프트, 시드)에 의해 결정적으로 정해집니다.
+    """
+
+    def __init__(self, model_name, step_latency=0.05, decode_latency=0.02, batch_cost=0.25, memory_gb=2.0,
+                 lora_step_cost=0.1, encode_latency=0.01, lora_load_latency=0.0, transfer_latency=0.0, pixel_cost=0.0):
+        """
+        step_latency: 디노이징 스텝 하나에 걸리는 시간 (초, 배치 크기 1 기준)
+        decode_latency: 이미지 한 장의 VAE 디코드 시간 (초)
+        batch_cost: 배치에 샘플이 하나 늘 때마다 추가되는 스텝 시간의 비율
+        lora_step_cost: 병합되지 않은 활성 어댑터 하나당 추가되는 스텝 시간의 비율
+        encode_latency: 프롬프트 하나를 텍스트 인코더로 인코딩하는 시간 (초)
+        lora_load_latency: LoRA 파일 하나를 로드하는 시간 (초)
+        transfer_latency: 파이프라인을 다른 장치(GPU <-> CPU)로 옮기는 시간 (초)
+        pixel_cost: 스텝/디코드 시간 중 픽셀 수에 비례하는 비율 (0이면 크기와 무관, 1이면 1024×1024 대비 픽셀 수에 비례)
+        memory_gb: PipelineCache가 예산 계산에 사용할 가상의 모델 크기 (GB)
+        """
+        self.model_name = model_name
+        self.step_latency = step_latency
+        self.decode_latency = decode_latency
+        self.batch_cost = batch_cost
+        self.lora_step_cost = lora_step_cost
+        self.encode_latency = encode_latency
+        self.lora_load_latency = lora_load_latency
+        self.transfer_latency = transfer_latency
+        self.pixel_cost = pixel_cost
+        self.memory_bytes = int(memory_gb * 1024 ** 3)
+        self.device = "cpu"
+        self.adapters = {}
+        self.active_adapters = []
+        self.adapter_weights = []
+        self.lora_enabled = True
+        self.fused_loras = None # fuse_lora()로 병합된 (LoRA 파일 이름, 강도) 목록
+        self.fused_offset = None # 기본 가중치에 병합된 LoRA 변화량 (bfloat16 정밀도로 저장)
+        self.peak_pixels = 0 # 한 번의 호출에서 디노이징한 최대 픽셀 수 (배치 포함). 실제 파이프라인의 최대 활성화 메모리에 비례
+
+    # --- diffusers 호환 메서드 ---
+    def to(self, device):
+        if device != self.device:
+            time.sleep(self.transfer_latency)
+        self.device = device
+        return self
+
+    def load_lora_weights(self, path, adapter_name="default"):
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        time.sleep(self.lora_load_latency)
+        self.adapters[adapter_name] = path
+
+    def set_adapters(self, adapter_names, adapter_weights=None):
+        if isinstance(adapter_names, str):
+            adapter_names = [adapter_names]
+        missing = [name for name in adapter_names if name not in self.adapters]
+        if missing:
+            raise ValueError(f"로드되지 않은 어댑터: {missing}")
+        self.active_adapters = list(adapter_names)
+        self.adapter_weights = list(adapter_weights) if adapter_weights is not None else [1.0] * len(adapter_names)
+
+    def delete_adapter(self, adapter_names):
+        if isinstance(adapter_names, str):
+            adapter_names = [adapter_names]
+        for name in adapter_names:
+            self.adapters.pop(name, None)
+        active = [(name, weight) for name, weight in zip(self.active_adapters, self.adapter_weights) if name in self.adapters]
+        self.active_adapters = [name for name, _ in active]
+        self.adapter_weights = [weight for _, weight in active]
+
+    def disable_lora(self):
+        self.lora_enabled = False
+
+    def enable_lora(self):
+        self.lora_enabled = True
+
+    def fuse_lora(self, adapter_names=None, lora_scale=1.0, **kwargs):
+        if self.fused_loras is not None:
+            raise ValueError("이미 병합된 LoRA가 있습니다. 먼저 unfuse_lora()를 호출하세요.")
+        self.fused_loras = [(name, weight * lora_scale) for name, weight in self._active_loras(adapter_names)]
+        # 병합은 어댑터 변화량을 큰 기본 가중치에 더해 bfloat16으로 저장하므로 변화량의 아랫자리가 잘립니다.
+        # 그래서 병합한 결과는 병합하지 않은 결과와 채널마다 최대 1~2 정도 다릅니다.
+        self.fused_offset = [to_bfloat16(FUSED_BASE_WEIGHT + value) - FUSED_BASE_WEIGHT
+                             for value in lora_offset(self.fused_loras)]
+
+    def unfuse_lora(self, **kwargs):
+        self.fused_loras = None
+        self.fused_offset = None
+
+    def _active_loras(self, adapter_names=None):
+        """병합되지 않은 채 스텝마다 계산되는 (LoRA 파일 이름, 강도) 목록입니다."""
+        if not self.lora_enabled:
+            return []
+        return [(os.path.basename(self.adapters[name]), weight)
+                for name, weight in zip(self.active_adapters, self.adapter_weights)
+                if adapter_names is None or name in adapter_names]
+
+    def encode_prompt(self, prompt, device=None, do_classifier_free_guidance=False, **kwargs):
+        prompts = [prompt] if isinstance(prompt, str) else list(prompt)
+        time.sleep(self.encode_latency * len(prompts))
+        return [FakeEmbedding(text) for text in prompts], None
+
+    def make_generator(self, seed):
+        """torch.Generator 대신 사용할 결정적 난수 생성기를 만듭니다."""
+        generator = random.Random(int(seed))
+        generator.initial_seed = int(seed)
+        return generator
+
+    def __call__(self, prompt=None, width=1024, height=1024, num_inference_steps=8, generator=None,
+                 callback_on_step_end=None, negative_prompt=None, guidance_scale=0.0, prompt_embeds=None, image=None,
+                 strength=1.0, **kwargs):
+        # image가 있으면 img2img: 입력 이미지 크기로 strength 비율의 스텝만 디노이징합니다.
+        if image is not None:
+            width, height = image.size
+            num_inference_steps = min(num_inference_steps, max(1, int(num_inference_steps * strength)))
+        if prompt_embeds is None:
+            prompt_embeds, _ = self.encode_prompt(prompt)
+        prompts = [embedding.text for embedding in prompt_embeds]
+        if generator is None:
+            generators = [random.Random() for _ in prompts]
+        elif isinstance(generator, list):
+            generators = generator
+        else:
+            generators = [generator] * len(prompts)
+
+        batch_size = len(prompts)
+        self.peak_pixels = max(self.peak_pixels, width * height * batch_size)
+        # 병합된 어댑터는 기본 가중치에 포함되어 추가 비용이 없고, 병합되지 않은 어댑터만 스텝마다 비용이 듭니다.
+        unfused_adapters = 0 if self.fused_loras is not None else len(self._active_loras())
+        step_seconds = self.step_latency * (1 + self.batch_cost * (batch_size - 1)) * (1 + self.lora_step_cost * unfused_adapters)
+        size_factor = 1 + self.pixel_cost * (width * height / (1024 * 1024) - 1)
+        step_seconds *= size_factor
+        for step_index in range(num_inference_steps):
+            time.sleep(step_seconds)
+            if callback_on_step_end is not None:
+                callback_on_step_end(self, step_index, num_inference_steps - step_index, {})
+
+        images = []
+        for text, gen in zip(prompts, generators):
+            time.sleep(self.decode_latency * size_factor)
+            rendered = self._render(text, gen, width, height)
+            images.append(Image.blend(image.convert("RGB"), rendered, strength) if image is not None else rendered)
+        return SimpleNamespace(images=images)
+
+    def _render(self, prompt, generator, width, height):
+        # 모델, 활성 LoRA 파일과 강도, 프롬프트, 시드가 같으면 항상 같은 색의 이미지를 만듭니다.
+        # (어댑터 이름은 로드 순서에 따라 달라지므로 파일 이름을 사용)
+        # 병합된 LoRA는 기본 가중치(fused_offset)에 들어 있으므로 스텝마다 어댑터를 따로 계산하지 않습니다.
+        seed = getattr(generator, "initial_seed", None)
+        if seed is None:
+            seed = generator.getrandbits(32)
+        loras = [] if self.fused_offset is not None else self._active_loras()
+        return Image.new("RGB", (width, height), render_color(self.model_name, loras, prompt, seed, self.fused_offset))
+
+
+def load_fake_pipeline(model_name, load_latency=0.0, **kwargs):
+    """
+    ModelHandler의 pipeline_loader로 사용할 수 있는 (pipeline, model_type) 로더입니다.
+    load_latency: 디스크에서 가중치를 읽는 시간을 흉내 내는 지연 시간 (초)
+    """
+    time.sleep(load_latency)
+    return FakePipeline(model_name, **kwargs), get_model_type(model_name)
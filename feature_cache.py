@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+import threading
+import weakref
+from contextlib import contextmanager
+
+import metrics
+from compiler import DENOISER_COMPONENTS
+
+# "off": 모든 스텝에서 모든 블록을 계산 / 그 밖의 모드는 speed_presets의 (interval, threshold)로 블록 출력을 재사용
+SPEED_MODES = ("off", "fast", "fastest")
+
+# interval: 전체 계산 사이에 캐시로 건너뛸 수 있는 최대 스텝 수 + 1 (0이면 제한 없음)
+# threshold: 첫 블록 출력이 마지막 전체 계산 때보다 이 비율(상대 L1) 미만으로 변했을 때만 건너뜀 (0이면 interval만 사용)
+DEFAULT_SPEED_PRESETS = {
+    "fast": {"interval": 2, "threshold": 0.1},
+    "fastest": {"interval": 3, "threshold": 0.2},
+}
+
+# 트랜스포머 디노이저의 블록 목록 (FLUX: 이중/단일 스트림 블록, Qwen/SD3: transformer_blocks, Z-Image: layers)
+TRANSFORMER_BLOCK_LISTS = ("transformer_blocks", "single_transformer_blocks", "layers")
+
+DENOISER_STEPS_TOTAL = metrics.REGISTRY.counter(
+    "aigen_feature_cache_steps_total", "속도 모드의 디노이저 호출 수 (결과별: cached, computed)", ["result"]
+)
+
+
+class SpeedPolicy:
+    """
+    요청의 speed_mode를 블록 캐시 설정(cache_interval, cache_threshold)으로 바꾸는 정책입니다.
+    presets는 DEFAULT_SPEED_PRESETS를 덮어쓰는 {모드: {"interval": ..., "threshold": ...}}이며, 새 모드를 추가할 수도 있습니다.
+    """
+
+    def __init__(self, mode="off", presets=None):
+        self.presets = {name: dict(preset) for name, preset in DEFAULT_SPEED_PRESETS.items()}
+        for name, preset in (presets or {}).items():
+            self.presets[name] = {**self.presets.get(name, {}), **preset}
+        self.mode = self.validate_mode(mode)
+
+    def validate_mode(self, mode):
+        if mode != "off" and mode not in self.presets:
+            modes = ", ".join(["off"] + sorted(self.presets))
+            raise ValueError(f"지원하지 않는 speed_mode입니다: {mode} (가능한 값: {modes})")
+        return mode
+
+    def apply(self, request):
+        """
+        요청에 speed_mode와 실제로 사용할 cache_interval/cache_threshold를 기록합니다. (요청 딕셔너리를 직접 수정하고 반환)
+        요청의 speed_mode가 정책의 기본 모드보다 우선하고, 요청의 cache_interval/cache_threshold는 모드의 프리셋 값을 덮어씁니다.
+        "off"이면 두 값 모두 None입니다. 지원하지 않는 모드이거나 두 값이 모두 0이면 ValueError.
+        """
+        mode = self.validate_mode(request.get("speed_mode") or self.mode)
+        request["speed_mode"] = mode
+        if mode == "off":
+            request["cache_interval"] = request["cache_threshold"] = None
+            return request
+        preset = self.presets[mode]
+        interval = request.get("cache_interval")
+        threshold = request.get("cache_threshold")
+        interval = int(preset.get("interval", 0) if interval is None else interval)
+        threshold = float(preset.get("threshold", 0.0) if threshold is None else threshold)
+        if interval <= 0 and threshold <= 0:
+            raise ValueError("cache_interval과 cache_threshold 중 하나는 0보다 커야 합니다.")
+        request["cache_interval"] = interval
+        request["cache_threshold"] = threshold
+        return request
+
+
+def _tensors(output):
+    """블록 출력(텐서 또는 텐서 튜플)에서 최상위 텐서들을 꺼냅니다."""
+    if hasattr(output, "abs"):
+        return [output]
+    if isinstance(output, (tuple, list)):
+        return [value for value in output if hasattr(value, "abs")]
+    return []
+
+
+def relative_change(new, old):
+    """두 블록 출력의 상대 L1 변화량(평균 절댓값 차이 / 이전 평균 절댓값)입니다. 구조나 모양이 다르면 None."""
+    pairs = list(zip(_tensors(new), _tensors(old)))
+    if not pairs or len(pairs) != len(_tensors(old)) or any(a.shape != b.shape for a, b in pairs):
+        return None
+    base = sum(float(b.abs().mean()) for _, b in pairs)
+    if not base:
+        return None
+    return sum(float((a - b).abs().mean()) for a, b in pairs) / base
+
+
+def _add_residual(probe, cached, cached_probe):
+    """
+    이번 스텝의 첫 블록 출력에 지난 전체 계산의 (마지막 블록 출력 - 첫 블록 출력) 잔차를 더합니다. (First Block Cache)
+    세 출력의 구조와 모양이 같지 않으면(예: FLUX의 이중 스트림 블록과 단일 스트림 블록) None.
+    """
+    if hasattr(probe, "abs"):
+        if hasattr(cached, "abs") and hasattr(cached_probe, "abs") and probe.shape == cached.shape == cached_probe.shape:
+            return probe + (cached - cached_probe)
+        return None
+    if isinstance(probe, tuple) and isinstance(cached, tuple) and isinstance(cached_probe, tuple) \
+            and len(probe) == len(cached) == len(cached_probe):
+        parts = [_add_residual(p, c, cp) for p, c, cp in zip(probe, cached, cached_probe)]
+        return None if any(part is None for part in parts) else tuple(parts)
+    return None
+
+
+def _slot_key(args, kwargs):
+    """
+    한 스텝 안의 여러 디노이저 호출(예: Qwen의 조건/무조건 호출)을 구분하는 키입니다.
+    프롬프트 임베딩 텐서는 스텝마다 같은 텐서가 전달되므로 그 주소와 입력 모양으로 구분합니다.
+    """
+    hidden = kwargs.get("hidden_states", kwargs.get("sample", args[0] if args else None))
+    context = kwargs.get("encoder_hidden_states")
+    return (
+        tuple(hidden.shape) if hasattr(hidden, "shape") else None,
+        context.data_ptr() if hasattr(context, "data_ptr") else None,
+    )
+
+
+def block_layout(denoiser):
+    """
+    디노이저에서 (첫 블록, 재사용할 블록 그룹 목록, 방식)을 찾습니다. 지원하지 않는 구조이면 None.
+
+    - UNet(SD, SDXL): DeepCache처럼 첫 down 블록과 마지막 up 블록만 계산하고, 그 사이의 깊은 블록
+      (나머지 down 블록, mid 블록, 마지막을 제외한 up 블록)은 지난 전체 계산의 출력을 재사용합니다.
+    - 트랜스포머(FLUX, Qwen, Z-Image): 첫 블록만 계산하고 나머지 블록은 출력을 재사용합니다. (First Block Cache)
+    블록 목록 하나 안의 블록들은 출력 구조가 같으므로, 그룹마다 마지막 블록의 출력만 보관합니다.
+    """
+    if hasattr(denoiser, "down_blocks") and hasattr(denoiser, "up_blocks"):
+        down, up = list(denoiser.down_blocks), list(denoiser.up_blocks)
+        if len(down) < 2 or len(up) < 2:
+            return None
+        mid = [denoiser.mid_block] if getattr(denoiser, "mid_block", None) is not None else []
+        return down[0], [[block] for block in down[1:] + mid + up[:-1]], "deepcache"
+    lists = [list(getattr(denoiser, name)) for name in TRANSFORMER_BLOCK_LISTS if len(getattr(denoiser, name, None) or ())]
+    if not lists or sum(len(blocks) for blocks in lists) < 2:
+        return None
+    groups = [blocks for blocks in [lists[0][1:]] + lists[1:] if blocks]
+    return lists[0][0], groups, "first_block"
+
+
+class _SlotState:
+    """디노이저 호출 슬롯 하나의 캐시: 마지막 전체 계산 때의 첫 블록 출력과 그룹별 마지막 블록 출력"""
+
+    def __init__(self):
+        self.probe = None
+        self.outputs = {}
+        self.since_full = 0
+
+
+class _CacheSession:
+    """파이프라인 호출 한 번 동안 디노이저 블록에 설치되는 캐시 훅입니다."""
+
+    def __init__(self, interval, threshold, residual):
+        self.interval = interval
+        self.threshold = threshold
+        self.residual = residual
+        self.slots = {}
+        self.current = None # 진행 중인 디노이저 호출의 _SlotState
+        self.probe_output = None # 진행 중인 호출의 첫 블록 출력
+        self.skipping = False
+        self.cached = 0
+        self.computed = 0
+
+    def begin_call(self, module, args, kwargs):
+        self.current = self.slots.setdefault(_slot_key(args, kwargs), _SlotState())
+        self.skipping = False
+
+    def after_probe(self, module, args, output):
+        """첫 블록 출력을 보고 이번 호출에서 나머지 블록을 건너뛸지 정합니다."""
+        state = self.current
+        if state is None:
+            return
+        self.probe_output = output
+        self.skipping = False
+        if state.probe is not None and (self.interval <= 0 or state.since_full < self.interval - 1):
+            if self.threshold > 0:
+                change = relative_change(output, state.probe)
+                self.skipping = change is not None and change < self.threshold
+            else:
+                self.skipping = True
+        if not self.skipping:
+            state.probe = output
+
+    def end_call(self, module, args, output):
+        state = self.current
+        if state is not None:
+            if self.skipping:
+                state.since_full += 1
+                self.cached += 1
+            else:
+                state.since_full = 0
+                self.computed += 1
+        DENOISER_STEPS_TOTAL.inc(result="cached" if self.skipping else "computed")
+        self.current = None
+        self.probe_output = None
+        self.skipping = False
+
+    def wrap(self, forward, group, keep, final):
+        """블록 forward를 감싸 건너뛰는 호출에서는 보관한 출력을 반환하고, 계산하는 호출에서는 출력을 보관합니다."""
+        def cached_forward(*args, **kwargs):
+            state = self.current
+            if self.skipping and state is not None:
+                cached = state.outputs[group]
+                if final and self.residual:
+                    corrected = _add_residual(self.probe_output, cached, state.probe)
+                    if corrected is not None:
+                        return corrected
+                return cached
+            output = forward(*args, **kwargs)
+            if keep and state is not None:
+                state.outputs[group] = output
+            return output
+        return cached_forward
+
+
+class FeatureCache:
+    """
+    인접한 디노이징 스텝 사이에 블록 출력을 재사용하는 속도 모드입니다.
+
+    파이프라인 호출 동안만 디노이저 블록에 훅을 설치하며, 스텝마다 첫 블록은 항상 계산합니다.
+    첫 블록 출력이 마지막 전체 계산 때와 거의 같고(threshold) 연속으로 건너뛴 스텝이 interval-1보다 적으면
+    나머지 블록을 계산하지 않고 보관한 출력을 사용합니다. 첫 스텝은 항상 전체를 계산합니다.
+    """
+
+    def __init__(self):
+        self._layouts = weakref.WeakKeyDictionary() # pipeline -> (디노이저, 첫 블록, 그룹, 방식) 또는 None
+        self._lock = threading.Lock()
+        self._stats = {"calls": 0, "cached_steps": 0, "computed_steps": 0, "methods": {}}
+
+    def _layout(self, pipeline):
+        if pipeline in self._layouts:
+            return self._layouts[pipeline]
+        layout = None
+        for attr_name in DENOISER_COMPONENTS:
+            denoiser = getattr(pipeline, attr_name, None)
+            if denoiser is not None and hasattr(denoiser, "register_forward_hook"):
+                found = block_layout(denoiser)
+                if found is not None:
+                    layout = (denoiser,) + found
+                break
+        self._layouts[pipeline] = layout
+        return layout
+
+    @contextmanager
+    def activate(self, pipeline, interval, threshold, model_type=None):
+        """
+        파이프라인 호출을 감싸 블록 캐시를 적용합니다. 적용한 방식("deepcache", "first_block")을,
+        설정이 꺼져 있거나 디노이저 구조를 지원하지 않으면(예: 가짜 파이프라인) "disabled"를 반환합니다.
+        """
+        interval, threshold = int(interval or 0), float(threshold or 0.0)
+        layout = self._layout(pipeline) if interval > 0 or threshold > 0 else None
+        if layout is None:
+            yield "disabled"
+            return
+        denoiser, probe, groups, method = layout
+        session = _CacheSession(interval, threshold, residual=method == "first_block")
+        handles = [
+            denoiser.register_forward_pre_hook(session.begin_call, with_kwargs=True),
+            denoiser.register_forward_hook(session.end_call),
+            probe.register_forward_hook(session.after_probe),
+        ]
+        # 오프로드 훅(accelerate)도 인스턴스의 forward를 바꾸므로, 원래 인스턴스 속성을 기억했다가 되돌립니다.
+        patched = []
+        for index, group in enumerate(groups):
+            for position, block in enumerate(group):
+                keep = position == len(group) - 1
+                patched.append((block, block.__dict__.get("forward")))
+                block.forward = session.wrap(block.forward, index, keep, keep and index == len(groups) - 1)
+        try:
+            yield method
+        finally:
+            for handle in handles:
+                handle.remove()
+            for block, original in patched:
+                if original is None:
+                    del block.forward
+                else:
+                    block.forward = original
+            with self._lock:
+                self._stats["calls"] += 1
+                self._stats["cached_steps"] += session.cached
+                self._stats["computed_steps"] += session.computed
+                key = f"{model_type}:{method}" if model_type else method
+                self._stats["methods"][key] = self._stats["methods"].get(key, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, methods=dict(self._stats["methods"]))
+        steps = stats["cached_steps"] + stats["computed_steps"]
+        stats["cached_ratio"] = round(stats["cached_steps"] / steps, 4) if steps else 0.0
+        return stats
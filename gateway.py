@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+"""
+여러 워커(app.py) 앞에서 요청을 나누어 보내는 게이트웨이 서버입니다.
+
+워커는 설정의 gateway_url로 자신을 등록하고, 게이트웨이는 요청한 모델(과 LoRA)을 이미 가진 워커로,
+없으면 가장 한가한 워커로 요청을 전달합니다. 워커에 연결하지 못하면 다른 워커로 다시 시도합니다.
+
+실행: python gateway.py (포트는 설정의 gateway_port)  또는  uvicorn gateway:app --host 0.0.0.0 --port 8880
+"""
+import asyncio
+import concurrent.futures
+import hmac
+import ipaddress
+import json
+import socket
+import time
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+import uvicorn
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import StreamingResponse, FileResponse, Response, PlainTextResponse
+from fastapi.staticfiles import StaticFiles
+
+import metrics
+from cluster import NoWorkerAvailable, WorkerRegistry
+from config import config
+from schemas import GenerationRequest
+
+# 워커로 전달할 요청 헤더
+FORWARD_REQUEST_HEADERS = ("accept", "if-none-match", "x-api-key", "x-client-id")
+# 워커 응답 본문을 클라이언트로 전달할 때 한 번에 읽는 최대 크기 (바이트)
+STREAM_CHUNK_SIZE = 64 * 1024
+# 클라이언트로 전달하지 않을 워커 응답 헤더 (연결별 헤더와 응답을 다시 만들 때 새로 정해지는 헤더)
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "content-length", "date", "server"}
+
+registry = WorkerRegistry(
+    heartbeat_timeout=config["worker_timeout"],
+    affinity_slack=config["gateway_affinity_slack"],
+    failure_backoff=config["gateway_failure_backoff"],
+)
+
+# 워커 요청 스레드 풀: urllib 호출은 블로킹이므로 이벤트 루프 밖에서 실행합니다.
+proxy_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=config["gateway_connections"],
+    thread_name_prefix="proxy",
+)
+
+# 작업 ID -> (워커 ID, 등록 시각). 비동기 작업의 후속 요청을 작업을 만든 워커로 보냅니다.
+_job_routes = OrderedDict()
+
+ROUTES_TOTAL = metrics.REGISTRY.counter(
+    "aigen_gateway_routes_total", "워커로 보낸 요청 수 (선택 이유별: affinity, least_loaded)", ["reason"]
+)
+RETRIES_TOTAL = metrics.REGISTRY.counter("aigen_gateway_retries_total", "다른 워커로 다시 보낸 요청 수")
+
+
+class WorkerUnavailable(Exception):
+    """워커에 연결하지 못했거나 응답을 끝까지 받지 못했을 때 발생하는 예외입니다."""
+
+
+class WorkerTimeout(Exception):
+    """
+    요청을 보낸 뒤 워커가 제한 시간 안에 응답하지 않았을 때 발생하는 예외입니다.
+    워커는 요청을 받아 아직 처리 중일 수 있으므로, 실패한 워커로 표시하거나 다른 워커로 다시 보내지 않습니다.
+    """
+
+
+# --- 워커 요청 ---
+def _open(worker, method, path, body, headers, timeout):
+    """
+    워커에 요청을 보내고 응답 객체를 반환합니다. HTTP 오류 응답도 그대로 반환합니다.
+    연결이나 요청 전송에 실패하면 WorkerUnavailable, 요청을 보낸 뒤 응답을 기다리다 시간이 지나면 WorkerTimeout.
+    """
+    request = urllib.request.Request(worker.url + path, data=body, method=method, headers=headers)
+    try:
+        return urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        return e
+    except urllib.error.URLError as e:
+        # urllib은 연결과 요청 전송 단계의 오류만 URLError로 감쌉니다. (연결 시간 초과 포함)
+        raise WorkerUnavailable(str(e.reason))
+    except socket.timeout as e:
+        raise WorkerTimeout(str(e) or "timed out")
+    except OSError as e:
+        raise WorkerUnavailable(str(e))
+
+
+def _read(response):
+    """응답 본문을 모두 읽고 닫습니다."""
+    try:
+        return response.read()
+    except socket.timeout as e:
+        raise WorkerTimeout(str(e) or "timed out")
+    except OSError as e:
+        raise WorkerUnavailable(str(e))
+    finally:
+        response.close()
+
+
+def _fetch(worker, method, path, body, headers, timeout):
+    """워커에 요청을 보내고 (상태 코드, 헤더, 본문)을 반환합니다."""
+    response = _open(worker, method, path, body, headers, timeout)
+    data = _read(response)
+    return response.getcode(), response.headers, data
+
+
+def timeout_error(e):
+    return HTTPException(status_code=504, detail=f"워커가 제한 시간({config['gateway_request_timeout']}초) 안에 응답하지 않았습니다: {e}")
+
+
+async def _call(function, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(proxy_executor, function, *args)
+
+
+def forward_headers(http_request):
+    """
+    워커로 전달할 헤더를 만듭니다. 워커는 게이트웨이가 보낸 X-Client-Id를 믿으므로, 클라이언트가 보낸
+    X-Client-Id는 버리고 클라이언트 IP를 X-Client-Id로 전달해 워커의 클라이언트별 예산과 우선순위가 그대로 동작하게 합니다.
+    (X-API-Key는 워커가 설정에 등록된 키인지 확인하므로 그대로 전달)
+    """
+    headers = {name: http_request.headers[name] for name in FORWARD_REQUEST_HEADERS
+               if name in http_request.headers and name != "x-client-id"}
+    if http_request.client:
+        headers["x-client-id"] = http_request.client.host
+    headers["content-type"] = "application/json"
+    return headers
+
+
+def _response_headers(worker, headers):
+    response_headers = {name: value for name, value in headers.items() if name.lower() not in HOP_BY_HOP_HEADERS}
+    response_headers["X-Worker"] = worker.worker_id
+    return response_headers
+
+
+def proxy_response(worker, status, headers, data):
+    """이미 읽은 워커 응답 본문을 그대로 전달합니다."""
+    return Response(content=data, status_code=status, headers=_response_headers(worker, headers))
+
+
+def stream_response(worker, response):
+    """
+    워커 응답을 본문을 모으지 않고 읽는 대로 클라이언트에 전달합니다.
+    여러 장 응답(multipart/zip)도 게이트웨이 메모리에 쌓이지 않고 워커가 보내는 대로 흘러갑니다.
+    워커 응답은 전달이 끝나거나 클라이언트가 연결을 끊으면 닫습니다.
+    """
+    async def body():
+        try:
+            while True:
+                chunk = await _call(response.read1, STREAM_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            response.close()
+
+    return StreamingResponse(body(), status_code=response.getcode(), headers=_response_headers(worker, response.headers))
+
+
+async def dispatch(request_data, path, http_request):
+    """
+    요청을 고른 워커에 보내고 (워커, 응답 객체)를 반환합니다. 응답 본문은 아직 읽지 않은 상태입니다.
+    워커에 연결하지 못하거나 워커의 큐가 가득 찼으면(503) 다른 워커로 최대 gateway_retries번 다시 보냅니다.
+    요청을 보낸 뒤 응답이 늦는 것은 워커가 렌더링 중이라는 뜻이므로, 같은 생성을 두 번 하지 않도록 다시 보내지 않고 504를 반환합니다.
+    """
+    body = json.dumps(request_data).encode("utf-8")
+    headers = forward_headers(http_request)
+    tried = set()
+    last_error = None
+    last_busy = None
+    for attempt in range(config["gateway_retries"] + 1):
+        try:
+            worker, reason = registry.choose(request_data, exclude=tried)
+        except NoWorkerAvailable as e:
+            if last_busy is not None:
+                break
+            raise HTTPException(status_code=503, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+        if attempt:
+            registry.count_retry()
+            RETRIES_TOTAL.inc()
+        ROUTES_TOTAL.inc(reason=reason)
+        tried.add(worker.worker_id)
+        try:
+            response = await _call(_open, worker, "POST", path, body, headers, config["gateway_request_timeout"])
+        except WorkerTimeout as e:
+            if last_busy is not None:
+                last_busy[1].close()
+            raise timeout_error(e)
+        except WorkerUnavailable as e:
+            registry.mark_failed(worker)
+            last_error = e
+            continue
+        finally:
+            registry.release(worker, request_data.get("model_name"))
+        if response.getcode() == 503:
+            if last_busy is not None:
+                last_busy[1].close()
+            last_busy = (worker, response)
+            continue
+        if last_busy is not None:
+            last_busy[1].close()
+        return worker, response
+
+    if last_busy is not None:
+        return last_busy
+    raise HTTPException(status_code=502, detail=f"워커에 요청을 전달하지 못했습니다: {last_error}")
+
+
+# --- 워커 인증 ---
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def authorize_worker(http_request):
+    """
+    워커 등록/해제 요청을 확인합니다. 등록된 워커는 프롬프트와 클라이언트의 X-API-Key를 전달받으므로,
+    cluster_token이 설정되어 있으면 X-Cluster-Token 헤더가 같을 때만, 없으면 같은 호스트(루프백)에서 온 요청만 받습니다.
+    """
+    token = config["cluster_token"]
+    if token:
+        given = http_request.headers.get("x-cluster-token", "")
+        if not hmac.compare_digest(given.encode("utf-8"), token.encode("utf-8")):
+            raise HTTPException(status_code=401, detail="클러스터 토큰(X-Cluster-Token)이 올바르지 않습니다.")
+        return
+    if not (http_request.client and is_loopback(http_request.client.host)):
+        raise HTTPException(status_code=403, detail="cluster_token이 설정되지 않아 다른 호스트의 워커 등록/해제는 받지 않습니다.")
+
+
+# --- 비동기 작업 경로 ---
+def _remember_job(job_id, worker):
+    now = time.monotonic()
+    _job_routes[job_id] = (worker.worker_id, now)
+    while _job_routes:
+        oldest_id, (_, created) = next(iter(_job_routes.items()))
+        if now - created <= config["job_ttl"] * 2:
+            break
+        del _job_routes[oldest_id]
+
+
+def _job_worker(job_id):
+    route = _job_routes.get(job_id)
+    if route is None:
+        raise HTTPException(status_code=404, detail=f"작업 '{job_id}'을(를) 찾을 수 없습니다.")
+    worker = registry.get(route[0])
+    if worker is None:
+        raise HTTPException(status_code=502, detail=f"작업 '{job_id}'을(를) 처리한 워커가 더 이상 등록되어 있지 않습니다.")
+    return worker
+
+
+async def proxy_job_request(job_id, method, path, http_request):
+    worker = _job_worker(job_id)
+    try:
+        response = await _call(
+            _open, worker, method, path, None, forward_headers(http_request), config["gateway_request_timeout"]
+        )
+    except WorkerTimeout as e:
+        raise timeout_error(e)
+    except WorkerUnavailable as e:
+        registry.mark_failed(worker)
+        raise HTTPException(status_code=502, detail=f"작업을 처리한 워커에 연결하지 못했습니다: {e}")
+    return stream_response(worker, response)
+
+
+# --- FastAPI 앱 ---
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    proxy_executor.shutdown(wait=False)
+
+app = FastAPI(
+    title="Z-Image-Turbo Gateway",
+    description="여러 GPU 워커에 이미지 생성 요청을 나누어 보내는 게이트웨이입니다.",
+    version="1.0.0",
+    lifespan=lifespan
+)
+
+app.mount("/static", StaticFiles(directory="static"), name="static")
+
+@app.get("/", response_class=FileResponse, tags=["UI"])
+async def read_root():
+    """웹 UI의 메인 페이지(index.html)를 반환합니다."""
+    return "static/index.html"
+
+@app.post("/api/workers/register", tags=["워커"])
+async def register_worker_api(http_request: Request):
+    """워커의 등록(하트비트). 장치, 메모리, 상주 모델, 로드된 LoRA, 큐 길이를 받습니다."""
+    authorize_worker(http_request)
+    try:
+        worker = registry.register(await http_request.json())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"worker_id": worker.worker_id, "heartbeat_timeout": registry.heartbeat_timeout}
+
+@app.delete("/api/workers/{worker_id}", tags=["워커"])
+async def remove_worker_api(worker_id: str, http_request: Request):
+    """워커 등록을 해제합니다. (워커 종료 시 호출)"""
+    authorize_worker(http_request)
+    if registry.remove(worker_id) is None:
+        raise HTTPException(status_code=404, detail=f"워커 '{worker_id}'을(를) 찾을 수 없습니다.")
+    return {"removed": worker_id}
+
+@app.get("/api/workers", tags=["워커"])
+async def list_workers_api():
+    """등록된 워커와 상태, 라우팅 통계를 반환합니다."""
+    return registry.stats()
+
+@app.get("/api/status", tags=["정보"])
+async def get_status_api():
+    """전체 워커의 대기/실행 중인 작업 수와 워커별 상태를 반환합니다."""
+    stats = registry.stats()
+    infos = [w["info"] for w in stats["workers"]]
+    return {
+        "queue_depth": sum(info.get("queue_depth", 0) for info in infos),
+        "running_jobs": sum(info.get("running_jobs", 0) for info in infos),
+        "gateway": stats,
+    }
+
+async def _collect_from_workers(path, field):
+    """정상 워커들에 같은 조회 요청을 보내 목록 필드의 합집합을 반환합니다. (응답하지 않는 워커는 무시)"""
+    workers = registry.healthy_workers()
+    results = await asyncio.gather(
+        *[_call(_fetch, worker, "GET", path, None, {}, 5.0) for worker in workers], return_exceptions=True
+    )
+    values = []
+    for result in results:
+        if isinstance(result, Exception) or result[0] != 200:
+            continue
+        for value in json.loads(result[2]).get(field, []):
+            if value not in values:
+                values.append(value)
+    return values
+
+@app.get("/api/models", tags=["정보"])
+async def get_models_api():
+    """모든 워커에서 사용 가능한 모델 목록을 반환합니다."""
+    return {"models": await _collect_from_workers("/api/models", "models")}
+
+@app.get("/api/loras", tags=["정보"])
+async def get_loras_api():
+    """모든 워커에서 사용 가능한 LoRA 파일 목록을 반환합니다."""
+    return {"loras": await _collect_from_workers("/api/loras", "loras")}
+
+@app.get("/metrics", response_class=PlainTextResponse, tags=["정보"])
+async def metrics_api():
+    """게이트웨이 라우팅 지표와 워커별 진행 중 요청 수를 Prometheus 형식으로 반환합니다."""
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
+def collect_gateway_metrics():
+    workers = registry.workers()
+    now = time.monotonic()
+    yield ("aigen_gateway_workers", "gauge", "등록된 워커 수 (상태별)",
+           [({"state": "healthy"}, sum(1 for w in workers if now >= w.failed_until)),
+            ({"state": "failed"}, sum(1 for w in workers if now < w.failed_until))])
+    yield ("aigen_gateway_worker_load", "gauge", "워커별 대기/실행 중인 작업 수 (게이트웨이가 보낸 진행 중 요청 포함)",
+           [({"worker": w.worker_id}, w.load()) for w in workers])
+
+metrics.REGISTRY.add_collector(collect_gateway_metrics)
+
+@app.post("/api/generate", tags=["이미지 생성"])
+async def generate_image_api(request: GenerationRequest, http_request: Request):
+    """요청을 워커에 전달하고 워커의 응답(이미지, ETag, X-Seed, Server-Timing 등)을 그대로 반환합니다."""
+    worker, response = await dispatch(request.dict(), "/api/generate", http_request)
+    return stream_response(worker, response)
+
+@app.post("/api/jobs", status_code=202, tags=["작업"])
+async def submit_job_api(request: GenerationRequest, http_request: Request):
+    """작업을 워커에 등록합니다. 이후 작업 ID로 조회하는 요청은 같은 워커로 전달됩니다."""
+    worker, response = await dispatch(request.dict(), "/api/jobs", http_request)
+    status, headers = response.getcode(), response.headers
+    try:
+        data = await _call(_read, response)
+    except WorkerTimeout as e:
+        raise timeout_error(e)
+    except WorkerUnavailable as e:
+        raise HTTPException(status_code=502, detail=f"워커의 응답을 끝까지 받지 못했습니다: {e}")
+    if status == 202:
+        _remember_job(json.loads(data)["job_id"], worker)
+    return proxy_response(worker, status, headers, data)
+
+@app.get("/api/jobs/{job_id}", tags=["작업"])
+async def get_job_api(job_id: str, http_request: Request):
+    return await proxy_job_request(job_id, "GET", f"/api/jobs/{job_id}", http_request)
+
+@app.delete("/api/jobs/{job_id}", tags=["작업"])
+async def cancel_job_api(job_id: str, http_request: Request):
+    return await proxy_job_request(job_id, "DELETE", f"/api/jobs/{job_id}", http_request)
+
+@app.get("/api/jobs/{job_id}/images", tags=["작업"])
+async def get_job_images_api(job_id: str, http_request: Request):
+    return await proxy_job_request(job_id, "GET", f"/api/jobs/{job_id}/images", http_request)
+
+@app.get("/api/jobs/{job_id}/image", tags=["작업"])
+async def get_job_image_api(job_id: str, http_request: Request, index: int = 0):
+    return await proxy_job_request(job_id, "GET", f"/api/jobs/{job_id}/image?index={index}", http_request)
+
+@app.get("/api/jobs/{job_id}/events", tags=["작업"])
+async def job_events_api(job_id: str, http_request: Request):
+    """작업을 처리하는 워커의 Server-Sent Events 스트림을 그대로 전달합니다."""
+    worker = _job_worker(job_id)
+    try:
+        response = await _call(
+            _open, worker, "GET", f"/api/jobs/{job_id}/events", None, forward_headers(http_request),
+            config["gateway_request_timeout"],
+        )
+    except WorkerTimeout as e:
+        raise timeout_error(e)
+    except WorkerUnavailable as e:
+        registry.mark_failed(worker)
+        raise HTTPException(status_code=502, detail=f"작업을 처리한 워커에 연결하지 못했습니다: {e}")
+    if response.getcode() != 200:
+        return stream_response(worker, response)
+
+    async def event_stream():
+        try:
+            while True:
+                line = await _call(response.readline)
+                if not line:
+                    break
+                yield line
+        finally:
+            response.close()
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Worker": worker.worker_id})
+
+if __name__ == "__main__":
+    if not config["cluster_token"]:
+        print("경고: cluster_token이 설정되지 않아 같은 호스트의 워커만 등록할 수 있습니다.")
+    print(f"게이트웨이를 http://{config['host']}:{config['gateway_port']} 에서 시작합니다.")
+    uvicorn.run(app, host=config["host"], port=config["gateway_port"], log_level="info")
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+import math
+
+from PIL import Image, ImageChops, ImageDraw
+
+import metrics
+from resolution import fit_image, nearest_bucket
+
+# "off": 요청 크기로 한 번에 생성 / "on": 항상 2단계 생성 / "auto": 요청 픽셀 수가 highres_min_pixels 이상일 때만 2단계 생성
+HIGHRES_MODES = ("off", "auto", "on")
+
+HIGHRES_TILES_TOTAL = metrics.REGISTRY.counter(
+    "aigen_highres_tiles_total", "고해상도 모드에서 다시 디노이징한 타일 수"
+)
+
+
+def tile_starts(length, tile, overlap):
+    """
+    길이 length를 최소 overlap만큼 겹치는 tile 크기 구간들로 나눈 시작 위치 목록입니다.
+    필요한 최소 개수의 구간을 고르게 배치하므로 마지막 구간만 거의 전부 겹치는 일이 없습니다.
+    """
+    if length <= tile:
+        return [0]
+    count = math.ceil((length - overlap) / max(1, tile - overlap))
+    return [round(i * (length - tile) / (count - 1)) for i in range(count)]
+
+
+def tile_boxes(width, height, tile, overlap):
+    """이미지를 덮는 (left, top, right, bottom) 타일 목록 (행 우선 순서). 이미지보다 큰 타일은 이미지 크기로 줄입니다."""
+    tile_w, tile_h = min(tile, width), min(tile, height)
+    return [(left, top, left + tile_w, top + tile_h)
+            for top in tile_starts(height, tile_h, overlap)
+            for left in tile_starts(width, tile_w, overlap)]
+
+
+def feather_mask(size, overlap, left, top):
+    """
+    타일을 붙일 때 쓰는 마스크입니다. 앞서 붙인 타일과 겹치는 왼쪽/위쪽 가장자리(left/top이 True일 때)는
+    overlap 픽셀에 걸쳐 0에서 255로 선형으로 바뀌어 이음매가 보이지 않게 섞입니다.
+    """
+    width, height = size
+    mask = Image.new("L", size, 255)
+    if overlap <= 0 or not (left or top):
+        return mask
+    horizontal = Image.new("L", size, 255)
+    vertical = Image.new("L", size, 255)
+    draw_h, draw_v = ImageDraw.Draw(horizontal), ImageDraw.Draw(vertical)
+    for i in range(overlap):
+        value = int(255 * (i + 1) / (overlap + 1))
+        if left and i < width:
+            draw_h.line([(i, 0), (i, height - 1)], fill=value)
+        if top and i < height:
+            draw_v.line([(0, i), (width - 1, i)], fill=value)
+    return ImageChops.darker(horizontal, vertical)
+
+
+def refine_steps(steps, strength):
+    """img2img가 strength로 실제 실행하는 디노이징 스텝 수 (diffusers와 같은 방식)"""
+    return min(steps, max(1, int(steps * strength)))
+
+
+def highres_work(request):
+    """2단계 생성의 작업량 (스텝 × 픽셀): 기본 크기 생성 + 타일별 다시 디노이징"""
+    base_w, base_h = request["highres_base"]
+    steps = request.get("steps") or 1
+    boxes = tile_boxes(request["width"], request["height"], request["highres_tile"], request["highres_overlap"])
+    tile_pixels = sum((right - left) * (bottom - top) for left, top, right, bottom in boxes)
+    return base_w * base_h * steps + tile_pixels * refine_steps(steps, request["highres_strength"])
+
+
+def refine_tiles(image, refine, tile, overlap, progress=None):
+    """
+    이미지를 겹치는 타일로 나누어 refine(타일 이미지, 타일 번호)로 다시 그린 뒤 가장자리를 섞어 붙입니다.
+    타일마다 따로 인코딩/디노이징/디코딩하므로 최대 메모리는 이미지 전체가 아니라 타일 크기에 비례합니다.
+    progress(끝난 타일 수, 전체 타일 수)는 타일 하나가 끝날 때마다 호출됩니다.
+    """
+    boxes = tile_boxes(image.width, image.height, tile, overlap)
+    result = image.copy()
+    for index, box in enumerate(boxes):
+        size = (box[2] - box[0], box[3] - box[1])
+        refined = refine(image.crop(box), index)
+        if refined.size != size:
+            # 파이프라인이 크기를 VAE 배율의 배수로 맞춘 경우 원래 타일 크기로 되돌립니다.
+            refined = refined.resize(size, Image.LANCZOS)
+        result.paste(refined.convert(result.mode), box[:2], feather_mask(size, overlap, box[0] > 0, box[1] > 0))
+        HIGHRES_TILES_TOTAL.inc()
+        if progress is not None:
+            progress(index + 1, len(boxes))
+    return result
+
+
+def upscale(image, size):
+    """기본 크기로 생성한 이미지를 비율을 유지해 요청 크기로 확대합니다. (비율이 다르면 가운데를 자름)"""
+    return fit_image(image, tuple(size), "crop")
+
+
+class HighResPolicy:
+    """
+    큰 요청을 2단계로 생성하는 정책입니다.
+
+    1. 요청 비율에 가장 가까운 해상도 버킷(모델이 학습된 약 1MP 크기)으로 전체 구도를 생성합니다.
+    2. 요청 크기로 확대한 뒤, 겹치는 tile_size 타일마다 img2img로 strength만큼 다시 디노이징해 세부를 채웁니다.
+    디노이저와 VAE가 한 번에 처리하는 크기가 버킷/타일 크기로 제한되므로, 요청 크기가 커져도 최대 메모리가 늘지 않고
+    어텐션 비용이 픽셀 수의 제곱으로 늘지 않습니다.
+    resolution_policy는 모델 타입별 버킷 목록을 제공하는 ResolutionPolicy입니다.
+    """
+
+    def __init__(self, resolution_policy, mode="off", min_pixels=1536 * 1536, tile_size=1024, tile_overlap=128,
+                 strength=0.35):
+        if tile_overlap * 2 > tile_size:
+            raise ValueError("highres_tile_overlap은 highres_tile_size의 절반 이하여야 합니다.")
+        self.resolution_policy = resolution_policy
+        self.mode = self.validate_mode(mode)
+        self.min_pixels = min_pixels
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
+        self.strength = strength
+
+    @staticmethod
+    def validate_mode(mode):
+        if mode not in HIGHRES_MODES:
+            raise ValueError(f"지원하지 않는 highres_mode입니다: {mode} (가능한 값: {', '.join(HIGHRES_MODES)})")
+        return mode
+
+    def apply(self, request, model_type):
+        """
+        요청에 highres_mode와 2단계 생성 설정(highres_base, highres_strength, highres_tile, highres_overlap)을 기록합니다.
+        (요청 딕셔너리를 직접 수정하고 반환) 한 번에 생성하는 요청은 네 값이 모두 None입니다.
+        요청의 highres_mode가 정책의 기본 모드보다 우선하고, highres_strength는 기본 강도를 덮어씁니다.
+        기본 크기 버킷이 요청 크기보다 작지 않으면 2단계로 나눌 이유가 없으므로 한 번에 생성합니다.
+        """
+        mode = self.validate_mode(request.get("highres_mode") or self.mode)
+        request["highres_mode"] = mode
+        width, height = request["width"], request["height"]
+        base = None
+        if mode == "on" or (mode == "auto" and width * height >= self.min_pixels):
+            base = nearest_bucket(width, height, self.resolution_policy.buckets_for(model_type))
+            if base[0] * base[1] >= width * height:
+                base = None
+        if base is None:
+            request["highres_base"] = request["highres_strength"] = None
+            request["highres_tile"] = request["highres_overlap"] = None
+            return request
+        strength = request.get("highres_strength")
+        request["highres_base"] = list(base)
+        request["highres_strength"] = float(self.strength if strength is None else strength)
+        request["highres_tile"] = self.tile_size
+        request["highres_overlap"] = self.tile_overlap
+        return request
+
+    def describe(self):
+        return {"mode": self.mode, "min_pixels": self.min_pixels, "tile_size": self.tile_size,
+                "tile_overlap": self.tile_overlap, "strength": self.strength}
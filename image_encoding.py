@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import io
+import zipfile
+
+# 지원하는 출력 형식과 MIME 타입. raw는 압축하지 않은 RGB 바이트(행 순서: 위에서 아래)입니다.
+MEDIA_TYPES = {
+    "png": "image/png",
+    "webp": "image/webp",
+    "jpeg": "image/jpeg",
+    "raw": "application/x-rgb",
+}
+FORMAT_ALIASES = {"jpg": "jpeg", "rgb": "raw"}
+FILE_EXTENSIONS = {"png": "png", "webp": "webp", "jpeg": "jpg", "raw": "rgb"}
+
+
+class ImageEncoding:
+    """출력 형식과 압축 옵션입니다. quality는 webp/jpeg, compress_level은 png에만 사용됩니다."""
+
+    def __init__(self, format="png", quality=90, compress_level=6):
+        self.format = format
+        self.quality = quality
+        self.compress_level = compress_level
+
+    @property
+    def media_type(self):
+        return MEDIA_TYPES[self.format]
+
+    @property
+    def extension(self):
+        return FILE_EXTENSIONS[self.format]
+
+    def cache_key(self):
+        """결과 캐시 키에 포함할 값. 형식에 영향을 주는 옵션만 포함합니다."""
+        if self.format in ("webp", "jpeg"):
+            return [self.format, self.quality]
+        if self.format == "png":
+            return [self.format, self.compress_level]
+        return [self.format]
+
+    def encode(self, image):
+        """PIL 이미지를 이 형식의 바이트로 인코딩합니다. (CPU 작업이므로 스레드 풀에서 호출하세요)"""
+        if self.format == "raw":
+            return image.convert("RGB").tobytes()
+
+        buffer = io.BytesIO()
+        if self.format == "png":
+            image.save(buffer, format="PNG", compress_level=self.compress_level)
+        elif self.format == "webp":
+            image.save(buffer, format="WEBP", quality=self.quality, method=4)
+        else:
+            image.convert("RGB").save(buffer, format="JPEG", quality=self.quality)
+        return buffer.getvalue()
+
+    def headers(self, image_size):
+        """raw 형식은 텍스처 업로드에 필요한 크기와 픽셀 형식을 헤더로 알려 줍니다."""
+        if self.format != "raw":
+            return {}
+        width, height = image_size
+        return {"X-Image-Width": str(width), "X-Image-Height": str(height), "X-Pixel-Format": "RGB24"}
+
+
+def normalize_format(name):
+    """형식 이름을 정규화합니다. 지원하지 않으면 ValueError."""
+    name = (name or "").strip().lower()
+    name = FORMAT_ALIASES.get(name, name)
+    if name not in MEDIA_TYPES:
+        raise ValueError(f"지원하지 않는 출력 형식입니다: {name} (지원: {', '.join(MEDIA_TYPES)})")
+    return name
+
+
+def parse_accept(accept_header):
+    """Accept 헤더를 (MIME 타입, q값, 순서) 목록으로 파싱합니다."""
+    entries = []
+    for index, part in enumerate((accept_header or "").split(",")):
+        fields = [field.strip() for field in part.split(";")]
+        media = fields[0].lower()
+        if not media:
+            continue
+        q = 1.0
+        for param in fields[1:]:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        entries.append((media, q, index))
+    return entries
+
+
+def negotiate_format(accept_header, default="png"):
+    """
+    Accept 헤더에서 지원하는 형식 중 q값이 가장 높은(같으면 먼저 나온) 형식을 고릅니다.
+    image/* 나 */* 만 있거나 헤더가 없으면 default를 사용합니다.
+    """
+    best = None
+    for media, q, index in parse_accept(accept_header):
+        if q <= 0:
+            continue
+        if media in ("*/*", "image/*"):
+            fmt = default
+        else:
+            fmt = next((name for name, mime in MEDIA_TYPES.items() if mime == media), None)
+            if fmt is None:
+                continue
+        # 명시적인 형식이 와일드카드보다 우선합니다.
+        rank = (q, media not in ("*/*", "image/*"), -index)
+        if best is None or rank > best[0]:
+            best = (rank, fmt)
+    return best[1] if best else default
+
+
+def choose_encoding(request, accept_header, settings):
+    """
+    요청 필드(output_format, quality, png_compress_level), Accept 헤더, 서버 설정 순서로 출력 형식을 정합니다.
+    settings: default_output_format, jpeg_quality, webp_quality, png_compress_level 키를 가진 설정
+    """
+    if request.get("output_format"):
+        fmt = normalize_format(request["output_format"])
+    else:
+        fmt = negotiate_format(accept_header, default=normalize_format(settings["default_output_format"]))
+
+    quality = request.get("quality")
+    if quality is None:
+        quality = settings["webp_quality"] if fmt == "webp" else settings["jpeg_quality"]
+    compress_level = request.get("png_compress_level")
+    if compress_level is None:
+        compress_level = settings["png_compress_level"]
+    return ImageEncoding(fmt, quality=quality, compress_level=compress_level)
+
+
+# --- 여러 이미지 응답 ---
+def accepts_zip(accept_header):
+    """Accept 헤더가 application/zip을 허용하면 True (기본 컨테이너는 multipart/mixed)"""
+    return any(media == "application/zip" and q > 0 for media, q, _ in parse_accept(accept_header))
+
+
+def multipart_part(boundary, data, headers):
+    """multipart/mixed 응답의 파트 하나(경계선, 헤더, 본문)를 바이트로 만듭니다."""
+    lines = [f"--{boundary}"] + [f"{name}: {value}" for name, value in headers.items()]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("ascii") + data + b"\r\n"
+
+
+def multipart_end(boundary):
+    return f"--{boundary}--\r\n".encode("ascii")
+
+
+class ZipStream:
+    """
+    파일을 추가할 때마다 새로 쓰인 zip 바이트를 돌려주는 스트리밍 zip 작성기입니다.
+    이미지는 이미 압축되어 있으므로 압축하지 않고(ZIP_STORED) 저장합니다.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        # tell()/seek()가 없는 스트림에 쓰면 zipfile이 데이터 디스크립터 방식으로 순차 기록합니다.
+        self._zip = zipfile.ZipFile(self, mode="w", compression=zipfile.ZIP_STORED)
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _take(self):
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+    def add(self, name, data):
+        """파일 하나를 추가하고 그동안 쓰인 바이트를 반환합니다."""
+        self._zip.writestr(name, data)
+        return self._take()
+
+    def close(self):
+        """중앙 디렉토리를 기록하고 남은 바이트를 반환합니다."""
+        self._zip.close()
+        return self._take()
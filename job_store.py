@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+
+
+class JobStore:
+    """
+    작업 ID로 GenerationJob을 조회할 수 있도록 보관하는 저장소입니다.
+    완료된 작업은 TTL(초)이 지나면 결과와 함께 자동으로 제거됩니다.
+    """
+
+    def __init__(self, ttl=600):
+        self.ttl = ttl
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._jobs)
+
+    def add(self, job):
+        with self._lock:
+            self._purge_expired()
+            self._jobs[job.id] = job
+
+    def get(self, job_id):
+        """작업을 반환합니다. 없거나 만료된 경우 None을 반환합니다."""
+        with self._lock:
+            self._purge_expired()
+            return self._jobs.get(job_id)
+
+    def remove(self, job_id):
+        with self._lock:
+            return self._jobs.pop(job_id, None)
+
+    def _purge_expired(self):
+        # 호출자가 self._lock을 보유하고 있어야 합니다.
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.finished_at is not None and now - job.finished_at > self.ttl
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
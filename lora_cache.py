@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+from collections import OrderedDict, deque
+
+import metrics
+
+
+def request_loras(request):
+    """
+    요청에서 적용할 LoRA 목록을 ((파일 이름, 강도), ...) 튜플로 추출합니다.
+    'loras' 목록이 있으면 이를 사용하고, 없으면 기존 lora_name/lora_scale 필드를 사용합니다.
+    """
+    loras = request.get("loras")
+    if loras:
+        return tuple(
+            (lora["name"], float(lora.get("scale", 0.7)))
+            for lora in loras
+            if lora.get("name") and lora["name"] != "None"
+        )
+
+    lora_name = request.get("lora_name") or "None"
+    if lora_name == "None":
+        return ()
+    lora_scale = request.get("lora_scale")
+    return ((lora_name, float(lora_scale if lora_scale is not None else 0.7)),)
+
+
+def new_lora_stats():
+    """AdapterCache들이 공유하는 LoRA 통계 딕셔너리를 만듭니다."""
+    return {
+        "requests": 0,
+        "misses": 0,
+        "evictions": 0,
+        "load_seconds_total": 0.0,
+        "activations": 0,
+        "activation_seconds_total": 0.0,
+        "fuses": 0,
+        "unfuses": 0,
+        "fuse_seconds_total": 0.0,
+    }
+
+
+class AdapterCache:
+    """
+    하나의 파이프라인에 로드된 LoRA 어댑터를 관리하는 LRU 캐시입니다.
+
+    어댑터는 파일 경로별로 한 번만 로드되어 max_adapters개까지 파이프라인에 남아 있으며,
+    요청마다 set_adapters()로 필요한 어댑터와 가중치만 활성화합니다.
+    따라서 최근에 쓴 LoRA로 전환할 때 파일을 다시 읽지 않습니다.
+
+    fuse_threshold가 0보다 크면, 최근 fuse_window번의 호출 중 같은 (어댑터, 가중치) 조합이
+    fuse_threshold번 이상 쓰였을 때 그 조합을 기본 가중치에 병합(fuse_lora)하여
+    디노이징 스텝마다 어댑터를 따로 계산하는 비용을 없앱니다.
+    다른 조합이 요청되면 먼저 병합을 되돌린(unfuse_lora) 뒤 평소처럼 활성화합니다.
+    병합을 되돌리지 못하면 기본 가중치가 오염된 것이므로 corrupted를 표시하고 on_corrupted()를 호출합니다.
+    (ModelHandler는 이 파이프라인을 캐시에서 제거해 다음 요청에서 디스크에서 다시 로드합니다)
+    """
+
+    def __init__(self, pipeline, max_adapters=4, stats=None, fuse_threshold=0, fuse_window=16, on_corrupted=None):
+        self.pipeline = pipeline
+        self.on_corrupted = on_corrupted
+        self.corrupted = False # 병합을 되돌리지 못해 기본 가중치가 오염된 상태
+        self.max_adapters = max_adapters
+        self.stats = stats if stats is not None else new_lora_stats()
+        self.fuse_threshold = fuse_threshold
+        self._recent = deque(maxlen=max(fuse_window, fuse_threshold, 1)) # 최근 활성화한 조합
+        self._fused = None # 기본 가중치에 병합된 (어댑터 이름, 가중치) 조합
+        self._unfusable = set() # 병합에 실패한 조합 (다시 시도하지 않음)
+        self._adapters = OrderedDict() # lora_path -> adapter_name
+        self._next_id = 0
+        self._active = None # 마지막으로 활성화한 (어댑터 이름, 가중치) 튜플. ()는 LoRA 비활성 상태
+        self._disabled = False # disable_lora()로 LoRA를 끈 상태인지 여부
+
+    def __contains__(self, lora_path):
+        return lora_path in self._adapters
+
+    def state_key(self):
+        """활성화된 어댑터 조합과 병합된 조합을 반환합니다. 같은 값이면 디노이저 가중치와 LoRA 계층이 같은 상태입니다."""
+        return (self._active, self._fused)
+
+    def loaded_paths(self):
+        return list(self._adapters)
+
+    def fused_paths(self):
+        """기본 가중치에 병합되어 있는 LoRA의 (파일 경로, 강도) 목록을 반환합니다."""
+        if not self._fused:
+            return []
+        paths = {name: path for path, name in self._adapters.items()}
+        return [(paths.get(name, name), weight) for name, weight in zip(*self._fused)]
+
+    def ensure(self, lora_paths):
+        """
+        요청한 LoRA가 모두 파이프라인에 로드되어 있도록 합니다. 새로 로드하면서 max_adapters를 넘으면
+        이번 요청에 쓰이지 않는 가장 오래된 어댑터를 제거합니다. 로드에 실패한 LoRA는 경고 후 건너뜁니다.
+        """
+        for lora_path in lora_paths:
+            if lora_path in self._adapters:
+                self._adapters.move_to_end(lora_path)
+                continue
+
+            self.stats["misses"] += 1
+            # 병합된 상태에서는 새 어댑터를 로드하지 않도록 먼저 병합을 되돌립니다.
+            self.unfuse()
+            adapter_name = f"lora_{self._next_id}"
+            self._next_id += 1
+            print(f"LoRA 로딩 시도 중: {lora_path}")
+            try:
+                start = time.perf_counter()
+                self.pipeline.load_lora_weights(lora_path, adapter_name=adapter_name)
+                elapsed = time.perf_counter() - start
+                self.stats["load_seconds_total"] += elapsed
+                metrics.record_stage("load_lora", elapsed)
+                self._adapters[lora_path] = adapter_name
+                print(f"LoRA 로딩 성공. (어댑터: {adapter_name})")
+            except Exception as e:
+                # 실패할 경우, 경고를 출력하고 LoRA 없이 계속 진행합니다.
+                print(f"경고: 현재 모델은 LoRA '{lora_path}'를 지원하지 않을 수 있습니다. 오류: {e}")
+
+        while len(self._adapters) > self.max_adapters:
+            victim = next((path for path in self._adapters if path not in lora_paths), None)
+            if victim is None:
+                break
+            self.evict(victim)
+
+    def evict(self, lora_path):
+        if lora_path not in self._adapters:
+            return
+        self.unfuse()
+        adapter_name = self._adapters.pop(lora_path)
+        try:
+            self.pipeline.delete_adapter([adapter_name])
+            print(f"LoRA 어댑터 '{lora_path}' 제거됨.")
+        except Exception: pass
+        self.stats["evictions"] += 1
+        self._active = None
+
+    def activate(self, loras):
+        """
+        (LoRA 경로, 강도) 목록에 해당하는 어댑터만 활성화합니다. 목록이 비어 있으면 LoRA를 끕니다.
+        직전 호출과 같은 조합이면 set_adapters를 다시 호출하지 않습니다.
+        """
+        # 사용한 어댑터를 LRU 순서의 끝으로 옮기고 요청 수를 집계합니다. (히트 = 요청 - 미스)
+        for path, _ in loras:
+            self.stats["requests"] += 1
+            if path in self._adapters:
+                self._adapters.move_to_end(path)
+        loaded = [(self._adapters[path], scale) for path, scale in loras if path in self._adapters]
+        active = (tuple(name for name, _ in loaded), tuple(scale for _, scale in loaded)) if loaded else ()
+        self._recent.append(active)
+        if self._fused is not None and active != self._fused:
+            self.unfuse()
+        if active != self._active:
+            self._set_active(active, loras)
+        if self._should_fuse(active):
+            self.fuse()
+
+    def _set_active(self, active, loras):
+        loaded = list(zip(*active)) if active else []
+        start = time.perf_counter()
+        try:
+            if not loaded:
+                if self._adapters:
+                    self.pipeline.disable_lora()
+                    self._disabled = True
+            else:
+                if self._disabled:
+                    self.pipeline.enable_lora()
+                    self._disabled = False
+                self.pipeline.set_adapters(list(active[0]), adapter_weights=list(active[1]))
+                names = ", ".join(os.path.basename(path) for path, _ in loras if path in self._adapters)
+                print(f"LoRA 활성화: {names} (강도: {list(active[1])})")
+            self._active = active
+        except Exception as e:
+            print(f"경고: LoRA 어댑터 가중치를 설정하지 못했습니다. LoRA가 적용되지 않을 수 있습니다. 오류: {e}")
+            self._active = None
+        self.stats["activations"] += 1
+        self.stats["activation_seconds_total"] += time.perf_counter() - start
+
+    def _should_fuse(self, active):
+        return (
+            self.fuse_threshold > 0
+            and active
+            and active == self._active
+            and active != self._fused
+            and active not in self._unfusable
+            and self._recent.count(active) >= self.fuse_threshold
+        )
+
+    def fuse(self):
+        """현재 활성화된 어댑터 조합을 기본 가중치에 병합합니다. 실패하면 이 조합은 병합하지 않고 계속 진행합니다."""
+        active = self._active
+        start = time.perf_counter()
+        try:
+            # set_adapters로 지정한 어댑터별 가중치가 그대로 병합됩니다.
+            self.pipeline.fuse_lora(adapter_names=list(active[0]), lora_scale=1.0)
+            self._fused = active
+            self.stats["fuses"] += 1
+            print(f"LoRA 병합(fuse) 완료: {list(active[0])} (강도: {list(active[1])})")
+        except Exception as e:
+            print(f"경고: LoRA를 기본 가중치에 병합하지 못했습니다. 병합 없이 계속 진행합니다. 오류: {e}")
+            self._unfusable.add(active)
+        self.stats["fuse_seconds_total"] += time.perf_counter() - start
+
+    def unfuse(self):
+        """병합된 LoRA를 기본 가중치에서 되돌립니다. 병합된 조합이 없으면 아무것도 하지 않습니다."""
+        if self._fused is None:
+            return
+        start = time.perf_counter()
+        try:
+            self.pipeline.unfuse_lora()
+            print("LoRA 병합 해제(unfuse) 완료.")
+        except Exception as e:
+            # 되돌리지 못하면 기본 가중치가 오염되므로 이 파이프라인을 더 쓰지 않도록 표시하고 오류를 그대로 전달합니다.
+            self._fused = None
+            self._active = None
+            self.corrupted = True
+            if self.on_corrupted is not None:
+                self.on_corrupted()
+            raise RuntimeError(f"병합된 LoRA를 되돌리지 못했습니다. 모델을 다시 로드합니다: {e}") from e
+        finally:
+            self.stats["fuse_seconds_total"] += time.perf_counter() - start
+        self._fused = None
+        self._active = None
+        self.stats["unfuses"] += 1
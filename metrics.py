@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+import bisect
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# 지연 시간 히스토그램의 기본 버킷 경계 (초)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """레이블 값 조합별로 값을 보관하는 지표입니다. 값 갱신은 잠금 하나와 딕셔너리 조회뿐이라 항상 켜 두어도 됩니다."""
+
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def samples(self):
+        """(이름 접미사, 레이블 목록, 값) 목록을 반환합니다."""
+        with self._lock:
+            items = list(self._values.items())
+        return [("", list(zip(self.labelnames, key)), value) for key, value in sorted(items)]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [버킷별 개수(마지막은 +Inf), 합계, 개수]
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(key, [list(state[0]), state[1], state[2]]) for key, state in self._values.items()]
+        samples = []
+        for key, (counts, total, count) in sorted(items):
+            labels = list(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                samples.append(("_bucket", labels + [("le", _format_value(float(bound)))], cumulative))
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, count))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Prometheus 텍스트 형식(0.0.4)으로 내보낼 지표 모음입니다.
+    직접 갱신하는 지표 외에, 조회 시점에 값을 읽어 오는 수집 함수(collector)를 등록할 수 있습니다.
+    (캐시 통계나 큐 길이처럼 이미 다른 곳에서 집계하는 값은 중복으로 세지 않고 수집 함수로 내보냅니다)
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _add(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self._add(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def add_collector(self, collector):
+        """
+        collector(): (이름, 형식, 설명, [(레이블 딕셔너리, 값), ...]) 튜플을 내보내는 함수.
+        수집 함수의 오류는 다른 지표 출력을 막지 않도록 무시합니다.
+        """
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+
+        for collector in collectors:
+            try:
+                families = list(collector())
+            except Exception as e:
+                print(f"경고: 지표 수집 중 오류가 발생했습니다: {e}")
+                continue
+            for name, metric_type, help, samples in families:
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for labels, value in samples:
+                    if value is None:
+                        continue
+                    lines.append(f"{name}{_format_labels(sorted(labels.items()))} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "aigen_stage_seconds",
+    "요청 처리 단계별 소요 시간 (denoise는 디노이징 스텝 하나의 시간)",
+    ["stage"],
+)
+GENERATION_SECONDS = REGISTRY.histogram(
+    "aigen_generation_seconds",
+    "작업 등록부터 생성 완료까지의 시간 (모델, 해상도별)",
+    ["model", "resolution"],
+)
+JOBS_TOTAL = REGISTRY.counter("aigen_jobs_total", "처리한 생성 작업 수 (상태별)", ["status"])
+IMAGES_TOTAL = REGISTRY.counter("aigen_images_generated_total", "생성한 이미지 수 (모델별)", ["model"])
+
+
+# --- 요청별 단계 시간 ---
+_local = threading.local()
+
+
+@contextmanager
+def trace():
+    """
+    이 블록 안에서(같은 스레드) 기록되는 단계 시간을 모은 딕셔너리를 제공합니다.
+    같은 단계가 여러 번 기록되면 합산됩니다. (예: denoise는 전체 디노이징 시간)
+    """
+    timings = {}
+    previous = getattr(_local, "timings", None)
+    _local.timings = timings
+    try:
+        yield timings
+    finally:
+        _local.timings = previous
+
+
+def record_stage(stage_name, seconds):
+    """단계 시간을 히스토그램에 기록하고, 진행 중인 trace()가 있으면 그 요청의 시간에도 더합니다."""
+    STAGE_SECONDS.observe(seconds, stage=stage_name)
+    timings = getattr(_local, "timings", None)
+    if timings is not None:
+        timings[stage_name] = timings.get(stage_name, 0.0) + seconds
+
+
+@contextmanager
+def stage(stage_name):
+    """블록의 실행 시간을 단계 시간으로 기록합니다."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage_name, time.perf_counter() - start)
+
+
+def server_timing(timings):
+    """단계 시간(초) 딕셔너리를 Server-Timing 헤더 값(밀리초)으로 만듭니다."""
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
+
+
+# --- GPU 메모리 ---
+def collect_gpu_memory():
+    """torch가 이미 로드되어 있고 CUDA를 쓸 수 있으면 장치별 메모리 사용량과 최고 기록을 내보냅니다."""
+    torch = sys.modules.get("torch")
+    if torch is None or not torch.cuda.is_available():
+        return
+    devices = range(torch.cuda.device_count())
+    yield ("aigen_gpu_memory_allocated_bytes", "gauge", "현재 할당된 GPU 메모리",
+           [({"device": str(d)}, torch.cuda.memory_allocated(d)) for d in devices])
+    yield ("aigen_gpu_memory_max_allocated_bytes", "gauge", "프로세스 시작 후 할당된 GPU 메모리의 최고 기록",
+           [({"device": str(d)}, torch.cuda.max_memory_allocated(d)) for d in devices])
+    yield ("aigen_gpu_memory_max_reserved_bytes", "gauge", "프로세스 시작 후 예약된 GPU 메모리의 최고 기록",
+           [({"device": str(d)}, torch.cuda.max_memory_reserved(d)) for d in devices])
+
+
+REGISTRY.add_collector(collect_gpu_memory)
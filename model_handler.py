@@ -1,8 +1,27 @@
 # -*- coding: utf-8 -*-
+import functools
 import gc
+import inspect
 import json
 import os
+import random
 import sys
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+
+import devices
+import metrics
+from artifact_cache import ArtifactCache
+from compiler import CompilePolicy, configure_dynamo
+from feature_cache import FeatureCache
+from highres import refine_steps, refine_tiles, tile_boxes, upscale
+from lora_cache import AdapterCache, new_lora_stats
+from pipeline_cache import PipelineCache, estimate_pipeline_bytes
+from prompt_cache import PromptEmbeddingCache
+from result_cache import file_fingerprint, model_revision
+from state_lock import StateLock
 
 # --- 지연 로딩될 라이브러리 (Lazy-loaded library placeholders) ---
 torch = None
@@ -13,6 +32,8 @@ FluxPipeline = None
 SDNQConfig = None
 _triton_available = False # Triton 설치 여부를 저장할 플래그
 apply_sdnq_options_to_model = None
+save_sdnq_model = None # SDNQ 변환 결과 저장/불러오기 (sdnq 버전에 따라 없을 수 있음)
+load_sdnq_model = None
 
 def _lazy_import():
     """
@@ -20,6 +41,7 @@ def _lazy_import():
     이로 인해 애플리케이션 시작 속도가 매우 빨라집니다.
     """
     global torch, diffusers, DiffusionPipeline, AutoPipelineForText2Image, FluxPipeline, SDNQConfig, _triton_available, apply_sdnq_options_to_model
+    global save_sdnq_model, load_sdnq_model
     
     if torch is not None:
         return
@@ -48,6 +70,12 @@ def _lazy_import():
         FluxPipeline = FP_lib
         SDNQConfig = SDNQ_lib
         apply_sdnq_options_to_model = apply_sdnq_lib
+        try:
+            from sdnq.loader import save_sdnq_model as save_sdnq_lib, load_sdnq_model as load_sdnq_lib
+            save_sdnq_model = save_sdnq_lib
+            load_sdnq_model = load_sdnq_lib
+        except ImportError:
+            pass # 아티팩트 캐시는 diffusers/transformers의 save_pretrained 형식으로 저장합니다.
         
         print("라이브러리 로딩 완료.")
     except ImportError as e:
@@ -60,167 +88,737 @@ if getattr(sys, 'frozen', False):
 else:
     BASE_PATH = os.path.dirname(os.path.abspath(__file__))
 
+def get_model_type(model_name):
+    """모델 이름에서 아키텍처 타입('sd', 'flux', 'qwen')을 식별합니다."""
+    model_name_lower = model_name.lower()
+    if 'flux' in model_name_lower:
+        return 'flux'
+    elif 'qwen' in model_name_lower:
+        return 'qwen'
+    return 'sd' # 기본값
+
+# SDNQ 최적화를 적용하는 파이프라인 구성 요소
+SDNQ_COMPONENTS = ('transformer', 'text_encoder', 'text_encoder_2', 'unet')
+
+def _save_component(component, path):
+    """아티팩트 캐시에 구성 요소 하나를 safetensors로 저장하고, 불러올 때 필요한 메타데이터를 반환합니다."""
+    if save_sdnq_model is not None:
+        save_sdnq_model(component, path)
+        return {"format": "sdnq"}
+    component.save_pretrained(path, safe_serialization=True)
+    component_class = type(component)
+    return {"format": "pretrained", "class": f"{component_class.__module__}:{component_class.__qualname__}"}
+
+def _load_component(path, meta, dtype):
+    """_save_component로 저장한 구성 요소를 불러옵니다. safetensors 파일은 메모리 매핑(mmap)으로 읽습니다."""
+    if meta["format"] == "sdnq":
+        if load_sdnq_model is None:
+            raise RuntimeError("설치된 sdnq에 load_sdnq_model이 없습니다.")
+        return load_sdnq_model(path, dtype=dtype, use_quantized_matmul=True)
+    import importlib
+    module_name, class_name = meta["class"].split(":")
+    component_class = getattr(importlib.import_module(module_name), class_name)
+    return component_class.from_pretrained(path, torch_dtype=dtype, low_cpu_mem_usage=True)
+
 class ModelHandler:
-    def __init__(self):
+    def __init__(self, pipeline_loader=None, pipeline_cache=None, max_loras=4, lora_fuse_threshold=0, lora_fuse_window=16,
+                 prompt_cache=None, device="auto", dtype="auto", offload="auto", model_placements=None,
+                 vae_policy=None, artifact_cache=None, model_type_resolver=None, compile_policy=None,
+                 feature_cache=None):
         """
         ModelHandler를 초기화합니다.
         실제 모델과 무거운 라이브러리는 필요할 때까지 로드되지 않습니다.
+
+        pipeline_loader: (선택) model_name을 받아 (pipeline, model_type)을 반환하는 함수.
+                         지정하면 diffusers 대신 이 함수로 파이프라인을 만듭니다. (예: FakePipeline)
+        pipeline_cache: (선택) 여러 모델을 상주시키는 PipelineCache.
+                        지정하지 않으면 한 번에 하나의 모델만 유지합니다.
+        max_loras: 모델별로 로드해 둘 LoRA 어댑터의 최대 개수 (LRU)
+        lora_fuse_threshold: 최근 lora_fuse_window번의 생성 중 같은 LoRA 조합이 이 횟수 이상 쓰이면
+                             기본 가중치에 병합합니다. 0이면 병합하지 않습니다.
+        prompt_cache: (선택) 텍스트 인코더 출력을 재사용하는 PromptEmbeddingCache. None이면 매번 인코딩합니다.
+        device, dtype, offload: 모델을 실행할 장치, 가중치 dtype, CPU 오프로드 방식 ("auto"이면 자동 선택)
+        model_placements: 모델 이름 또는 모델 타입별로 device, dtype, offload를 덮어쓰는 딕셔너리
+        vae_policy: (선택) 요청 크기에 따라 VAE 타일링/슬라이싱을 정하는 devices.VaeMemoryPolicy
+        artifact_cache: (선택) SDNQ 최적화를 마친 구성 요소를 디스크에 보관하는 ArtifactCache.
+                        None이면 모델을 로드할 때마다 최적화를 다시 적용합니다.
+        model_type_resolver: (선택) 모델 이름으로 모델 타입('sd', 'flux', 'qwen')을 반환하는 함수.
+                             지정하지 않으면 get_model_type(모델 이름에 포함된 문자열)을 사용합니다.
+        compile_policy: (선택) 모델별로 디노이저를 torch.compile로 실행하는 CompilePolicy. None이면 항상 eager로 실행합니다.
+        feature_cache: (선택) 요청의 cache_interval/cache_threshold에 따라 스텝 사이에 블록 출력을 재사용하는 FeatureCache
         """
+        self.pipeline_loader = pipeline_loader
+        self.pipeline_cache = pipeline_cache or PipelineCache(gpu_budget_bytes=0)
+        if self.pipeline_cache.release_memory is None:
+            self.pipeline_cache.release_memory = self._release_memory
+        # 프롬프트 임베딩 캐시: 모델이 캐시에서 제거되면 그 모델의 임베딩도 함께 지웁니다.
+        self.prompt_cache = prompt_cache
+        if self.prompt_cache is not None and self.pipeline_cache.on_evict is None:
+            self.pipeline_cache.on_evict = self.prompt_cache.clear_model
+        # 모델/LoRA 상태 잠금: 생성 중에는 다른 스레드가 모델이나 LoRA를 바꿀 수 없습니다.
+        self._state_lock = StateLock()
+        # diffusers 파이프라인 호출은 재진입에 안전하지 않으므로 호출 자체는 직렬화합니다.
+        self._call_lock = threading.Lock()
         self.pipeline = None
         self.current_model_name = None
-        self.current_lora = None
+        self.current_lora = None # load_lora()로 지정한 기본 LoRA 경로
         self.model_type = None # 'sd', 'flux', 'qwen' 등 모델 아키텍처 타입
+        self.adapters = None # 현재 파이프라인의 AdapterCache
+        self.max_loras = max_loras
+        self.lora_fuse_threshold = lora_fuse_threshold
+        self.lora_fuse_window = lora_fuse_window
+        self.lora_stats = new_lora_stats()
+        self._step_callback_support = {} # 파이프라인 클래스 -> callback_on_step_end 지원 여부
+        self._img2img_support = {} # 파이프라인 클래스 -> image/strength 인수(img2img) 지원 여부
+        self._img2img = weakref.WeakKeyDictionary() # pipeline -> 구성 요소를 공유하는 img2img 파이프라인 (지원하지 않으면 None)
+        self.placement_defaults = {"device": device, "dtype": dtype, "offload": offload}
+        self.model_placements = model_placements or {}
+        self._resolved_placements = {} # 모델 이름 -> "auto"를 실제 값으로 정한 device/dtype/offload 설정 (결과 캐시 키용)
+        self.vae_policy = vae_policy or devices.VaeMemoryPolicy()
+        self.artifact_cache = artifact_cache
+        self.model_type_of = model_type_resolver or get_model_type
+        self.compile_policy = compile_policy or CompilePolicy()
+        self.feature_cache = feature_cache or FeatureCache()
+        self.device = None # 현재 파이프라인이 실행되는 장치 (가짜 파이프라인은 None)
         self.cache_dir = os.path.join(os.path.expanduser("~"), "AI-models")
         print(f"모델 디렉토리: {self.cache_dir}")
         if not os.path.exists(self.cache_dir):
             os.makedirs(self.cache_dir)
 
-    def _get_pipeline_info(self, model_name):
+    def placement_settings(self, model_name):
+        """모델의 device, dtype, offload 설정을 반환합니다. (모델 이름별 설정 > 모델 타입별 설정 > 기본값)"""
+        settings = dict(self.placement_defaults)
+        settings.update(self.model_placements.get(self.model_type_of(model_name), {}))
+        settings.update(self.model_placements.get(model_name, {}))
+        return settings
+
+    def result_settings(self, model_name):
+        """
+        요청이 같아도 생성 결과(픽셀)를 바꿀 수 있는 서버 설정을 반환합니다. (결과 캐시 키용)
+        device/dtype은 "auto"를 이 환경에서 실제로 고르는 값으로 바꾸고, VAE 타일링과 LoRA 병합 설정을 함께 담습니다.
+        """
+        placement = self._resolved_placements.get(model_name)
+        if placement is None:
+            placement = self.placement_settings(model_name)
+            if self.pipeline_loader is None:
+                device = devices.resolve_device(placement["device"])
+                dtype = devices.resolve_dtype(device, placement["dtype"])
+                placement = dict(placement, device=device, dtype=str(dtype).replace("torch.", ""))
+            self._resolved_placements[model_name] = placement
+        return {
+            "placement": placement,
+            "vae_tiling": self.vae_policy.tiling,
+            "vae_tiling_min_pixels": self.vae_policy.tiling_min_pixels,
+            "lora_fuse_threshold": self.lora_fuse_threshold,
+            "lora_fuse_window": self.lora_fuse_window,
+        }
+
+    def _get_pipeline_info(self, model_name, dtype):
         """모델 이름에 따라 적절한 파이프라인 클래스와 로더 인수를 반환합니다."""
         _lazy_import()
-        model_name_lower = model_name.lower()
-        dtype = torch.bfloat16 if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else torch.float16
+        model_type = self.model_type_of(model_name)
 
-        if 'flux' in model_name_lower:
+        if model_type == 'flux':
             print("FLUX 모델 타입 감지됨.")
             return AutoPipelineForText2Image, 'flux', {'torch_dtype': dtype}
-        elif 'qwen' in model_name_lower:
+        elif model_type == 'qwen':
             print("Qwen 모델 타입 감지됨.")
             return AutoPipelineForText2Image, 'qwen', {'torch_dtype': dtype}
         else: # 기본값: Stable Diffusion
             print("Stable Diffusion 모델 타입 감지됨.")
             return DiffusionPipeline, 'sd', {'torch_dtype': dtype, 'use_safetensors': True}
 
+    def is_resident(self, model_name):
+        """모델이 이미 GPU에 상주하여 로딩 없이 바로 사용할 수 있는지 반환합니다."""
+        return self.current_model_name == model_name or self.pipeline_cache.is_resident(model_name)
+
+    def loaded_loras(self):
+        """현재 모델에 로드되어 있는 LoRA 파일 경로 목록을 반환합니다."""
+        adapters = self.adapters
+        return adapters.loaded_paths() if adapters is not None else []
+
+    def lora_cache_stats(self):
+        """LoRA 어댑터 캐시 통계(히트/미스, 로딩/활성화 횟수와 시간)와 현재 모델에 로드된 LoRA를 반환합니다."""
+        stats = dict(self.lora_stats)
+        stats["hits"] = max(0, stats["requests"] - stats["misses"])
+        stats["hit_rate"] = stats["hits"] / stats["requests"] if stats["requests"] else 0.0
+        stats["avg_load_seconds"] = stats["load_seconds_total"] / stats["misses"] if stats["misses"] else 0.0
+        stats["avg_activation_seconds"] = (
+            stats["activation_seconds_total"] / stats["activations"] if stats["activations"] else 0.0
+        )
+        stats["max_adapters"] = self.max_loras
+        stats["fuse_threshold"] = self.lora_fuse_threshold
+        stats["loaded"] = [os.path.basename(path) for path in self.loaded_loras()]
+        adapters = self.adapters
+        stats["fused"] = [
+            {"name": os.path.basename(path), "scale": scale}
+            for path, scale in (adapters.fused_paths() if adapters is not None else [])
+        ]
+        return stats
+
+    @contextmanager
+    def session(self, model_name, lora_paths=()):
+        """
+        요청한 모델과 LoRA들이 로드된 상태를 고정한 채 생성을 실행하는 세션입니다.
+        현재 상태로 충분한 세션(같은 모델이고 필요한 LoRA가 모두 로드됨)은 동시에 들어갈 수 있고,
+        모델을 바꾸거나 새 LoRA를 로드해야 하는 세션은 진행 중인 세션이 모두 끝난 뒤 단독으로 상태를 바꿉니다.
+
+        사용 예:
+            with handler.session("Disty0/Z-Image-Turbo-SDNQ-int8", [lora_path]):
+                images = handler.generate_batch(requests, loras=[(lora_path, 0.8)])
+        """
+        lora_paths = tuple(lora_paths)
+
+        def satisfied():
+            return (self.current_model_name == model_name and not self.adapters.corrupted
+                    and all(path in self.adapters for path in lora_paths))
+
+        def switch():
+            self._load_model(model_name)
+            self.adapters.ensure(lora_paths)
+            return (self.current_model_name, lora_paths)
+
+        self._state_lock.acquire((model_name, lora_paths), switch, satisfied)
+        try:
+            yield self
+        finally:
+            self._state_lock.release()
+
     def load_model(self, model_name):
-        """AI 모델을 아키텍처에 맞게 메모리로 로드합니다."""
-        if self.current_model_name == model_name:
+        """
+        AI 모델을 아키텍처에 맞게 메모리로 로드합니다.
+        이전에 로드한 모델은 PipelineCache에 남아 있으므로, 다시 요청되면 디스크에서 읽지 않고 재사용합니다.
+        진행 중인 생성 세션이 있으면 끝날 때까지 기다립니다.
+        """
+        with self._state_lock.exclusive():
+            return self._load_model(model_name)
+
+    def _load_model(self, model_name):
+        # LoRA 병합을 되돌리지 못한 파이프라인은 캐시에서 제거되었으므로 디스크에서 다시 로드합니다.
+        if self.current_model_name == model_name and not self.adapters.corrupted:
+            self.pipeline_cache.get(model_name) # LRU 순서와 통계 갱신
             return self.pipeline
+        with metrics.stage("load_model"):
+            return self._switch_model(model_name)
 
-        if self.pipeline:
-            del self.pipeline
-            gc.collect()
-            torch.cuda.empty_cache()
-            self.pipeline = None
-            self.current_lora = None
-            self.model_type = None
+    def _switch_model(self, model_name):
+        # 현재 파이프라인의 기본 LoRA를 캐시 엔트리에 보관 (다시 전환될 때 복원)
+        current_entry = self.pipeline_cache.peek(self.current_model_name)
+        if current_entry is not None:
+            current_entry.current_lora = self.current_lora
+        self.pipeline = None
+        self.current_model_name = None
+        self.current_lora = None
+        self.model_type = None
+        self.adapters = None
+        self.device = None
 
-        print(f"모델 로딩 중: {model_name}")
-        
-        try:
-            pipeline_class, model_type, loader_args = self._get_pipeline_info(model_name)
-            
-            self.pipeline = pipeline_class.from_pretrained(
-                model_name,
-                **loader_args,
-                cache_dir=self.cache_dir
-            )
-            self.model_type = model_type
-
-            # SDNQ 최적화 적용: 모델 이름에 'sdnq'가 포함되고 Triton이 사용 가능한 경우에만 양자화 시도
-            if _triton_available and 'sdnq' in model_name.lower() and (torch.cuda.is_available() or hasattr(torch, 'xpu') and torch.xpu.is_available()):
-                print("SDNQ 모델 감지됨. 양자화 최적화를 시도합니다.")
-                # 모델의 각 구성 요소에 양자화 적용 시도
-                for attr_name in ['transformer', 'text_encoder', 'text_encoder_2', 'unet']:
-                    if hasattr(self.pipeline, attr_name) and getattr(self.pipeline, attr_name) is not None:
-                        try:
-                            component = getattr(self.pipeline, attr_name)
-                            setattr(self.pipeline, attr_name, apply_sdnq_options_to_model(component, use_quantized_matmul=True))
-                            print(f"SDNQ 최적화 적용됨: {attr_name} (INT8 MatMul)")
-                        except Exception as e:
-                            print(f"경고: '{attr_name}'에 SDNQ 최적화를 적용하지 못했습니다: {e}")
-            
-            self.pipeline.to("cuda")
-            self.current_model_name = model_name
+        entry = self.pipeline_cache.get(model_name)
+        if entry is None:
+            print(f"모델 로딩 중: {model_name}")
+            try:
+                start = time.perf_counter()
+                pipeline, model_type, placement = self._load_pipeline(model_name)
+                entry = self.pipeline_cache.put(
+                    model_name, pipeline, model_type, time.perf_counter() - start, placement=placement
+                )
+            except Exception as e:
+                print(f"모델 {model_name} 로딩 중 오류 발생: {e}")
+                raise e
             print("모델 로딩 성공.")
-            return self.pipeline
-        except Exception as e:
-            print(f"모델 {model_name} 로딩 중 오류 발생: {e}")
-            self.current_model_name = None
-            self.model_type = None
-            raise e
 
-    def load_lora(self, lora_path):
-        """LoRA 파일을 로드합니다. 모델이 지원하는 경우에만 적용됩니다."""
+        # 로드된 LoRA 어댑터는 파이프라인과 함께 캐시 엔트리에 남아 있으므로 그대로 재사용
+        if entry.adapters is None:
+            entry.adapters = AdapterCache(
+                entry.pipeline,
+                self.max_loras,
+                self.lora_stats,
+                fuse_threshold=self.lora_fuse_threshold,
+                fuse_window=self.lora_fuse_window,
+                on_corrupted=functools.partial(self._evict_corrupted, model_name, entry.pipeline),
+            )
+        self.pipeline = entry.pipeline
+        self.model_type = entry.model_type
+        self.adapters = entry.adapters
+        self.current_lora = entry.current_lora
+        self.device = entry.device
+        self.current_model_name = model_name
+        return self.pipeline
+
+    def _evict_corrupted(self, model_name, pipeline):
+        """LoRA 병합을 되돌리지 못해 기본 가중치가 오염된 파이프라인을 캐시에서 제거합니다."""
+        entry = self.pipeline_cache.peek(model_name)
+        if entry is not None and entry.pipeline is pipeline:
+            print(f"경고: '{model_name}'의 기본 가중치가 오염되어 캐시에서 제거합니다. 다음 요청에서 다시 로드합니다.")
+            self.pipeline_cache.remove(model_name)
+
+    def _load_pipeline(self, model_name):
+        """
+        디스크에서 파이프라인을 로드하여 (pipeline, model_type, placement)를 반환합니다.
+        오프로드가 필요하면 여기서 훅을 설치하고, 그 밖의 장치 이동은 캐시가 담당합니다.
+        """
+        if self.pipeline_loader is not None:
+            pipeline, model_type = self.pipeline_loader(model_name)
+            return pipeline, model_type, None
+
         _lazy_import()
-        if self.current_lora == lora_path:
+        settings = self.placement_settings(model_name)
+        device = devices.resolve_device(settings["device"])
+        dtype = devices.resolve_dtype(device, settings["dtype"])
+        pipeline_class, model_type, loader_args = self._get_pipeline_info(model_name, dtype)
+
+        # SDNQ 최적화: 모델 이름에 'sdnq'가 포함되고 Triton이 사용 가능한 경우에만 양자화 시도
+        use_sdnq = _triton_available and 'sdnq' in model_name.lower() and device in ('cuda', 'xpu')
+        artifact_inputs, preloaded = None, {}
+        if use_sdnq and self.artifact_cache is not None:
+            artifact_inputs, preloaded = self._load_artifact(model_name, device, dtype)
+
+        # 아티팩트에서 불러온 구성 요소는 인수로 넘겨 원본 가중치를 다시 읽지 않습니다.
+        pipeline = pipeline_class.from_pretrained(
+            model_name,
+            **loader_args,
+            **preloaded,
+            cache_dir=self.cache_dir
+        )
+
+        if use_sdnq and not preloaded:
+            print("SDNQ 모델 감지됨. 양자화 최적화를 시도합니다.")
+            applied = []
+            # 모델의 각 구성 요소에 양자화 적용 시도
+            for attr_name in SDNQ_COMPONENTS:
+                if hasattr(pipeline, attr_name) and getattr(pipeline, attr_name) is not None:
+                    try:
+                        component = getattr(pipeline, attr_name)
+                        setattr(pipeline, attr_name, apply_sdnq_options_to_model(component, use_quantized_matmul=True))
+                        applied.append(attr_name)
+                        print(f"SDNQ 최적화 적용됨: {attr_name} (INT8 MatMul)")
+                    except Exception as e:
+                        print(f"경고: '{attr_name}'에 SDNQ 최적화를 적용하지 못했습니다: {e}")
+            # 변환 결과를 저장해 두면 다음 로딩(재시작, 캐시에서 제거된 뒤 다시 요청)에서는 변환을 건너뜁니다.
+            if applied and artifact_inputs is not None:
+                self.artifact_cache.store(artifact_inputs, {
+                    name: functools.partial(_save_component, getattr(pipeline, name)) for name in applied
+                })
+
+        # 로드한 모델 크기와 남은 장치 메모리로 오프로드 방식을 정합니다.
+        offload = devices.choose_offload(
+            device, estimate_pipeline_bytes(pipeline), devices.component_bytes(pipeline), settings["offload"]
+        )
+        placement = devices.Placement(device, dtype, offload)
+        devices.apply_offload(pipeline, placement)
+        print(f"장치 배치: {device}, {str(dtype).replace('torch.', '')}, 오프로드 {offload}")
+        return pipeline, model_type, placement
+
+    def _load_artifact(self, model_name, device, dtype):
+        """
+        아티팩트 캐시에서 SDNQ 최적화를 마친 구성 요소를 불러와 (키 값, {구성 요소 이름: 모듈})을 반환합니다.
+        아티팩트가 없으면 빈 딕셔너리를 반환하고, 불러오기에 실패하면 그 아티팩트를 지우고 빈 딕셔너리를 반환합니다.
+        """
+        # 허브 모델은 refs/main의 리비전, 로컬 디렉토리 모델은 model_index.json의 크기/수정 시각으로 버전을 구분합니다.
+        revision = model_revision(self.cache_dir, model_name)
+        if revision is None and os.path.isdir(model_name):
+            revision = file_fingerprint(os.path.join(model_name, "model_index.json"))
+        inputs = self.artifact_cache.key_inputs(
+            model_name, revision, device, dtype, {"sdnq": True, "use_quantized_matmul": True}
+        )
+        artifact = self.artifact_cache.lookup(inputs)
+        if artifact is None:
+            return inputs, {}
+
+        start = time.perf_counter()
+        try:
+            components = {
+                name: _load_component(artifact.component_path(name), meta, dtype)
+                for name, meta in artifact.components.items()
+            }
+        except Exception as e:
+            print(f"경고: 아티팩트 캐시에서 '{model_name}'을(를) 불러오지 못했습니다. 다시 변환합니다: {e}")
+            self.artifact_cache.invalidate(inputs)
+            return inputs, {}
+        elapsed = time.perf_counter() - start
+        self.artifact_cache.record_load(elapsed)
+        print(f"아티팩트 캐시에서 SDNQ 최적화된 구성 요소를 불러왔습니다: {', '.join(components)} ({elapsed:.1f}초)")
+        return inputs, components
+
+    def _apply_prompt_cache(self, gen_args, loras):
+        """지원되는 파이프라인이면 프롬프트 텍스트를 캐시된 임베딩(prompt_embeds 등)으로 바꿉니다."""
+        if self.prompt_cache is None:
+            return
+        # 텍스트 인코더에 적용되는 LoRA가 있을 수 있으므로 활성 LoRA 조합도 키에 포함합니다.
+        encoder_key = (type(self.pipeline).__name__, tuple(loras))
+        try:
+            with metrics.stage("text_encoding"):
+                embeds = self.prompt_cache.encode_batch(
+                    self.pipeline,
+                    self.current_model_name,
+                    encoder_key,
+                    gen_args["prompt"],
+                    gen_args.get("negative_prompt"),
+                )
+        except Exception as e:
+            print(f"경고: 프롬프트 임베딩 캐시를 사용하지 못했습니다. 텍스트 프롬프트로 계속 진행합니다. 오류: {e}")
             return
+        if embeds is None:
+            return
+        gen_args.pop("prompt")
+        gen_args.pop("negative_prompt", None)
+        gen_args.update(embeds)
+
+    def _supports_step_callback(self):
+        """파이프라인이 callback_on_step_end 인수를 받는지 확인합니다. (파이프라인 클래스별로 한 번만 검사)"""
+        pipeline_class = type(self.pipeline)
+        supported = self._step_callback_support.get(pipeline_class)
+        if supported is None:
+            try:
+                supported = "callback_on_step_end" in inspect.signature(self.pipeline.__call__).parameters
+            except (TypeError, ValueError):
+                supported = False
+            self._step_callback_support[pipeline_class] = supported
+        return supported
+
+    def _release_memory(self):
+        """해제된 파이프라인의 메모리를 회수합니다."""
+        gc.collect()
+        devices.empty_cache()
+
+    def _make_generator(self, seed):
+        """시드로 초기화된 난수 생성기를 만듭니다."""
+        # 파이프라인이 자체 생성기를 제공하는 경우(예: FakePipeline) 이를 사용
+        if hasattr(self.pipeline, "make_generator"):
+            return self.pipeline.make_generator(seed)
+        _lazy_import()
+        return torch.Generator(devices.generator_device(self.device or "cpu")).manual_seed(int(seed))
 
+    def load_lora(self, lora_path):
+        """LoRA 파일을 로드합니다. 모델이 지원하는 경우에만 적용됩니다. 진행 중인 생성 세션이 있으면 기다립니다."""
+        with self._state_lock.exclusive():
+            self._load_lora(lora_path)
+
+    def _load_lora(self, lora_path):
         if not self.pipeline:
             raise ValueError("LoRA를 로드하기 전에 기본 모델을 먼저 로드해야 합니다.")
 
-        # 이전에 로드된 LoRA가 있으면 먼저 제거
-        if self.current_lora is not None:
-            try:
-                self.pipeline.delete_adapter(["default_lora"])
-                print(f"기존 LoRA 어댑터 '{self.current_lora}' 제거됨.")
-            except Exception: pass
-        self.current_lora = None
-        
-        # LoRA 경로가 없으면 여기서 종료 (LoRA 비활성화)
-        if lora_path is None: 
+        # LoRA 경로가 없으면 기본 LoRA 비활성화 (로드된 어댑터는 캐시에 남겨 둠)
+        if lora_path is None:
+            self.current_lora = None
             print("LoRA 비활성화됨.")
             return
 
-        print(f"LoRA 로딩 시도 중: {lora_path}")
-        try:
-            # 이제 모든 모델에 대해 LoRA 로드를 시도합니다.
-            self.pipeline.load_lora_weights(lora_path, adapter_name="default_lora")
-            self.current_lora = lora_path
-            print("LoRA 로딩 성공.")
-        except Exception as e:
-            # 실패할 경우, 경고를 출력하고 계속 진행합니다.
-            print(f"경고: 현재 모델 '{self.current_model_name}'은(는) LoRA '{lora_path}'를 지원하지 않을 수 있습니다. 오류: {e}")
-            self.current_lora = None
-            # 에러를 다시 발생시키지 않고, LoRA 없이 계속 진행하도록 합니다.
+        # 이미 로드된 어댑터는 다시 읽지 않고, 실패하면 경고 후 LoRA 없이 계속 진행합니다.
+        self.adapters.ensure([lora_path])
+        self.current_lora = lora_path if lora_path in self.adapters else None
 
     def generate(self, **kwargs):
         """로드된 모델 타입에 맞춰 적절한 인수로 이미지를 생성합니다."""
-        _lazy_import()
+        return self.generate_batch([kwargs], progress_callback=kwargs.get('progress_callback'))[0]
+
+    def generate_batch(self, requests, progress_callback=None, loras=None):
+        """
+        호환되는 여러 요청(같은 모델, LoRA, 크기, 스텝, 가이던스)을 한 번의 파이프라인 호출로 생성합니다.
+        프롬프트와 난수 생성기는 샘플별로 전달되므로 각 요청의 시드가 그대로 유지됩니다.
+        반환값은 requests와 같은 순서의 이미지 리스트입니다.
+
+        loras: 활성화할 (LoRA 경로, 강도) 목록. 여러 개를 지정하면 함께 적용됩니다.
+               None이면 load_lora()로 지정한 기본 LoRA를 요청의 lora_scale로 적용합니다.
+        """
         if not self.pipeline:
             raise ValueError("로드된 모델이 없습니다. 먼저 모델을 선택해 주세요.")
 
-        # 공통 파라미터 추출
-        prompt = kwargs.get('prompt', "")
-        width = kwargs.get('width', 1024)
-        height = kwargs.get('height', 1024)
-        seed = kwargs.get('seed', -1)
-        steps = kwargs.get('steps', 8)
-        
-        generator = torch.Generator("cuda").manual_seed(int(seed)) if seed not in [None, -1] else None
-        
+        # 공통 파라미터 추출 (배치 내 모든 요청이 같은 값을 가짐)
+        first = requests[0]
+        if first.get('highres_base'):
+            return self._generate_highres(requests, progress_callback, loras)
+        width = first.get('width', 1024)
+        height = first.get('height', 1024)
+        steps = first.get('steps', 8)
+
+        # 샘플별 시드: -1(무작위)인 경우 여기서 시드를 정해 배치 내 다른 샘플과 독립적으로 만듦
+        seeds = [
+            int(r['seed']) if r.get('seed') not in [None, -1] else random.randint(0, 2**32 - 1)
+            for r in requests
+        ]
+        generators = [self._make_generator(seed) for seed in seeds]
+
         gen_args = {
-            "prompt": prompt,
+            "prompt": [r.get('prompt', "") for r in requests],
             "width": width,
             "height": height,
             "num_inference_steps": steps,
-            "generator": generator
+            "generator": generators
         }
-        
-        print(f"'{self.model_type}' 타입 모델을 사용하여 이미지 생성 중...")
 
-        # 1. LoRA 어댑터 처리: 모델 타입과 관계없이 로드된 LoRA가 있다면 활성화를 시도
-        lora_scale = kwargs.get('lora_scale', 0.8)
-        if self.current_lora:
-            try:
-                self.pipeline.set_adapters(["default_lora"], adapter_weights=[lora_scale])
-                print(f"LoRA '{self.current_lora}' 활성화 (강도: {lora_scale}).")
-            except Exception as e:
-                print(f"경고: LoRA 어댑터 가중치를 설정하지 못했습니다. LoRA가 적용되지 않을 수 있습니다. 오류: {e}")
-        elif self.model_type == 'sd':
-            # SD 계열 파이프라인은 LoRA가 없을 때 비활성화 호출이 필요할 수 있음
-            try:
-                self.pipeline.disable_lora()
-            except Exception: pass
+        # 스텝 종료 콜백: 스텝마다 디노이징 시간을 기록하고 진행률 콜백에 (현재 스텝, 전체 스텝)을 전달
+        # 첫 스텝 시간에는 파이프라인 내부의 준비 작업(캐시되지 않은 텍스트 인코딩 등)이 포함됩니다.
+        step_clock = {"last": None}
+        if self._supports_step_callback():
+            def _on_step_end(pipe, step_index, timestep, callback_kwargs):
+                now = time.perf_counter()
+                metrics.record_stage("denoise", now - step_clock["last"])
+                step_clock["last"] = now
+                if progress_callback is not None:
+                    progress_callback(step_index + 1, steps)
+                return callback_kwargs
+            gen_args["callback_on_step_end"] = _on_step_end
+
+        print(f"'{self.model_type}' 타입 모델을 사용하여 이미지 {len(requests)}장 생성 중...")
 
-        # 2. 모델 아키텍처별 인수 처리
+        # 1. 모델 아키텍처별 인수 처리
         if self.model_type == 'flux':
             # FLUX는 일반적으로 negative_prompt와 guidance_scale을 무시함
             pass 
         else:
             # SD, Qwen 등 다른 모델들은 이 파라미터들을 사용
-            gen_args["negative_prompt"] = kwargs.get('negative_prompt', "")
-            gen_args["guidance_scale"] = kwargs.get('guidance_scale', 0.0)
+            gen_args["negative_prompt"] = [r.get('negative_prompt', "") for r in requests]
+            gen_args["guidance_scale"] = first.get('guidance_scale', 0.0)
 
-        image = self.pipeline(**gen_args).images[0]
-        
-        return image
+        # 어댑터 가중치 설정과 파이프라인 호출은 다른 스레드의 호출과 섞이지 않도록 함께 잠급니다.
+        with self._call_lock:
+            # 2. LoRA 어댑터 처리: 요청한 어댑터만 set_adapters로 활성화 (로드된 LoRA가 없으면 비활성화)
+            if loras is None:
+                loras = [(self.current_lora, first.get('lora_scale', 0.8))] if self.current_lora else []
+            with metrics.stage("lora_activation"):
+                self.adapters.activate(loras)
+
+            # 3. 캐시된 프롬프트 임베딩 사용: 반복되는 프롬프트는 텍스트 인코더를 다시 실행하지 않음
+            self._apply_prompt_cache(gen_args, loras)
+
+            # 4. 해상도와 배치 크기에 맞춰 VAE 타일링/슬라이싱 설정
+            device = self.device or "cpu"
+            self.vae_policy.configure(self.pipeline, device, width, height, len(requests))
+
+            # 5. 컴파일 키: 디노이저 입력 모양(크기, 배치, CFG 여부)과 그래프에 영향을 주는 LoRA 상태(활성화/병합된 조합)
+            compile_key = (width, height, len(requests), gen_args.get("guidance_scale", 0.0) > 1.0,
+                           self.adapters.state_key())
+            entry = self.pipeline_cache.peek(self.current_model_name)
+
+            # 속도 모드(블록 캐시)는 디노이저 블록에 훅을 설치하므로 컴파일된 그래프 대신 eager 디노이저로 실행합니다.
+            if first.get('cache_interval') or first.get('cache_threshold'):
+                acceleration = self.feature_cache.activate(self.pipeline, first.get('cache_interval'),
+                                                           first.get('cache_threshold'), model_type=self.model_type)
+            else:
+                acceleration = self.compile_policy.activate(self.pipeline, self.current_model_name, self.model_type,
+                                                            compile_key,
+                                                            placement=entry.placement if entry is not None else None,
+                                                            guard=self._compile_guard)
+
+            step_clock["last"] = time.perf_counter()
+            with acceleration:
+                images = self._call_pipeline(gen_args, seeds, width, height, len(requests), step_clock)
+            # 마지막 스텝 이후의 시간은 VAE 디코딩과 후처리 시간입니다.
+            if "callback_on_step_end" in gen_args:
+                metrics.record_stage("vae_decode", time.perf_counter() - step_clock["last"])
+
+        return images
+
+    @contextmanager
+    def _compile_guard(self, pipeline, key):
+        """
+        백그라운드 컴파일을 파이프라인 호출과 같은 잠금 아래에서 실행합니다. (CompilePolicy가 컴파일 스레드에서 사용)
+        모델/LoRA 전환과 파이프라인 호출이 끝나기를 기다린 뒤 엔트리를 고정해 컴파일하는 동안 장치 이동을 막고,
+        파이프라인이 여전히 GPU의 현재 모델이고 LoRA 상태가 키를 만들 때와 같은지를 반환합니다.
+        False이면 컴파일하지 않고 다음 요청에서 다시 캡처합니다.
+        """
+        with self._state_lock.shared(), self._call_lock:
+            model_name = self.current_model_name
+            entry = self.pipeline_cache.peek(model_name)
+            pinned = model_name in self.pipeline_cache.pinned
+            if entry is not None and not pinned:
+                self.pipeline_cache.pin(model_name)
+            try:
+                yield (self.pipeline is pipeline and self.adapters is not None
+                       and (entry is None or entry.location == "gpu")
+                       and key[-1] == self.adapters.state_key())
+            finally:
+                if entry is not None and not pinned:
+                    self.pipeline_cache.unpin(model_name)
+
+    def _img2img_pipeline(self):
+        """
+        타일을 다시 그릴 img2img 파이프라인을 반환합니다. 파이프라인이 image/strength 인수를 직접 받으면 그대로 쓰고,
+        아니면 AutoPipelineForImage2Image.from_pipe로 같은 구성 요소(가중치, LoRA 어댑터, 오프로드 훅)를 공유하는
+        파이프라인을 만듭니다. 이 모델 타입의 img2img 파이프라인이 없으면 None.
+        """
+        pipeline_class = type(self.pipeline)
+        supported = self._img2img_support.get(pipeline_class)
+        if supported is None:
+            try:
+                parameters = inspect.signature(self.pipeline.__call__).parameters
+                supported = "image" in parameters and "strength" in parameters
+            except (TypeError, ValueError):
+                supported = False
+            self._img2img_support[pipeline_class] = supported
+        if supported:
+            return self.pipeline
+        if self.pipeline not in self._img2img:
+            try:
+                _lazy_import()
+                from diffusers import AutoPipelineForImage2Image
+                self._img2img[self.pipeline] = AutoPipelineForImage2Image.from_pipe(self.pipeline)
+            except Exception as e:
+                print(f"경고: '{self.current_model_name}' 모델의 img2img 파이프라인을 만들 수 없어 고해상도 모드 대신 "
+                      f"요청 크기로 한 번에 생성합니다. ({e})")
+                self._img2img[self.pipeline] = None
+        return self._img2img[self.pipeline]
+
+    def _generate_highres(self, requests, progress_callback, loras):
+        """
+        2단계 고해상도 생성 (highres.HighResPolicy 참고). 기본 크기(highres_base)로 배치를 한 번에 생성한 뒤,
+        이미지마다 요청 크기로 확대하고 겹치는 highres_tile 타일을 img2img로 highres_strength만큼 다시 디노이징합니다.
+        진행률은 기본 크기 생성의 스텝과 타일 하나당 1을 더한 값으로 전달합니다.
+        """
+        first = requests[0]
+        target = (first['width'], first['height'])
+        tile, overlap, strength = first['highres_tile'], first['highres_overlap'], first['highres_strength']
+        steps = first.get('steps', 8)
+        direct = [dict(r, highres_base=None) for r in requests]
+        if self._img2img_pipeline() is None:
+            return self.generate_batch(direct, progress_callback=progress_callback, loras=loras)
+
+        # 타일마다 시드를 이어 쓰므로 무작위 시드도 여기서 정합니다.
+        seeds = [
+            int(r['seed']) if r.get('seed') not in [None, -1] else random.randint(0, 2**32 - 1)
+            for r in requests
+        ]
+        if loras is None:
+            loras = [(self.current_lora, first.get('lora_scale', 0.8))] if self.current_lora else []
+        tiles = len(tile_boxes(*target, tile, overlap))
+        total = steps + tiles * len(requests)
+
+        base_requests = [dict(r, seed=seed, width=first['highres_base'][0], height=first['highres_base'][1])
+                         for r, seed in zip(direct, seeds)]
+        base_progress = None if progress_callback is None else (lambda step, _: progress_callback(step, total))
+        base_images = self.generate_batch(base_requests, progress_callback=base_progress, loras=loras)
+
+        images = []
+        for number, (request, seed, base_image) in enumerate(zip(requests, seeds, base_images)):
+            with metrics.stage("highres_upscale"):
+                upscaled = upscale(base_image, target)
+
+            gen_args = {
+                "prompt": [request.get('prompt', "")],
+                "num_inference_steps": steps,
+                "strength": strength,
+            }
+            if self.model_type != 'flux':
+                gen_args["negative_prompt"] = [request.get('negative_prompt', "")]
+                gen_args["guidance_scale"] = first.get('guidance_scale', 0.0)
+
+            def refine(image, index, gen_args=gen_args, seed=seed):
+                # 타일마다 시드를 바꿔 같은 잡음 패턴이 반복되지 않게 합니다.
+                args = dict(gen_args, image=image,
+                            generator=[self._make_generator((seed + index + 1) % 2**32)])
+                with self._call_lock:
+                    self.adapters.activate(loras)
+                    self._apply_prompt_cache(args, loras)
+                    # img2img 파이프라인은 VAE를 공유하므로 타일 크기에 맞춘 설정이 그대로 적용됩니다.
+                    self.vae_policy.configure(self.pipeline, self.device or "cpu", image.width, image.height, 1)
+                    return self._img2img_pipeline()(**args).images[0]
+
+            def progress(done, _, number=number):
+                if progress_callback is not None:
+                    progress_callback(steps + number * tiles + done, total)
+
+            print(f"고해상도 모드: {target[0]}x{target[1]} 이미지를 타일 {tiles}개로 다시 디노이징 중... "
+                  f"(강도 {strength}, 타일당 {refine_steps(steps, strength)}스텝)")
+            with metrics.stage("highres_refine"):
+                images.append(refine_tiles(upscaled, refine, tile, overlap, progress=progress))
+        return images
+
+    def _call_pipeline(self, gen_args, seeds, width, height, batch_size, step_clock):
+        """파이프라인을 호출합니다. 장치 메모리가 부족하면 메모리를 회수하고 VAE 타일링/슬라이싱을 켠 뒤 한 번 더 시도합니다."""
+        device = self.device or "cpu"
+        try:
+            return self.pipeline(**gen_args).images
+        except Exception as e:
+            if not devices.is_out_of_memory(e):
+                raise
+            print(f"경고: 장치 메모리가 부족합니다. VAE 타일링/슬라이싱을 켜고 다시 시도합니다. ({e})")
+            self._release_memory()
+            self.vae_policy.configure(self.pipeline, device, width, height, batch_size, force=True)
+            gen_args["generator"] = [self._make_generator(seed) for seed in seeds]
+            step_clock["last"] = time.perf_counter()
+            return self.pipeline(**gen_args).images
+
+
+def create_handler(settings, backend=None, model_type_resolver=None):
+    """
+    설정(config.py의 config와 같은 키를 가진 딕셔너리)으로 모델 상주 캐시, 프롬프트 임베딩 캐시와
+    ModelHandler를 만듭니다. backend를 지정하면 설정의 backend 대신 사용합니다.
+    model_type_resolver는 ModelHandler에 그대로 전달됩니다. (예: ModelRegistry.model_type)
+    backend가 "fake"이면 GPU와 모델 가중치 없이 CPU에서 동작하는 FakePipeline을 사용합니다. (테스트/벤치마크용)
+    """
+    from pipeline_cache import GB
+    from prompt_cache import MB
+
+    def gb_to_bytes(value):
+        # GB 단위 설정값을 바이트로 변환합니다. None은 '제한 없음'을 의미합니다.
+        return None if value is None else int(value * GB)
+
+    pipeline_loader = None
+    if (backend or settings["backend"]) == "fake":
+        from fake_pipeline import load_fake_pipeline
+        pipeline_loader = functools.partial(
+            load_fake_pipeline,
+            step_latency=settings["fake_step_latency"],
+            decode_latency=settings["fake_decode_latency"],
+            pixel_cost=settings["fake_pixel_cost"],
+            load_latency=settings["fake_load_latency"],
+            memory_gb=settings["fake_memory_gb"],
+            lora_load_latency=settings["fake_lora_load_latency"],
+            transfer_latency=settings["fake_transfer_latency"],
+        )
+
+    # 모델 상주 캐시: 예산 안에서 여러 모델을 GPU/CPU에 유지하여 모델 전환 시 디스크 재로딩을 피합니다.
+    pipeline_cache = PipelineCache(
+        gpu_budget_bytes=gb_to_bytes(settings["gpu_memory_budget_gb"]),
+        cpu_budget_bytes=gb_to_bytes(settings["cpu_memory_budget_gb"]),
+        policy=settings["model_cache_policy"],
+        pinned=settings["pinned_models"],
+    )
+
+    # 프롬프트 임베딩 캐시: 반복되는 프롬프트/네거티브 프롬프트의 텍스트 인코딩을 재사용합니다.
+    prompt_cache = None
+    if settings["prompt_cache_mb"]:
+        prompt_cache = PromptEmbeddingCache(
+            max_bytes=int(settings["prompt_cache_mb"] * MB),
+            storage_device=settings["prompt_cache_device"],
+        )
+
+    # 아티팩트 캐시: SDNQ 최적화 결과와 torch.compile 결과를 디스크에 보관해 재시작 후 변환을 건너뜁니다.
+    artifact_cache = None
+    if settings["artifact_cache_gb"] != 0 and pipeline_loader is None:
+        artifact_cache = ArtifactCache(
+            settings["artifact_cache_dir"] or os.path.join(os.path.expanduser("~"), "AI-cache", "artifacts"),
+            max_bytes=gb_to_bytes(settings["artifact_cache_gb"]),
+        )
+        artifact_cache.configure_compile_cache()
+
+    # torch.compile 재컴파일 한도는 프로세스 전체 설정이므로 핸들러를 만들 때 한 번만 맞춥니다.
+    if settings["compile_models"] and pipeline_loader is None:
+        configure_dynamo(settings["compile_max_graphs"])
+
+    return ModelHandler(
+        pipeline_loader=pipeline_loader,
+        pipeline_cache=pipeline_cache,
+        max_loras=settings["max_loras_per_model"],
+        lora_fuse_threshold=settings["lora_fuse_threshold"],
+        lora_fuse_window=settings["lora_fuse_window"],
+        prompt_cache=prompt_cache,
+        device=settings["device"],
+        dtype=settings["dtype"],
+        offload=settings["offload"],
+        model_placements=settings["model_placements"],
+        vae_policy=devices.VaeMemoryPolicy(
+            tiling=settings["vae_tiling"],
+            slicing=settings["vae_slicing"],
+            tiling_min_pixels=settings["vae_tiling_min_pixels"],
+        ),
+        artifact_cache=artifact_cache,
+        model_type_resolver=model_type_resolver,
+        compile_policy=CompilePolicy(
+            models=settings["compile_models"],
+            mode=settings["compile_mode"],
+            backend=settings["compile_backend"],
+            max_graphs=settings["compile_max_graphs"],
+        ),
+    )
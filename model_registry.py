@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import re
+import struct
+import threading
+import time
+
+from model_handler import get_model_type
+
+# 가중치 파일로 보고 크기를 합산할 확장자
+WEIGHT_EXTENSIONS = (".safetensors", ".bin", ".pt", ".ckpt", ".gguf")
+# safetensors 헤더 최대 크기 (이보다 크면 손상된 파일로 봄)
+MAX_HEADER_BYTES = 100 * 1024 * 1024
+
+
+class IncompatibleLoraError(ValueError):
+    """요청한 LoRA가 모델과 다른 아키텍처용일 때 발생하는 예외입니다."""
+
+
+def architecture_of_pipeline(class_name, components=()):
+    """
+    model_index.json의 파이프라인 클래스 이름으로 아키텍처('sd', 'sdxl', 'flux', 'qwen')를 반환합니다.
+    알 수 없는 파이프라인이면 None.
+    """
+    class_name = class_name or ""
+    if "Flux" in class_name:
+        return "flux"
+    if "QwenImage" in class_name:
+        return "qwen"
+    if "StableDiffusionXL" in class_name or ("StableDiffusion" in class_name and "text_encoder_2" in components):
+        return "sdxl"
+    if "StableDiffusion" in class_name:
+        return "sd"
+    return None
+
+
+def read_safetensors_header(path):
+    """safetensors 파일의 헤더(텐서 이름 -> dtype/shape, __metadata__)만 읽습니다. 텐서 데이터는 읽지 않습니다."""
+    with open(path, "rb") as f:
+        length_bytes = f.read(8)
+        if len(length_bytes) != 8:
+            raise ValueError("safetensors 헤더가 없습니다.")
+        (length,) = struct.unpack("<Q", length_bytes)
+        if length > MAX_HEADER_BYTES:
+            raise ValueError(f"safetensors 헤더가 너무 큽니다. ({length} 바이트)")
+        return json.loads(f.read(length))
+
+
+def _lora_down_keys(tensors):
+    """LoRA의 down(A) 행렬 텐서 이름과 정보. PEFT/diffusers(lora_A)와 kohya(lora_down) 형식을 모두 지원합니다."""
+    return [(name, info) for name, info in tensors.items()
+            if name.endswith((".lora_A.weight", ".lora_down.weight"))]
+
+
+def _target_module(name):
+    """LoRA 텐서 이름에서 대상 모듈 이름(to_q, proj_out 등)을 추출합니다."""
+    module = re.sub(r"\.(lora_A|lora_down)\.weight$", "", name)
+    if "." in module:
+        return module.rsplit(".", 1)[-1]
+    # kohya 형식은 경로를 '_'로 이어 붙이므로 마지막 블록 번호 뒤의 부분을 사용합니다. (..._0_attn1_to_q -> attn1_to_q)
+    match = re.search(r"^.*_\d+_([a-z][a-z0-9_]*)$", module)
+    return match.group(1) if match else module
+
+
+def lora_architecture(tensors, metadata):
+    """LoRA가 학습된 기반 모델 아키텍처('sd', 'sdxl', 'flux', 'qwen')를 메타데이터와 텐서 이름/모양으로 추정합니다. 모르면 None."""
+    spec = (metadata.get("modelspec.architecture") or metadata.get("ss_base_model_version") or "").lower()
+    for keyword, architecture in (("flux", "flux"), ("qwen", "qwen"), ("xl", "sdxl"),
+                                  ("sd_v1", "sd"), ("sd_v2", "sd"), ("stable-diffusion-v1", "sd"),
+                                  ("stable-diffusion-v2", "sd")):
+        if keyword in spec:
+            return architecture
+
+    names = list(tensors)
+    if any("double_blocks" in n or "single_blocks" in n or "single_transformer_blocks" in n for n in names):
+        return "flux"
+    if any("img_mlp" in n or "txt_mlp" in n for n in names):
+        return "qwen"
+    if any("lora_te2_" in n or "text_encoder_2" in n or "add_embedding" in n for n in names):
+        return "sdxl"
+    # UNet 교차 어텐션의 key 입력 차원(텍스트 임베딩 차원)으로 SD 1.x/2.x(768/1024)와 SDXL(2048)을 구분합니다.
+    for name, info in _lora_down_keys(tensors):
+        if "attn2" in name and "to_k" in name and len(info.get("shape", ())) >= 2:
+            return "sdxl" if info["shape"][1] >= 2048 else "sd"
+    if any("down_blocks" in n or "input_blocks" in n for n in names):
+        return "sd"
+    return None
+
+
+def index_lora(path):
+    """LoRA 파일 하나의 색인 정보(랭크, 대상 모듈, 기반 아키텍처, 크기)를 헤더만 읽어 만듭니다."""
+    header = read_safetensors_header(path)
+    metadata = header.pop("__metadata__", None) or {}
+    down_keys = _lora_down_keys(header)
+    ranks = sorted({info["shape"][0] for _, info in down_keys if info.get("shape")})
+    return {
+        "name": os.path.basename(path),
+        "size_bytes": os.path.getsize(path),
+        "architecture": lora_architecture(header, metadata),
+        "rank": ranks[-1] if ranks else None,
+        "ranks": ranks,
+        "target_modules": sorted({_target_module(name) for name, _ in down_keys}),
+        "tensors": len(header),
+    }
+
+
+def _snapshot_dir(model_dir):
+    """Hugging Face 캐시 디렉토리에서 refs/main이 가리키는 스냅샷 디렉토리와 리비전을 반환합니다."""
+    try:
+        with open(os.path.join(model_dir, "refs", "main"), "r", encoding="utf-8") as f:
+            revision = f.read().strip()
+    except OSError:
+        # refs가 없으면 스냅샷이 하나뿐인 경우에만 사용합니다.
+        snapshots = os.path.join(model_dir, "snapshots")
+        names = os.listdir(snapshots) if os.path.isdir(snapshots) else []
+        if len(names) != 1:
+            return None, None
+        revision = names[0]
+    return os.path.join(model_dir, "snapshots", revision), revision
+
+
+def _weight_bytes(directory):
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.endswith(WEIGHT_EXTENSIONS):
+                try:
+                    total += os.path.getsize(os.path.join(root, name)) # 심볼릭 링크는 blob 크기
+                except OSError:
+                    pass
+    return total
+
+
+def index_model(model_name, model_dir):
+    """모델 하나의 색인 정보(파이프라인 클래스, 구성 요소별 크기/양자화, 아키텍처)를 model_index.json과 구성 요소 설정으로 만듭니다."""
+    snapshot, revision = _snapshot_dir(model_dir)
+    info = {
+        "model_name": model_name,
+        "revision": revision,
+        "pipeline_class": None,
+        "architecture": None,
+        "model_type": get_model_type(model_name),
+        "components": {},
+        "size_bytes": 0,
+        "quantization": None,
+        "complete": False,
+    }
+    if snapshot is None:
+        return info
+    try:
+        with open(os.path.join(snapshot, "model_index.json"), "r", encoding="utf-8") as f:
+            model_index = json.load(f)
+    except (OSError, ValueError):
+        return info # 다운로드 중이거나 diffusers 형식이 아닌 모델
+
+    quantization = {}
+    for name, value in model_index.items():
+        if name.startswith("_") or not isinstance(value, list) or len(value) != 2 or value[1] is None:
+            continue
+        component = {"library": value[0], "class": value[1], "size_bytes": _weight_bytes(os.path.join(snapshot, name))}
+        try:
+            with open(os.path.join(snapshot, name, "config.json"), "r", encoding="utf-8") as f:
+                quant_config = json.load(f).get("quantization_config")
+        except (OSError, ValueError):
+            quant_config = None
+        if quant_config:
+            component["quantization"] = quant_config.get("quant_method") or "unknown"
+            quantization[name] = component["quantization"]
+        info["components"][name] = component
+
+    info["pipeline_class"] = model_index.get("_class_name")
+    info["architecture"] = architecture_of_pipeline(info["pipeline_class"], info["components"])
+    if info["architecture"] in ("flux", "qwen"):
+        info["model_type"] = info["architecture"]
+    elif info["architecture"] in ("sd", "sdxl"):
+        info["model_type"] = "sd"
+    info["size_bytes"] = sum(c["size_bytes"] for c in info["components"].values())
+    info["quantization"] = quantization or None
+    info["complete"] = True
+    return info
+
+
+class ModelRegistry:
+    """
+    모델 디렉토리(Hugging Face 캐시)와 LoRA 디렉토리의 색인을 메모리에 유지합니다.
+
+    요청마다 디렉토리를 스캔하지 않고, poll_interval초마다 파일의 수정 시각을 비교해 바뀐 모델/LoRA만 다시 색인합니다.
+    모델은 model_index.json과 구성 요소의 config.json을, LoRA는 safetensors 헤더만 읽으므로 텐서는 로드하지 않습니다.
+    목록이 바뀔 때마다 버전이 바뀌어 목록 응답의 ETag로 사용됩니다.
+    """
+
+    def __init__(self, models_dir, lora_dir, poll_interval=5.0):
+        self.models_dir = models_dir
+        self.lora_dir = lora_dir
+        self.poll_interval = poll_interval
+        self._models = {} # 모델 이름 -> (지문, 색인 정보)
+        self._loras = {} # 파일 이름 -> (지문, 색인 정보)
+        self._etags = {"models": None, "loras": None}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._stats = {"refreshes": 0, "model_indexes": 0, "lora_indexes": 0, "errors": 0, "refresh_seconds_total": 0.0}
+        for directory in (models_dir, lora_dir):
+            os.makedirs(directory, exist_ok=True)
+        self.refresh()
+
+    def start(self):
+        if self.poll_interval and self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="model-registry", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"경고: 모델/LoRA 목록을 갱신하지 못했습니다: {e}")
+
+    def refresh(self):
+        """디렉토리를 다시 확인해 추가/변경/삭제된 모델과 LoRA의 색인을 갱신합니다. 변경이 있었으면 True."""
+        with self._refresh_lock:
+            start = time.perf_counter()
+            changed = self._refresh_models() | self._refresh_loras()
+            with self._lock:
+                self._stats["refreshes"] += 1
+                self._stats["refresh_seconds_total"] += time.perf_counter() - start
+            return changed
+
+    def _model_fingerprint(self, model_dir):
+        # 리비전(refs/main)과 스냅샷 디렉토리들의 수정 시각: 다운로드가 진행되면 파일 링크가 추가되어 바뀝니다.
+        snapshot, revision = _snapshot_dir(model_dir)
+        if snapshot is None or not os.path.isdir(snapshot):
+            return (revision,)
+        mtimes = [os.stat(snapshot).st_mtime_ns]
+        for entry in os.scandir(snapshot):
+            if entry.is_dir():
+                mtimes.append(entry.stat().st_mtime_ns)
+        return (revision, tuple(mtimes))
+
+    def _refresh_models(self):
+        found = {}
+        for directory in os.listdir(self.models_dir):
+            if directory.startswith("models--"):
+                # Hugging Face 저장소 ID로 다시 변환합니다.
+                found[directory.replace("models--", "").replace("--", "/")] = os.path.join(self.models_dir, directory)
+        return self._update(self._models, found, self._model_fingerprint, index_model, "models")
+
+    def _refresh_loras(self):
+        found = {name: os.path.join(self.lora_dir, name) for name in os.listdir(self.lora_dir)
+                 if name.endswith(".safetensors")}
+
+        def fingerprint(path):
+            st = os.stat(path)
+            return (st.st_size, st.st_mtime_ns)
+
+        return self._update(self._loras, found, fingerprint, lambda name, path: index_lora(path), "loras")
+
+    def _update(self, entries, found, fingerprint_fn, index_fn, kind):
+        """found(이름 -> 경로)와 현재 색인을 비교해 바뀐 항목만 다시 색인합니다."""
+        updated = {}
+        for name, path in found.items():
+            try:
+                fingerprint = fingerprint_fn(path)
+            except OSError:
+                continue # 스캔 도중 삭제됨
+            current = entries.get(name)
+            if current is not None and current[0] == fingerprint:
+                updated[name] = current
+                continue
+            try:
+                info = index_fn(name, path)
+            except Exception as e:
+                print(f"경고: '{name}'의 정보를 읽지 못했습니다: {e}")
+                info = {"model_name" if kind == "models" else "name": name, "error": str(e)}
+                with self._lock:
+                    self._stats["errors"] += 1
+            updated[name] = (fingerprint, info)
+            with self._lock:
+                self._stats["model_indexes" if kind == "models" else "lora_indexes"] += 1
+
+        changed = set(updated) != set(entries) or any(updated[n] is not entries.get(n) for n in updated)
+        if changed or self._etags[kind] is None:
+            canonical = json.dumps([info for _, (_, info) in sorted(updated.items())], sort_keys=True, default=str)
+            with self._lock:
+                entries.clear()
+                entries.update(updated)
+                self._etags[kind] = '"' + hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:32] + '"'
+        return changed
+
+    def etag(self, kind):
+        """"models" 또는 "loras" 목록의 ETag. 목록이나 색인 정보가 바뀌면 달라집니다."""
+        with self._lock:
+            return self._etags[kind]
+
+    def model_names(self):
+        with self._lock:
+            return sorted(self._models)
+
+    def lora_names(self):
+        with self._lock:
+            return sorted(self._loras)
+
+    def models(self):
+        with self._lock:
+            return [info for _, (_, info) in sorted(self._models.items())]
+
+    def loras(self):
+        with self._lock:
+            return [info for _, (_, info) in sorted(self._loras.items())]
+
+    def model(self, model_name):
+        with self._lock:
+            entry = self._models.get(model_name)
+        return entry[1] if entry else None
+
+    def lora(self, name):
+        with self._lock:
+            entry = self._loras.get(name)
+        return entry[1] if entry else None
+
+    def model_type(self, model_name):
+        """파이프라인 로딩에 쓸 모델 타입('sd', 'flux', 'qwen'). 색인된 모델은 model_index.json을, 아니면 이름을 기준으로 합니다."""
+        info = self.model(model_name)
+        return info["model_type"] if info and info.get("complete") else get_model_type(model_name)
+
+    def check_compatibility(self, model_name, lora_names):
+        """
+        LoRA가 모델과 다른 아키텍처용이면 IncompatibleLoraError를 발생시킵니다.
+        모델이나 LoRA의 아키텍처를 알 수 없으면(아직 다운로드하지 않은 모델 등) 통과시킵니다.
+        """
+        model_info = self.model(model_name)
+        model_architecture = model_info.get("architecture") if model_info else None
+        if model_architecture is None:
+            return
+        for name in lora_names:
+            lora_info = self.lora(name)
+            lora_arch = lora_info.get("architecture") if lora_info else None
+            if lora_arch is not None and lora_arch != model_architecture:
+                raise IncompatibleLoraError(
+                    f"LoRA '{name}'은(는) {lora_arch} 모델용이라 {model_architecture} 모델 '{model_name}'에 적용할 수 없습니다."
+                )
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["models"] = len(self._models)
+            stats["loras"] = len(self._loras)
+        return stats
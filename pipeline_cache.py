@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from devices import component_bytes
+
+GB = 1024 ** 3
+
+
+def estimate_pipeline_bytes(pipeline):
+    """파이프라인 구성 요소의 파라미터와 버퍼 크기를 합산하여 메모리 사용량(바이트)을 추정합니다."""
+    # FakePipeline 등 크기를 직접 알려주는 파이프라인
+    if hasattr(pipeline, "memory_bytes"):
+        return int(pipeline.memory_bytes)
+
+    return sum(component_bytes(pipeline).values())
+
+
+class CacheEntry:
+    """캐시에 상주하는 파이프라인 하나의 상태입니다."""
+
+    def __init__(self, model_name, pipeline, model_type, size_bytes, load_seconds):
+        self.model_name = model_name
+        self.pipeline = pipeline
+        self.model_type = model_type
+        self.size_bytes = size_bytes
+        self.load_seconds = load_seconds
+        self.location = None # 'gpu' 또는 'cpu'
+        self.current_lora = None # 이 파이프라인의 기본 LoRA 경로 (load_lora)
+        self.adapters = None # 이 파이프라인에 로드된 LoRA 어댑터 캐시 (AdapterCache)
+        self.last_used = time.monotonic()
+        self.hits = 0
+        # 장치 배치 (devices.Placement). None이면 캐시의 기본 장치에 모델 전체를 올립니다.
+        self.placement = None
+        self.device_bytes = size_bytes # 장치 메모리 예산에 포함되는 크기 (오프로드하면 더 작음)
+
+    @property
+    def device(self):
+        return self.placement.device if self.placement is not None else None
+
+    @property
+    def offloaded(self):
+        """accelerate 훅이 장치 이동을 관리하는(CPU 오프로드된) 엔트리인지 반환합니다."""
+        return self.placement is not None and self.placement.offloaded
+
+
+class PipelineCache:
+    """
+    모델 ID별로 여러 파이프라인을 메모리 예산 안에서 상주시키는 캐시입니다.
+
+    GPU 예산을 넘으면 덜 중요한 모델을 CPU RAM으로 내리고(offload),
+    CPU 예산까지 넘으면 캐시에서 완전히 제거합니다.
+    policy가 "lru"이면 가장 오래 사용되지 않은 모델을, "cost"이면 다시 불러오는 비용
+    (로딩 시간 대비 확보되는 메모리)이 가장 작은 모델을 먼저 내보냅니다.
+
+    잠금은 두 가지입니다. _transfer_lock은 엔트리를 옮기거나 등록/제거하는 작업을 하나씩 실행되게 하고,
+    _lock은 엔트리 목록과 통계만 짧게 보호합니다. 수 초가 걸리는 장치 이동(pipeline.to)과 메모리 회수 동안에는
+    _lock을 놓으므로, 이벤트 루프에서 호출되는 is_resident()/stats()가 모델 전환을 기다리지 않습니다.
+    """
+
+    def __init__(self, gpu_budget_bytes=None, cpu_budget_bytes=0, policy="lru",
+                 device="cuda", offload_device="cpu", release_memory=None, on_evict=None, pinned=()):
+        """
+        gpu_budget_bytes: GPU에 상주시킬 수 있는 최대 바이트 (None이면 제한 없음)
+        cpu_budget_bytes: CPU RAM으로 내린 모델에 쓸 수 있는 최대 바이트 (0이면 오프로드 안 함)
+        release_memory: 파이프라인을 내보낸 후 호출할 메모리 회수 함수
+        on_evict: 모델이 캐시에서 완전히 제거될 때 모델 이름으로 호출할 함수 (모델별 부가 캐시 정리용)
+        pinned: GPU에서 내리거나 제거하지 않을 모델 이름 목록 (예산을 넘더라도 유지)
+        """
+        if policy not in ("lru", "cost"):
+            raise ValueError(f"지원하지 않는 캐시 정책입니다: {policy}")
+        self.gpu_budget_bytes = gpu_budget_bytes
+        self.cpu_budget_bytes = cpu_budget_bytes
+        self.policy = policy
+        self.device = device
+        self.offload_device = offload_device
+        self.release_memory = release_memory
+        self.on_evict = on_evict
+        self.pinned = set(pinned)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._transfer_lock = threading.RLock()
+        self._stats = {
+            "hits": 0,
+            "cpu_hits": 0,
+            "misses": 0,
+            "offloads": 0,
+            "evictions": 0,
+            "load_seconds_total": 0.0,
+        }
+
+    # --- 조회 ---
+    def __contains__(self, model_name):
+        with self._lock:
+            return model_name in self._entries
+
+    def is_resident(self, model_name):
+        """모델이 GPU에 올라가 있는지 반환합니다."""
+        with self._lock:
+            entry = self._entries.get(model_name)
+            return entry is not None and entry.location == "gpu"
+
+    def resident_models(self):
+        """GPU에 상주 중인 모델 이름 목록을 반환합니다."""
+        with self._lock:
+            return [name for name, e in self._entries.items() if e.location == "gpu"]
+
+    def peek(self, model_name):
+        """통계나 위치를 바꾸지 않고 엔트리를 반환합니다."""
+        with self._lock:
+            return self._entries.get(model_name)
+
+    def get(self, model_name):
+        """
+        캐시된 엔트리를 반환하고 GPU로 올립니다. 캐시에 없으면 None을 반환하며,
+        이 경우 호출자가 디스크에서 로드한 뒤 put()으로 등록해야 합니다.
+        """
+        with self._transfer_lock, self._lock:
+            entry = self._entries.get(model_name)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+
+            self._stats["hits"] += 1
+            if entry.location != "gpu":
+                self._stats["cpu_hits"] += 1
+                # 이동 중인 엔트리는 어느 예산에도 포함되지 않도록 하여 자기 자신이 제거되지 않게 합니다.
+                entry.location = None
+                self._make_room(entry.device_bytes, "gpu", exclude=entry)
+                self._move_to_device(entry)
+                entry.location = "gpu"
+                print(f"캐시: '{model_name}'을(를) CPU에서 GPU로 다시 올렸습니다.")
+            self._touch(entry)
+            return entry
+
+    def put(self, model_name, pipeline, model_type, load_seconds, placement=None):
+        """
+        디스크에서 새로 로드한 파이프라인을 등록하고 GPU에 배치합니다.
+        placement: (선택) 모델별 장치와 오프로드 방식 (devices.Placement). 오프로드된 파이프라인은
+                   이미 accelerate 훅이 장치 이동을 관리하므로 옮기지 않고, 장치에 계속 올라가 있는 크기만 예산에 포함합니다.
+        GPU로 옮기는 동안에는 엔트리를 공개하지 않고, 이동이 끝난 뒤 목록에 등록합니다.
+        """
+        with self._transfer_lock, self._lock:
+            size_bytes = estimate_pipeline_bytes(pipeline)
+            entry = CacheEntry(model_name, pipeline, model_type, size_bytes, load_seconds)
+            if placement is not None:
+                entry.placement = placement
+                entry.device_bytes = placement.device_bytes(size_bytes, component_bytes(pipeline))
+            self._stats["load_seconds_total"] += load_seconds
+
+            self._make_room(entry.device_bytes, "gpu", exclude=entry)
+            self._move_to_device(entry)
+            entry.location = "gpu"
+            self._entries[model_name] = entry
+            self._touch(entry)
+            print(f"캐시: '{model_name}' 등록 ({size_bytes / GB:.2f} GB, 로딩 {load_seconds:.1f}초)")
+            return entry
+
+    def pin(self, model_name):
+        """모델을 고정하여 예산을 넘더라도 GPU에서 내리거나 제거하지 않습니다."""
+        with self._lock:
+            self.pinned.add(model_name)
+
+    def unpin(self, model_name):
+        with self._lock:
+            self.pinned.discard(model_name)
+
+    def remove(self, model_name):
+        """모델을 캐시에서 완전히 제거합니다."""
+        with self._transfer_lock, self._lock:
+            entry = self._entries.pop(model_name, None)
+            if entry is not None:
+                self._discard(entry)
+
+    def clear(self):
+        with self._transfer_lock:
+            for name in list(self._entries):
+                self.remove(name)
+
+    def stats(self):
+        """히트/미스, 오프로드/제거 횟수, 로딩 시간, 상주 모델 정보를 반환합니다."""
+        with self._lock:
+            stats = dict(self._stats)
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+            stats["avg_load_seconds"] = stats["load_seconds_total"] / stats["misses"] if stats["misses"] else 0.0
+            stats["gpu_bytes"] = self._used_bytes("gpu")
+            stats["cpu_bytes"] = self._used_bytes("cpu")
+            stats["gpu_budget_bytes"] = self.gpu_budget_bytes
+            stats["cpu_budget_bytes"] = self.cpu_budget_bytes
+            stats["entries"] = [
+                {
+                    "model_name": e.model_name,
+                    "location": e.location,
+                    "size_bytes": e.size_bytes,
+                    "device_bytes": e.device_bytes,
+                    "placement": e.placement.to_dict() if e.placement is not None else None,
+                    "load_seconds": e.load_seconds,
+                    "hits": e.hits,
+                    "pinned": e.model_name in self.pinned,
+                }
+                for e in self._entries.values()
+            ]
+            return stats
+
+    # --- 내부 구현 (호출자가 self._transfer_lock과 self._lock을 보유해야 함) ---
+    @contextmanager
+    def _released(self):
+        """오래 걸리는 장치 이동/메모리 회수 동안 self._lock을 잠시 놓습니다. (다른 변경은 self._transfer_lock이 막음)"""
+        self._lock.release()
+        try:
+            yield
+        finally:
+            self._lock.acquire()
+
+    def _touch(self, entry):
+        entry.last_used = time.monotonic()
+        entry.hits += 1
+        self._entries.move_to_end(entry.model_name)
+
+    def _budget(self, location):
+        return self.gpu_budget_bytes if location == "gpu" else self.cpu_budget_bytes
+
+    def _used_bytes(self, location):
+        if location == "gpu":
+            return sum(e.device_bytes for e in self._entries.values() if e.location == location)
+        return sum(e.size_bytes for e in self._entries.values() if e.location == location)
+
+    def _pick_victim(self, location, exclude):
+        candidates = [
+            e for e in self._entries.values()
+            if e.location == location and e is not exclude and e.model_name not in self.pinned
+        ]
+        if not candidates:
+            return None
+        if self.policy == "cost":
+            # 확보되는 메모리 대비 다시 불러오는 비용이 가장 작은 모델 (동률이면 LRU)
+            return min(candidates, key=lambda e: (e.load_seconds / max(e.size_bytes, 1), e.last_used))
+        return min(candidates, key=lambda e: e.last_used)
+
+    def _make_room(self, size_bytes, location, exclude=None):
+        """location 예산 안에 size_bytes가 들어갈 때까지 다른 엔트리를 내보냅니다."""
+        budget = self._budget(location)
+        if budget is None:
+            return
+        while self._used_bytes(location) + size_bytes > budget:
+            victim = self._pick_victim(location, exclude)
+            if victim is None:
+                # 다른 모델을 모두 내보내도 부족하면 그대로 진행 (단일 모델이 예산보다 크거나 고정된 모델이 예산을 차지한 경우)
+                return
+            if location == "gpu":
+                self._offload(victim)
+            else:
+                del self._entries[victim.model_name]
+                self._discard(victim)
+
+    def _offload(self, entry):
+        """GPU의 엔트리를 CPU RAM으로 내리거나, CPU 예산이 없으면 제거합니다."""
+        if self.cpu_budget_bytes and entry.size_bytes <= self.cpu_budget_bytes:
+            self._make_room(entry.size_bytes, "cpu", exclude=entry)
+            # 옮기는 동안에는 어느 위치에도 속하지 않습니다.
+            entry.location = None
+            with self._released():
+                if entry.offloaded:
+                    # 오프로드 훅이 있는 파이프라인은 장치에 남아 있는 구성 요소만 CPU로 돌려보냅니다.
+                    free_hooks = getattr(entry.pipeline, "maybe_free_model_hooks", None)
+                    if free_hooks is not None:
+                        free_hooks()
+                else:
+                    entry.pipeline.to(self.offload_device)
+                if self.release_memory:
+                    self.release_memory()
+            entry.location = "cpu"
+            self._stats["offloads"] += 1
+            print(f"캐시: '{entry.model_name}'을(를) CPU RAM으로 내렸습니다.")
+        else:
+            del self._entries[entry.model_name]
+            self._discard(entry)
+
+    def _move_to_device(self, entry):
+        if entry.offloaded:
+            return
+        with self._released():
+            entry.pipeline.to(entry.device or self.device)
+
+    def _discard(self, entry):
+        self._stats["evictions"] += 1
+        print(f"캐시: '{entry.model_name}'을(를) 메모리에서 제거했습니다.")
+        entry.pipeline = None
+        with self._released():
+            if self.on_evict:
+                self.on_evict(entry.model_name)
+            if self.release_memory:
+                self.release_memory()
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+import inspect
+import threading
+import time
+from collections import OrderedDict
+from contextlib import nullcontext
+
+MB = 1024 ** 2
+
+# 파이프라인 클래스별 encode_prompt 사용 방법입니다.
+# kwargs: encode_prompt에 넘길 추가 인수 (시그니처에 있는 것만 전달)
+# outputs: encode_prompt 반환값의 앞에서부터 대응하는 파이프라인 호출 인수 이름
+# negative: 네거티브 프롬프트도 같은 방법으로 인코딩해 negative_<이름>으로 전달할 수 있는지 여부
+ENCODER_SPECS = {
+    "StableDiffusionPipeline": {
+        "kwargs": {"num_images_per_prompt": 1, "do_classifier_free_guidance": False},
+        "outputs": ("prompt_embeds",),
+        "negative": True,
+    },
+    "ZImagePipeline": {
+        "kwargs": {"do_classifier_free_guidance": False},
+        "outputs": ("prompt_embeds",),
+        "negative": True,
+    },
+    "FluxPipeline": {
+        "kwargs": {"prompt_2": None, "num_images_per_prompt": 1},
+        "outputs": ("prompt_embeds", "pooled_prompt_embeds"),
+        "negative": False,
+    },
+    "QwenImagePipeline": {
+        "kwargs": {"num_images_per_prompt": 1},
+        "outputs": ("prompt_embeds", "prompt_embeds_mask"),
+        "negative": True,
+    },
+    "FakePipeline": {
+        "kwargs": {},
+        "outputs": ("prompt_embeds",),
+        "negative": True,
+    },
+}
+
+
+def normalize_prompt(text):
+    """캐시 키로 쓰기 위해 앞뒤 공백을 없애고 연속된 공백을 하나로 합칩니다."""
+    return " ".join((text or "").split())
+
+
+def _nbytes(value):
+    """텐서(또는 텐서의 리스트/튜플)가 차지하는 메모리 크기(바이트)를 추정합니다."""
+    if value is None:
+        return 0
+    if isinstance(value, (list, tuple)):
+        return sum(_nbytes(v) for v in value)
+    if hasattr(value, "numel") and hasattr(value, "element_size"):
+        return value.numel() * value.element_size()
+    return getattr(value, "nbytes", 0)
+
+
+def _move(value, device):
+    if value is None or device is None:
+        return value
+    if isinstance(value, (list, tuple)):
+        return type(value)(_move(v, device) for v in value)
+    return value.to(device) if hasattr(value, "to") else value
+
+
+def _detach(value):
+    """캐시에 보관하는 텐서가 인코더의 autograd 그래프(와 활성화 메모리)를 붙잡지 않도록 떼어 냅니다."""
+    if value is None:
+        return value
+    if isinstance(value, (list, tuple)):
+        return type(value)(_detach(v) for v in value)
+    return value.detach() if hasattr(value, "detach") else value
+
+
+def _inference_mode():
+    """torch가 있으면 torch.inference_mode(), 없으면 (가짜 파이프라인) 아무것도 하지 않는 컨텍스트입니다."""
+    try:
+        import torch
+    except ImportError:
+        return nullcontext()
+    return torch.inference_mode()
+
+
+def _stack(values):
+    """
+    프롬프트별로 캐시된 값을 하나의 배치 인수로 합칩니다.
+    리스트(가변 길이 임베딩 목록)는 이어 붙이고, 텐서는 길이(1번 축)가 다르면 0으로 채운 뒤 배치 축으로 합칩니다.
+    """
+    if isinstance(values[0], list):
+        return [item for value in values for item in value]
+
+    import torch
+    import torch.nn.functional as F
+
+    max_len = max(v.shape[1] for v in values) if values[0].dim() > 1 else None
+    if max_len is not None and any(v.shape[1] != max_len for v in values):
+        padded = []
+        for v in values:
+            # F.pad는 마지막 축부터 (앞, 뒤) 쌍으로 지정하므로 1번 축 뒤쪽만 채웁니다.
+            pad = [0, 0] * (v.dim() - 2) + [0, max_len - v.shape[1]]
+            padded.append(F.pad(v, pad))
+        values = padded
+    return torch.cat(values, dim=0)
+
+
+class PromptEmbeddingCache:
+    """
+    텍스트 인코더 출력(prompt_embeds, pooled/negative 임베딩 등)을 재사용하는 LRU 캐시입니다.
+
+    키는 (모델 이름, 인코더 키, 정규화된 프롬프트)이며, 인코더 키에는 파이프라인 종류와
+    활성 LoRA 조합이 포함됩니다. (텍스트 인코더에 적용되는 LoRA가 결과를 바꿀 수 있기 때문)
+    저장된 임베딩의 총 크기가 max_bytes를 넘으면 가장 오래 사용하지 않은 항목부터 제거합니다.
+    """
+
+    def __init__(self, max_bytes=512 * MB, storage_device="cpu"):
+        """
+        max_bytes: 캐시에 보관할 임베딩의 최대 총 크기 (바이트)
+        storage_device: 임베딩을 보관할 장치. None이면 인코딩된 장치(GPU)에 그대로 둡니다.
+        """
+        self.max_bytes = max_bytes
+        self.storage_device = storage_device
+        self._entries = OrderedDict() # key -> (값 튜플, 크기)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "encode_seconds_total": 0.0}
+
+    @staticmethod
+    def spec_for(pipeline):
+        """파이프라인이 지원되면 인코딩 방법을, 아니면 None을 반환합니다."""
+        spec = ENCODER_SPECS.get(type(pipeline).__name__)
+        if spec is None or not hasattr(pipeline, "encode_prompt"):
+            return None
+        return spec
+
+    def encode_batch(self, pipeline, model_name, encoder_key, prompts, negative_prompts=None):
+        """
+        프롬프트 목록을 인코딩한 파이프라인 호출 인수(prompt_embeds 등)를 반환합니다.
+        캐시에 있는 프롬프트는 텍스트 인코더를 다시 실행하지 않습니다.
+        지원하지 않는 파이프라인이면 None을 반환하며, 이 경우 호출자는 텍스트 프롬프트를 그대로 사용해야 합니다.
+        """
+        spec = self.spec_for(pipeline)
+        if spec is None:
+            return None
+        if negative_prompts is not None and not spec["negative"]:
+            return None
+
+        device = getattr(pipeline, "_execution_device", None)
+        gen_args = {}
+        groups = [("", prompts)]
+        if negative_prompts is not None:
+            groups.append(("negative_", negative_prompts))
+
+        for prefix, texts in groups:
+            encoded = [self._get_or_encode(pipeline, spec, model_name, encoder_key, text, device) for text in texts]
+            for index, name in enumerate(spec["outputs"]):
+                gen_args[prefix + name] = _stack([value[index] for value in encoded])
+        return gen_args
+
+    def _get_or_encode(self, pipeline, spec, model_name, encoder_key, text, device):
+        key = (model_name, encoder_key, normalize_prompt(text))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                return _move(entry[0], device)
+            self._stats["misses"] += 1
+
+        start = time.perf_counter()
+        value = self._encode(pipeline, spec, key[2], device)
+        elapsed = time.perf_counter() - start
+
+        stored = _move(value, self.storage_device)
+        size = _nbytes(stored)
+        with self._lock:
+            self._stats["encode_seconds_total"] += elapsed
+            if size <= self.max_bytes and key not in self._entries:
+                self._entries[key] = (stored, size)
+                self._bytes += size
+                self._evict_over_budget()
+        return value
+
+    def _encode(self, pipeline, spec, text, device):
+        params = inspect.signature(pipeline.encode_prompt).parameters
+        kwargs = {name: value for name, value in spec["kwargs"].items() if name in params}
+        if "device" in params:
+            kwargs["device"] = device
+        # 파이프라인 호출 밖에서 인코딩하므로 diffusers의 no_grad가 적용되지 않습니다. 직접 그래프 기록을 끄고 결과를 떼어 냅니다.
+        with _inference_mode():
+            result = pipeline.encode_prompt(prompt=text, **kwargs)
+        if not isinstance(result, tuple):
+            result = (result,)
+        return _detach(tuple(result[:len(spec["outputs"])]))
+
+    def _evict_over_budget(self):
+        while self._bytes > self.max_bytes and self._entries:
+            _, (_, size) = self._entries.popitem(last=False)
+            self._bytes -= size
+            self._stats["evictions"] += 1
+
+    def clear_model(self, model_name):
+        """모델이 캐시에서 제거될 때 그 모델의 임베딩을 모두 지웁니다."""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == model_name]:
+                _, size = self._entries.pop(key)
+                self._bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """히트/미스, 히트율, 인코딩 시간, 보관 중인 항목 수와 크기를 반환합니다."""
+        with self._lock:
+            stats = dict(self._stats)
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+            stats["avg_encode_seconds"] = stats["encode_seconds_total"] / stats["misses"] if stats["misses"] else 0.0
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+            stats["max_bytes"] = self.max_bytes
+            return stats
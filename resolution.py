@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import ast
+import math
+import os
+
+from PIL import Image
+
+BASE_PATH = os.path.dirname(os.path.abspath(__file__))
+ASPECT_RATIO_FILE = os.path.join(BASE_PATH, "해상도")
+
+# exact: 요청 크기 그대로 생성 / snap: 가장 가까운 버킷 크기로 생성하고 그 크기로 반환
+# snap_resize: 버킷 크기로 생성한 뒤 요청 크기로 늘이거나 줄여 반환 / snap_crop: 비율을 유지해 확대/축소한 뒤 가운데를 잘라 반환
+RESOLUTION_MODES = ("exact", "snap", "snap_resize", "snap_crop")
+
+# 약 1MP 해상도 버킷 (SDXL, Z-Image, FLUX가 학습된 크기)
+MEGAPIXEL_BUCKETS = [
+    (1024, 1024), (1152, 896), (896, 1152), (1216, 832), (832, 1216),
+    (1344, 768), (768, 1344), (1536, 640), (640, 1536),
+]
+
+
+def load_aspect_ratio_file(path=ASPECT_RATIO_FILE):
+    """'해상도' 파일의 aspect_ratios = {"1:1": (1328, 1328), ...} 표를 [(너비, 높이), ...]로 읽습니다. 없으면 빈 목록."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            source = f.read()
+    except OSError:
+        return []
+    _, _, literal = source.partition("=")
+    return [tuple(size) for size in ast.literal_eval(literal.strip()).values()]
+
+
+# 모델 타입별 기본 버킷. Qwen-Image는 저장소의 '해상도' 표(1328x1328, 1664x928, ...)를 사용합니다.
+DEFAULT_BUCKETS = {
+    "sd": MEGAPIXEL_BUCKETS,
+    "flux": MEGAPIXEL_BUCKETS,
+    "qwen": load_aspect_ratio_file() or [(1328, 1328), (1664, 928), (928, 1664), (1472, 1104), (1104, 1472),
+                                         (1584, 1056), (1056, 1584)],
+}
+
+
+def nearest_bucket(width, height, buckets):
+    """
+    요청 크기에 가장 가까운 버킷을 반환합니다. 가로세로 비율이 가장 가까운 버킷을 우선하고,
+    비율이 비슷하면 면적이 가까운 버킷을 고릅니다. (둘 다 로그 비율로 비교)
+    """
+    def distance(bucket):
+        aspect = abs(math.log((bucket[0] / bucket[1]) / (width / height)))
+        area = abs(math.log((bucket[0] * bucket[1]) / (width * height)))
+        return (aspect + 0.5 * area, bucket)
+
+    return min(buckets, key=distance)
+
+
+def fit_image(image, size, fit):
+    """
+    버킷 크기로 생성한 이미지를 요청 크기(size)로 맞춥니다.
+    fit이 "resize"이면 비율과 상관없이 늘이거나 줄이고, "crop"이면 요청 크기를 덮도록 비율을 유지해 확대/축소한 뒤 가운데를 자릅니다.
+    """
+    width, height = size
+    if image.size == (width, height):
+        return image
+    if fit == "crop":
+        scale = max(width / image.width, height / image.height)
+        scaled = (max(width, round(image.width * scale)), max(height, round(image.height * scale)))
+        image = image.resize(scaled, Image.LANCZOS)
+        left = (image.width - width) // 2
+        top = (image.height - height) // 2
+        return image.crop((left, top, left + width, top + height))
+    return image.resize((width, height), Image.LANCZOS)
+
+
+def fit_output(images, request):
+    """요청에 output_size가 기록되어 있으면(snap_resize/snap_crop) 이미지들을 그 크기로 맞춥니다."""
+    output_size = request.get("output_size")
+    if not output_size:
+        return images
+    return [fit_image(image, output_size, request.get("output_fit") or "resize") for image in images]
+
+
+class ResolutionPolicy:
+    """
+    요청 해상도를 모델 타입별 버킷에 맞추는 정책입니다.
+
+    임의의 크기를 그대로 받으면 크기가 조금만 달라도 배치로 묶을 수 없고(batch_key에 크기가 포함됨)
+    크기별로 준비되는 커널/컴파일 결과도 재사용되지 않습니다. 버킷에 맞추면 요청 크기가 몇 가지로 모입니다.
+    buckets는 DEFAULT_BUCKETS를 덮어쓰는 {모델 타입: [[너비, 높이], ...]}이며, "default" 키는 목록이 없는 모델 타입에 쓰입니다.
+    """
+
+    def __init__(self, mode="exact", buckets=None):
+        self.mode = self.validate_mode(mode)
+        self.buckets = {model_type: list(sizes) for model_type, sizes in DEFAULT_BUCKETS.items()}
+        for model_type, sizes in (buckets or {}).items():
+            self.buckets[model_type] = [tuple(size) for size in sizes]
+
+    @staticmethod
+    def validate_mode(mode):
+        if mode not in RESOLUTION_MODES:
+            raise ValueError(f"지원하지 않는 resolution_mode입니다: {mode} (가능한 값: {', '.join(RESOLUTION_MODES)})")
+        return mode
+
+    def buckets_for(self, model_type):
+        return self.buckets.get(model_type) or self.buckets.get("default") or MEGAPIXEL_BUCKETS
+
+    def apply(self, request, model_type):
+        """
+        요청의 width/height를 버킷 크기로 바꿉니다. (요청 딕셔너리를 직접 수정하고 반환)
+        요청의 resolution_mode가 정책의 기본 모드보다 우선하며, 지원하지 않는 모드이면 ValueError.
+        snap_resize/snap_crop이면 원래 요청 크기를 output_size에, 맞추는 방식을 output_fit에 기록합니다.
+        """
+        mode = self.validate_mode(request.get("resolution_mode") or self.mode)
+        request["resolution_mode"] = mode
+        if mode == "exact":
+            return request
+        requested = (request["width"], request["height"])
+        bucket = nearest_bucket(*requested, self.buckets_for(model_type))
+        request["width"], request["height"] = bucket
+        if mode != "snap" and bucket != requested:
+            request["output_size"] = list(requested)
+            request["output_fit"] = "crop" if mode == "snap_crop" else "resize"
+        return request
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from lora_cache import request_loras
+
+# 결과 이미지에 영향을 주는 요청 필드 (이 필드와 모델/LoRA 지문이 같으면 같은 이미지가 생성됨)
+RESULT_FIELDS = ("model_name", "prompt", "negative_prompt", "steps", "guidance_scale", "width", "height", "seed",
+                 "output_size", "output_fit", "cache_interval", "cache_threshold", "highres_base", "highres_strength",
+                 "highres_tile", "highres_overlap", "resolution_mode", "speed_mode", "highres_mode")
+
+
+def is_deterministic(request):
+    """시드가 고정된(-1이 아닌) 요청인지 반환합니다. 무작위 시드 요청은 캐시하지 않습니다."""
+    return request.get("seed") not in (None, -1)
+
+
+def file_fingerprint(path):
+    """파일 내용이 바뀌면 달라지는 가벼운 지문 (크기, 수정 시각)을 반환합니다. 파일이 없으면 None."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def model_revision(models_dir, model_name):
+    """Hugging Face 캐시(models--조직--이름/refs/main)에 기록된 모델 리비전을 반환합니다. 없으면 None."""
+    ref_path = os.path.join(models_dir, "models--" + model_name.replace("/", "--"), "refs", "main")
+    try:
+        with open(ref_path, "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def result_key(request, fingerprint):
+    """요청의 정규화된 필드와 모델/LoRA 지문으로 결과 캐시 키(SHA-256 16진수)를 만듭니다."""
+    payload = {field: request.get(field) for field in RESULT_FIELDS}
+    payload["loras"] = [list(lora) for lora in request_loras(request)]
+    payload["fingerprint"] = fingerprint
+    canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    시드가 고정된 요청의 결과 이미지를 디스크에 보관하는 캐시입니다.
+
+    결과는 요청 해시(키)를 이름으로 하는 파일(<디렉토리>/<키 앞 2자리>/<키>.bin)에 저장되며,
+    총 크기가 max_bytes를 넘으면 가장 오래 사용하지 않은 파일부터 삭제합니다.
+    키가 같으면 내용도 같으므로 키를 그대로 ETag로 사용할 수 있습니다.
+    """
+
+    def __init__(self, directory, max_bytes, extension="bin"):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.extension = extension
+        self._entries = OrderedDict() # key -> 파일 크기 (오래 사용하지 않은 순)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.{self.extension}")
+
+    def _scan(self):
+        """서버 재시작 후에도 캐시를 이어서 쓸 수 있도록 기존 파일을 마지막 사용 시각 순으로 등록합니다."""
+        found = []
+        suffix = "." + self.extension
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(suffix):
+                    continue
+                st = os.stat(os.path.join(root, name))
+                found.append((st.st_mtime, name[:-len(suffix)], st.st_size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._bytes += size
+        self._evict_over_budget()
+
+    def get(self, key):
+        """캐시된 이미지 바이트를 반환합니다. 없으면 None."""
+        with self._lock:
+            if key not in self._entries:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path) # 마지막 사용 시각 갱신 (재시작 후 LRU 순서 유지)
+        except OSError:
+            with self._lock:
+                self._bytes -= self._entries.pop(key, 0)
+                self._stats["misses"] += 1
+            return None
+        with self._lock:
+            self._stats["hits"] += 1
+        return data
+
+    def put(self, key, data):
+        """이미지 바이트를 저장합니다. 임시 파일에 쓴 뒤 이름을 바꾸므로 읽는 쪽이 쓰다 만 파일을 보지 않습니다."""
+        if len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"경고: 결과 캐시에 저장하지 못했습니다: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+
+        with self._lock:
+            self._bytes -= self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self._bytes += len(data)
+            self._evict_over_budget()
+
+    def _evict_over_budget(self):
+        # 호출자가 self._lock을 보유해야 합니다. (초기화 중에는 예외)
+        while self._bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            self._stats["evictions"] += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        """히트/미스, 히트율, 보관 중인 파일 수와 크기를 반환합니다."""
+        with self._lock:
+            stats = dict(self._stats)
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self._bytes
+            stats["max_bytes"] = self.max_bytes
+            return stats
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""
+작업 큐에서 다음에 처리할 작업을 고르는 스케줄링 정책입니다.
+
+정책은 select(jobs, context, now)로 대기 중인 작업 목록에서 처리할 작업의 인덱스를 반환합니다.
+jobs의 각 작업은 request(dict), created_at(초), priority(int) 속성을 가져야 합니다.
+"""
+import os
+
+from lora_cache import request_loras
+
+
+class SchedulingContext:
+    """스케줄링 시점의 GPU 워커 상태입니다. loaded_loras는 현재 모델에 로드된 LoRA 파일 이름의 집합입니다."""
+
+    def __init__(self, current_model=None, loaded_loras=(), is_resident=None):
+        self.current_model = current_model
+        self.loaded_loras = set(loaded_loras)
+        self._is_resident = is_resident
+
+    @classmethod
+    def from_handler(cls, handler):
+        loaded_loras = {os.path.basename(path) for path in handler.loaded_loras()}
+        return cls(handler.current_model_name, loaded_loras, handler.is_resident)
+
+    def is_resident(self, model_name):
+        if self._is_resident is None:
+            return model_name == self.current_model
+        return self._is_resident(model_name)
+
+
+class FifoPolicy:
+    """도착 순서대로 처리합니다."""
+
+    name = "fifo"
+
+    def select(self, jobs, context, now):
+        return 0
+
+
+class AffinityPolicy:
+    """
+    현재 로드된 (모델, LoRA)와 같은 작업을 묶어 연속으로 처리하여 모델/LoRA 전환을 줄입니다.
+
+    - 공정성: max_wait초 이상 기다린 작업이 있으면 그중 가장 오래된 작업을 먼저 처리하므로
+      우선순위나 모델과 관계없이 어떤 작업도 무한히 밀리지 않습니다.
+    - 우선순위: 작업의 priority가 높을수록 먼저 처리합니다.
+    - 같은 우선순위 안에서는 (모델이 같고 필요한 LoRA가 모두 로드됨) > (모델만 같음) > (모델이 GPU에 상주)
+      > (그 외) 순서로 고르고, 그다음은 도착 순서를 따릅니다.
+    """
+
+    name = "affinity"
+
+    def __init__(self, max_wait=60.0):
+        self.max_wait = max_wait
+
+    def affinity(self, request, context):
+        model_name = request.get("model_name")
+        if model_name == context.current_model:
+            if all(name in context.loaded_loras for name, _ in request_loras(request)):
+                return 3
+            return 2
+        if context.is_resident(model_name):
+            return 1
+        return 0
+
+    def select(self, jobs, context, now):
+        if self.max_wait is not None:
+            overdue = [i for i, job in enumerate(jobs) if now - job.created_at >= self.max_wait]
+            if overdue:
+                return min(overdue, key=lambda i: jobs[i].created_at)
+
+        return max(
+            range(len(jobs)),
+            key=lambda i: (
+                getattr(jobs[i], "priority", 0),
+                self.affinity(jobs[i].request, context),
+                -jobs[i].created_at,
+            ),
+        )
+
+
+def create_policy(name, max_wait=60.0):
+    """설정 이름으로 스케줄링 정책을 만듭니다."""
+    if name == "fifo":
+        return FifoPolicy()
+    if name == "affinity":
+        return AffinityPolicy(max_wait=max_wait)
+    raise ValueError(f"지원하지 않는 스케줄링 정책입니다: {name}")
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from typing import List, Optional
+
+from pydantic import BaseModel, Field
+
+# --- API 유효성 검사를 위한 Pydantic 모델 (API 서버와 배치 생성 CLI가 함께 사용) ---
+class LoraSpec(BaseModel):
+    name: str
+    scale: float = 0.7
+
+class GenerationRequest(BaseModel):
+    model_name: str
+    lora_name: Optional[str] = "None"
+    lora_scale: Optional[float] = 0.7
+    # 여러 LoRA를 함께 적용할 때 사용합니다. 지정하면 lora_name/lora_scale 대신 사용됩니다.
+    loras: Optional[List[LoraSpec]] = None
+    prompt: str
+    negative_prompt: Optional[str] = ""
+    steps: int = Field(default=8, ge=1, le=50)
+    guidance_scale: float = Field(default=0.0)
+    width: int = Field(default=1024, ge=256, le=2048)
+    height: int = Field(default=1024, ge=256, le=2048)
+    # 해상도 버킷 정책: "exact", "snap", "snap_resize", "snap_crop". 지정하지 않으면 서버 설정(resolution_mode)을 따릅니다.
+    resolution_mode: Optional[str] = None
+    # 속도 모드: "off", "fast", "fastest". 인접한 스텝 사이에 디노이저 블록 출력을 재사용해 품질을 조금 낮추고 지연 시간을 줄입니다.
+    # 지정하지 않으면 서버 설정(speed_mode)을 따르며, cache_interval/cache_threshold는 모드의 기본값을 덮어씁니다.
+    speed_mode: Optional[str] = None
+    cache_interval: Optional[int] = Field(default=None, ge=0, le=10) # 전체 계산 사이 최대 간격 (0이면 제한 없음)
+    cache_threshold: Optional[float] = Field(default=None, ge=0.0, le=1.0) # 첫 블록 출력의 상대 변화 기준 (0이면 간격만 사용)
+    # 고해상도 모드: "off", "auto", "on". 버킷 크기로 생성한 뒤 확대하고 겹치는 타일마다 다시 디노이징합니다.
+    # 지정하지 않으면 서버 설정(highres_mode)을 따르며, highres_strength는 타일을 다시 디노이징하는 강도(서버 기본값)를 덮어씁니다.
+    highres_mode: Optional[str] = None
+    highres_strength: Optional[float] = Field(default=None, gt=0.0, le=1.0)
+    seed: int = Field(default=-1)
+    # 한 요청으로 생성할 이미지 수. seed가 고정되어 있으면 seed, seed+1, ... 을 사용합니다.
+    num_images: int = Field(default=1, ge=1, le=8)
+    # 이미지별 시드를 직접 지정할 때 사용합니다. 지정하면 num_images는 이 목록의 길이가 됩니다.
+    seeds: Optional[List[int]] = None
+    # 출력 형식: "png", "webp", "jpeg", "raw"(압축하지 않은 RGB 바이트). 지정하지 않으면 Accept 헤더로 결정합니다.
+    output_format: Optional[str] = None
+    quality: Optional[int] = Field(default=None, ge=1, le=100) # webp/jpeg 품질
+    png_compress_level: Optional[int] = Field(default=None, ge=0, le=9) # png 압축 수준 (낮을수록 빠름)
+    # 마감 시간 (요청을 받은 시점부터, 밀리초). 대기 중인 작업과 예상 비용으로 이 시간 안에 끝낼 수 없으면 바로 거절합니다.
+    deadline_ms: Optional[int] = Field(default=None, ge=1)
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import threading
+from contextlib import contextmanager
+
+
+class StateLock:
+    """
+    공유 상태(예: 로드된 모델과 LoRA)에 대한 읽기/쓰기 잠금입니다.
+
+    - 상태 키가 원하는 값과 같으면 여러 스레드가 동시에 '읽기'로 들어가 그 상태를 고정한 채 사용할 수 있습니다.
+    - 상태를 바꿔야 하면 '쓰기'로 들어가며, 진행 중인 읽기가 모두 끝날 때까지 기다렸다가 단독으로 상태를 바꿉니다.
+    - 쓰기를 기다리는 스레드가 있으면 새 읽기는 들어가지 못하므로 상태 전환이 무한히 밀리지 않습니다.
+    """
+
+    def __init__(self):
+        self.current_key = None
+        self._readers = 0
+        self._writer_active = False
+        self._writers_waiting = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, key, switch, satisfied=None):
+        """
+        상태가 key인 채로 읽기 잠금을 얻습니다. 상태가 다르면 단독으로 switch()를 호출해 바꾼 뒤 들어갑니다.
+        switch()는 실제로 적용된 상태 키를 반환합니다. (요청한 LoRA 로드에 실패한 경우 등 key와 다를 수 있음)
+        satisfied: (선택) 현재 상태로 충분한지 판단하는 함수. 지정하지 않으면 상태 키가 같은지 비교합니다.
+                   잠금 내부에서 다른 스레드가 상태를 바꾸지 않는 동안에만 호출됩니다.
+        """
+        if satisfied is None:
+            satisfied = lambda: self.current_key == key
+
+        with self._cond:
+            while True:
+                if not self._writer_active and not self._writers_waiting and satisfied():
+                    self._readers += 1
+                    return
+                if not self._writer_active and self._readers == 0:
+                    self._writer_active = True
+                    break
+                # 상태 전환이 필요한 스레드만 '쓰기 대기'로 집계합니다.
+                wants_switch = self._writer_active or not satisfied()
+                if wants_switch:
+                    self._writers_waiting += 1
+                self._cond.wait()
+                if wants_switch:
+                    self._writers_waiting -= 1
+
+        try:
+            applied_key = switch()
+        except BaseException:
+            with self._cond:
+                self.current_key = None
+                self._writer_active = False
+                self._cond.notify_all()
+            raise
+
+        with self._cond:
+            self.current_key = applied_key
+            self._writer_active = False
+            self._readers += 1
+            self._cond.notify_all()
+
+    @contextmanager
+    def shared(self):
+        """
+        상태를 바꾸지 않고 현재 상태 그대로 읽기 잠금을 얻습니다. (예: 백그라운드 작업이 현재 모델을 사용하는 동안)
+        상태 전환이 진행 중이거나 기다리는 스레드가 있으면 끝날 때까지 기다립니다.
+        """
+        with self._cond:
+            while self._writer_active or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield self.current_key
+        finally:
+            self.release()
+
+    def release(self):
+        """읽기 잠금을 해제합니다."""
+        with self._cond:
+            self._readers -= 1
+            if self._readers == 0:
+                self._cond.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        """진행 중인 읽기가 모두 끝난 뒤 단독으로 상태를 변경합니다. 변경 후 상태 키는 알 수 없음(None)으로 둡니다."""
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer_active or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer_active = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.current_key = None
+                self._writer_active = False
+                self._cond.notify_all()
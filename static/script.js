@@ -52,6 +52,51 @@ document.addEventListener('DOMContentLoaded', () => {
         }
     }
 
+    // 응답이 실패한 경우 서버 오류 메시지를 포함한 Error를 던짐
+    async function throwIfNotOk(response) {
+        if (response.ok) return;
+        let errorMessageText = `HTTP Error: ${response.status} ${response.statusText}`;
+        try {
+            const errorData = await response.json();
+            if (errorData.detail) {
+                errorMessageText += `\n\nDetails: ${errorData.detail}`;
+            }
+        } catch (jsonError) {
+            try {
+                const rawText = await response.text();
+                if (rawText) {
+                    errorMessageText += `\n\nServer response: ${rawText}`;
+                }
+            } catch (textError) {
+                // Ignore if we can't even get text
+            }
+        }
+        throw new Error(errorMessageText);
+    }
+
+    // 작업이 끝날 때까지 SSE 진행률 이벤트를 수신하고 최종 상태를 반환
+    function waitForJob(jobId, onUpdate) {
+        return new Promise((resolve, reject) => {
+            const source = new EventSource(`/api/jobs/${jobId}/events`);
+            source.onmessage = (event) => {
+                const update = JSON.parse(event.data);
+                onUpdate(update);
+                if (['done', 'failed', 'cancelled'].includes(update.status)) {
+                    source.close();
+                    resolve(update);
+                }
+            };
+            source.onerror = () => {
+                source.close();
+                // 스트림이 끊기면 상태를 한 번 조회하여 판단
+                fetch(`/api/jobs/${jobId}`)
+                    .then(res => res.json())
+                    .then(resolve)
+                    .catch(reject);
+            };
+        });
+    }
+
     // 이미지 생성 함수
     async function generateImage() {
         if (!promptInput.value.trim()) {
@@ -85,48 +130,39 @@ document.addEventListener('DOMContentLoaded', () => {
         console.log('Sending payload:', payload);
 
         try {
-            let progress = 0;
             const progressBar = document.getElementById('progress-bar');
             progressBar.style.width = '0%';
-            const interval = setInterval(() => {
-                progress += 1;
-                progressBar.style.width = `${progress}%`;
-                if (progress >= 100) {
-                    clearInterval(interval);
-                }
-            }, 100); // 10 seconds simulation
 
-            const response = await fetch('/api/generate', {
+            // 1. 작업 등록 (즉시 작업 ID 반환)
+            const submitRes = await fetch('/api/jobs', {
                 method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                    'Accept': 'image/png'
-                },
+                headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify(payload)
             });
-
-            clearInterval(interval);
-            progressBar.style.width = '100%';
-
-            if (!response.ok) {
-                let errorMessageText = `HTTP Error: ${response.status} ${response.statusText}`;
-                try {
-                    const errorData = await response.json();
-                    if (errorData.detail) {
-                        errorMessageText += `\n\nDetails: ${errorData.detail}`;
-                    }
-                } catch (jsonError) {
-                    try {
-                        const rawText = await response.text();
-                        if (rawText) {
-                            errorMessageText += `\n\nServer response: ${rawText}`;
-                        }
-                    } catch (textError) {
-                        // Ignore if we can't even get text
+            await throwIfNotOk(submitRes);
+            const job = await submitRes.json();
+
+            // 2. SSE로 큐 위치와 스텝별 진행률 수신
+            const finalStatus = await waitForJob(job.job_id, (update) => {
+                if (update.status === 'queued' && update.queue_position !== null) {
+                    status.textContent = `Queued... (position ${update.queue_position + 1})`;
+                } else if (update.status === 'running') {
+                    status.textContent = 'Generating... this may take a moment.';
+                    if (update.total_steps) {
+                        progressBar.style.width = `${Math.round(100 * update.step / update.total_steps)}%`;
                     }
                 }
-                throw new Error(errorMessageText);
+            });
+            if (finalStatus.status !== 'done') {
+                throw new Error(finalStatus.error || `Job ${finalStatus.status}`);
             }
+            progressBar.style.width = '100%';
+
+            // 3. 결과 이미지 가져오기
+            const response = await fetch(`/api/jobs/${job.job_id}/image`, {
+                headers: { 'Accept': 'image/png' }
+            });
+            await throwIfNotOk(response);
 
             const imageBlob = await response.blob();
             const imageUrl = URL.createObjectURL(imageBlob);
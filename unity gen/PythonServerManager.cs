@@ -56,6 +56,8 @@ public class PythonServerManager : MonoBehaviour
     public int height = 1024;
     [Tooltip("The seed for randomization. Use -1 for a random seed.")]
     public int seed = -1;
+    [Tooltip("Interval in seconds between job status polls.")]
+    public float jobPollInterval = 1.0f;
 
 
     private Process pythonServerProcess;
@@ -383,28 +385,39 @@ public class PythonServerManager : MonoBehaviour
 
         var jsonPayload = JsonConvert.SerializeObject(payload);
 
-        using (var requestMessage = new HttpRequestMessage(HttpMethod.Post, $"{serverBaseUrl}/api/generate"))
+        // 1. 작업 등록: 서버는 즉시 작업 ID를 반환하므로 연결을 오래 유지하지 않습니다.
+        string jobId;
+        using (var requestMessage = new HttpRequestMessage(HttpMethod.Post, $"{serverBaseUrl}/api/jobs"))
         {
             requestMessage.Content = new StringContent(jsonPayload, Encoding.UTF8, "application/json");
             // Force the connection to close after this request. This mimics the behavior of python's requests library
             // and can solve issues where the server (uvicorn) has problems with keep-alive connections.
             requestMessage.Headers.ConnectionClose = true;
 
-            try
-            {
-                var response = await client.SendAsync(requestMessage);
-                response.EnsureSuccessStatusCode();
+            var response = await client.SendAsync(requestMessage);
+            response.EnsureSuccessStatusCode();
+            var json = await response.Content.ReadAsStringAsync();
+            jobId = JsonConvert.DeserializeObject<JobStatusResponse>(json).job_id;
+        }
 
-                var imageBytes = await response.Content.ReadAsByteArrayAsync();
-                return imageBytes;
-            }
-            catch (Exception)
+        // 2. 작업이 끝날 때까지 상태를 주기적으로 조회합니다.
+        while (true)
+        {
+            await Task.Delay(TimeSpan.FromSeconds(jobPollInterval));
+            var json = await client.GetStringAsync($"{serverBaseUrl}/api/jobs/{jobId}");
+            var status = JsonConvert.DeserializeObject<JobStatusResponse>(json);
+            if (status.status == "done") break;
+            if (status.status == "failed" || status.status == "cancelled")
             {
-                throw;
+                throw new Exception($"작업 실패 ({status.status}): {status.error}");
             }
         }
+
+        // 3. 결과 이미지를 가져옵니다.
+        return await client.GetByteArrayAsync($"{serverBaseUrl}/api/jobs/{jobId}/image");
     }
 
     [Serializable] private class ModelListResponse { public List<string> models; }
     [Serializable] private class LoraListResponse { public List<string> loras; }
+    [Serializable] private class JobStatusResponse { public string job_id; public string status; public string error; }
 }
\ No newline at end of file
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import time
+
+import metrics
+from admission import AdmissionError
+from schemas import GenerationRequest
+
+
+def parse_preload_entries(preload_models, pinned_models=()):
+    """
+    preload_models 설정을 [{"model_name", "loras", "pin"}, ...] 목록으로 정규화합니다.
+    항목은 모델 이름 문자열 또는 {"model_name": ..., "loras": [LoRA 파일 이름, ...], "pin": true} 딕셔너리입니다.
+    """
+    entries = []
+    for item in preload_models or []:
+        if isinstance(item, str):
+            item = {"model_name": item}
+        if not item.get("model_name"):
+            raise ValueError(f"preload_models 항목에 model_name이 없습니다: {item}")
+        entries.append({
+            "model_name": item["model_name"],
+            "loras": list(item.get("loras") or []),
+            "pin": bool(item.get("pin")) or item["model_name"] in pinned_models,
+        })
+    return entries
+
+
+class Warmup:
+    """
+    서버 시작 시 라이브러리 로딩, 모델/LoRA 미리 로드, 설정한 해상도의 예열 렌더링을 백그라운드에서 실행합니다.
+
+    예열 렌더링은 일반 요청과 같은 GPU 워커 경로로 처리되므로 CUDA 커널 선택(autotune)과 첫 호출 준비 작업이
+    실제 요청 전에 끝납니다. ready가 True가 되기 전까지 준비 상태 엔드포인트는 503을 반환합니다.
+    """
+
+    def __init__(self, handler, worker, lora_dir, entries, resolutions=(), steps=2, preload_libraries=True):
+        self.handler = handler
+        self.worker = worker
+        self.lora_dir = lora_dir
+        self.entries = entries
+        self.resolutions = [tuple(size) for size in resolutions]
+        self.steps = steps
+        self.preload_libraries = preload_libraries
+        self.status = "pending" # 'pending', 'running', 'ready', 'failed'
+        self.current = None # 진행 중인 단계 설명
+        self.completed = [] # 완료된 단계와 소요 시간
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+        self._thread = None
+
+    @property
+    def ready(self):
+        return self.status == "ready"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="warmup", daemon=True)
+        self._thread.start()
+
+    def to_dict(self):
+        finished_at = self.finished_at or time.time()
+        return {
+            "ready": self.ready,
+            "status": self.status,
+            "current": self.current,
+            "completed": list(self.completed),
+            "remaining_models": [e["model_name"] for e in self.entries
+                                 if e["model_name"] not in {c["model_name"] for c in self.completed}],
+            "error": self.error,
+            "seconds": finished_at - self.started_at if self.started_at else None,
+        }
+
+    def _step(self, description, function, *args):
+        self.current = description
+        start = time.perf_counter()
+        with metrics.stage("warmup"):
+            function(*args)
+        return time.perf_counter() - start
+
+    def _run(self):
+        self.status = "running"
+        self.started_at = time.time()
+        try:
+            # 실제 파이프라인을 쓰는 경우 torch/diffusers 가져오기를 첫 요청 전에 끝냅니다.
+            if self.preload_libraries and self.handler.pipeline_loader is None:
+                from model_handler import _lazy_import
+                self._step("라이브러리 로딩", _lazy_import)
+
+            for entry in self.entries:
+                model_name = entry["model_name"]
+                lora_paths = [os.path.join(self.lora_dir, name) for name in entry["loras"]]
+                load_seconds = self._step(f"{model_name} 로딩", self._load, model_name, lora_paths)
+                if entry["pin"]:
+                    self.handler.pipeline_cache.pin(model_name)
+                render_seconds = {}
+                for width, height in self.resolutions:
+                    render_seconds[f"{width}x{height}"] = self._step(
+                        f"{model_name} {width}x{height} 예열", self._render, entry, width, height
+                    )
+                self.completed.append({
+                    "model_name": model_name,
+                    "loras": entry["loras"],
+                    "pinned": entry["pin"],
+                    "load_seconds": load_seconds,
+                    "render_seconds": render_seconds,
+                })
+                print(f"예열 완료: {model_name} (로딩 {load_seconds:.1f}초, 렌더링 {render_seconds})")
+        except Exception as e:
+            self.status = "failed"
+            self.error = f"{self.current}: {e}"
+            print(f"경고: 예열에 실패했습니다. 준비 상태가 되지 않습니다. ({self.error})")
+            return
+        finally:
+            self.current = None
+            self.finished_at = time.time()
+        self.status = "ready"
+        print(f"예열이 끝났습니다. ({self.finished_at - self.started_at:.1f}초)")
+
+    def _load(self, model_name, lora_paths):
+        # 세션에 들어가면 모델과 LoRA가 로드된 상태가 되므로 바로 빠져나옵니다.
+        with self.handler.session(model_name, lora_paths):
+            pass
+        self.worker.refresh_residency()
+
+    def _render(self, entry, width, height):
+        """일반 요청과 같은 GPU 워커 경로로 예열 이미지를 생성합니다. 큐가 가득 차면 자리가 날 때까지 기다립니다."""
+        request = GenerationRequest(
+            model_name=entry["model_name"],
+            loras=[{"name": name} for name in entry["loras"]] or None,
+            prompt="warm-up",
+            steps=self.steps,
+            width=width,
+            height=height,
+            seed=0,
+        ).dict()
+        while True:
+            try:
+                job = self.worker.submit(request, client_id="warmup", priority=1 << 30)
+                break
+            except AdmissionError as e:
+                # 큐가 가득 찼거나 예산/동시 작업 수 제한에 걸렸으면 기다렸다가 다시 넣습니다.
+                if e.retry_after is None:
+                    raise
+                time.sleep(e.retry_after)
+        job.future.result()
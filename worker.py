@@ -0,0 +1,522 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import concurrent.futures
+import math
+import os
+import random
+import threading
+import time
+import uuid
+
+import metrics
+from admission import AdmissionError, request_work
+from lora_cache import request_loras
+from resolution import fit_output
+from scheduler import FifoPolicy, SchedulingContext
+
+
+class QueueFullError(AdmissionError):
+    """작업 큐가 가득 차서 새 작업을 받을 수 없을 때 발생합니다."""
+
+    def __init__(self, retry_after):
+        super().__init__("작업 큐가 가득 찼습니다. 잠시 후 다시 시도해 주세요.", "queue_full", retry_after=retry_after)
+
+
+def batch_key(request):
+    """
+    한 번의 파이프라인 호출로 묶을 수 있는 요청인지 판단하는 키를 반환합니다.
+    모델, LoRA 조합(이름과 강도), 크기, 스텝, 가이던스, 블록 캐시 설정, 고해상도 설정이 모두 같아야 합니다. (프롬프트와 시드는 달라도 됨)
+    """
+    return (
+        request.get("model_name"),
+        request_loras(request),
+        request.get("width"),
+        request.get("height"),
+        request.get("steps"),
+        request.get("guidance_scale"),
+        request.get("cache_interval"),
+        request.get("cache_threshold"),
+        tuple(request.get("highres_base") or ()),
+        request.get("highres_strength"),
+        request.get("highres_tile"),
+        request.get("highres_overlap"),
+    )
+
+
+def request_seeds(request):
+    """
+    요청이 생성할 이미지들의 시드 목록을 반환합니다.
+    seeds 목록이 있으면 그대로 사용하고, 없으면 num_images장에 대해 seed부터 1씩 증가시킨 시드를,
+    seed가 -1(무작위)이면 이미지마다 무작위 시드를 사용합니다.
+    """
+    if request.get("seeds"):
+        return [int(seed) for seed in request["seeds"]]
+    num_images = request.get("num_images") or 1
+    seed = request.get("seed")
+    if seed in (None, -1):
+        return [random.randint(0, 2**32 - 1) for _ in range(num_images)]
+    return [int(seed) + index for index in range(num_images)]
+
+
+def request_image_count(request):
+    """요청이 생성할 이미지 수 (배치 크기 계산용)"""
+    return len(request["seeds"]) if request.get("seeds") else (request.get("num_images") or 1)
+
+
+def job_work(request):
+    """요청의 작업량 (스텝 × 메가픽셀 × 이미지 수, 비용 추정용)"""
+    return request_work(request, request_image_count(request))
+
+
+def render_batch(handler, lora_dir, requests, progress_callback=None):
+    """요청에 맞는 모델과 LoRA를 로드하고 이미지를 생성합니다. (배치 내 요청은 모두 batch_key가 같아야 함)"""
+    request = requests[0]
+
+    loras = [(os.path.join(lora_dir, name), scale) for name, scale in request_loras(request)]
+
+    # 요청한 모델과 LoRA를 로드하고, 생성이 끝날 때까지 다른 스레드가 바꾸지 못하도록 고정
+    with handler.session(request["model_name"], [path for path, _ in loras]):
+        # 이미지 생성 (전체 요청을 kwargs로 전달하여 유연성 확보)
+        images = handler.generate_batch(requests, progress_callback=progress_callback, loras=loras)
+
+    # 버킷 크기로 생성한 이미지를 요청별 출력 크기로 맞춥니다. (같은 배치라도 요청한 크기가 다를 수 있음)
+    if images is None or not any(r.get("output_size") for r in requests):
+        return images
+    with metrics.stage("output_resize"):
+        return [fit_output([image], r)[0] if image is not None else None for image, r in zip(images, requests)]
+
+
+class GenerationJob:
+    """
+    워커 큐에 들어가는 생성 작업입니다. 요청의 num_images(또는 seeds)만큼 이미지를 만들며,
+    결과는 이미지 리스트이고 각 이미지의 시드는 seeds 속성에 기록됩니다.
+    """
+
+    FINISHED_STATUSES = ("done", "failed", "cancelled")
+
+    def __init__(self, request, client_id=None, priority=0):
+        self.id = uuid.uuid4().hex
+        self.request = request
+        self.client_id = client_id
+        self.priority = priority
+        self.status = "queued" # 'queued', 'running', 'done', 'failed', 'cancelled'
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.step = 0
+        self.total_steps = request.get("steps")
+        self.error = None
+        self.seeds = None # 실행 시 정해진 이미지별 시드
+        self.timings = {} # 처리 단계별 소요 시간 (초)
+        self.work = job_work(request)
+        self.estimated_seconds = None # 입장 제어가 추정한 생성 시간 (초)
+        # 스레드 안전한 Future: 워커 스레드가 결과를 설정하고, 이벤트 루프는 await 합니다.
+        self.future = concurrent.futures.Future()
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    async def wait(self):
+        """이벤트 루프를 막지 않고 작업 결과(PIL 이미지 리스트)를 기다립니다."""
+        return await asyncio.wrap_future(self.future)
+
+    def to_dict(self, queue_position=None):
+        """API 응답용 작업 상태를 반환합니다."""
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "queue_position": queue_position,
+            "step": self.step,
+            "total_steps": self.total_steps,
+            "num_images": request_image_count(self.request),
+            "seeds": self.seeds,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "timings": self.timings,
+            "estimated_seconds": self.estimated_seconds,
+            "error": self.error,
+        }
+
+    def subscribe(self):
+        """
+        상태 변경 알림을 받을 asyncio.Queue를 등록합니다.
+        이벤트 루프 안에서 호출해야 하며, 사용 후 unsubscribe()로 해제합니다.
+        """
+        listener = (asyncio.get_running_loop(), asyncio.Queue())
+        with self._lock:
+            self._listeners.append(listener)
+        return listener[1]
+
+    def unsubscribe(self, queue):
+        with self._lock:
+            self._listeners = [l for l in self._listeners if l[1] is not queue]
+
+    def notify(self):
+        """현재 상태를 모든 구독자에게 전달합니다. 어느 스레드에서나 호출할 수 있습니다."""
+        snapshot = self.to_dict()
+        with self._lock:
+            listeners = list(self._listeners)
+        for loop, queue in listeners:
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, snapshot)
+            except RuntimeError:
+                # 이벤트 루프가 이미 닫힌 경우
+                pass
+
+    def update_progress(self, step, total_steps):
+        """디퓨전 스텝 콜백에서 호출되어 진행률을 갱신합니다."""
+        self.step = step
+        self.total_steps = total_steps
+        self.notify()
+
+
+class JobQueue:
+    """최대 크기가 정해진 스레드 안전 작업 큐입니다."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._jobs = []
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._jobs)
+
+    def position(self, job):
+        """큐에서 작업의 위치(0부터 시작)를 반환합니다. 큐에 없으면 None."""
+        with self._cond:
+            try:
+                return self._jobs.index(job)
+            except ValueError:
+                return None
+
+    def snapshot(self):
+        """대기 중인 작업 목록의 복사본을 큐 순서대로 반환합니다."""
+        with self._cond:
+            return list(self._jobs)
+
+    def remove(self, job):
+        """대기 중인 작업을 큐에서 제거합니다. 제거되었으면 True를 반환합니다."""
+        with self._cond:
+            try:
+                self._jobs.remove(job)
+                return True
+            except ValueError:
+                return False
+
+    def put(self, job, retry_after=None):
+        """작업을 큐에 추가합니다. 큐가 가득 차면 QueueFullError를 발생시킵니다."""
+        with self._cond:
+            if len(self._jobs) >= self.max_size:
+                raise QueueFullError(retry_after)
+            self._jobs.append(job)
+            self._cond.notify()
+
+    def get(self, timeout=None, select=None):
+        """
+        다음 작업을 꺼냅니다. 시간 내에 작업이 없으면 None을 반환합니다.
+        select가 주어지면 select(대기 작업 리스트)가 반환한 인덱스의 작업을, 없으면 맨 앞 작업을 꺼냅니다.
+        """
+        with self._cond:
+            if not self._jobs:
+                self._cond.wait(timeout)
+            if not self._jobs:
+                return None
+            index = select(list(self._jobs)) if select is not None else 0
+            return self._jobs.pop(index)
+
+    def take_matching(self, predicate, max_count, size=None):
+        """
+        조건을 만족하는 작업을 큐 순서대로 꺼냅니다. 꺼낸 작업의 크기 합은 max_count를 넘지 않습니다.
+        size: 작업의 크기를 반환하는 함수 (기본값: 작업당 1)
+        """
+        with self._cond:
+            taken = []
+            total = 0
+            for job in self._jobs:
+                if total >= max_count:
+                    break
+                job_size = size(job) if size is not None else 1
+                if predicate(job) and total + job_size <= max_count:
+                    taken.append(job)
+                    total += job_size
+            for job in taken:
+                self._jobs.remove(job)
+            return taken
+
+    def wait_for_put(self, timeout):
+        """새 작업이 들어오거나 timeout(초)이 지날 때까지 기다립니다."""
+        with self._cond:
+            self._cond.wait(timeout)
+
+
+class GenerationWorker:
+    """
+    ModelHandler를 소유하고 전용 스레드에서 작업을 순서대로 처리하는 GPU 워커입니다.
+    무거운 모델 로딩과 생성이 asyncio 이벤트 루프를 막지 않도록 분리합니다.
+
+    max_batch_size가 1보다 크면, 큐에서 꺼낸 작업과 호환되는(batch_key가 같은) 대기 작업을
+    최대 batch_wait초 동안 모아 한 번의 파이프라인 호출로 함께 생성합니다.
+
+    다음 작업은 scheduling_policy(scheduler.py)가 고릅니다. 기본값은 FIFO이며,
+    AffinityPolicy를 사용하면 현재 로드된 모델/LoRA의 작업을 묶어 처리하여 전환을 줄입니다.
+
+    admission(admission.AdmissionController)을 지정하면 작업을 큐에 넣기 전에 예상 비용으로
+    마감 시간과 클라이언트별 예산/동시 작업 수를 검사하고, 실행한 배치의 시간으로 비용 모델을 갱신합니다.
+    """
+
+    def __init__(self, handler, lora_dir, max_queue_size=16, default_retry_after=10, store=None,
+                 max_batch_size=1, batch_wait=0.0, scheduling_policy=None, admission=None):
+        self.handler = handler
+        self.lora_dir = lora_dir
+        self.store = store
+        self.queue = JobQueue(max_queue_size)
+        self.default_retry_after = default_retry_after
+        self.max_batch_size = max(1, max_batch_size)
+        self.batch_wait = batch_wait
+        self.scheduling_policy = scheduling_policy or FifoPolicy()
+        self.admission = admission
+        self.current_jobs = []
+        self._collecting = [] # 큐에서 꺼내 배치로 모으는 중인 작업
+        self._avg_job_seconds = None
+        # GPU에 상주 중인 모델 이름. 워커 스레드가 배치마다 새 frozenset으로 바꾸고, 이벤트 루프는 잠금 없이 읽습니다.
+        self._resident_models = frozenset()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """워커 스레드를 시작합니다."""
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run_loop, name="gpu-worker", daemon=True)
+        self._thread.start()
+        print("GPU 워커 스레드가 시작되었습니다.")
+
+    def stop(self, timeout=5):
+        """워커 스레드를 정지합니다. 진행 중인 작업은 끝까지 실행됩니다."""
+        self._running = False
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def estimate_retry_after(self):
+        """
+        클라이언트가 재시도할 시간(초)을 추정합니다. 입장 제어를 사용하면 대기/실행 중인 작업의 남은 예상 시간을,
+        아니면 큐 길이와 평균 작업 시간을 사용합니다.
+        """
+        if self.admission is not None:
+            return max(1, int(math.ceil(self.backlog_seconds()))) if len(self.queue) or self.current_jobs else 1
+        if self._avg_job_seconds is None:
+            return self.default_retry_after
+        pending = len(self.queue) + len(self.current_jobs)
+        return max(1, int(round(self._avg_job_seconds * pending)))
+
+    def backlog_seconds(self, now=None):
+        """
+        대기 중인 작업의 예상 시간과 실행 중인 배치의 남은 예상 시간의 합 (초).
+        대기 중인 작업은 따로 실행된다고 보므로, 배치로 묶이면 실제로는 더 빨리 끝납니다.
+        """
+        now = time.time() if now is None else now
+        cost_model = self.admission.cost_model
+        seconds = sum(job.estimated_seconds or cost_model.estimate(job.request["model_name"], job.work)
+                      for job in self.queue.snapshot() + list(self._collecting))
+        running = list(self.current_jobs)
+        if running:
+            cost = cost_model.estimate(running[0].request["model_name"], sum(job.work for job in running))
+            seconds += max(0.0, cost - (now - (running[0].started_at or now)))
+        return seconds
+
+    def refresh_residency(self):
+        """
+        상주 모델 목록을 다시 읽어 둡니다. 캐시 잠금을 잡으므로 모델을 바꾸는 쪽(워커 스레드, 예열)에서 호출합니다.
+        이벤트 루프의 입장 제어는 이 목록만 읽으므로 모델 전환이나 장치 이동을 기다리지 않습니다.
+        """
+        resident = set(self.handler.pipeline_cache.resident_models())
+        if self.handler.current_model_name is not None:
+            resident.add(self.handler.current_model_name)
+        self._resident_models = frozenset(resident)
+
+    def _load_estimate(self, model_name):
+        """모델이 상주하지 않고 앞선 작업도 그 모델을 쓰지 않으면 모델 로딩 예상 시간, 아니면 0"""
+        pending = self.queue.snapshot() + list(self._collecting) + list(self.current_jobs)
+        if model_name in self._resident_models or any(job.request["model_name"] == model_name for job in pending):
+            return 0.0
+        return self.admission.cost_model.load_estimate(model_name)
+
+    def submit(self, request, client_id=None, priority=0):
+        """
+        작업을 큐에 넣고 GenerationJob을 반환합니다. 큐가 가득 차면 QueueFullError,
+        입장 제어가 거절하면(마감 시간, 클라이언트 예산/동시 작업 수) AdmissionError.
+        """
+        job = GenerationJob(request, client_id=client_id, priority=priority)
+        try:
+            if self.admission is not None:
+                model_name = request["model_name"]
+                self.admission.admit(job, self.admission.cost_model.estimate(model_name, job.work),
+                                     self.backlog_seconds(), self._load_estimate(model_name))
+            self.queue.put(job, retry_after=self.estimate_retry_after())
+        except AdmissionError:
+            if self.admission is not None:
+                self.admission.release(job)
+            metrics.JOBS_TOTAL.inc(status="rejected")
+            raise
+        if self.store is not None:
+            self.store.add(job)
+        return job
+
+    def queue_position(self, job):
+        """대기 중인 작업의 큐 위치를 반환합니다. 실행 중이거나 완료된 작업은 None."""
+        return self.queue.position(job)
+
+    def cancel(self, job):
+        """
+        대기 중인 작업을 취소합니다. 이미 실행 중이거나 완료된 작업은 취소할 수 없으며,
+        이 경우 False를 반환합니다.
+        """
+        if not self.queue.remove(job) or not job.future.cancel():
+            return False
+        job.status = "cancelled"
+        job.finished_at = time.time()
+        self._record_metrics(job)
+        self._release(job)
+        job.notify()
+        return True
+
+    def _select_next(self, jobs):
+        context = SchedulingContext.from_handler(self.handler)
+        return self.scheduling_policy.select(jobs, context, time.time())
+
+    def _run_loop(self):
+        self.refresh_residency()
+        while self._running:
+            job = self.queue.get(timeout=0.5, select=self._select_next)
+            if job is None:
+                continue
+            batch = [j for j in self._collect_batch(job) if self._start_job(j)]
+            self._collecting = []
+            if batch:
+                self._execute(batch)
+
+    def _collect_batch(self, first):
+        """첫 작업과 호환되는 대기 작업을 이미지 수 합계가 max_batch_size가 될 때까지 모읍니다."""
+        batch = self._collecting = [first]
+        images = request_image_count(first.request)
+        if images >= self.max_batch_size:
+            return batch
+
+        key = batch_key(first.request)
+        deadline = time.monotonic() + self.batch_wait
+        while True:
+            taken = self.queue.take_matching(
+                lambda job: batch_key(job.request) == key,
+                self.max_batch_size - images,
+                size=lambda job: request_image_count(job.request),
+            )
+            batch += taken
+            images += sum(request_image_count(job.request) for job in taken)
+            remaining = deadline - time.monotonic()
+            if images >= self.max_batch_size or remaining <= 0:
+                return batch
+            self.queue.wait_for_put(remaining)
+
+    def _start_job(self, job):
+        # 대기 중 클라이언트가 연결을 끊어 취소된 작업은 건너뜁니다.
+        if job.future.set_running_or_notify_cancel():
+            return True
+        job.status = "cancelled"
+        job.finished_at = time.time()
+        self._record_metrics(job)
+        self._release(job)
+        job.notify()
+        return False
+
+    def _execute(self, jobs):
+        self.current_jobs = jobs
+        started_at = time.time()
+        for job in jobs:
+            job.status = "running"
+            job.started_at = started_at
+            job.seeds = request_seeds(job.request)
+            metrics.record_stage("queue_wait", started_at - job.created_at)
+            job.notify()
+
+        def progress_callback(step, total_steps):
+            for job in jobs:
+                job.update_progress(step, total_steps)
+
+        timings = {}
+        try:
+            # 작업별 이미지(시드)를 샘플 하나씩으로 펼쳐 한 번의 파이프라인 호출로 생성합니다.
+            samples = [dict(job.request, seed=seed) for job in jobs for seed in job.seeds]
+            with metrics.trace() as timings:
+                images = self._render(samples, progress_callback=progress_callback)
+            if images is None or len(images) != len(samples) or any(image is None for image in images):
+                raise RuntimeError("모델이 이미지 생성에 실패했습니다.")
+            self._observe_cost(jobs, time.time() - started_at, timings)
+            offset = 0
+            for job in jobs:
+                job.timings = self._job_timings(job, timings)
+                # 상태를 본 클라이언트가 바로 결과를 가져갈 수 있도록 결과를 먼저 설정한 뒤 상태를 바꿉니다.
+                job.future.set_result(images[offset:offset + len(job.seeds)])
+                job.status = "done"
+                offset += len(job.seeds)
+        except Exception as e:
+            print(f"작업 {', '.join(job.id for job in jobs)} 처리 중 오류: {e}")
+            for job in jobs:
+                job.error = str(e)
+                job.timings = self._job_timings(job, timings)
+                job.future.set_exception(e)
+                job.status = "failed"
+        finally:
+            finished_at = time.time()
+            # 배치 처리 시간은 작업 수로 나누어 작업당 평균 시간으로 기록합니다.
+            self._record_duration((finished_at - started_at) / len(jobs))
+            # 실행 중인 작업 목록을 비우기 전에 상주 목록을 갱신해야 그 사이에 로딩 시간이 잘못 더해지지 않습니다.
+            self.refresh_residency()
+            self.current_jobs = []
+            total_work = sum(job.work for job in jobs) or 1.0
+            for job in jobs:
+                job.finished_at = finished_at
+                self._record_metrics(job)
+                # 예산은 배치 시간을 작업량 비율로 나눈 만큼 정산합니다.
+                self._release(job, (finished_at - started_at) * job.work / total_work)
+                job.notify()
+
+    def _observe_cost(self, jobs, seconds, timings):
+        """배치의 작업량 합계와 생성 시간(모델/LoRA 로딩 제외)으로 비용 모델을 갱신합니다."""
+        if self.admission is None:
+            return
+        load_seconds = timings.get("load_model", 0.0) + timings.get("load_lora", 0.0)
+        self.admission.cost_model.observe(jobs[0].request["model_name"], sum(job.work for job in jobs),
+                                          max(0.0, seconds - load_seconds), timings.get("load_model", 0.0))
+
+    def _release(self, job, seconds=None):
+        if self.admission is not None:
+            self.admission.release(job, seconds)
+
+    @staticmethod
+    def _job_timings(job, timings):
+        # 배치로 함께 생성한 작업은 같은 단계 시간을 공유합니다. (대기 시간만 작업별로 다름)
+        return dict(queue_wait=job.started_at - job.created_at, **timings)
+
+    def _record_metrics(self, job):
+        metrics.JOBS_TOTAL.inc(status=job.status)
+        if job.status == "done":
+            request = job.request
+            metrics.IMAGES_TOTAL.inc(len(job.seeds), model=request.get("model_name"))
+            metrics.GENERATION_SECONDS.observe(
+                job.finished_at - job.created_at,
+                model=request.get("model_name"),
+                resolution=f"{request.get('width')}x{request.get('height')}",
+            )
+
+    def _render(self, requests, progress_callback=None):
+        return render_batch(self.handler, self.lora_dir, requests, progress_callback=progress_callback)
+
+    def _record_duration(self, seconds):
+        # 지수 이동 평균으로 평균 작업 시간을 갱신합니다.
+        if self._avg_job_seconds is None:
+            self._avg_job_seconds = seconds
+        else:
+            self._avg_job_seconds = 0.8 * self._avg_job_seconds + 0.2 * seconds